@@ -0,0 +1,169 @@
+import asyncio
+import json
+import threading
+from typing import Dict, List, Optional
+from app.config import app_config
+from app.utils.model_utils import to_utc_datetime
+
+
+class BroadcastMessage:
+    """
+    This class holds a message that is sent to all subscribers.
+    It is serialized once, when it is published, and the same bytes are shared by every subscriber.
+    """
+
+    def __init__(self, payload: Dict):
+        self.json: str = json.dumps(payload)
+        # Server-Sent Events frame
+        self.sse: bytes = f"data: {self.json}\n\n".encode("utf-8")
+
+    @classmethod
+    def from_location(cls, location: Dict) -> "BroadcastMessage":
+        """
+        Builds the message of a location. It has the same keys as the ISSPos schema.
+
+        :param      location:  The location
+        :type       location:  Dictionary compliant with LocationSchema
+
+        :returns:   The message
+        :rtype:     BroadcastMessage
+        """
+        timestamp = to_utc_datetime(location["timestamp"])
+        return cls(
+            {
+                "sat_id": location["sat_id"],
+                "latitude": location["latitude"],
+                "longitude": location["longitude"],
+                "timestamp": timestamp.isoformat().replace("+00:00", "Z"),
+            }
+        )
+
+
+class Subscription:
+    """
+    This class represents a subscriber of a topic. Messages are buffered in a bounded queue that belongs
+    to the event loop of the subscriber. When the queue is full the oldest message is dropped, so a slow
+    subscriber always receives the latest positions and never makes the publisher wait.
+    """
+
+    def __init__(self, topic: int, queue_size: int):
+        self.topic = topic
+        self.loop = asyncio.get_running_loop()
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.dropped = 0
+
+    def offer(self, message: BroadcastMessage) -> None:
+        """
+        Adds a message to the queue, dropping the oldest one if the queue is full.
+        This must run in the event loop of the subscriber.
+        """
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(message)
+
+    async def get(self) -> BroadcastMessage:
+        """
+        Waits for the next message.
+        """
+        return await self.queue.get()
+
+
+class Broadcaster:
+    """
+    This class fans out messages to the subscribers of a topic. The topics are satellite ids.
+    Messages can be published from any thread, for example from the scheduler's threads,
+    and are handed over to the event loop of every subscriber.
+    """
+
+    def __init__(self, queue_size: int):
+        """
+        Constructs a new instance.
+
+        :param      queue_size:  The number of messages buffered per subscriber
+        :type       queue_size:  int
+        """
+        self.queue_size = queue_size
+        self._subscriptions: Dict[int, List[Subscription]] = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, topic: int) -> Subscription:
+        """
+        Subscribes to a topic. This must be called from the event loop that will consume the messages.
+
+        :param      topic:  The satellite id
+        :type       topic:  int
+
+        :returns:   The subscription
+        :rtype:     Subscription
+        """
+        subscription = Subscription(topic, self.queue_size)
+        with self._lock:
+            self._subscriptions.setdefault(topic, []).append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        """
+        Removes a subscription.
+
+        :param      subscription:  The subscription
+        :type       subscription:  Subscription
+        """
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.topic, [])
+            if subscription in subscriptions:
+                subscriptions.remove(subscription)
+            if not subscriptions:
+                self._subscriptions.pop(subscription.topic, None)
+
+    def subscribers(self, topic: Optional[int] = None) -> int:
+        """
+        Counts the subscribers of a topic, or of all topics if no topic is provided.
+        """
+        with self._lock:
+            if topic is not None:
+                return len(self._subscriptions.get(topic, []))
+            return sum(len(s) for s in self._subscriptions.values())
+
+    def publish(self, topic: int, message: BroadcastMessage) -> int:
+        """
+        Publishes a message to all subscribers of a topic.
+
+        :param      topic:    The satellite id
+        :type       topic:    int
+        :param      message:  The message
+        :type       message:  BroadcastMessage
+
+        :returns:   The number of subscribers the message was handed to
+        :rtype:     int
+        """
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(topic, []))
+        delivered = 0
+        for subscription in subscriptions:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.offer, message)
+                delivered += 1
+            except RuntimeError:
+                # The event loop of the subscriber is closed
+                self.unsubscribe(subscription)
+        return delivered
+
+    def publish_location(self, location: Dict) -> int:
+        """
+        Publishes a location to the subscribers of its satellite.
+        The message is only built if there is at least one subscriber.
+
+        :param      location:  The location
+        :type       location:  Dictionary compliant with LocationSchema
+
+        :returns:   The number of subscribers the message was handed to
+        :rtype:     int
+        """
+        if not self.subscribers(location["sat_id"]):
+            return 0
+        return self.publish(location["sat_id"], BroadcastMessage.from_location(location))
+
+
+# Define application wide the broadcaster object
+broadcaster = Broadcaster(app_config.app_stream_queue_size)
@@ -0,0 +1,250 @@
+import queue
+import threading
+from collections import deque
+from datetime import timedelta
+from typing import Callable, Deque, Dict, Iterable, List, Optional, Set
+import pymongo
+from bson import ObjectId
+from pymongo import CursorType
+from pymongo.collection import Collection
+from pymongo.errors import PyMongoError
+from app.config import app_config
+from app.components.broadcaster import broadcaster
+from app.components.lease import process_owner
+from app.components.location_cache import location_cache
+
+# Seconds of events that are read again when the tailable cursor is reopened, since the ObjectIds of the events of
+# different processes are not ordered exactly like the events were inserted
+RESUME_WINDOW = 5
+# Number of the latest events that are remembered so that an event read again is not applied twice
+SEEN_SIZE = 10000
+# Maximum number of events that are inserted with a single write
+PUBLISH_BATCH = 1000
+
+
+class EventBus:
+    """
+    This class shares the changes of the in-memory components between the processes (workers or replicas).
+    The pull_position service only runs on the process that holds its lease, but every process serves the streams
+    and the location cache. So the new locations of the service and the invalidations of the location cache by the
+    writes of the routers are appended as events to a capped collection, and every process follows the collection
+    with a tailable cursor and applies them. Unlike change streams, capped collections work on a standalone MongoDB.
+
+    The events of a process are applied to it when they are published, so they do not wait for the database,
+    and they are skipped when the process reads them back. They are queued and inserted by a thread of their own,
+    so publishing never waits for the database either: the ingestion of the locations is not slowed down by the events.
+    An insert that fails or takes longer than the timeout drops its events, and so does a full queue.
+    While the database can not be reached a process only sees its own events. Events may be missed meanwhile,
+    so the whole location cache is invalidated when the cursor fails.
+    """
+
+    def __init__(
+        self,
+        loader: Callable[[], Collection],
+        owner: str,
+        enabled: bool = True,
+        queue_size: int = 1000,
+        timeout: Optional[float] = None,
+    ):
+        """
+        Constructs a new instance.
+
+        :param      loader:   Function that returns the capped collection of the events
+        :type       loader:   Callable[[], Collection]
+        :param      owner:    The unique name of the process
+        :type       owner:    str
+        :param      enabled:     When False the events are only applied to this process
+        :type       enabled:     bool
+        :param      queue_size:  The number of events that wait to be inserted
+        :type       queue_size:  int
+        :param      timeout:     Seconds an insert of the events waits for the database, None to wait for as long as the client does
+        :type       timeout:     Optional[float]
+        """
+        self.loader = loader
+        self.owner = owner
+        self.enabled = enabled
+        self.timeout = timeout
+        self._queue: "queue.Queue[Dict]" = queue.Queue(maxsize=queue_size)
+        self._seen: Set[ObjectId] = set()
+        self._seen_order: Deque[ObjectId] = deque()
+        # The scheduler thread and the routers publish while the thread of the cursor reads
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._publisher: Optional[threading.Thread] = None
+
+    def publish_locations(self, locations: List[Dict]) -> None:
+        """
+        Adds new locations to the location cache and pushes them to the subscribers of the streams of every process.
+
+        :param      locations:  The new locations, including their "_id"
+        :type       locations:  List[dict] compliant with LocationInDBSchema
+        """
+        for location in locations:
+            self._apply_location(location)
+        self._append([{"type": "location", "location": location} for location in locations])
+
+    def invalidate(self, sat_ids: Iterable[int]) -> None:
+        """
+        Removes the cached locations of satellites from the location cache of every process.
+        This is needed whenever locations are created or deleted outside of the pull_position service.
+
+        :param      sat_ids:  The satellite ids
+        :type       sat_ids:  Iterable[int]
+        """
+        sat_ids = list(set(sat_ids))
+        for sat_id in sat_ids:
+            location_cache.invalidate(sat_id)
+        self._append([{"type": "invalidate", "sat_id": sat_id} for sat_id in sat_ids])
+
+    def apply(self, event: Dict) -> None:
+        """
+        Applies an event of another process to this process.
+        """
+        if event.get("type") == "location":
+            self._apply_location(event["location"])
+        elif event.get("type") == "invalidate":
+            location_cache.invalidate(event["sat_id"])
+
+    @staticmethod
+    def _apply_location(location: Dict) -> None:
+        # Keep the latest locations in memory for the routers
+        location_cache.add(location)
+        # Push the location to the subscribers of the stream endpoints
+        broadcaster.publish_location(location)
+
+    def _append(self, events: List[Dict]) -> None:
+        """
+        Queues events to be appended to the capped collection, without waiting for them to be inserted.
+        They get their "_id" here, so they are skipped when they are read back.
+        """
+        if not self.enabled or not events:
+            return
+        dropped = 0
+        for event in events:
+            event["_id"] = ObjectId()
+            event["owner"] = self.owner
+            self._remember(event["_id"])
+            try:
+                self._queue.put_nowait(event)
+            except queue.Full:
+                dropped += 1
+        if dropped:
+            print(f"Dropped {dropped} events that could not be shared with the other processes in time")
+        with self._lock:
+            if self._publisher is None or not self._publisher.is_alive():
+                self._publisher = threading.Thread(target=self._publish, name="event-bus-publisher", daemon=True)
+                self._publisher.start()
+
+    def _publish(self) -> None:
+        """
+        Inserts the queued events in batches, in the order they were published, until stop() is called and the queue is empty.
+        """
+        while True:
+            try:
+                events = [self._queue.get(timeout=1)]
+            except queue.Empty:
+                if self._stop.is_set():
+                    return
+                continue
+            while len(events) < PUBLISH_BATCH:
+                try:
+                    events.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                with pymongo.timeout(self.timeout):
+                    self.loader().insert_many(events, ordered=True)
+            except PyMongoError as e:
+                print(f"Failed to share {len(events)} events with the other processes: {e}")
+
+    def _remember(self, event_id: ObjectId) -> bool:
+        """
+        Remembers an event that was applied.
+
+        :returns:   False if the event was already applied
+        :rtype:     bool
+        """
+        with self._lock:
+            if event_id in self._seen:
+                return False
+            self._seen.add(event_id)
+            self._seen_order.append(event_id)
+            if len(self._seen_order) > SEEN_SIZE:
+                self._seen.discard(self._seen_order.popleft())
+            return True
+
+    def start(self) -> None:
+        """
+        Starts following the events of the other processes in a thread.
+        """
+        if not self.enabled or (self._thread is not None and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._follow, name="event-bus", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Stops following the events, once the queued events are inserted.
+        """
+        self._stop.set()
+        for thread in (self._publisher, self._thread):
+            if thread is not None:
+                thread.join(timeout=5)
+        self._publisher = None
+        self._thread = None
+
+    def _follow(self) -> None:
+        """
+        Reads the events of the other processes until stop() is called. The cursor is reopened after the last
+        event that was read when it dies, e.g. while the collection is empty or the database can not be reached.
+        """
+        last: Optional[ObjectId] = None
+        while not self._stop.is_set():
+            try:
+                collection = self.loader()
+                if last is None:
+                    # Only the events published after the process started are read
+                    newest = list(collection.find({}, {"_id": 1}).sort("$natural", -1).limit(1))
+                    last = newest[0]["_id"] if newest else ObjectId()
+                resume = ObjectId.from_datetime(last.generation_time - timedelta(seconds=RESUME_WINDOW))
+                cursor = collection.find(
+                    {"_id": {"$gt": resume}}, cursor_type=CursorType.TAILABLE_AWAIT
+                ).max_await_time_ms(1000)
+                while cursor.alive and not self._stop.is_set():
+                    for event in cursor:
+                        last = max(last, event["_id"])
+                        if self._remember(event["_id"]) and event.get("owner") != self.owner:
+                            self.apply(event)
+                        if self._stop.is_set():
+                            break
+                    if not cursor.alive:
+                        break
+            except PyMongoError as e:
+                print(f"Failed to follow the events of the other processes: {e}")
+                # Events may be missed until the cursor is reopened
+                location_cache.invalidate()
+                self._stop.wait(5)
+                continue
+            self._stop.wait(1)
+
+
+def events_collection() -> Collection:
+    """
+    Gets the capped collection of the events.
+    """
+    # Imported here because the database module imports the components
+    from app.db import EventsDB
+
+    return EventsDB
+
+
+# Define application wide the event bus object. Look at events in app_config.yaml for how it is configured
+event_bus = EventBus(
+    events_collection,
+    process_owner(),
+    app_config.app_events_enabled,
+    queue_size=app_config.app_events_queue_size,
+    timeout=app_config.app_events_timeout,
+)
@@ -0,0 +1,142 @@
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Optional
+import pymongo
+from pymongo.collection import Collection
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+
+def process_owner() -> str:
+    """
+    Builds a name that is unique per process, also across the hosts and the restarts of a process.
+    """
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class LeaseManager:
+    """
+    This class elects the process that runs a service when many processes (workers or replicas) run the scheduler.
+    Every service has a lease document in a collection, with the process that holds it and when it expires.
+    A process takes a lease that is free or expired and renews the leases it holds with a heartbeat. If the process
+    stops renewing a lease (e.g. it crashed), another process takes it over after it expires.
+
+    The expiration is written with the clock of the process, so the clocks of the hosts need to be synchronized
+    to well below the ttl. A process considers a lease held until the ttl passes from the moment it sent the
+    renewal, which is never after the lease expires in the database.
+
+    While the database can not be reached, a process keeps the leases it held, for as long as the outage lasts.
+    No other process can take them over without the database, and the services of the holder keep running
+    (e.g. the pull_position service logs its locations on the disk until the database is back).
+    If only the holder is cut off from the database, another process takes over once the leases expire, and both
+    run the services until the next heartbeat of the holder reaches the database and finds the leases taken.
+    """
+
+    def __init__(self, collection: Collection, owner: str, ttl: float, timeout: Optional[float] = None):
+        """
+        Constructs a new instance.
+
+        :param      collection:  The collection of the leases
+        :type       collection:  Collection
+        :param      owner:       The unique name of the process
+        :type       owner:       str
+        :param      ttl:         Seconds a lease is held without being renewed
+        :type       ttl:         float
+        :param      timeout:     Seconds a renewal waits for the database, None to wait for as long as the client does
+        :type       timeout:     Optional[float]
+        """
+        self.collection = collection
+        self.owner = owner
+        self.ttl = ttl
+        self.timeout = timeout
+        # The monotonic time until which every held lease is valid
+        self._deadlines: Dict[str, float] = {}
+        # The monotonic time of the first heartbeat that could not reach the database, None while it is reachable
+        self._unreachable_since: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def acquire(self, name: str, sent: Optional[float] = None) -> bool:
+        """
+        Takes a lease that is free or expired, or renews it if it is already held by this process.
+
+        :param      name:  The name of the lease
+        :type       name:  str
+        :param      sent:  The monotonic time the heartbeat started, now by default. Waiting for an unreachable
+                           database does not make the leases that were held when the heartbeat started look expired.
+        :type       sent:  Optional[float]
+
+        :returns:   True if the lease is held by this process
+        :rtype:     bool
+        """
+        sent = time.monotonic() if sent is None else sent
+        now = datetime.now(timezone.utc)
+        try:
+            # A lease held by another process does not match, so the upsert fails on its _id
+            with pymongo.timeout(self.timeout):
+                self.collection.find_one_and_update(
+                    {"_id": name, "$or": [{"owner": self.owner}, {"expires": {"$lt": now}}]},
+                    {
+                        "$set": {
+                            "owner": self.owner,
+                            "expires": now + timedelta(seconds=self.ttl),
+                            "renewed": now,
+                        }
+                    },
+                    upsert=True,
+                )
+        except DuplicateKeyError:
+            with self._lock:
+                self._unreachable_since = None
+                self._deadlines.pop(name, None)
+            return False
+        except PyMongoError as e:
+            # The lease is kept until the database is reached again, if it was held
+            print(f"Failed to renew the lease {name}: {e}")
+            with self._lock:
+                if self._unreachable_since is None:
+                    self._unreachable_since = sent
+                # Only a lease that was still held when the outage started is kept
+                if self._deadlines.get(name, 0) <= self._unreachable_since:
+                    self._deadlines.pop(name, None)
+            return self.held(name)
+        with self._lock:
+            self._unreachable_since = None
+            self._deadlines[name] = sent + self.ttl
+        return True
+
+    def held(self, name: str) -> bool:
+        """
+        Checks if a lease is held by this process, without querying the database.
+        A held lease is kept while the database can not be reached.
+        """
+        deadline = self._deadlines.get(name)
+        return deadline is not None and (
+            self._unreachable_since is not None or deadline > time.monotonic()
+        )
+
+    def heartbeat(self, names: Iterable[str]) -> List[str]:
+        """
+        Takes or renews every lease.
+
+        :returns:   The names of the leases that are held by this process
+        :rtype:     List[str]
+        """
+        sent = time.monotonic()
+        return [name for name in names if self.acquire(name, sent)]
+
+    def release(self, names: Iterable[str]) -> None:
+        """
+        Releases the leases held by this process, so that another process takes them over without waiting for them
+        to expire.
+        """
+        for name in names:
+            with self._lock:
+                self._deadlines.pop(name, None)
+            try:
+                with pymongo.timeout(self.timeout):
+                    self.collection.delete_one({"_id": name, "owner": self.owner})
+            except PyMongoError as e:
+                print(f"Failed to release the lease {name}: {e}")
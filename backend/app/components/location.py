@@ -1,7 +1,12 @@
-from typing import Any, List, Dict
+import numpy as np
+from typing import Any, List, Dict, Optional, Sequence, Tuple
 from app.models.location import LocationInDBSchema
+from app.utils.model_utils import to_utc_datetime
 from datetime import datetime, timezone
 
+# Codes of the visibility column used by get_daylight_windows_columnar. Any other visibility is coded as -1
+VISIBILITY_CODES = {"eclipsed": 0, "daylight": 1}
+
 
 class LocationComponent:
     """
@@ -32,18 +37,14 @@ class LocationComponent:
                         location["visibility"] == "daylight"
                         and window.get("start") is None
                     ):
-                        window["start"] = datetime.fromtimestamp(
-                            location["timestamp"], tz=timezone.utc
-                        )
+                        window["start"] = to_utc_datetime(location["timestamp"])
                         # window["start"] = location["timestamp"]
                     # Else if it is eclipsed and there is already a window open, then close the window
                     elif (
                         location["visibility"] == "eclipsed"
                         and window.get("start") is not None
                     ):
-                        window["end"] = datetime.fromtimestamp(
-                            location["timestamp"], tz=timezone.utc
-                        )
+                        window["end"] = to_utc_datetime(location["timestamp"])
                         # window["end"] = location["timestamp"]
                         windows.append(window.copy())
                         window = {}
@@ -67,10 +68,171 @@ class LocationComponent:
 
             # If there is still an open window after going through all locations
             if window.get("start") is not None:
-                window["end"] = datetime.fromtimestamp(
-                    locations[-1]["timestamp"], tz=timezone.utc
-                )
+                window["end"] = to_utc_datetime(locations[-1]["timestamp"])
                 # window["end"] = locations[-1]["timestamp"]
                 windows.append(window.copy())
 
         return windows
+
+    def get_daylight_windows_columnar(
+        self, timestamps: np.ndarray, visibility: np.ndarray
+    ) -> List[Dict]:
+        """
+        Finds the daylight windows from the columns of a list of locations. This is the vectorized
+        version of get_daylight_windows and returns identical windows for the same locations.
+        Only the timestamps of the windows' limits are converted to datetimes.
+
+        :param      timestamps:     The epoch timestamps of the locations in ascending order
+        :type       timestamps:     1-D numeric array
+        :param      visibility:     The visibility of the locations, as strings or as VISIBILITY_CODES
+        :type       visibility:     1-D string or integer array, with the same length as timestamps
+
+        :returns:   The daylight windows.
+        :rtype:     List[Dict] with the keys "start" and "end"
+        """
+        timestamps = np.asarray(timestamps)
+        visibility = np.asarray(visibility)
+        if timestamps.ndim != 1 or timestamps.shape != visibility.shape:
+            raise ValueError(
+                f"Timestamps and visibility must be 1-D arrays of the same length. Received {timestamps.shape} and {visibility.shape}"
+            )
+        if not np.issubdtype(timestamps.dtype, np.number):
+            raise TypeError(
+                f"Timestamps must be a numeric array. Received an array of {timestamps.dtype}"
+            )
+
+        if visibility.dtype.kind in "OUS":
+            visibility = self.visibility_codes(visibility)
+
+        windows = []
+        # Only daylight and eclipsed locations can open or close a window, the rest are ignored
+        known = visibility >= 0
+        if known.all():
+            state = visibility == VISIBILITY_CODES["daylight"]
+        else:
+            changes = np.flatnonzero(known)
+            if not changes.size:
+                return windows
+            state = visibility[changes] == VISIBILITY_CODES["daylight"]
+        # A window opens on a daylight location after an eclipsed one and closes on the next eclipsed one
+        transitions = np.flatnonzero(np.diff(state, prepend=False))
+        starts = transitions[state[transitions]]
+        ends = transitions[~state[transitions]]
+        if not known.all():
+            starts, ends = changes[starts], changes[ends]
+        # If there is still an open window, it ends at the last location
+        if len(starts) > len(ends):
+            ends = np.append(ends, len(timestamps) - 1)
+
+        limits = np.column_stack((starts, ends)).ravel()
+        datetimes = []
+        for i, timestamp in zip(limits.tolist(), timestamps[limits].tolist()):
+            try:
+                datetimes.append(datetime.fromtimestamp(timestamp, tz=timezone.utc))
+            except ValueError as e:
+                raise ValueError(
+                    f"Error related to invalid or out-of-range timestamps while processing location {i} with timestamp {timestamp}: {e}"
+                )
+            except OverflowError as e:
+                raise OverflowError(
+                    f"Error related to invalid or out-of-range timestamps while processing location {i} with timestamp {timestamp}: {e}"
+                )
+        for start, end in zip(datetimes[::2], datetimes[1::2]):
+            windows.append({"start": start, "end": end})
+        return windows
+
+    @staticmethod
+    def visibility_codes(visibility: np.ndarray) -> np.ndarray:
+        """
+        Encodes an array of visibility strings with VISIBILITY_CODES.
+
+        :param      visibility:     The visibility of the locations
+        :type       visibility:     1-D string array
+
+        :returns:   The visibility codes
+        :rtype:     np.ndarray of int8
+        """
+        codes = np.full(len(visibility), -1, dtype=np.int8)
+        for name, code in VISIBILITY_CODES.items():
+            codes[visibility == name] = code
+        return codes
+
+    @staticmethod
+    def to_columns(locations: Sequence[Dict]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Transforms a list of locations to the columns used by get_daylight_windows_columnar.
+
+        :param      locations:      The list of locations
+        :type       locations:      Dictionary compliant with LocationSchema
+
+        :returns:   The epoch timestamps and the visibility codes of the locations
+        :rtype:     Tuple[np.ndarray, np.ndarray]
+        """
+        timestamps = np.fromiter(
+            (to_utc_datetime(location["timestamp"]).timestamp() for location in locations),
+            dtype=np.float64,
+            count=len(locations),
+        )
+        visibility = np.fromiter(
+            (VISIBILITY_CODES.get(location["visibility"], -1) for location in locations),
+            dtype=np.int8,
+            count=len(locations),
+        )
+        return timestamps, visibility
+
+    def update_daylight_window(
+        self, window: Optional[Dict], location: Dict
+    ) -> Optional[Dict]:
+        """
+        Applies a new location to the latest daylight window of the satellite. This is the incremental
+        version of get_daylight_windows and produces the same windows when the locations are
+        applied one by one in ascending timestamp order. A location that is not newer than the latest
+        window is ignored, whether the window is open or closed, so a late location never opens a window
+        that overlaps with the existing ones.
+
+        :param      window:         The latest window, open or closed, or None if there is no window
+        :type       window:         Dictionary with the keys "sat_id", "start", "end" and "open"
+        :param      location:       The new location
+        :type       location:       Dictionary compliant with LocationSchema
+
+        :returns:   The window that needs to be stored or None if nothing changed.
+        :rtype:     Dict with the keys "sat_id", "start", "end" and "open"
+        """
+        try:
+            timestamp = to_utc_datetime(location["timestamp"])
+            visibility = location["visibility"]
+        except KeyError as e:
+            raise KeyError(
+                f"Error related to missing or invalid keys while processing location: {location}: {e}"
+            )
+        except TypeError as e:
+            raise TypeError(
+                f"Error related to missing or invalid keys while processing location: {location}: {e}"
+            )
+
+        # Ignore locations that are older than the latest window (e.g. a repeated poll or a late location)
+        if window is not None and timestamp <= to_utc_datetime(window["end"]):
+            return None
+        # A closed window is only used to ignore the older locations
+        if window is not None and not window["open"]:
+            window = None
+
+        # If it is daylight and there is no open window, then open a new one
+        if visibility == "daylight" and window is None:
+            return {
+                "sat_id": location["sat_id"],
+                "start": timestamp,
+                "end": timestamp,
+                "open": True,
+            }
+        # Else if it is daylight and there is an open window, then extend it
+        elif visibility == "daylight":
+            window["end"] = timestamp
+            return window
+        # Else if it is eclipsed and there is an open window, then close it
+        elif visibility == "eclipsed" and window is not None:
+            window["end"] = timestamp
+            window["open"] = False
+            return window
+
+        return None
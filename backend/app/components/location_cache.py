@@ -0,0 +1,94 @@
+import threading
+from collections import deque
+from typing import Deque, Dict, List, Optional
+from app.config import app_config
+from app.utils.model_utils import to_utc_datetime
+
+
+class LocationCache:
+    """
+    This class keeps the latest locations of every satellite in memory.
+    The pull_position service adds every location it stores, so the most frequent reads
+    (the last known position and the last few locations of a satellite) do not need to hit the database.
+    Locations are returned as copies, so callers can transform them without changing the cache.
+    """
+
+    def __init__(self, size: int):
+        """
+        Constructs a new instance.
+
+        :param      size:  The number of latest locations kept per satellite
+        :type       size:  int
+        """
+        self.size = size
+        self._locations: Dict[int, Deque[Dict]] = {}
+        # The scheduler thread writes while the event loop reads
+        self._lock = threading.Lock()
+
+    def add(self, location: Dict) -> None:
+        """
+        Adds a newly stored location. If it is not newer than the cached locations of the satellite
+        the cache can not tell where it belongs, so the satellite is invalidated instead.
+
+        :param      location:  The stored location, including its "_id"
+        :type       location:  Dictionary compliant with LocationInDBSchema
+        """
+        sat_id = location["sat_id"]
+        with self._lock:
+            locations = self._locations.setdefault(sat_id, deque(maxlen=self.size))
+            if locations and to_utc_datetime(location["timestamp"]) <= to_utc_datetime(
+                locations[-1]["timestamp"]
+            ):
+                del self._locations[sat_id]
+                return
+            locations.append(dict(location))
+
+    def latest(self, sat_id: int) -> Optional[Dict]:
+        """
+        Gets the latest location of a satellite.
+
+        :param      sat_id:  The satellite id
+        :type       sat_id:  int
+
+        :returns:   The latest location or None on a cache miss
+        :rtype:     Dict
+        """
+        with self._lock:
+            locations = self._locations.get(sat_id)
+            return dict(locations[-1]) if locations else None
+
+    def last(self, sat_id: int, n: int) -> Optional[List[Dict]]:
+        """
+        Gets the last n locations of a satellite, newest first.
+
+        :param      sat_id:  The satellite id
+        :type       sat_id:  int
+        :param      n:       The number of locations
+        :type       n:       int
+
+        :returns:   The locations or None on a cache miss, i.e. when fewer than n locations are cached
+        :rtype:     List[Dict]
+        """
+        with self._lock:
+            locations = self._locations.get(sat_id)
+            if n <= 0 or not locations or len(locations) < n:
+                return None
+            return [dict(locations[-i]) for i in range(1, n + 1)]
+
+    def invalidate(self, sat_id: Optional[int] = None) -> None:
+        """
+        Removes the cached locations of a satellite, or of all satellites if no sat_id is provided.
+        This is needed whenever locations are created or deleted outside of the pull_position service.
+
+        :param      sat_id:  The satellite id
+        :type       sat_id:  int
+        """
+        with self._lock:
+            if sat_id is None:
+                self._locations.clear()
+            else:
+                self._locations.pop(sat_id, None)
+
+
+# Define application wide the location cache object
+location_cache = LocationCache(app_config.app_cache_locations_size)
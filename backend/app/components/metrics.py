@@ -0,0 +1,318 @@
+import functools
+import os
+import time
+from typing import Callable, Dict, List
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, multiprocess
+from pymongo import monitoring
+from app.config import app_config
+from apscheduler.events import (
+    EVENT_JOB_ERROR,
+    EVENT_JOB_MAX_INSTANCES,
+    EVENT_JOB_MISSED,
+    JobEvent,
+)
+
+# The metrics of the application are kept in their own registry, so only they are exposed by /api/metrics
+registry = CollectorRegistry()
+# When set, the workers of the host write their metrics to files in this directory, and /api/metrics aggregates the
+# files of every worker instead of exposing the registry of the one that got the scrape. Look at metrics in app_config.yaml
+multiprocess_dir = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+
+http_request_duration = Histogram(
+    "http_request_duration_seconds",
+    "Seconds until the response of a request starts, per route template and status code",
+    ["method", "route", "status"],
+    registry=registry,
+)
+mongodb_command_duration = Histogram(
+    "mongodb_command_duration_seconds",
+    "Seconds of the MongoDB commands, per collection and command. The _count is the number of commands",
+    ["collection", "command"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+    registry=registry,
+)
+mongodb_command_failures = Counter(
+    "mongodb_command_failures_total",
+    "MongoDB commands that failed, per collection and command",
+    ["collection", "command"],
+    registry=registry,
+)
+mongodb_pool_connections = Gauge(
+    "mongodb_pool_connections",
+    "Open connections of the MongoDB connection pools, per client and server",
+    ["client", "address"],
+    # The connections of the workers that are alive are summed
+    multiprocess_mode="livesum",
+    registry=registry,
+)
+mongodb_pool_checked_out = Gauge(
+    "mongodb_pool_checked_out_connections",
+    "Connections of the MongoDB connection pools that are in use, per client and server",
+    ["client", "address"],
+    # The connections of the workers that are alive are summed
+    multiprocess_mode="livesum",
+    registry=registry,
+)
+mongodb_pool_checkout_failures = Counter(
+    "mongodb_pool_checkout_failures_total",
+    "Connections that could not be checked out of the MongoDB connection pools, per client, server and reason",
+    ["client", "address", "reason"],
+    registry=registry,
+)
+mongodb_pool_cleared = Counter(
+    "mongodb_pool_cleared_total",
+    "Times the MongoDB connection pools were cleared after an error, per client and server",
+    ["client", "address"],
+    registry=registry,
+)
+scheduler_job_duration = Histogram(
+    "scheduler_job_duration_seconds",
+    "Seconds of the runs of the scheduled services",
+    ["service"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300),
+    registry=registry,
+)
+scheduler_job_failures = Counter(
+    "scheduler_job_failures_total",
+    "Runs of the scheduled services that raised an exception",
+    ["service"],
+    registry=registry,
+)
+scheduler_job_misfires = Counter(
+    "scheduler_job_misfires_total",
+    "Runs of the scheduled services that were skipped, because they were missed or the previous run was still running",
+    ["service", "reason"],
+    registry=registry,
+)
+upstream_request_duration = Histogram(
+    "upstream_request_duration_seconds",
+    "Seconds of the requests to the external APIs, including the failed ones",
+    ["api"],
+    registry=registry,
+)
+upstream_responses = Counter(
+    "upstream_responses_total",
+    "Responses of the external APIs per status code. The status code is 0 if there was no response",
+    ["api", "status"],
+    registry=registry,
+)
+
+
+def observe_upstream(api: str, status_code: int, seconds: float) -> None:
+    """
+    Records a request to an external API.
+
+    :param      api:          The name of the API in app_config.yaml, e.g. sat_loc
+    :type       api:          str
+    :param      status_code:  The status code of the response, 0 if there was no response
+    :type       status_code:  int
+    :param      seconds:      The duration of the request
+    :type       seconds:      float
+    """
+    upstream_request_duration.labels(api).observe(seconds)
+    upstream_responses.labels(api, str(status_code)).inc()
+
+
+def route_template(scope: Dict) -> str:
+    """
+    Finds the template of the route that matched a request, e.g. /api/location/{locationId}.
+    The router sets the matched route in the scope. The path of a route of an included router may not hold
+    the prefix of the router, so the prefix is taken from the path of the request.
+
+    :returns:   The template or "unmatched" if no route matched the request
+    :rtype:     str
+    """
+    route = scope.get("route")
+    template = getattr(route, "path", None)
+    if template is None:
+        return "unmatched"
+    regex = getattr(route, "path_regex", None)
+    path = scope.get("path", "")
+    if regex is None or regex.match(path):
+        return template
+    # The prefixes of the routers have no path parameters, so the route matches the rest of the path
+    for i, character in enumerate(path):
+        if character == "/" and regex.match(path[i:]):
+            return path[:i] + template
+    return template
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware that records the latency of every request per route template (e.g. /api/location/{locationId}),
+    so the number of series does not grow with the ids in the paths. Requests that do not match a route share one series.
+    The latency is measured until the response starts, so the streams and the exports are measured until they start
+    streaming instead of for as long as they are open.
+    """
+
+    def __init__(self, app: Callable):
+        self.app = app
+
+    async def __call__(self, scope: Dict, receive: Callable, send: Callable):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        start = time.perf_counter()
+        observed = False
+
+        def observe(status_code: int):
+            nonlocal observed
+            observed = True
+            http_request_duration.labels(scope["method"], route_template(scope), str(status_code)).observe(
+                time.perf_counter() - start
+            )
+
+        async def send_wrapper(message: Dict):
+            if message["type"] == "http.response.start" and not observed:
+                observe(message["status"])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            if not observed:
+                # The application failed before it started a response
+                observe(500)
+
+
+class CommandMetrics(monitoring.CommandListener):
+    """
+    This class records the duration of every MongoDB command per collection and command.
+    The collection is only known when the command starts, so it is kept until the command ends.
+    """
+
+    def __init__(self):
+        self._collections: Dict[int, str] = {}
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        # Most commands hold the collection as the value of the command name, getMore holds it in "collection"
+        collection = event.command.get(event.command_name)
+        if event.command_name == "getMore":
+            collection = event.command.get("collection")
+        self._collections[event.request_id] = collection if isinstance(collection, str) else ""
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        collection = self._collections.pop(event.request_id, "")
+        mongodb_command_duration.labels(collection, event.command_name).observe(event.duration_micros / 1e6)
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        collection = self._collections.pop(event.request_id, "")
+        mongodb_command_duration.labels(collection, event.command_name).observe(event.duration_micros / 1e6)
+        mongodb_command_failures.labels(collection, event.command_name).inc()
+
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """
+    This class keeps the statistics of the connection pools of a MongoDB client.
+    """
+
+    def __init__(self, client: str):
+        """
+        Constructs a new instance.
+
+        :param      client:  The name of the client, e.g. sync or async
+        :type       client:  str
+        """
+        self.client = client
+
+    def _labels(self, event) -> tuple:
+        host, port = event.address
+        return self.client, f"{host}:{port}"
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        mongodb_pool_cleared.labels(*self._labels(event)).inc()
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        mongodb_pool_connections.labels(*self._labels(event)).inc()
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        mongodb_pool_connections.labels(*self._labels(event)).dec()
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        mongodb_pool_checkout_failures.labels(*self._labels(event), event.reason).inc()
+
+    def connection_checked_out(self, event):
+        mongodb_pool_checked_out.labels(*self._labels(event)).inc()
+
+    def connection_checked_in(self, event):
+        mongodb_pool_checked_out.labels(*self._labels(event)).dec()
+
+
+def mongodb_listeners(client: str) -> List:
+    """
+    Builds the pymongo monitoring listeners of a MongoDB client, or none if the metrics are disabled.
+
+    :param      client:  The name of the client, e.g. sync or async
+    :type       client:  str
+
+    :returns:   The listeners
+    :rtype:     List
+    """
+    if not app_config.app_metrics_enabled:
+        return []
+    return [CommandMetrics(), PoolMetrics(client)]
+
+
+def timed_job(service_key: str, function: Callable) -> Callable:
+    """
+    Wraps the function of a scheduled service so that the duration of its runs is recorded.
+    """
+
+    @functools.wraps(function)
+    def run(*args, **kwargs):
+        with scheduler_job_duration.labels(service_key).time():
+            return function(*args, **kwargs)
+
+    return run
+
+
+def job_listener(event: JobEvent) -> None:
+    """
+    Listener of the scheduler that counts the failed and the skipped runs of the services.
+    The jobs of the services have the name of the service as their id.
+    """
+    if event.code == EVENT_JOB_ERROR:
+        scheduler_job_failures.labels(event.job_id).inc()
+    elif event.code == EVENT_JOB_MISSED:
+        scheduler_job_misfires.labels(event.job_id, "missed").inc()
+    elif event.code == EVENT_JOB_MAX_INSTANCES:
+        scheduler_job_misfires.labels(event.job_id, "max_instances").inc()
+
+
+# The scheduler events the job_listener needs
+JOB_EVENTS = EVENT_JOB_ERROR | EVENT_JOB_MISSED | EVENT_JOB_MAX_INSTANCES
+
+
+def exposition_registry() -> CollectorRegistry:
+    """
+    Gets the registry that /api/metrics exposes. Without a multiprocess directory it is the registry of this process,
+    otherwise a new registry that collects the metrics of every worker of the host from their files.
+    """
+    if not multiprocess_dir:
+        return registry
+    collected = CollectorRegistry()
+    multiprocess.MultiProcessCollector(collected, path=multiprocess_dir)
+    return collected
+
+
+def mark_process_dead() -> None:
+    """
+    Removes the live gauges of this process from the multiprocess directory, so they are not summed after it exits.
+    """
+    if multiprocess_dir:
+        multiprocess.mark_process_dead(os.getpid(), multiprocess_dir)
@@ -0,0 +1,288 @@
+import math
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from typing import Dict, List, Sequence, Tuple
+import numpy as np
+from sgp4.api import Satrec, SatrecArray
+from app.components.location import LocationComponent, VISIBILITY_CODES
+
+# WGS84 ellipsoid, used to transform the positions to latitude, longitude and altitude
+EARTH_EQUATORIAL_RADIUS = 6378.137  # km
+EARTH_FLATTENING = 1 / 298.257223563
+# Mean radius of the Earth, used for the footprint and the shadow of the Earth
+EARTH_MEAN_RADIUS = 6371.0  # km
+# Julian date of 1970-01-01T00:00:00Z and of the J2000 epoch
+UNIX_EPOCH_JD = 2440587.5
+J2000_JD = 2451545.0
+SECONDS_PER_DAY = 86400
+# Kilometers per unit of the distances, the same units as the sat_loc API
+KILOMETERS_PER_UNIT = {"kilometers": 1.0, "miles": 1.609344}
+
+
+@lru_cache(maxsize=1024)
+def satrec(line1: str, line2: str) -> Satrec:
+    """
+    Parses a TLE. The parsed TLEs are kept, since the same TLE is propagated by many requests.
+    """
+    return Satrec.twoline2rv(line1, line2)
+
+
+def tle_epoch(line1: str, line2: str) -> datetime:
+    """
+    Returns the epoch of a TLE as a timezone aware UTC datetime.
+    """
+    sat = satrec(line1, line2)
+    days = (sat.jdsatepoch - UNIX_EPOCH_JD) + sat.jdsatepochF
+    return datetime(1970, 1, 1, tzinfo=timezone.utc) + timedelta(days=days)
+
+
+def add_tle_epoch(data: Dict) -> Dict:
+    """
+    Adds the "epoch" of the TLE to the data of a TLE that is created or updated.
+    """
+    if "line1" in data and "line2" in data:
+        data["epoch"] = tle_epoch(data["line1"], data["line2"])
+    return data
+
+
+class OrbitComponent:
+    """
+    This class predicts the locations of satellites from their TLEs with the SGP4 propagator, without the sat_loc API.
+    Many satellites and timestamps are propagated at once and every transformation is applied to whole arrays.
+    The positions are transformed from the TEME frame of SGP4 to the Earth with the Greenwich mean sidereal time
+    (the polar motion is ignored) and the sun comes from a low precision solar ephemeris (about 0.01 degrees),
+    which are well below the error of a TLE. A satellite is eclipsed in the cylindrical shadow of the Earth.
+    """
+
+    def __init__(self, step: float):
+        """
+        Constructs a new instance.
+
+        :param      step:  Seconds between two samples of the predicted daylight windows
+        :type       step:  float
+        """
+        self.step = step
+
+    @staticmethod
+    def julian_dates(timestamps: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Splits epoch timestamps into whole and fractional Julian dates, which keeps the precision of the seconds.
+
+        :returns:   The whole and the fractional parts of the Julian dates
+        :rtype:     Tuple[np.ndarray, np.ndarray]
+        """
+        days = np.asarray(timestamps, dtype=np.float64) / SECONDS_PER_DAY
+        whole = np.floor(days)
+        return whole + UNIX_EPOCH_JD, days - whole
+
+    @staticmethod
+    def gmst(jd: np.ndarray, fr: np.ndarray) -> np.ndarray:
+        """
+        Greenwich mean sidereal time (IAU 1982), the angle between the TEME frame and the Earth.
+
+        :returns:   The angles in radians
+        :rtype:     np.ndarray
+        """
+        t = ((jd - J2000_JD) + fr) / 36525
+        seconds = (
+            67310.54841
+            + (876600 * 3600 + 8640184.812866) * t
+            + 0.093104 * t**2
+            - 6.2e-6 * t**3
+        )
+        return np.mod(seconds, SECONDS_PER_DAY) / SECONDS_PER_DAY * 2 * math.pi
+
+    @staticmethod
+    def sun(jd: np.ndarray, fr: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Low precision solar ephemeris of the Astronomical Almanac.
+
+        :returns:   The unit vectors towards the sun in the equatorial frame, the right ascensions and
+                    the declinations in radians
+        :rtype:     Tuple[np.ndarray, np.ndarray, np.ndarray]
+        """
+        n = (jd - J2000_JD) + fr
+        mean_longitude = np.radians(np.mod(280.460 + 0.9856474 * n, 360))
+        anomaly = np.radians(np.mod(357.528 + 0.9856003 * n, 360))
+        longitude = (
+            mean_longitude
+            + np.radians(1.915) * np.sin(anomaly)
+            + np.radians(0.020) * np.sin(2 * anomaly)
+        )
+        obliquity = np.radians(23.439 - 0.0000004 * n)
+        direction = np.stack(
+            (
+                np.cos(longitude),
+                np.cos(obliquity) * np.sin(longitude),
+                np.sin(obliquity) * np.sin(longitude),
+            ),
+            axis=-1,
+        )
+        right_ascension = np.arctan2(direction[..., 1], direction[..., 0])
+        declination = np.arcsin(direction[..., 2])
+        return direction, right_ascension, declination
+
+    @staticmethod
+    def geodetic(x: np.ndarray, y: np.ndarray, z: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Transforms Earth fixed positions to WGS84 latitudes, longitudes and altitudes.
+        The latitude is found with a few fixed point iterations, which converge to below a millimeter in orbit.
+
+        :returns:   The latitudes and longitudes in degrees and the altitudes in km
+        :rtype:     Tuple[np.ndarray, np.ndarray, np.ndarray]
+        """
+        e2 = EARTH_FLATTENING * (2 - EARTH_FLATTENING)
+        p = np.hypot(x, y)
+        latitude = np.arctan2(z, p * (1 - e2))
+        for _ in range(4):
+            sin = np.sin(latitude)
+            radius = EARTH_EQUATORIAL_RADIUS / np.sqrt(1 - e2 * sin**2)
+            latitude = np.arctan2(z + e2 * radius * sin, p)
+        sin = np.sin(latitude)
+        # This form of the altitude is stable at the poles
+        altitude = (
+            p * np.cos(latitude)
+            + z * sin
+            - EARTH_EQUATORIAL_RADIUS * np.sqrt(1 - e2 * sin**2)
+        )
+        return np.degrees(latitude), np.degrees(np.arctan2(y, x)), altitude
+
+    def propagate(self, tles: Sequence[Dict], timestamps: np.ndarray) -> Dict[str, np.ndarray]:
+        """
+        Propagates every TLE to every timestamp.
+
+        :param      tles:        The TLEs with at least their "line1" and "line2"
+        :type       tles:        Sequence[Dict]
+        :param      timestamps:  The epoch timestamps
+        :type       timestamps:  np.ndarray
+
+        :returns:   Columns with a row per TLE and a column per timestamp: "error" (the SGP4 error code, 0 if the
+                    propagation succeeded), "latitude", "longitude", "altitude" (km), "velocity" (km/h),
+                    "eclipsed" and "footprint" (km), followed by the columns of the timestamps "daynum",
+                    "solar_lat" and "solar_lon" (degrees, from 0 to 360 like the sat_loc API)
+        :rtype:     Dict[str, np.ndarray]
+        """
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        jd, fr = self.julian_dates(timestamps)
+        satellites = SatrecArray([satrec(tle["line1"], tle["line2"]) for tle in tles])
+        error, position, velocity = satellites.sgp4(jd, fr)
+
+        # Rotate the TEME positions around the pole to the Earth fixed frame
+        theta = self.gmst(jd, fr)
+        cos, sin = np.cos(theta), np.sin(theta)
+        x = cos * position[..., 0] + sin * position[..., 1]
+        y = cos * position[..., 1] - sin * position[..., 0]
+        latitude, longitude, altitude = self.geodetic(x, y, position[..., 2])
+
+        # The satellite is eclipsed when it is behind the Earth and inside the cylinder of its shadow
+        direction, right_ascension, declination = self.sun(jd, fr)
+        along = np.einsum("stk,tk->st", position, direction)
+        across = np.linalg.norm(position - along[..., None] * direction, axis=-1)
+        eclipsed = (along < 0) & (across < EARTH_MEAN_RADIUS)
+
+        # The footprint is the diameter of the area of the Earth that sees the satellite
+        ratio = np.clip(EARTH_MEAN_RADIUS / (EARTH_MEAN_RADIUS + altitude), -1, 1)
+        return {
+            "error": error,
+            "latitude": latitude,
+            "longitude": longitude,
+            "altitude": altitude,
+            "velocity": np.linalg.norm(velocity, axis=-1) * 3600,
+            "eclipsed": eclipsed,
+            "footprint": 2 * EARTH_MEAN_RADIUS * np.arccos(ratio),
+            "daynum": jd + fr,
+            "solar_lat": np.degrees(declination),
+            "solar_lon": np.mod(np.degrees(right_ascension - theta), 360),
+        }
+
+    def locations(
+        self, tles: Sequence[Dict], timestamps: np.ndarray, units: str = "kilometers"
+    ) -> List[Dict]:
+        """
+        Predicts the locations of the satellites of the TLEs, in the same format as the sat_loc API.
+        The locations that SGP4 can not calculate (e.g. a decayed orbit) are skipped.
+
+        :param      tles:        The TLEs with at least their "sat_id", "line1" and "line2"
+        :type       tles:        Sequence[Dict]
+        :param      timestamps:  The epoch timestamps
+        :type       timestamps:  np.ndarray
+        :param      units:       The units of the distances, "kilometers" or "miles"
+        :type       units:       str
+
+        :returns:   The locations, grouped by TLE and sorted by timestamp
+        :rtype:     List[Dict] compliant with LocationSchema
+        """
+        if not tles or len(timestamps) == 0:
+            return []
+        columns = self.propagate(tles, timestamps)
+        scale = 1 / KILOMETERS_PER_UNIT[units]
+        datetimes = [
+            datetime.fromtimestamp(timestamp, tz=timezone.utc)
+            for timestamp in np.asarray(timestamps, dtype=np.float64).tolist()
+        ]
+        daynum, solar_lat, solar_lon = (
+            columns["daynum"].tolist(),
+            columns["solar_lat"].tolist(),
+            columns["solar_lon"].tolist(),
+        )
+        locations = []
+        for i, tle in enumerate(tles):
+            valid = columns["error"][i] == 0
+            latitude, longitude = columns["latitude"][i].tolist(), columns["longitude"][i].tolist()
+            altitude = (columns["altitude"][i] * scale).tolist()
+            velocity = (columns["velocity"][i] * scale).tolist()
+            footprint = (columns["footprint"][i] * scale).tolist()
+            eclipsed = columns["eclipsed"][i].tolist()
+            for j in np.flatnonzero(valid).tolist():
+                locations.append(
+                    {
+                        "sat_id": tle["sat_id"],
+                        "latitude": latitude[j],
+                        "longitude": longitude[j],
+                        "altitude": altitude[j],
+                        "velocity": velocity[j],
+                        "visibility": "eclipsed" if eclipsed[j] else "daylight",
+                        "footprint": footprint[j],
+                        "timestamp": datetimes[j],
+                        "daynum": daynum[j],
+                        "solar_lat": solar_lat[j],
+                        "solar_lon": solar_lon[j],
+                        "units": units,
+                    }
+                )
+        return locations
+
+    @staticmethod
+    def period(tle: Dict) -> float:
+        """
+        Returns the orbital period of a TLE in seconds.
+        """
+        # The mean motion is in radians per minute
+        return 2 * math.pi / satrec(tle["line1"], tle["line2"]).no_kozai * 60
+
+    def daylight_windows(self, tle: Dict, start: datetime, orbits: float) -> List[Dict]:
+        """
+        Predicts the daylight windows of a satellite for a number of orbits after a start.
+        The orbits are sampled every `step` seconds, so the limits of the windows are precise to a step.
+        A window that is still open at the end of the orbits ends with them, the same way as the stored windows.
+
+        :param      tle:     The TLE of the satellite
+        :type       tle:     Dict
+        :param      start:   The start of the prediction
+        :type       start:   datetime
+        :param      orbits:  The number of orbits
+        :type       orbits:  float
+
+        :returns:   The daylight windows
+        :rtype:     List[Dict] with the keys "start" and "end"
+        """
+        begin = start.timestamp()
+        timestamps = np.arange(begin, begin + orbits * self.period(tle) + self.step, self.step)
+        columns = self.propagate([tle], timestamps)
+        valid = columns["error"][0] == 0
+        visibility = np.where(
+            columns["eclipsed"][0], VISIBILITY_CODES["eclipsed"], VISIBILITY_CODES["daylight"]
+        ).astype(np.int8)
+        return LocationComponent().get_daylight_windows_columnar(
+            timestamps[valid], visibility[valid]
+        )
@@ -0,0 +1,145 @@
+import asyncio
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Callable, Mapping, Optional
+from app.config import app_config
+
+# Status codes after which the API is given time to recover before the next request
+BACKOFF_STATUS_CODES = {0, 429, 500, 502, 503, 504}  # 0 means that there was no response at all
+
+
+def retry_after(headers: Mapping[str, str]) -> Optional[float]:
+    """
+    Reads the Retry-After header of a response, in seconds or as an HTTP date.
+
+    :returns:   The seconds to wait or None if the header is missing or invalid
+    :rtype:     Optional[float]
+    """
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimiter:
+    """
+    This class paces the requests to an external API with a token bucket shared by every caller of the process,
+    from the event loop of the pull_position service and from the threads of the other services.
+    Every request takes a token and waits until the token is available, so the requests are spread evenly
+    at the rate of the API instead of being sent in bursts.
+    When the API answers with a status code of BACKOFF_STATUS_CODES, no request is sent until the backoff passes.
+    The backoff doubles with every failure in a row, with a random jitter, and is at least the Retry-After of the API.
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        burst: float,
+        backoff_base: float,
+        backoff_max: float,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        """
+        Constructs a new instance.
+
+        :param      rate:          Requests per second
+        :type       rate:          float
+        :param      burst:         Requests that can be sent at once after an idle period
+        :type       burst:         float
+        :param      backoff_base:  Seconds of the first backoff
+        :type       backoff_base:  float
+        :param      backoff_max:   Maximum seconds of a backoff, unless the API asks for more with Retry-After
+        :type       backoff_max:   float
+        :param      clock:         Function that returns the seconds of a monotonic clock, used by the tests
+        :type       clock:         Callable[[], float]
+        """
+        self.rate = rate
+        self.burst = burst
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.clock = clock
+        self.failures = 0
+        self._tokens = burst
+        # The tokens are counted from this time, which is in the future during a backoff
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """
+        Takes a token. The token may only be available in the future, so the caller needs to wait before sending.
+
+        :returns:   The seconds to wait before sending the request
+        :rtype:     float
+        """
+        with self._lock:
+            now = self.clock()
+            if now > self._updated:
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+            self._tokens -= 1
+            return max(0.0, self._updated - now) + max(0.0, -self._tokens) / self.rate
+
+    def acquire(self) -> None:
+        """
+        Takes a token and waits for it in the calling thread.
+        """
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    async def wait(self) -> None:
+        """
+        Takes a token and waits for it without blocking the event loop.
+        """
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def record(self, status_code: int, wait: Optional[float] = None) -> float:
+        """
+        Records the outcome of a request. A status code of BACKOFF_STATUS_CODES starts a backoff,
+        any other status code resets it.
+
+        :param      status_code:  The status code of the response, 0 if there was no response
+        :type       status_code:  int
+        :param      wait:         The Retry-After of the response in seconds
+        :type       wait:         Optional[float]
+
+        :returns:   The seconds of the backoff, 0 if there is none
+        :rtype:     float
+        """
+        with self._lock:
+            if status_code not in BACKOFF_STATUS_CODES:
+                self.failures = 0
+                return 0.0
+            self.failures += 1
+            delay = min(self.backoff_max, self.backoff_base * 2 ** (self.failures - 1))
+            delay = random.uniform(delay / 2, delay)
+            if wait is not None:
+                delay = max(delay, wait)
+            until = self.clock() + delay
+            if until > self._updated:
+                # A single request is sent when the backoff ends and the next ones follow at the rate
+                self._updated = until
+                self._tokens = 1
+            return delay
+
+
+# Define application wide the rate limiter of the sat_loc API. The TLEs are read from the same API, so the tles service
+# shares the lease of the pull_position service and both use this limiter on the same process
+sat_loc_limiter = RateLimiter(
+    app_config.app_apis_sat_loc_rate,
+    app_config.app_apis_sat_loc_burst,
+    app_config.app_apis_sat_loc_backoff_base,
+    app_config.app_apis_sat_loc_backoff_max,
+)
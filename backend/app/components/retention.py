@@ -0,0 +1,135 @@
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+from app.config import app_config
+from app.utils.model_utils import to_utc_datetime
+
+SECONDS_PER_DAY = 86400
+
+
+class RetentionTier:
+    """
+    This class describes a tier of the locations: the raw locations or one of their rollups.
+    """
+
+    def __init__(self, name: str, resolution: int, ttl: Optional[int]):
+        """
+        Constructs a new instance.
+
+        :param      name:        The name of the collection of the tier
+        :type       name:        str
+        :param      resolution:  Seconds between two locations of the tier
+        :type       resolution:  int
+        :param      ttl:         Seconds the locations are kept or None to keep them forever
+        :type       ttl:         Optional[int]
+        """
+        self.name = name
+        self.resolution = resolution
+        self.ttl = ttl
+
+    def covers(self, from_: datetime, now: datetime) -> bool:
+        """
+        Checks if the tier still holds the locations of a point in time.
+        """
+        return self.ttl is None or from_ >= now - timedelta(seconds=self.ttl)
+
+    def __repr__(self) -> str:
+        return f"RetentionTier({self.name}, resolution={self.resolution}, ttl={self.ttl})"
+
+
+class RetentionPolicy:
+    """
+    This class holds the retention tiers of the locations, finest first, and picks the tier of a range query.
+    The raw locations are the first tier. Their resolution is the polling frequency of the pull_position service.
+    """
+
+    def __init__(
+        self,
+        raw_name: str,
+        raw_resolution: int,
+        raw_days: Optional[float],
+        rollups: List[Dict],
+        min_points: int,
+    ):
+        """
+        Constructs a new instance.
+
+        :param      raw_name:        The name of the collection of the raw locations
+        :type       raw_name:        str
+        :param      raw_resolution:  Seconds between two raw locations
+        :type       raw_resolution:  int
+        :param      raw_days:        Days the raw locations are kept or None to keep them forever
+        :type       raw_days:        Optional[float]
+        :param      rollups:         The rollup tiers with their "resolution" in seconds and "days"
+        :type       rollups:         List[Dict]
+        :param      min_points:      Minimum number of locations a range query should return
+        :type       min_points:      int
+        """
+        self.raw = RetentionTier(raw_name, raw_resolution, self.days_to_seconds(raw_days))
+        self.rollups = [
+            RetentionTier(
+                f"{raw_name}_{rollup['resolution']}s",
+                rollup["resolution"],
+                self.days_to_seconds(rollup.get("days")),
+            )
+            for rollup in sorted(rollups, key=lambda rollup: rollup["resolution"])
+        ]
+        self.tiers = [self.raw] + self.rollups
+        self.min_points = min_points
+
+    @staticmethod
+    def days_to_seconds(days: Optional[float]) -> Optional[int]:
+        """
+        Converts the days of the configuration to seconds. None stays None.
+        """
+        return None if days is None else int(days * SECONDS_PER_DAY)
+
+    def select(
+        self,
+        from_: Optional[datetime] = None,
+        to: Optional[datetime] = None,
+        now: Optional[datetime] = None,
+    ) -> RetentionTier:
+        """
+        Picks the coarsest tier that still holds the start of the range and returns at least min_points locations for it.
+        If no tier returns enough locations, the finest tier that holds the start of the range is used.
+        If no tier holds the start of the range anymore, the tier with the longest retention is used.
+        A range without a start asks for the whole history.
+
+        :param      from_:  The start of the range
+        :type       from_:  Optional[datetime]
+        :param      to:     The end of the range, now by default
+        :type       to:     Optional[datetime]
+        :param      now:    The current time, used by the tests
+        :type       now:    Optional[datetime]
+
+        :returns:   The tier to query
+        :rtype:     RetentionTier
+        """
+        now = now or datetime.now(timezone.utc)
+        # Query parameters without a timezone are in UTC, the same way as the stored timestamps
+        from_ = to_utc_datetime(from_) if from_ is not None else None
+        to = to_utc_datetime(to) if to is not None else None
+        if from_ is None:
+            candidates = [tier for tier in self.tiers if tier.ttl is None]
+        else:
+            candidates = [tier for tier in self.tiers if tier.covers(from_, now)]
+        if not candidates:
+            return max(self.tiers, key=lambda tier: tier.ttl)
+        if from_ is None:
+            return candidates[-1]
+
+        span = ((to or now) - from_).total_seconds()
+        for tier in reversed(candidates):
+            if span / tier.resolution >= self.min_points:
+                return tier
+        return candidates[0]
+
+
+# Define application wide the retention policy object
+retention_policy = RetentionPolicy(
+    "locations",
+    app_config.app_services["pull_position"]["freq"],
+    app_config.app_retention_raw_days,
+    app_config.app_retention_rollups,
+    app_config.app_retention_min_points,
+)
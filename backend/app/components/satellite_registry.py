@@ -0,0 +1,176 @@
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional
+import pymongo
+from fastapi import HTTPException
+from pymongo.errors import PyMongoError
+from app.config import app_config
+
+
+class SatelliteRegistry:
+    """
+    This class keeps all satellites in memory by their sat_id, so that the routers, the pull_position service
+    and the validation of the locations do not query the database for every lookup.
+    It follows the writes of the satellites CRUD and is reloaded periodically to see the writes of other processes.
+    A satellite that is unknown is never reported as missing: the callers confirm it in the database,
+    so a satellite created by another process is found immediately. A satellite deleted by another process
+    is still reported as existing until the next reload, so for at most max_age seconds.
+    A stale registry answers nothing, so the lookups fall back to the database until it is reloaded.
+    The background services keep using the last loaded satellites while the database can not be reached.
+    """
+
+    def __init__(self, loader: Callable[[], List[Dict]], max_age: float, timeout: Optional[float] = None):
+        """
+        Constructs a new instance.
+
+        :param      loader:   Function that returns all satellites from the database
+        :type       loader:   Callable[[], List[Dict]]
+        :param      max_age:  Seconds after which the satellites are reloaded
+        :type       max_age:  float
+        :param      timeout:  Seconds the reload of the background services waits for the database, None to wait for
+                              as long as the client does
+        :type       timeout:  Optional[float]
+        """
+        self.loader = loader
+        self.max_age = max_age
+        self.timeout = timeout
+        # The satellites by their _id, so that an update of the sat_id replaces the satellite
+        self._satellites: Dict[str, Dict] = {}
+        self._by_sat_id: Dict[Any, Dict] = {}
+        self._loaded_at: Optional[float] = None
+        # When the last reload failed, so that an unreachable database is not waited for on every lookup
+        self._failed_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def stale(self) -> bool:
+        """
+        Checks if the satellites need to be reloaded from the database.
+        """
+        return self._loaded_at is None or time.monotonic() - self._loaded_at > self.max_age
+
+    def refresh(self) -> int:
+        """
+        Reloads all satellites from the database.
+
+        :returns:   The number of satellites
+        :rtype:     int
+        """
+        satellites = self.loader()
+        with self._lock:
+            self._satellites = {
+                str(satellite["_id"]): satellite for satellite in satellites
+            }
+            self._index()
+            self._loaded_at = time.monotonic()
+        return len(satellites)
+
+    def refresh_if_stale(self) -> bool:
+        """
+        Reloads the satellites if they are stale. The background services call this before their lookups.
+        If the database can not be reached, the last loaded satellites are kept and the reload is only tried again
+        after max_age seconds. The reload waits for the database for at most the timeout, so the services keep their pace.
+
+        :returns:   True if the satellites are up to date, False if they are stale
+        :rtype:     bool
+        """
+        if not self.stale():
+            return True
+        if self._failed_at is not None and time.monotonic() - self._failed_at <= self.max_age:
+            return False
+        try:
+            with pymongo.timeout(self.timeout):
+                self.refresh()
+        except (HTTPException, PyMongoError) as e:
+            self._failed_at = time.monotonic()
+            print(f"Failed to reload the satellites, the last loaded ones are used: {e}")
+            return False
+        self._failed_at = None
+        return True
+
+    def on_write(self, operation: str, satellites: List[Dict]) -> None:
+        """
+        Applies a write of the satellites CRUD. It is registered as a listener of the CRUD.
+
+        :param      operation:   "create", "update" or "delete"
+        :type       operation:   str
+        :param      satellites:  The written satellites
+        :type       satellites:  List[Dict]
+        """
+        with self._lock:
+            for satellite in satellites:
+                if operation == "delete":
+                    self._satellites.pop(str(satellite["_id"]), None)
+                else:
+                    self._satellites[str(satellite["_id"])] = dict(satellite)
+            self._index()
+
+    def get(self, sat_id: Any) -> Optional[Dict]:
+        """
+        Finds a satellite in memory.
+
+        :param      sat_id:  The sat_id of the satellite
+        :type       sat_id:  Any
+
+        :returns:   A copy of the satellite or None if it is unknown or the registry is stale
+        :rtype:     Optional[Dict]
+        """
+        if self.stale():
+            return None
+        satellite = self._by_sat_id.get(sat_id)
+        return dict(satellite) if satellite is not None else None
+
+    def all(self, allow_stale: bool = False) -> Optional[List[Dict]]:
+        """
+        Lists all satellites in memory.
+
+        :param      allow_stale:  When True the last loaded satellites are returned even if they are stale,
+                                  e.g. while the database can not be reached
+        :type       allow_stale:  bool
+
+        :returns:   Copies of all satellites or None if the registry is stale
+        :rtype:     Optional[List[Dict]]
+        """
+        if self.stale() and not allow_stale:
+            return None
+        return [dict(satellite) for satellite in self._by_sat_id.values()]
+
+    def exists(self, sat_ids: Iterable[Any]) -> bool:
+        """
+        Checks if satellites exist without querying the database.
+        It is used by the locations CRUD to validate their sat_id.
+
+        :param      sat_ids:  The sat_id of the satellites
+        :type       sat_ids:  Iterable[Any]
+
+        :returns:   True if all satellites are known. False means they need to be checked in the database.
+        :rtype:     bool
+        """
+        if self.stale():
+            return False
+        by_sat_id = self._by_sat_id
+        return all(sat_id in by_sat_id for sat_id in sat_ids)
+
+    def _index(self) -> None:
+        """
+        Rebuilds the satellites by their sat_id. This needs to be called with the lock.
+        The index is replaced at once, so that the lookups do not need the lock.
+        """
+        self._by_sat_id = {
+            satellite.get("sat_id"): satellite for satellite in self._satellites.values()
+        }
+
+
+def load_satellites() -> List[Dict]:
+    """
+    Loads all satellites.
+    """
+    # Imported here because the database module registers the listeners of this module
+    from app.db import SatellitesCRUD
+
+    return SatellitesCRUD.find({})
+
+
+# Define application wide the satellite registry object
+satellite_registry = SatelliteRegistry(
+    load_satellites, app_config.app_registry_refresh, app_config.app_registry_timeout
+)
@@ -0,0 +1,205 @@
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from typing import Callable, Dict, List, Optional, Tuple
+import numpy as np
+from app.config import app_config
+from app.utils.model_utils import normalize_name
+
+# Upper bound of every string that starts with a prefix
+PREFIX_END = chr(0x10FFFF)
+
+
+class SatelliteSearchIndex:
+    """
+    This class keeps the names of all satellites in memory for autocomplete searches.
+    The normalized names and their words are kept in sorted arrays, so every prefix lookup is a binary search.
+    Results are ranked: exact names first, then names that start with the query and then names whose
+    words start with the words of the query (e.g. "zar" finds "ISS (ZARYA)"). Shorter names come first within a rank.
+    The satellites are numbered in that order, so the ranking is a few vectorized operations over the matches.
+    The index follows the writes of the satellites CRUD and is reloaded periodically to see the writes of other processes.
+    The writes that happen while the satellites are loaded are recorded and applied again to the loaded satellites,
+    so a reload never loses them.
+    """
+
+    def __init__(self, loader: Callable[[], List[Dict]], max_age: float):
+        """
+        Constructs a new instance.
+
+        :param      loader:   Function that returns all satellites from the database
+        :type       loader:   Callable[[], List[Dict]]
+        :param      max_age:  Seconds after which the satellites are reloaded
+        :type       max_age:  float
+        """
+        self.loader = loader
+        self.max_age = max_age
+        self._satellites: Dict[str, Dict] = {}
+        # The satellites sorted by the length of their name and by their name
+        self._ordered: List[Dict] = []
+        # The sorted names and words, with the position of their satellite in _ordered
+        self._keys: List[str] = []
+        self._key_positions = np.empty(0, dtype=np.int64)
+        self._words: List[str] = []
+        self._word_positions = np.empty(0, dtype=np.int64)
+        self._loaded_at: Optional[float] = None
+        self._dirty = False
+        # The writes recorded while at least one reload is running, None otherwise
+        self._writes: Optional[List[Tuple[str, List[Dict]]]] = None
+        self._refreshes = 0
+        self._lock = threading.Lock()
+
+    def stale(self) -> bool:
+        """
+        Checks if the satellites need to be reloaded from the database.
+        """
+        return self._loaded_at is None or time.monotonic() - self._loaded_at > self.max_age
+
+    def refresh(self) -> int:
+        """
+        Reloads all satellites from the database.
+
+        :returns:   The number of satellites
+        :rtype:     int
+        """
+        with self._lock:
+            if self._writes is None:
+                self._writes = []
+            start = len(self._writes)
+            self._refreshes += 1
+        try:
+            satellites = self.loader()
+        except BaseException:
+            with self._lock:
+                self._end_refresh()
+            raise
+        with self._lock:
+            self._satellites = {
+                str(satellite["_id"]): satellite for satellite in satellites
+            }
+            # The writes that happened during the load may not be part of it
+            for operation, written in self._writes[start:]:
+                self._apply(operation, written)
+            self._end_refresh()
+            self._build()
+            self._loaded_at = time.monotonic()
+        return len(self._satellites)
+
+    def on_write(self, operation: str, satellites: List[Dict]) -> None:
+        """
+        Applies a write of the satellites CRUD. It is registered as a listener of the CRUD.
+        The sorted arrays are rebuilt on the next search.
+
+        :param      operation:   "create", "update" or "delete"
+        :type       operation:   str
+        :param      satellites:  The written satellites
+        :type       satellites:  List[Dict]
+        """
+        with self._lock:
+            self._apply(operation, satellites)
+            if self._writes is not None:
+                self._writes.append((operation, [dict(satellite) for satellite in satellites]))
+            self._dirty = True
+
+    def _apply(self, operation: str, satellites: List[Dict]) -> None:
+        """
+        Applies a write to the satellites. This needs to be called with the lock.
+        """
+        for satellite in satellites:
+            if operation == "delete":
+                self._satellites.pop(str(satellite["_id"]), None)
+            else:
+                self._satellites[str(satellite["_id"])] = dict(satellite)
+
+    def _end_refresh(self) -> None:
+        """
+        Stops recording the writes once no reload is running anymore. This needs to be called with the lock.
+        """
+        self._refreshes -= 1
+        if self._refreshes == 0:
+            self._writes = None
+
+    def search(self, query: str, limit: int = 10) -> Tuple[List[Dict], int]:
+        """
+        Finds the satellites whose name starts with the query or whose words start with the words of the query.
+
+        :param      query:  The text typed by the user
+        :type       query:  str
+        :param      limit:  The maximum number of satellites to return
+        :type       limit:  int
+
+        :returns:   The best ranked satellites, as copies, and the number of matching satellites
+        :rtype:     Tuple[List[Dict], int]
+        """
+        key = normalize_name(query)
+        if not key:
+            return [], 0
+        with self._lock:
+            if self._dirty:
+                self._build()
+            # Rank 2 for names with a word that starts with every word of the query
+            ranks = np.full(len(self._ordered), 3, dtype=np.int64)
+            words = None
+            for word in key.split():
+                start, end = self._prefixed(self._words, word)
+                found = np.zeros(len(self._ordered), dtype=bool)
+                found[self._word_positions[start:end]] = True
+                words = found if words is None else words & found
+            ranks[words] = 2
+            # Rank 1 for names that start with the query and 0 for the exact name
+            start, end = self._prefixed(self._keys, key)
+            ranks[self._key_positions[start:end]] = 1
+            ranks[self._key_positions[start : bisect_right(self._keys, key)]] = 0
+
+            matches = np.flatnonzero(ranks < 3)
+            scores = ranks[matches] * len(self._ordered) + matches
+            if len(matches) > limit:
+                best = np.argpartition(scores, limit)[:limit]
+            else:
+                best = np.arange(len(matches))
+            best = matches[best[np.argsort(scores[best])]]
+            return [dict(self._ordered[position]) for position in best.tolist()], len(matches)
+
+    def _build(self) -> None:
+        """
+        Rebuilds the sorted arrays of names and words. This needs to be called with the lock.
+        """
+        for satellite in self._satellites.values():
+            # Satellites created before the name_key was introduced are normalized here
+            if "name_key" not in satellite:
+                satellite["name_key"] = normalize_name(satellite.get("name", ""))
+        self._ordered = sorted(
+            self._satellites.values(),
+            key=lambda satellite: (len(satellite["name_key"]), satellite["name_key"]),
+        )
+        keys, words = [], []
+        for position, satellite in enumerate(self._ordered):
+            keys.append((satellite["name_key"], position))
+            words.extend((word, position) for word in set(satellite["name_key"].split()))
+        keys.sort()
+        words.sort()
+        self._keys = [key for key, _ in keys]
+        self._key_positions = np.array([position for _, position in keys], dtype=np.int64)
+        self._words = [word for word, _ in words]
+        self._word_positions = np.array([position for _, position in words], dtype=np.int64)
+        self._dirty = False
+
+    @staticmethod
+    def _prefixed(entries: List[str], prefix: str) -> Tuple[int, int]:
+        """
+        Finds the range of the entries of a sorted array that start with a prefix.
+        """
+        return bisect_left(entries, prefix), bisect_left(entries, prefix + PREFIX_END)
+
+
+def load_satellites() -> List[Dict]:
+    """
+    Loads the fields of all satellites that are returned by the search.
+    """
+    # Imported here because the database module registers the listeners of this module
+    from app.db import SatellitesCRUD
+
+    return SatellitesCRUD.find({}, {"sat_id": 1, "name": 1, "units": 1, "name_key": 1})
+
+
+# Define application wide the satellite search object
+satellite_search = SatelliteSearchIndex(load_satellites, app_config.app_search_refresh)
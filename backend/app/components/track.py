@@ -0,0 +1,275 @@
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Any, Dict, Hashable, List, Optional, Sequence, Tuple
+import numpy as np
+from app.config import app_config
+from app.utils.model_utils import to_utc_datetime
+
+
+class TrackComponent:
+    """
+    This class simplifies the ground track of a satellite into the polylines drawn on the map.
+    The longitudes are unwrapped (e.g. 179 -> 181 instead of 179 -> -179) before simplifying, so that the algorithms
+    see a continuous line. The simplified line is then split where it crosses the antimeridian, with an interpolated
+    point on both sides, so that no segment is drawn across the whole map.
+    The line is also split where locations are missing (e.g. the pull_position service was stopped),
+    since the path of the satellite in between is unknown.
+    """
+
+    def __init__(self, max_gap: float):
+        """
+        Constructs a new instance.
+
+        :param      max_gap:  Number of sampling periods without locations after which the line is split
+        :type       max_gap:  float
+        """
+        self.max_gap = max_gap
+
+    @staticmethod
+    def to_columns(locations: Sequence[Dict]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Transforms a list of locations to columns. Older locations hold epoch seconds instead of datetimes.
+
+        :returns:   The epoch timestamps, the latitudes and the longitudes of the locations
+        :rtype:     Tuple[np.ndarray, np.ndarray, np.ndarray]
+        """
+        count = len(locations)
+        timestamps = np.fromiter(
+            (to_utc_datetime(location["timestamp"]).timestamp() for location in locations),
+            dtype=np.float64,
+            count=count,
+        )
+        latitudes = np.fromiter(
+            (location["latitude"] for location in locations), dtype=np.float64, count=count
+        )
+        longitudes = np.fromiter(
+            (location["longitude"] for location in locations), dtype=np.float64, count=count
+        )
+        return timestamps, latitudes, longitudes
+
+    @staticmethod
+    def lttb(x: np.ndarray, y: np.ndarray, n: int) -> np.ndarray:
+        """
+        Largest-Triangle-Three-Buckets downsampling of a line to n points. The first and the last points are kept
+        and every bucket in between keeps the point that forms the largest triangle with the point kept in the previous
+        bucket and the average of the next bucket. The areas of a bucket are calculated at once.
+
+        :returns:   The sorted indexes of the kept points
+        :rtype:     np.ndarray
+        """
+        size = len(x)
+        if n >= size:
+            return np.arange(size)
+        if n <= 2:
+            return np.array([0, size - 1][:n], dtype=np.int64)
+        # n - 2 buckets between the first and the last point, followed by the last point as its own bucket
+        edges = np.append(np.linspace(1, size - 1, n - 1).astype(np.int64), size)
+        selected = np.empty(n, dtype=np.int64)
+        selected[0], selected[-1] = 0, size - 1
+        a = 0
+        for i in range(n - 2):
+            start, end, next_end = edges[i], edges[i + 1], edges[i + 2]
+            cx, cy = x[end:next_end].mean(), y[end:next_end].mean()
+            areas = np.abs(
+                (x[a] - cx) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (cy - y[a])
+            )
+            a = start + int(np.argmax(areas))
+            selected[i + 1] = a
+        return selected
+
+    @staticmethod
+    def douglas_peucker(x: np.ndarray, y: np.ndarray, tolerance: float) -> np.ndarray:
+        """
+        Douglas-Peucker simplification of a line. A point is kept if it is further than the tolerance from the line
+        between the points kept around it. The distances of a span are calculated at once and the spans are processed
+        with a stack instead of recursion.
+
+        :returns:   The sorted indexes of the kept points
+        :rtype:     np.ndarray
+        """
+        size = len(x)
+        if size <= 2:
+            return np.arange(size)
+        keep = np.zeros(size, dtype=bool)
+        keep[0] = keep[-1] = True
+        spans = [(0, size - 1)]
+        while spans:
+            start, end = spans.pop()
+            if end - start < 2:
+                continue
+            dx, dy = x[end] - x[start], y[end] - y[start]
+            px, py = x[start + 1 : end] - x[start], y[start + 1 : end] - y[start]
+            norm = np.hypot(dx, dy)
+            if norm == 0:
+                distances = np.hypot(px, py)
+            else:
+                distances = np.abs(dx * py - dy * px) / norm
+            farthest = int(np.argmax(distances))
+            if distances[farthest] > tolerance:
+                middle = start + 1 + farthest
+                keep[middle] = True
+                spans.append((start, middle))
+                spans.append((middle, end))
+        return np.flatnonzero(keep)
+
+    def runs(self, timestamps: np.ndarray, resolution: float) -> List[Tuple[int, int]]:
+        """
+        Splits the locations where more than max_gap sampling periods are missing.
+
+        :returns:   The start and end (exclusive) of every run of locations
+        :rtype:     List[Tuple[int, int]]
+        """
+        if len(timestamps) == 0:
+            return []
+        gaps = np.flatnonzero(np.diff(timestamps) > self.max_gap * resolution) + 1
+        bounds = np.concatenate(([0], gaps, [len(timestamps)]))
+        return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+    @staticmethod
+    def split_antimeridian(
+        timestamps: np.ndarray, latitudes: np.ndarray, longitudes: np.ndarray
+    ) -> List[List[Dict]]:
+        """
+        Splits a line with unwrapped longitudes where it crosses the antimeridian.
+        The crossing is interpolated and added at the end of a segment and at the start of the next one.
+
+        :returns:   The segments of the line with longitudes in [-180, 180]
+        :rtype:     List[List[Dict]]
+        """
+        # The number of turns of every point. A crossing is a change of turn between two points
+        turns = np.floor((longitudes + 180) / 360)
+        wrapped = longitudes - turns * 360
+        segments, segment, start = [], [], 0
+        for i in np.flatnonzero(np.diff(turns) != 0).tolist():
+            # Moving east, the line leaves at 180 and enters at -180. Moving west the opposite
+            east = turns[i + 1] > turns[i]
+            boundary = max(turns[i], turns[i + 1]) * 360 - 180
+            fraction = (boundary - longitudes[i]) / (longitudes[i + 1] - longitudes[i])
+            latitude = latitudes[i] + fraction * (latitudes[i + 1] - latitudes[i])
+            timestamp = timestamps[i] + fraction * (timestamps[i + 1] - timestamps[i])
+            segment += TrackComponent.points(
+                timestamps[start : i + 1], latitudes[start : i + 1], wrapped[start : i + 1]
+            )
+            segment.append(TrackComponent.point(timestamp, latitude, 180.0 if east else -180.0))
+            segments.append(segment)
+            # The next segment starts on the other side of the map
+            segment = [TrackComponent.point(timestamp, latitude, -180.0 if east else 180.0)]
+            start = i + 1
+        segment += TrackComponent.points(timestamps[start:], latitudes[start:], wrapped[start:])
+        segments.append(segment)
+        return segments
+
+    @staticmethod
+    def point(timestamp: float, latitude: float, longitude: float) -> Dict:
+        """
+        Builds a point of the polyline.
+        """
+        return {
+            "latitude": float(latitude),
+            "longitude": float(longitude),
+            "timestamp": datetime.fromtimestamp(float(timestamp), tz=timezone.utc),
+        }
+
+    @staticmethod
+    def points(
+        timestamps: np.ndarray, latitudes: np.ndarray, longitudes: np.ndarray
+    ) -> List[Dict]:
+        """
+        Builds the points of the polyline from columns.
+        """
+        return [
+            TrackComponent.point(timestamp, latitude, longitude)
+            for timestamp, latitude, longitude in zip(
+                timestamps.tolist(), latitudes.tolist(), longitudes.tolist()
+            )
+        ]
+
+    def simplify(
+        self,
+        locations: Sequence[Dict],
+        resolution: float,
+        points: Optional[int] = None,
+        tolerance: Optional[float] = None,
+    ) -> List[List[Dict]]:
+        """
+        Simplifies the ground track of a satellite. Every run of locations without gaps is simplified on its own,
+        with LTTB to a number of points (shared by the runs by their size) or with Douglas-Peucker to a tolerance.
+
+        :param      locations:   The locations sorted by timestamp, with at least their latitude, longitude and timestamp
+        :type       locations:   Sequence[Dict]
+        :param      resolution:  Seconds between two locations
+        :type       resolution:  float
+        :param      points:      The number of points to keep
+        :type       points:      Optional[int]
+        :param      tolerance:   The maximum distance in degrees between the track and the simplified line
+        :type       tolerance:   Optional[float]
+
+        :returns:   The segments of the polyline
+        :rtype:     List[List[Dict]]
+        """
+        if (points is None) == (tolerance is None):
+            raise ValueError("Either points or tolerance must be provided")
+        timestamps, latitudes, longitudes = self.to_columns(locations)
+        segments = []
+        for start, end in self.runs(timestamps, resolution):
+            latitude = latitudes[start:end]
+            longitude = np.unwrap(longitudes[start:end], period=360)
+            if tolerance is not None:
+                kept = self.douglas_peucker(longitude, latitude, tolerance)
+            else:
+                budget = max(2, round(points * (end - start) / len(timestamps)))
+                kept = self.lttb(longitude, latitude, budget)
+            segments.extend(
+                self.split_antimeridian(
+                    timestamps[start:end][kept], latitude[kept], longitude[kept]
+                )
+            )
+        return segments
+
+
+class TrackCache:
+    """
+    This class keeps the latest simplified tracks in memory, so that every client that shows the same
+    track does not query and simplify the same locations again.
+    The tracks expire after a few seconds, since a range that ends now changes with every poll.
+    """
+
+    def __init__(self, size: int, ttl: float):
+        """
+        Constructs a new instance.
+
+        :param      size:  The number of tracks that are kept
+        :type       size:  int
+        :param      ttl:   Seconds a track is kept for
+        :type       ttl:   float
+        """
+        self.size = size
+        self.ttl = ttl
+        self._tracks: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """
+        Gets a track.
+
+        :returns:   The track or None if it is not cached or it expired
+        """
+        cached = self._tracks.get(key)
+        if cached is None or cached[0] < time.monotonic():
+            self._tracks.pop(key, None)
+            return None
+        self._tracks.move_to_end(key)
+        return cached[1]
+
+    def put(self, key: Hashable, track: Any) -> None:
+        """
+        Caches a track. The least recently used track is removed when the cache is full.
+        """
+        self._tracks[key] = (time.monotonic() + self.ttl, track)
+        self._tracks.move_to_end(key)
+        while len(self._tracks) > self.size:
+            self._tracks.popitem(last=False)
+
+
+# Define application wide the track cache object
+track_cache = TrackCache(app_config.app_track_cache_size, app_config.app_track_cache_ttl)
@@ -0,0 +1,243 @@
+import fcntl
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import timezone
+from typing import Callable, Dict, Iterator, List, Optional, TextIO
+import pymongo
+from bson import ObjectId, json_util
+from fastapi import HTTPException, status
+from pymongo.errors import PyMongoError
+from app.db.crud import CRUD
+
+# The log holds extended JSON, so the dates and the ObjectIds are read back with their types
+WAL_JSON_OPTIONS = json_util.JSONOptions(
+    json_mode=json_util.JSONMode.RELAXED, tz_aware=True, tzinfo=timezone.utc
+)
+
+
+class WriteBuffer:
+    """
+    This class buffers the documents written by a service and inserts them in batches with a single insert_many,
+    when the oldest document is old enough or when there are enough documents.
+    When the database can not be reached, the documents are appended to a write-ahead log on the local disk instead
+    of being lost. The log is replayed in order, before any newer document, once the database is back.
+
+    Every document gets its "_id" when it is buffered, so a document that was inserted before a failure
+    is skipped when the log is replayed instead of being inserted twice.
+    The log is local to the host and its path is shared by the workers of the host, so it is only read or written
+    while holding a lock on the file next to it ({path}.lock). A worker that does not run the service must not
+    replay the log while another one appends to it, so its flush can be told to leave the log alone.
+
+    Every write waits for the database for at most the timeout, instead of the server selection timeout of the client,
+    so that a service that adds documents keeps its pace while the database can not be reached.
+    """
+
+    def __init__(
+        self,
+        crud: CRUD,
+        path: str,
+        max_size: int,
+        max_age: float,
+        timeout: Optional[float] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        """
+        Constructs a new instance.
+
+        :param      crud:      The CRUD that inserts the documents
+        :type       crud:      CRUD
+        :param      path:      The path of the write-ahead log
+        :type       path:      str
+        :param      max_size:  The number of documents that are inserted at once
+        :type       max_size:  int
+        :param      max_age:   Seconds a document is buffered before it is inserted
+        :type       max_age:   float
+        :param      timeout:   Seconds a write waits for the database, None to wait for as long as the client does
+        :type       timeout:   Optional[float]
+        :param      clock:     Function that returns the seconds of a monotonic clock, used by the tests
+        :type       clock:     Callable[[], float]
+        """
+        self.crud = crud
+        self.path = path
+        self.max_size = max_size
+        self.max_age = max_age
+        self.timeout = timeout
+        self.clock = clock
+        self._documents: List[Dict] = []
+        # When the oldest document that is not stored yet was buffered, either in memory or in the log
+        self._oldest: Optional[float] = clock() if self.logged() else None
+        # The scheduler thread adds while the shutdown flushes
+        self._lock = threading.RLock()
+        # The lock file while this process holds it
+        self._lock_file: Optional[TextIO] = None
+
+    def logged(self) -> bool:
+        """
+        Checks if there are documents in the write-ahead log.
+        """
+        return os.path.exists(self.path) and os.path.getsize(self.path) > 0
+
+    def due(self) -> bool:
+        """
+        Checks if the buffered documents need to be inserted.
+        """
+        return len(self._documents) >= self.max_size or (
+            self._oldest is not None and self.clock() - self._oldest >= self.max_age
+        )
+
+    def add(self, documents: List[Dict]) -> List[Dict]:
+        """
+        Buffers new documents and inserts the buffer if it is due.
+        While the log holds documents, the new ones are appended to it to keep their order.
+
+        :param      documents:  The documents to insert. They get their "_id" here
+        :type       documents:  List[Dict]
+
+        :returns:   The documents that were stored, in order, including the replayed ones
+        :rtype:     List[Dict]
+        """
+        with self._locked():
+            for document in documents:
+                document.setdefault("_id", ObjectId())
+            if documents and self._oldest is None:
+                self._oldest = self.clock()
+            self._documents.extend(documents)
+            if self.logged():
+                self._spill()
+            return self.flush() if self.due() else []
+
+    def flush(self, replay: bool = True) -> List[Dict]:
+        """
+        Replays the write-ahead log and inserts the buffered documents.
+        If the database can not be reached, the documents that are not stored are kept in the log
+        and the next try is max_age seconds later.
+
+        :param      replay:  When False and the log holds documents, the buffered documents are appended to it
+                             after them instead of being inserted, so the log is left to the process that runs the service
+        :type       replay:  bool
+
+        :returns:   The documents that were stored, in order, including the replayed ones
+        :rtype:     List[Dict]
+        """
+        stored: List[Dict] = []
+        with self._locked():
+            if not replay and self.logged():
+                self._spill()
+                return stored
+            try:
+                self._replay(stored)
+                if self._documents:
+                    stored.extend(self._insert(self._documents))
+                    self._documents = []
+                self._oldest = None
+            except (HTTPException, PyMongoError) as e:
+                print(f"Failed to store the documents of {self.crud.collection.name}, they are logged in {self.path}: {e}")
+                self._spill()
+                # The database is tried again once max_age passes, so that every add does not wait for it
+                self._oldest = self.clock()
+        return stored
+
+    @contextmanager
+    def _locked(self) -> Iterator[None]:
+        """
+        Holds the lock of the thread and the lock of the write-ahead log file, which is shared with the other processes
+        of the host. The file lock is taken once per thread, since a second flock of the same process would wait for itself.
+        """
+        with self._lock:
+            if self._lock_file is not None:
+                yield
+                return
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(f"{self.path}.lock", "a", encoding="utf-8") as file:
+                # Released when the file is closed
+                fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+                self._lock_file = file
+                try:
+                    yield
+                finally:
+                    self._lock_file = None
+
+    def _insert(self, documents: List[Dict]) -> List[Dict]:
+        """
+        Inserts documents with a single write. If any of them is invalid (e.g. its satellite was deleted)
+        they are inserted one by one and the invalid ones are dropped, since they will never be stored.
+        A database error is raised to the caller.
+        """
+        try:
+            with pymongo.timeout(self.timeout):
+                return self.crud.create_many(documents)
+        except HTTPException as e:
+            if e.status_code != status.HTTP_400_BAD_REQUEST:
+                raise
+        stored = []
+        for document in documents:
+            try:
+                with pymongo.timeout(self.timeout):
+                    stored.append(self.crud.create(document))
+            except HTTPException as e:
+                if e.status_code != status.HTTP_400_BAD_REQUEST:
+                    raise
+                print(f"Dropped an invalid document of {self.crud.collection.name}: {e.detail}")
+        return stored
+
+    def _replay(self, stored: List[Dict]) -> None:
+        """
+        Inserts the documents of the write-ahead log in order, max_size at a time, and removes the log.
+        If an insert fails, the log is rewritten with the documents that were not stored yet.
+        """
+        if not self.logged():
+            return
+        documents = self._read()
+        for start in range(0, len(documents), self.max_size):
+            batch = documents[start : start + self.max_size]
+            try:
+                # The documents that were inserted before the failure are skipped
+                ids = [document["_id"] for document in batch]
+                with pymongo.timeout(self.timeout):
+                    existing = {document["_id"] for document in self.crud.find({"_id": {"$in": ids}}, {"_id": 1})}
+                batch = [document for document in batch if document["_id"] not in existing]
+                if batch:
+                    stored.extend(self._insert(batch))
+            except (HTTPException, PyMongoError):
+                self._write(documents[start:], "w")
+                raise
+        os.remove(self.path)
+
+    def _spill(self) -> None:
+        """
+        Appends the buffered documents to the write-ahead log.
+        """
+        if self._documents:
+            self._write(self._documents, "a")
+            self._documents = []
+
+    def _read(self) -> List[Dict]:
+        """
+        Reads the documents of the write-ahead log. A line that was only partly written
+        (e.g. the process was killed while appending) is skipped.
+        """
+        documents = []
+        with open(self.path, encoding="utf-8") as file:
+            for line in file:
+                try:
+                    documents.append(json_util.loads(line, json_options=WAL_JSON_OPTIONS))
+                except ValueError:
+                    print(f"Skipped a partly written line of {self.path}")
+        return documents
+
+    def _write(self, documents: List[Dict], mode: str) -> None:
+        """
+        Writes documents to the write-ahead log, one per line, and waits until they are on the disk.
+        The log is rewritten through a temporary file, so it is never left half rewritten.
+        """
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        path = self.path if mode == "a" else f"{self.path}.tmp"
+        with open(path, mode, encoding="utf-8") as file:
+            for document in documents:
+                file.write(json_util.dumps(document, json_options=WAL_JSON_OPTIONS) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+        if path != self.path:
+            os.replace(path, self.path)
@@ -1,6 +1,7 @@
 from pydantic_settings import BaseSettings
 import os
 import yaml
+from typing import List, Optional
 
 # Define and load the yaml application configuration file.
 yaml_app_config = dict()
@@ -36,6 +37,71 @@ class AppConfig:
     app_apis: dict = app_config["apis"]
     app_apis_sat_loc: dict = app_apis["sat_loc"]
     app_apis_sat_loc_url: str = app_apis_sat_loc["url"]
+    app_apis_sat_loc_timeout: float = app_apis_sat_loc["timeout"]
+    app_apis_sat_loc_max_connections: int = app_apis_sat_loc["max_connections"]
+    app_apis_sat_loc_max_in_flight: int = app_apis_sat_loc["max_in_flight"]
+    app_apis_sat_loc_rate: float = app_apis_sat_loc["rate"]
+    app_apis_sat_loc_burst: float = app_apis_sat_loc["burst"]
+    app_apis_sat_loc_backoff_base: float = app_apis_sat_loc["backoff_base"]
+    app_apis_sat_loc_backoff_max: float = app_apis_sat_loc["backoff_max"]
+    app_apis_sat_loc_max_retries: int = app_apis_sat_loc["max_retries"]
+    app_apis_sat_tle: dict = app_apis["sat_tle"]
+    app_apis_sat_tle_url: str = app_apis_sat_tle["url"]
+    app_apis_sat_tle_timeout: float = app_apis_sat_tle["timeout"]
+    app_cache: dict = app_config["cache"]
+    app_cache_locations_size: int = app_cache["locations_size"]
+    app_stream: dict = app_config["stream"]
+    app_stream_queue_size: int = app_stream["queue_size"]
+    app_stream_keepalive: float = app_stream["keepalive"]
+    app_events: dict = app_config["events"]
+    app_events_enabled: bool = app_events["enabled"]
+    app_events_size: int = app_events["size"]
+    app_events_queue_size: int = app_events["queue_size"]
+    app_events_timeout: float = app_events["timeout"]
+    app_count: dict = app_config["count"]
+    app_count_cache_ttl: float = app_count["cache_ttl"]
+    app_search: dict = app_config["search"]
+    app_search_refresh: float = app_search["refresh"]
+    app_registry: dict = app_config["registry"]
+    app_registry_refresh: float = app_registry["refresh"]
+    app_registry_timeout: float = app_registry["timeout"]
+    app_responses: dict = app_config["responses"]
+    app_responses_fast: bool = app_responses["fast"]
+    app_track: dict = app_config["track"]
+    app_track_default_points: int = app_track["default_points"]
+    app_track_default_range: float = app_track["default_range"]
+    app_track_max_gap: float = app_track["max_gap"]
+    app_track_cache_size: int = app_track["cache_size"]
+    app_track_cache_ttl: float = app_track["cache_ttl"]
+    app_orbit: dict = app_config["orbit"]
+    app_orbit_step: float = app_orbit["step"]
+    app_orbit_daylight_step: float = app_orbit["daylight_step"]
+    app_orbit_max_points: int = app_orbit["max_points"]
+    app_orbit_max_orbits: float = app_orbit["max_orbits"]
+    app_export: dict = app_config["export"]
+    app_export_batch_size: int = app_export["batch_size"]
+    app_bulk: dict = app_config["bulk"]
+    app_bulk_batch_size: int = app_bulk["batch_size"]
+    app_storage: dict = app_config["storage"]
+    app_storage_locations_mode: str = app_storage["locations"]["mode"]
+    app_storage_locations_granularity: str = app_storage["locations"]["granularity"]
+    app_storage_buffer: dict = app_storage["buffer"]
+    app_storage_buffer_max_size: int = app_storage_buffer["max_size"]
+    app_storage_buffer_max_age: float = app_storage_buffer["max_age"]
+    app_storage_buffer_wal: str = app_storage_buffer["wal"]
+    app_storage_buffer_timeout: float = app_storage_buffer["timeout"]
+    app_retention: dict = app_config["retention"]
+    app_retention_raw_days: Optional[float] = app_retention["raw_days"]
+    app_retention_rollups: List[dict] = app_retention["rollups"]
+    app_retention_min_points: int = app_retention["min_points"]
+    app_leader: dict = app_config["leader"]
+    app_leader_enabled: bool = app_leader["enabled"]
+    app_leader_ttl: float = app_leader["ttl"]
+    app_leader_heartbeat: float = app_leader["heartbeat"]
+    app_leader_timeout: float = app_leader["timeout"]
+    app_metrics: dict = app_config["metrics"]
+    app_metrics_enabled: bool = app_metrics["enabled"]
+    app_scheduler: dict = app_config["scheduler"]
     app_services: dict = app_config["services"]
 
 
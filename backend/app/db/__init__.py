@@ -1,22 +1,332 @@
-from app.db.database import MongoDB
-from app.config import secrets
+from typing import Dict, List, Tuple
+from bson.codec_options import CodecOptions
+from pymongo import IndexModel, ASCENDING
+from app.db.database import MongoDB, AsyncMongoDB
+from app.config import secrets, app_config
 from app.db.crud import CRUD
+from app.db.async_crud import AsyncCRUD
+from app.utils.model_utils import add_name_key, normalize_timestamp
+from app.components.satellite_search import satellite_search
+from app.components.satellite_registry import satellite_registry
+from app.components.metrics import mongodb_listeners
+from app.components.retention import retention_policy
+from app.components.orbit import add_tle_epoch
 
 # Initialization and connection to the database using the MongoDB Class
-mongodb = MongoDB(secrets.DATABASE_URL, secrets.MONGO_INITDB_DATABASE)
+# The commands and the connection pools of the clients are recorded for /api/metrics
+mongodb = MongoDB(
+    secrets.DATABASE_URL, secrets.MONGO_INITDB_DATABASE, event_listeners=mongodb_listeners("sync")
+)
 mongodb.connect()
+# The locations can be stored in a native time-series collection. Look at app_config.yaml for how it is configured
+LOCATIONS_TIMESERIES = app_config.app_storage_locations_mode == "timeseries"
+LOCATIONS_TIMESERIES_OPTIONS = {
+    "timeField": "timestamp",
+    "metaField": "sat_id",
+    "granularity": app_config.app_storage_locations_granularity,
+}
+# Locations are almost always filtered by satellite and sorted by time.
+# The _id breaks ties between equal timestamps when paginating with a cursor.
+LOCATIONS_INDEXES = [
+    IndexModel([("sat_id", ASCENDING), ("timestamp", ASCENDING), ("_id", ASCENDING)]),
+    IndexModel([("timestamp", ASCENDING), ("_id", ASCENDING)]),
+]
+# Time-series collections are indexed on their buckets, which are already grouped by sat_id and time.
+# The server creates the (sat_id, timestamp) index itself, so it is declared to be kept.
+LOCATIONS_TIMESERIES_INDEXES = [
+    IndexModel([("sat_id", ASCENDING), ("timestamp", ASCENDING)]),
+    IndexModel([("timestamp", ASCENDING)]),
+]
 # Creation of the required collections
 SatellitesDB = mongodb.get_collection("satellites")
-# Mark sat_id as unique in the Satellites collection
-SatellitesDB.create_index("sat_id", unique=True)
 LocationsDB = mongodb.get_collection("locations")
+# The number of satellites and locations is maintained here on every create and delete
+CountersDB = mongodb.get_collection("counters")
+# The names of the indexes declared by the CRUD classes, one document per collection. Only these are ever dropped.
+IndexesDB = mongodb.get_collection("indexes")
+# Every scheduled service runs on the process that holds its lease, one document per service
+LeasesDB = mongodb.get_collection("leases")
+# The new locations and the invalidations of the location cache are shared between the processes through a capped collection.
+# The locations are read back as timezone aware UTC datetimes, the same way they were pulled.
+EventsDB = mongodb.get_collection("events").with_options(codec_options=CodecOptions(tz_aware=True))
+# The daylight windows are materialized by the pull_position service as new locations arrive.
+# Windows are returned as timezone aware UTC datetimes, the same way they were calculated from the locations.
+DaylightWindowsDB = mongodb.get_collection("daylight_windows").with_options(
+    codec_options=CodecOptions(tz_aware=True)
+)
+# A satellite has a marker once its daylight windows were rebuilt from its location history, one document per sat_id.
+# The marker is removed when its locations are written through the API, so the windows are rebuilt again.
+DaylightRebuildsDB = mongodb.get_collection("daylight_rebuilds")
 
-# Prepare the CRUD classes for each collection with the required relationships
+# Prepare the CRUD classes for each collection with the required relationships and indexes
 # When a Satellite is changed then this cascades to the LocationsDB because of sat_id
 SatellitesCRUD = CRUD(
-    SatellitesDB, cascaded_collection=LocationsDB, cascaded_field="sat_id"
+    SatellitesDB,
+    cascaded_collection=LocationsDB,
+    cascaded_field="sat_id",
+    counters=CountersDB,
+    count_cache_ttl=app_config.app_count_cache_ttl,
+    # Every write of a name also writes its normalized search key
+    preprocess=add_name_key,
+    index_registry=IndexesDB,
+    indexes=[
+        # Mark sat_id as unique in the Satellites collection
+        IndexModel([("sat_id", ASCENDING)], unique=True),
+        # Prefix searches are anchored on the normalized name and paginated by (name_key, _id)
+        IndexModel([("name_key", ASCENDING), ("_id", ASCENDING)]),
+    ],
 )
 # When a Locations is created or updated then sat_id needs to exist in the SatellitesDB
 LocationsCRUD = CRUD(
-    LocationsDB, related_collection=SatellitesDB, reference_field="sat_id"
+    LocationsDB,
+    related_collection=SatellitesDB,
+    reference_field="sat_id",
+    # Known satellites are validated from memory
+    known_references=satellite_registry.exists,
+    # Every write of a timestamp stores it as a BSON date
+    preprocess=normalize_timestamp,
+    indexes=LOCATIONS_TIMESERIES_INDEXES if LOCATIONS_TIMESERIES else LOCATIONS_INDEXES,
+    index_registry=IndexesDB,
+    timeseries=LOCATIONS_TIMESERIES,
+    counters=CountersDB,
+    count_cache_ttl=app_config.app_count_cache_ttl,
+)
+# The rollups of the locations are only written by the rollups service, one collection per tier.
+# A rollup is unique per satellite and bucket, so that rolling up a bucket again replaces it.
+ROLLUP_INDEXES = [
+    IndexModel([("sat_id", ASCENDING), ("bucket", ASCENDING)], unique=True),
+    IndexModel([("sat_id", ASCENDING), ("timestamp", ASCENDING)]),
+]
+RollupsCRUD = {
+    tier.resolution: CRUD(
+        mongodb.get_collection(tier.name),
+        index_registry=IndexesDB,
+        indexes=ROLLUP_INDEXES
+        + [
+            # The rollups expire through a TTL index, which also finds the latest rollup of the tier
+            IndexModel([("timestamp", ASCENDING)], expireAfterSeconds=tier.ttl)
+            if tier.ttl is not None
+            else IndexModel([("timestamp", ASCENDING)])
+        ],
+    )
+    for tier in retention_policy.rollups
+}
+# The TLEs are used to predict the locations of the satellites. A satellite has a single TLE, the latest one.
+TLEsCRUD = CRUD(
+    mongodb.get_collection("tles"),
+    related_collection=SatellitesDB,
+    reference_field="sat_id",
+    known_references=satellite_registry.exists,
+    # Every write of a TLE also writes its epoch
+    preprocess=add_tle_epoch,
+    indexes=[IndexModel([("sat_id", ASCENDING)], unique=True)],
+    index_registry=IndexesDB,
+)
+# Daylight Windows are only written by the pull_position service
+DaylightWindowsCRUD = CRUD(
+    DaylightWindowsDB,
+    index_registry=IndexesDB,
+    indexes=[
+        # Windows never overlap, so sorting by "end" is the same as sorting by "start".
+        # Having "start" in the index allows filtering a time range without fetching the documents.
+        IndexModel([("sat_id", ASCENDING), ("end", ASCENDING), ("start", ASCENDING)]),
+    ],
+)
+
+# The routers use the asynchronous versions of the CRUD classes, with the same relationships.
+# The background services keep using the synchronous ones since they run in the scheduler's threads.
+async_mongodb = AsyncMongoDB(
+    secrets.DATABASE_URL, secrets.MONGO_INITDB_DATABASE, event_listeners=mongodb_listeners("async")
+)
+async_mongodb.connect()
+AsyncSatellitesCRUD = AsyncCRUD(
+    async_mongodb.get_collection("satellites"),
+    cascaded_collection=async_mongodb.get_collection("locations"),
+    cascaded_field="sat_id",
+    counters=async_mongodb.get_collection("counters"),
+    count_cache_ttl=app_config.app_count_cache_ttl,
+    preprocess=add_name_key,
+)
+AsyncLocationsCRUD = AsyncCRUD(
+    async_mongodb.get_collection("locations"),
+    related_collection=async_mongodb.get_collection("satellites"),
+    reference_field="sat_id",
+    known_references=satellite_registry.exists,
+    preprocess=normalize_timestamp,
+    timeseries=LOCATIONS_TIMESERIES,
+    counters=async_mongodb.get_collection("counters"),
+    count_cache_ttl=app_config.app_count_cache_ttl,
+)
+AsyncDaylightWindowsCRUD = AsyncCRUD(
+    async_mongodb.get_collection(
+        "daylight_windows", codec_options=CodecOptions(tz_aware=True)
+    )
 )
+AsyncTLEsCRUD = AsyncCRUD(
+    async_mongodb.get_collection("tles"),
+    related_collection=async_mongodb.get_collection("satellites"),
+    reference_field="sat_id",
+    known_references=satellite_registry.exists,
+    preprocess=add_tle_epoch,
+)
+AsyncRollupsCRUD = {
+    tier.resolution: AsyncCRUD(async_mongodb.get_collection(tier.name))
+    for tier in retention_policy.rollups
+}
+AsyncDaylightRebuildsDB = async_mongodb.get_collection("daylight_rebuilds")
+
+
+async def invalidate_daylight_windows(operation: str, documents: List[Dict]) -> None:
+    """
+    Removes the rebuild markers of the satellites whose locations were written through the API, so that the
+    pull_position service rebuilds their daylight windows from the location history with its next location.
+    Its incremental updates only see the locations it pulls. It is registered as a listener of the asynchronous CRUDs.
+
+    :param      operation:  "create", "update" or "delete"
+    :type       operation:  str
+    :param      documents:  The written locations, or satellites whose locations were changed with them
+    :type       documents:  List[Dict]
+    """
+    sat_ids = list({document["sat_id"] for document in documents if "sat_id" in document})
+    if sat_ids:
+        await AsyncDaylightRebuildsDB.delete_many({"_id": {"$in": sat_ids}})
+
+# The in-memory satellite search and registry follow every write of the satellites
+SatellitesCRUD.add_listener(satellite_search.on_write)
+AsyncSatellitesCRUD.add_listener(satellite_search.on_write)
+SatellitesCRUD.add_listener(satellite_registry.on_write)
+AsyncSatellitesCRUD.add_listener(satellite_registry.on_write)
+# The daylight windows follow the locations written through the API, including the ones changed with their satellite
+AsyncLocationsCRUD.add_listener(invalidate_daylight_windows)
+AsyncSatellitesCRUD.add_listener(invalidate_daylight_windows)
+
+
+def ensure_collections() -> List[str]:
+    """
+    Creates the collections that need specific options before the first document is inserted (the capped events
+    and the time-series locations) and sets the expiration of the raw locations of a time-series collection.
+    This is called when the application starts, before the indexes are reconciled.
+
+    :returns:   The names of the created collections
+    :rtype:     List[str]
+    """
+    created = []
+    # The events are followed with a tailable cursor, which needs a capped collection
+    if app_config.app_events_enabled and mongodb.ensure_collection(
+        EventsDB.name, capped=True, size=app_config.app_events_size
+    ):
+        created.append(EventsDB.name)
+    if LOCATIONS_TIMESERIES:
+        if mongodb.ensure_collection(LocationsDB.name, timeseries=LOCATIONS_TIMESERIES_OPTIONS):
+            created.append(LocationsDB.name)
+        # The expiration of a time-series collection can be changed after it was created.
+        # It is turned off or updated here, but only turned on by the rollups service (look at enable_raw_expiry)
+        if retention_policy.raw.ttl is None:
+            mongodb.database.command("collMod", LocationsDB.name, expireAfterSeconds="off")
+        elif raw_expiry_enabled():
+            enable_raw_expiry()
+    return created
+
+
+def locations_expiry_index() -> IndexModel:
+    """
+    Builds the TTL index through which the raw locations expire. Time-series collections expire through
+    a collection option instead. It is only created by the rollups service, once the rollups hold every raw location
+    that would expire (look at enable_raw_expiry).
+    """
+    return IndexModel([("timestamp", ASCENDING)], expireAfterSeconds=retention_policy.raw.ttl)
+
+
+def raw_expiry_enabled() -> bool:
+    """
+    Checks if the raw locations expire, through their TTL index or through the option of their time-series collection.
+
+    :returns:   True if the raw locations expire
+    :rtype:     bool
+    """
+    if LOCATIONS_TIMESERIES:
+        return LocationsDB.options().get("expireAfterSeconds") is not None
+    return any(
+        "expireAfterSeconds" in index for index in LocationsDB.index_information().values()
+    )
+
+
+def enable_raw_expiry() -> bool:
+    """
+    Makes the raw locations expire after the days of the retention policy.
+    A raw location that expires before it is rolled up is lost from every tier, so this is only called by the
+    rollups service once the rollups hold every raw location that would expire. On the first deployment the whole
+    history is rolled up first. After that the expiration is kept by ensure_indexes and ensure_collections.
+
+    :returns:   True if the raw locations expire, False if the retention policy keeps them forever
+    :rtype:     bool
+    """
+    if retention_policy.raw.ttl is None:
+        return False
+    if LOCATIONS_TIMESERIES:
+        mongodb.database.command(
+            "collMod", LocationsDB.name, expireAfterSeconds=retention_policy.raw.ttl
+        )
+    else:
+        LocationsCRUD.indexes = LOCATIONS_INDEXES + [locations_expiry_index()]
+        LocationsCRUD.ensure_indexes()
+    return True
+
+
+def backfill_name_keys() -> int:
+    """
+    Adds the normalized "name_key" to the satellites that were created before it was introduced.
+    This is called when the application starts.
+
+    :returns:   The number of updated satellites
+    :rtype:     int
+    """
+    satellites = SatellitesCRUD.find({"name_key": {"$exists": False}}, {"name": 1})
+    for satellite in satellites:
+        SatellitesCRUD.update(str(satellite["_id"]), {"name": satellite.get("name", "")})
+    return len(satellites)
+
+
+def migrate_timestamps() -> int:
+    """
+    Converts the timestamps of the locations that were stored as epoch seconds to BSON dates.
+    Before the timestamps were normalized on every write, the pull_position service stored the epoch seconds of
+    the upstream API, so the collection held mixed types that are not matched by the time ranges.
+    This is called when the application starts. Finding the epoch timestamps is bounded by the timestamp index,
+    so it does nothing after the first run. Time-series collections only hold BSON dates.
+
+    :returns:   The number of updated locations
+    :rtype:     int
+    """
+    if LOCATIONS_TIMESERIES:
+        return 0
+    result = LocationsDB.update_many(
+        {"timestamp": {"$type": "number"}},
+        [{"$set": {"timestamp": {"$toDate": {"$toLong": {"$multiply": ["$timestamp", 1000]}}}}}],
+    )
+    return result.modified_count
+
+
+def ensure_indexes() -> Dict[str, Tuple[List[str], List[str]]]:
+    """
+    Reconciles the indexes of every collection with the indexes declared in its CRUD class.
+    This is called when the application starts.
+
+    :returns:   The created and dropped indexes per collection
+    :rtype:     Dict[str, Tuple[List[str], List[str]]]
+    """
+    # The TTL index of the raw locations is kept once the rollups service created it, or dropped if they are kept forever
+    if not LOCATIONS_TIMESERIES:
+        LocationsCRUD.indexes = LOCATIONS_INDEXES
+        if retention_policy.raw.ttl is not None and raw_expiry_enabled():
+            LocationsCRUD.indexes = LOCATIONS_INDEXES + [locations_expiry_index()]
+    return {
+        crud.collection.name: crud.ensure_indexes()
+        for crud in (
+            SatellitesCRUD,
+            LocationsCRUD,
+            DaylightWindowsCRUD,
+            TLEsCRUD,
+            *RollupsCRUD.values(),
+        )
+    }
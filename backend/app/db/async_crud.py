@@ -0,0 +1,462 @@
+import inspect
+from typing import Tuple, Any, Set, AsyncIterator, Callable, Dict, List, Optional
+from bson import ObjectId, json_util
+from pymongo import IndexModel
+from pymongo.errors import BulkWriteError, PyMongoError
+from app.db.base_crud import BaseCRUD, CountMode
+from app.db.database import LoopBoundCollection
+
+
+class AsyncCRUD(BaseCRUD):
+    """
+    This class implements the same CRUD functions as the CRUD class on top of Motor.
+    The functions have the same arguments, return values and HTTPExceptions but they need to be awaited.
+    The database round trips do not block a thread, so the routers can serve as many concurrent requests
+    as the connection pool allows.
+    """
+
+    def __init__(
+        self,
+        collection: LoopBoundCollection,
+        related_collection: Optional[LoopBoundCollection] = None,
+        reference_field: Optional[str] = None,
+        cascaded_collection: Optional[LoopBoundCollection] = None,
+        cascaded_field: Optional[str] = None,
+        indexes: Optional[List[IndexModel]] = None,
+        timeseries: bool = False,
+        counters: Optional[LoopBoundCollection] = None,
+        count_cache_ttl: float = 0,
+        preprocess: Optional[Callable[[Dict], Dict]] = None,
+        known_references: Optional[Callable[[Set[Any]], bool]] = None,
+        index_registry: Optional[LoopBoundCollection] = None,
+    ):
+        """
+        Initialize the AsyncCRUD object with a specific MongoDB collection.
+        :param collection: The Motor collection instance.
+        """
+        super().__init__(
+            collection,
+            related_collection=related_collection,
+            reference_field=reference_field,
+            cascaded_collection=cascaded_collection,
+            cascaded_field=cascaded_field,
+            indexes=indexes,
+            timeseries=timeseries,
+            counters=counters,
+            count_cache_ttl=count_cache_ttl,
+            preprocess=preprocess,
+            known_references=known_references,
+            index_registry=index_registry,
+        )
+
+    async def _notify(self, operation: str, documents: List[Dict]) -> None:
+        """
+        Call the listeners after a write. A failing listener does not fail the write.
+        The listeners that are coroutine functions (e.g. they write to the database) are awaited.
+        :param operation: "create", "update" or "delete".
+        :param documents: The created, updated or deleted documents.
+        """
+        for listener in self.listeners:
+            try:
+                result = listener(operation, documents)
+                if inspect.isawaitable(result):
+                    await result
+            except Exception as e:
+                self._listener_failed(listener, operation, e)
+
+    async def _validate_reference(self, data: Dict) -> None:
+        """
+        Validate that the reference field exists in the related collection.
+        :param data: The document data being validated.
+        """
+        ref_value = self._reference_to_check(data)
+        if ref_value is not None and not await self.related_collection.find_one(
+            {self.reference_field: ref_value}
+        ):
+            raise self._missing_reference(ref_value)
+
+    async def create(self, data: Dict) -> Dict:
+        """
+        Insert a new document into the collection.
+        :param data: The data to be inserted.
+        :return: The inserted document with its `_id`.
+        """
+        self._validate_data(data)
+        data = self._preprocess(data)
+        if self.reference_field in data.keys():
+            await self._validate_reference(data)
+
+        try:
+            result = await self.collection.insert_one(data)
+            data["_id"] = result.inserted_id
+            await self._increment_count(self.collection.name, 1)
+            await self._notify("create", [data])
+            return data
+        except PyMongoError as e:
+            raise self._database_error(e)
+
+    async def _validate_references(self, documents: List[Dict]) -> None:
+        """
+        Validate that the reference fields of many documents exist in the related collection.
+        All the referenced values are checked with a single query.
+        :param documents: The documents being validated.
+        """
+        self._require_references(documents)
+        self._missing_references_error(await self._missing_references(documents))
+
+    async def _missing_references(self, documents: List[Dict]) -> Set[Any]:
+        """
+        Find the reference values of many documents that do not exist in the related collection.
+        All the referenced values are checked with a single $in query.
+        :param documents: The documents being validated.
+        :return: The reference values that do not exist. Documents without a reference value are ignored.
+        """
+        ref_values = self._references_to_check(documents)
+        if not ref_values:
+            return set()
+        existing = set(
+            await self.related_collection.distinct(
+                self.reference_field, {self.reference_field: {"$in": list(ref_values)}}
+            )
+        )
+        return ref_values - existing
+
+    async def bulk_create(
+        self, documents: List[Dict]
+    ) -> Tuple[Dict[int, Dict], Dict[int, str]]:
+        """
+        Insert many new documents with a single unordered insert and report the result of every document.
+        Unlike create_many, invalid documents do not fail the others.
+        :param documents: The documents to be inserted.
+        :return: A tuple with the inserted documents (with their `_id`) and the errors, both by their index.
+        """
+        self._validate_documents(documents, allow_empty=True)
+        documents = [self._preprocess(data) for data in documents]
+
+        # Every referenced value of the batch is checked with a single query
+        errors = self._reference_errors(documents, await self._missing_references(documents))
+        pending = [i for i in range(len(documents)) if i not in errors]
+        if not pending:
+            return {}, errors
+
+        failed = {}
+        try:
+            # insert_many sets the `_id` of every document
+            await self.collection.insert_many(
+                [documents[i] for i in pending], ordered=False
+            )
+        except BulkWriteError as e:
+            failed = self._write_errors(pending, e)
+        except PyMongoError as e:
+            raise self._database_error(e)
+        errors.update(failed)
+        created = {i: documents[i] for i in pending if i not in failed}
+        await self._increment_count(self.collection.name, len(created))
+        if created:
+            await self._notify("create", list(created.values()))
+        return created, errors
+
+    async def create_many(self, documents: List[Dict]) -> List[Dict]:
+        """
+        Insert many new documents into the collection with a single round trip.
+        :param documents: The documents to be inserted.
+        :return: The inserted documents with their `_id`.
+        """
+        self._validate_documents(documents)
+        documents = [self._preprocess(data) for data in documents]
+        await self._validate_references(documents)
+
+        try:
+            # insert_many sets the `_id` of every document
+            await self.collection.insert_many(documents, ordered=False)
+            await self._increment_count(self.collection.name, len(documents))
+            await self._notify("create", documents)
+            return documents
+        except BulkWriteError as e:
+            # The documents that did not fail are still inserted
+            await self._increment_count(
+                self.collection.name, e.details.get("nInserted", 0)
+            )
+            raise self._database_error(e)
+        except PyMongoError as e:
+            raise self._database_error(e)
+
+    async def read(self, document_id: str) -> Optional[Dict]:
+        """
+        Retrieve a document by its ID.
+        :param document_id: The document's ID as a string.
+        :return: The document if found, otherwise None.
+        """
+        object_id = self._validate_object_id(document_id)
+        try:
+            document = await self.collection.find_one({"_id": object_id})
+            if not document:
+                raise self._not_found(document_id)
+            return document
+        except PyMongoError as e:
+            raise self._database_error(e, f"process document with id {document_id}")
+
+    async def update(self, document_id: str, update_data: Dict) -> Optional[Dict]:
+        """
+        Update a document by its ID.
+        :param document_id: The document's ID as a string.
+        :param update_data: The data to update the document with.
+        :return: The updated document if successful, otherwise None.
+        """
+        object_id = self._validate_object_id(document_id)
+        self._validate_data(update_data, "Update data")
+        update_data = self._preprocess(update_data)
+        if self.reference_field in update_data.keys():
+            await self._validate_reference(update_data)
+        try:
+            original_document = await self.read(document_id)
+            result = await self._find_one_and_update(object_id, update_data)
+            if not result:
+                raise self._not_found(document_id, "update")
+            cascade = self._cascaded_update(update_data, original_document, result)
+            if cascade is not None:
+                # Update all cascade collections with the new cascade value
+                updated_related = await self.cascaded_collection.update_many(*cascade)
+                print(
+                    f"Cascaded update: {updated_related.modified_count} related documents updated."
+                )
+            await self._notify("update", [result])
+            return result
+        except PyMongoError as e:
+            raise self._database_error(e, f"process document with id {document_id}")
+
+    async def _find_one_and_update(
+        self, object_id: ObjectId, update_data: Dict
+    ) -> Optional[Dict]:
+        """
+        Update a document by its ObjectId and return the updated document.
+        :param object_id: The document's ObjectId.
+        :param update_data: The data to update the document with.
+        :return: The updated document or None if it does not exist.
+        """
+        if not self.timeseries:
+            return await self.collection.find_one_and_update(
+                {"_id": object_id}, {"$set": update_data}, return_document=True
+            )
+        # Time-series collections only accept multi-document updates
+        await self.collection.update_many({"_id": object_id}, {"$set": update_data})
+        return await self.collection.find_one({"_id": object_id})
+
+    async def _find_one_and_delete(self, object_id: ObjectId) -> Optional[Dict]:
+        """
+        Delete a document by its ObjectId and return the deleted document.
+        :param object_id: The document's ObjectId.
+        :return: The deleted document or None if it does not exist.
+        """
+        if not self.timeseries:
+            return await self.collection.find_one_and_delete({"_id": object_id})
+        # Time-series collections only accept multi-document deletes
+        document = await self.collection.find_one({"_id": object_id})
+        if document is not None:
+            await self.collection.delete_many({"_id": object_id})
+        return document
+
+    async def delete(self, document_id: str) -> Tuple[bool, Dict[str, Any]]:
+        """
+        Delete a document by its ID.
+        :param document_id: The document's ID as a string.
+        :return: A tuple where the first element is True if the document was deleted,
+                 and the second element is the deleted document.
+        """
+        object_id = self._validate_object_id(document_id)
+        try:
+            result = await self._find_one_and_delete(object_id)
+            if result is None:
+                raise self._not_found(document_id, "deletion")
+            await self._increment_count(self.collection.name, -1)
+            # Cascade deletion if a cascaded collection exists
+            cascade = self._cascaded_delete(result)
+            if cascade is not None:
+                deleted_related = await self.cascaded_collection.delete_many(cascade)
+                await self._increment_count(
+                    self.cascaded_collection.name, -deleted_related.deleted_count
+                )
+                print(
+                    f"Cascaded deletion: {deleted_related.deleted_count} related documents removed."
+                )
+
+            await self._notify("delete", [result])
+            return True, result
+        except PyMongoError as e:
+            raise self._database_error(e, f"process document with id {document_id}")
+
+    async def find(
+        self, filters: Dict = {}, projection: Optional[Dict] = None, limit: int = 0
+    ) -> List[Dict]:
+        """
+        Find documents matching the given filters.
+        :param filters: Query filters.
+        :param projection: Projection to include/exclude specific fields.
+        :param limit: The maximum number of documents to return (0 for no limit).
+        :return: A list of matching documents.
+        """
+        self._validate_find(filters, projection, limit)
+        try:
+            cursor = self.collection.find(filters, projection).limit(limit)
+            return await cursor.to_list(length=None)
+        except PyMongoError as e:
+            raise self._database_error(e, f"process filters {filters}")
+
+    async def find_one(self, filters: Dict = {}) -> Optional[Dict]:
+        """
+        Find a document matching the given filters.
+        :param filters: Query filters.
+        :return: The document if found, otherwise None.
+        """
+        try:
+            document = await self.collection.find_one(filters)
+            return document
+        except PyMongoError as e:
+            raise self._database_error(e, f"process filters {filters}")
+
+    async def count(self, filters: Dict = {}, mode: CountMode = CountMode.EXACT) -> int:
+        """
+        Count documents matching the given filters.
+        :param filters: Query filters.
+        :param mode: How to count. The estimated and maintained counts can not be filtered.
+        :return: The count of matching documents.
+        """
+        self._validate_count(filters, mode)
+        try:
+            if mode == CountMode.ESTIMATED:
+                return await self.collection.estimated_document_count()
+            if mode == CountMode.MAINTAINED:
+                counter = await self.counters.find_one({"_id": self.collection.name})
+                if counter is not None:
+                    return counter["count"]
+                # The first time, the counter starts from an exact count
+                count = await self.collection.count_documents({})
+                await self.counters.update_one(
+                    {"_id": self.collection.name},
+                    {"$setOnInsert": {"count": count}},
+                    upsert=True,
+                )
+                return count
+            if mode == CountMode.CACHED:
+                key = json_util.dumps(filters)
+                count = self._cached_count(key)
+                if count is None:
+                    count = await self.collection.count_documents(filters)
+                    self._cache_count(key, count)
+                return count
+            return await self.collection.count_documents(filters)
+        except PyMongoError as e:
+            raise self._database_error(e, f"process filters {filters}")
+
+    async def total(self, filters: Dict = {}) -> Tuple[int, CountMode]:
+        """
+        Count documents matching the given filters with the cheapest mode that is accurate enough for pagination.
+        :param filters: Query filters.
+        :return: A tuple with the count and the mode that was used.
+        """
+        mode = self._total_mode(filters)
+        return await self.count(filters, mode), mode
+
+    async def reset_count(self) -> int:
+        """
+        Recount the documents of the collection and store the count in the counters collection.
+        This is needed after documents were created or deleted without this class (e.g. by a TTL index).
+        :return: The count of documents.
+        """
+        self._require_counters()
+        try:
+            count = await self.collection.count_documents({})
+            await self.counters.update_one(
+                {"_id": self.collection.name}, {"$set": {"count": count}}, upsert=True
+            )
+            return count
+        except PyMongoError as e:
+            raise self._database_error(e, f"count {self.collection.name}")
+
+    async def _increment_count(self, collection_name: str, amount: int) -> None:
+        """
+        Update the maintained count of a collection. Nothing happens until the counter is created by count().
+        :param collection_name: The name of the collection that changed.
+        :param amount: The number of documents that were created (positive) or deleted (negative).
+        """
+        if self.counters is not None and amount:
+            await self.counters.update_one(
+                {"_id": collection_name}, {"$inc": {"count": amount}}
+            )
+
+    async def aggregate(self, pipeline: List[Dict]) -> List[Any]:
+        """
+        Perform an aggregation pipeline query.
+        :param pipeline: The aggregation pipeline as a list of stages.
+        :return: The aggregation results as a list.
+        """
+        self._validate_pipeline(pipeline)
+        try:
+            return await self.collection.aggregate(pipeline).to_list(length=None)
+        except PyMongoError as e:
+            raise self._database_error(e, f"process pipeline {pipeline}")
+
+    async def aggregate_batches(
+        self, pipeline: List[Dict], batch_size: int
+    ) -> AsyncIterator[List[Any]]:
+        """
+        Perform an aggregation pipeline query and yield the results in batches instead of one list.
+        Only one batch is held in memory at a time. The query is sent when the first batch is requested.
+        :param pipeline: The aggregation pipeline as a list of stages.
+        :param batch_size: The number of documents per batch.
+        :return: An asynchronous iterator over the batches of results.
+        """
+        self._validate_pipeline(pipeline, batch_size)
+        try:
+            cursor = self.collection.aggregate(pipeline, batchSize=batch_size)
+            while True:
+                batch = await cursor.to_list(length=batch_size)
+                if not batch:
+                    break
+                yield batch
+        except PyMongoError as e:
+            raise self._database_error(e, f"process pipeline {pipeline}")
+
+    async def explain(self, pipeline: List[Dict]) -> Dict:
+        """
+        Explain how an aggregation pipeline query is executed.
+        :param pipeline: The aggregation pipeline as a list of stages.
+        :return: The query plan of the aggregation.
+        """
+        self._validate_pipeline(pipeline)
+        try:
+            return await self.collection.database.command(
+                "aggregate",
+                self.collection.name,
+                pipeline=pipeline,
+                explain=True,
+            )
+        except PyMongoError as e:
+            raise self._database_error(e, f"explain pipeline {pipeline}")
+
+    async def ensure_indexes(self) -> Tuple[List[str], List[str]]:
+        """
+        Reconcile the indexes of the collection with the declared ones, the same way as CRUD.ensure_indexes.
+        :return: A tuple with the names of the created and the dropped indexes.
+        """
+        try:
+            existing = await self.collection.index_information()
+            record = (
+                await self.index_registry.find_one({"_id": self.collection.name})
+                if self.index_registry is not None
+                else None
+            )
+            managed = self._managed_indexes(record)
+            dropped, missing = self._reconcile_indexes(existing, managed)
+            for name in dropped:
+                await self.collection.drop_index(name)
+            created = await self.collection.create_indexes(missing) if missing else []
+            names = self._registered_indexes(managed, dropped)
+            if self.index_registry is not None and names != sorted(managed):
+                await self.index_registry.update_one(
+                    {"_id": self.collection.name}, {"$set": {"names": names}}, upsert=True
+                )
+            self._report_indexes(created, dropped)
+            return created, dropped
+        except PyMongoError as e:
+            raise self._database_error(e, f"reconcile indexes of {self.collection.name}")
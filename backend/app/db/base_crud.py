@@ -0,0 +1,541 @@
+import time
+from enum import Enum
+from typing import Tuple, Any, Set, Callable, Dict, List, Optional
+from pymongo import IndexModel
+from bson import ObjectId, json_util
+from fastapi import HTTPException, status
+from pymongo.errors import BulkWriteError, PyMongoError
+
+# Index options that are compared when reconciling the declared indexes with the existing ones
+INDEX_OPTIONS = ("unique", "sparse", "expireAfterSeconds", "partialFilterExpression")
+# Maximum number of filtered counts that are cached per collection
+COUNT_CACHE_SIZE = 1000
+
+
+class CountMode(str, Enum):
+    """
+    How the total number of documents was counted.
+    """
+
+    EXACT = "exact"  # count_documents() on every call
+    ESTIMATED = "estimated"  # The collection metadata. It is fast but it ignores filters
+    MAINTAINED = "maintained"  # Exact count kept in the counters collection on every create and delete
+    CACHED = "cached"  # count_documents() cached for a few seconds
+
+
+class BaseCRUD:
+    """
+    This class implements the parts of the CRUD functions that do not query the database: the validation of the
+    arguments, the mapping of the errors to HTTPExceptions, the count cache and the comparison of the indexes.
+    CRUD (pymongo) and AsyncCRUD (Motor) extend it with the database round trips, so both behave the same way.
+    """
+
+    def __init__(
+        self,
+        collection: Any,
+        related_collection: Optional[Any] = None,
+        reference_field: Optional[str] = None,
+        cascaded_collection: Optional[Any] = None,
+        cascaded_field: Optional[str] = None,
+        indexes: Optional[List[IndexModel]] = None,
+        timeseries: bool = False,
+        counters: Optional[Any] = None,
+        count_cache_ttl: float = 0,
+        preprocess: Optional[Callable[[Dict], Dict]] = None,
+        known_references: Optional[Callable[[Set[Any]], bool]] = None,
+        index_registry: Optional[Any] = None,
+    ):
+        """
+        Initialize the CRUD object with a specific MongoDB collection.
+        :param collection: The collection instance.
+        :param indexes: The indexes the collection needs. They are created by ensure_indexes().
+        :param timeseries: True if the collection is a time-series collection. These do not support
+                           findAndModify, so single documents are updated and deleted with separate commands.
+        :param counters: The collection where the number of documents is maintained on every create and delete.
+                         Every process updates the same counter, so the count is exact for all of them.
+        :param count_cache_ttl: Seconds a filtered count is cached for.
+        :param preprocess: Function applied to the data of every create and update before it is written
+                           (e.g. to add derived fields).
+        :param known_references: Function that returns True when all the given reference values are known to exist
+                                 (e.g. from an in-memory registry). Otherwise the related collection is queried.
+        :param index_registry: The collection where the names of the declared indexes are recorded, one document per
+                               collection. Only the indexes recorded there are dropped once they are not declared anymore.
+        """
+        if collection is None:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail="Collection must not be None.",
+            )
+        self.collection = collection
+        self.related_collection = related_collection
+        self.reference_field = reference_field
+        self.cascaded_collection = cascaded_collection
+        self.cascaded_field = cascaded_field
+        self.indexes = indexes or []
+        self.timeseries = timeseries
+        self.counters = counters
+        self.count_cache_ttl = count_cache_ttl
+        self._count_cache: Dict[str, Tuple[float, int]] = {}
+        self.preprocess = preprocess
+        self.known_references = known_references
+        self.index_registry = index_registry
+        self.listeners: List[Callable[[str, List[Dict]], Any]] = []
+
+    def add_listener(self, listener: Callable[[str, List[Dict]], Any]) -> None:
+        """
+        Register a function that is called after every successful write of this CRUD.
+        :param listener: Called with the operation ("create", "update" or "delete") and the written documents.
+        """
+        self.listeners.append(listener)
+
+    def _listener_failed(self, listener: Callable, operation: str, error: Exception) -> None:
+        """
+        Report a failing listener. A failing listener does not fail the write.
+        :param listener: The listener that failed.
+        :param operation: "create", "update" or "delete".
+        :param error: The exception raised by the listener.
+        """
+        print(f"Listener {listener} failed for {operation} on {self.collection.name}: {error}")
+
+    @staticmethod
+    def _database_error(error: PyMongoError, action: Optional[str] = None) -> HTTPException:
+        """
+        Map a database error to the HTTPException that the CRUD functions raise.
+        :param error: The pymongo error.
+        :param action: What was being done (e.g. "process filters {...}"), None to omit it.
+        :return: The HTTPException with status 500.
+        """
+        detail = f"Database error trying to {action}: {str(error)}" if action else f"Database error: {str(error)}"
+        return HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=detail)
+
+    @staticmethod
+    def _not_found(document_id: str, operation: Optional[str] = None) -> HTTPException:
+        """
+        Build the HTTPException of a document that does not exist.
+        :param document_id: The document's ID as a string.
+        :param operation: "update" or "deletion", None for a read.
+        :return: The HTTPException with status 404.
+        """
+        suffix = f" for {operation}" if operation else ""
+        return HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Document with id {document_id} not found{suffix}.",
+        )
+
+    def _known_references(self, values: Set[Any]) -> bool:
+        """
+        Check if the reference values are known to exist without querying the related collection.
+        :param values: The reference values being validated.
+        :return: True if the known_references function confirms all of them.
+        """
+        return self.known_references is not None and self.known_references(values)
+
+    def _reference_to_check(self, data: Dict) -> Optional[Any]:
+        """
+        Get the reference value of a document that has to be looked up in the related collection.
+        :param data: The document data being validated.
+        :return: The reference value, or None if there is no related collection or the value is known to exist.
+        """
+        if self.related_collection is None or self.reference_field is None:
+            return None
+        ref_value = data.get(self.reference_field)
+        if ref_value is None:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"{self.reference_field} is required for this operation.",
+            )
+        return None if self._known_references({ref_value}) else ref_value
+
+    def _missing_reference(self, ref_value: Any) -> HTTPException:
+        """
+        Build the HTTPException of a reference value that does not exist.
+        :param ref_value: The reference value.
+        :return: The HTTPException with status 400.
+        """
+        return HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Reference {self.reference_field} with value {ref_value} does not exist.",
+        )
+
+    def _references_to_check(self, documents: List[Dict]) -> Set[Any]:
+        """
+        Get the reference values of many documents that have to be looked up in the related collection.
+        :param documents: The documents being validated. Documents without a reference value are ignored.
+        :return: The reference values, empty if there is no related collection or all of them are known to exist.
+        """
+        if self.related_collection is None or self.reference_field is None:
+            return set()
+        ref_values = {document.get(self.reference_field) for document in documents}
+        ref_values.discard(None)
+        if not ref_values or self._known_references(ref_values):
+            return set()
+        return ref_values
+
+    def _require_references(self, documents: List[Dict]) -> None:
+        """
+        Validate that every document has a reference value when there is a related collection.
+        :param documents: The documents being validated.
+        """
+        if self.related_collection is not None and self.reference_field is not None:
+            if any(document.get(self.reference_field) is None for document in documents):
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail=f"{self.reference_field} is required for this operation.",
+                )
+
+    def _missing_references_error(self, missing: Set[Any]) -> None:
+        """
+        Raise if some reference values do not exist.
+        :param missing: The reference values that do not exist.
+        """
+        if missing:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Reference {self.reference_field} with values {sorted(missing)} does not exist.",
+            )
+
+    def _reference_errors(self, documents: List[Dict], missing: Set[Any]) -> Dict[int, str]:
+        """
+        Report the documents of a bulk create whose reference value is absent or does not exist.
+        :param documents: The documents being created.
+        :param missing: The reference values that do not exist.
+        :return: The errors by the index of the document.
+        """
+        errors = {}
+        if self.related_collection is not None and self.reference_field is not None:
+            for i, data in enumerate(documents):
+                ref_value = data.get(self.reference_field)
+                if ref_value is None:
+                    errors[i] = f"{self.reference_field} is required for this operation."
+                elif ref_value in missing:
+                    errors[i] = f"Reference {self.reference_field} with value {ref_value} does not exist."
+        return errors
+
+    @staticmethod
+    def _write_errors(pending: List[int], error: BulkWriteError) -> Dict[int, str]:
+        """
+        Map the write errors of an unordered insert to the documents that failed.
+        :param pending: The indexes of the inserted documents, in the order they were inserted.
+        :param error: The error of the insert.
+        :return: The errors by the index of the document.
+        """
+        # The index of a write error is the position in the inserted list
+        return {
+            pending[write_error["index"]]: write_error.get("errmsg", str(write_error))
+            for write_error in error.details.get("writeErrors", [])
+        }
+
+    def _preprocess(self, data: Dict) -> Dict:
+        """
+        Apply the preprocess function to the data of a create or update.
+        :param data: The data to be written.
+        :return: The data to write.
+        """
+        return self.preprocess(data) if self.preprocess is not None else data
+
+    def _validate_object_id(self, document_id: str) -> ObjectId:
+        """
+        Validate and convert a string to an ObjectId.
+        :param document_id: The document's ID as a string.
+        :return: The ObjectId instance.
+        """
+        if not isinstance(document_id, str):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Document ID must be a string. Received {document_id}",
+            )
+        try:
+            return ObjectId(document_id)
+        except Exception as e:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Invalid ObjectId: {document_id}. Error: {e}",
+            )
+
+    @staticmethod
+    def _validate_data(data: Dict, name: str = "Data") -> None:
+        """
+        Validate the data of a create or update.
+        :param data: The data to be written.
+        :param name: How the data is called in the error.
+        """
+        if not isinstance(data, dict) or not data:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"{name} must be a non-empty dictionary. Received {data}",
+            )
+
+    @staticmethod
+    def _validate_documents(documents: List[Dict], allow_empty: bool = False) -> None:
+        """
+        Validate the documents of a create_many or bulk_create.
+        :param documents: The documents to be inserted.
+        :param allow_empty: True if the list and the documents can be empty. Invalid documents fail on their own.
+        """
+        if allow_empty:
+            if not isinstance(documents, list) or not all(
+                isinstance(data, dict) for data in documents
+            ):
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail=f"Documents must be a list of dictionaries. Received {documents}",
+                )
+        elif (
+            not isinstance(documents, list)
+            or not documents
+            or not all(isinstance(data, dict) and data for data in documents)
+        ):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Documents must be a non-empty list of non-empty dictionaries. Received {documents}",
+            )
+
+    def _cascaded_update(
+        self, update_data: Dict, original: Optional[Dict], result: Dict
+    ) -> Optional[Tuple[Dict, Dict]]:
+        """
+        Build the update of the cascaded collection after a document was updated.
+        :param update_data: The data the document was updated with.
+        :param original: The document before the update.
+        :param result: The document after the update.
+        :return: A tuple with the filter and the update, or None if nothing has to be cascaded.
+        """
+        # Cascade update if a cascaded collection exists and the cascaded_field was changed
+        if (
+            self.cascaded_collection is None
+            or self.cascaded_field is None
+            or self.cascaded_field not in update_data.keys()
+        ):
+            return None
+        cascade_value = result.get(self.cascaded_field)
+        if cascade_value is None or original is None:
+            return None
+        return (
+            {self.cascaded_field: original.get(self.cascaded_field)},
+            {"$set": {self.cascaded_field: cascade_value}},
+        )
+
+    def _cascaded_delete(self, result: Dict) -> Optional[Dict]:
+        """
+        Build the filter of the documents of the cascaded collection to delete after a document was deleted.
+        :param result: The deleted document.
+        :return: The filter, or None if nothing has to be cascaded.
+        """
+        if self.cascaded_collection is None or self.cascaded_field is None:
+            return None
+        ref_value = result.get(self.cascaded_field)
+        return {self.cascaded_field: ref_value} if ref_value is not None else None
+
+    @staticmethod
+    def _validate_find(filters: Dict, projection: Optional[Dict], limit: int) -> None:
+        """
+        Validate the arguments of find().
+        :param filters: Query filters.
+        :param projection: Projection to include/exclude specific fields.
+        :param limit: The maximum number of documents to return (0 for no limit).
+        """
+        if not isinstance(filters, dict):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Filters must be a dictionary. Received: {filters}",
+            )
+        if projection is not None and not isinstance(projection, dict):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Projection must be a dictionary or None. Received {projection}",
+            )
+        if not isinstance(limit, int) or limit < 0:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Limit must be a non-negative integer. Received {limit}",
+            )
+
+    @staticmethod
+    def _validate_pipeline(pipeline: List[Dict], batch_size: Optional[int] = None) -> None:
+        """
+        Validate the arguments of aggregate(), aggregate_batches() and explain().
+        :param pipeline: The aggregation pipeline as a list of stages.
+        :param batch_size: The number of documents per batch, None if the results are not batched.
+        """
+        if not isinstance(pipeline, list) or not all(
+            isinstance(stage, dict) for stage in pipeline
+        ):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Pipeline must be a list of dictionaries.",
+            )
+        if batch_size is not None and (not isinstance(batch_size, int) or batch_size <= 0):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Batch size must be a positive integer. Received {batch_size}",
+            )
+
+    def _validate_count(self, filters: Dict, mode: CountMode) -> None:
+        """
+        Validate the arguments of count().
+        :param filters: Query filters.
+        :param mode: How to count.
+        """
+        if not isinstance(filters, dict):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Filters must be a dictionary. Received {filters}",
+            )
+        if mode in (CountMode.ESTIMATED, CountMode.MAINTAINED) and filters:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"The {mode.value} count can not be filtered. Received {filters}",
+            )
+        if mode == CountMode.MAINTAINED:
+            self._require_counters()
+
+    def _require_counters(self) -> None:
+        """
+        Validate that the count of the collection is maintained.
+        """
+        if self.counters is None:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail=f"The count of {self.collection.name} is not maintained.",
+            )
+
+    def cached_total(self, filters: Dict = {}) -> Tuple[Optional[int], Optional[CountMode]]:
+        """
+        Get the count of total() from the count cache, without querying the database.
+        :param filters: Query filters.
+        :return: A tuple with the count and the mode, or (None, None) if the count is not cached.
+        """
+        if self._total_mode(filters) != CountMode.CACHED:
+            return None, None
+        count = self._cached_count(json_util.dumps(filters))
+        if count is None:
+            return None, None
+        return count, CountMode.CACHED
+
+    def _total_mode(self, filters: Dict) -> CountMode:
+        """
+        Choose how total() counts.
+        :param filters: Query filters.
+        :return: The maintained count if there are no filters and it is available, otherwise the estimated one.
+                 Filtered counts are cached. Time-series collections do not have estimated counts.
+        """
+        if filters:
+            return CountMode.CACHED
+        if self.counters is not None:
+            return CountMode.MAINTAINED
+        return CountMode.CACHED if self.timeseries else CountMode.ESTIMATED
+
+    def _cached_count(self, key: str) -> Optional[int]:
+        """
+        Get a filtered count from the cache.
+        :param key: The filters serialized with Extended JSON.
+        :return: The count or None if it is not cached or it expired.
+        """
+        cached = self._count_cache.get(key)
+        if cached is None or cached[0] < time.monotonic():
+            return None
+        return cached[1]
+
+    def _cache_count(self, key: str, count: int) -> None:
+        """
+        Add a filtered count to the cache.
+        :param key: The filters serialized with Extended JSON.
+        :param count: The count.
+        """
+        if self.count_cache_ttl <= 0:
+            return
+        now = time.monotonic()
+        if len(self._count_cache) >= COUNT_CACHE_SIZE:
+            self._count_cache = {
+                k: v for k, v in self._count_cache.items() if v[0] >= now
+            }
+            if len(self._count_cache) >= COUNT_CACHE_SIZE:
+                self._count_cache.clear()
+        self._count_cache[key] = (now + self.count_cache_ttl, count)
+
+    @staticmethod
+    def _managed_indexes(record: Optional[Dict]) -> Set[str]:
+        """
+        Read the names of the indexes that the application declared from the document of the index registry.
+        :param record: The document of the collection in the index registry, None if there is none.
+        :return: The names of the indexes.
+        """
+        return set(record.get("names", [])) if record else set()
+
+    def _reconcile_indexes(
+        self, existing: Dict[str, Dict], managed: Set[str]
+    ) -> Tuple[List[str], List[IndexModel]]:
+        """
+        Compare the existing indexes with the declared ones. The undeclared indexes that are kept are reported.
+        :param existing: The index information as returned by index_information().
+        :param managed: The names of the indexes that the application declared before.
+        :return: A tuple with the names of the indexes to drop and the indexes to create.
+        """
+        declared = {index.document["name"]: index.document for index in self.indexes}
+        dropped, kept = [], []
+        for name, info in existing.items():
+            if name == "_id_":
+                continue
+            if name in declared:
+                if not self._same_index(declared[name], info):
+                    dropped.append(name)
+            elif name in managed:
+                dropped.append(name)
+            else:
+                kept.append(name)
+        if kept:
+            print(
+                f"WARNING: Indexes {kept} of {self.collection.name} are not declared. They were not created by the "
+                f"application, so they are kept. Drop them by hand if they are not needed."
+            )
+        missing = [
+            index
+            for index in self.indexes
+            if index.document["name"] not in existing or index.document["name"] in dropped
+        ]
+        return dropped, missing
+
+    def _registered_indexes(self, managed: Set[str], dropped: List[str]) -> List[str]:
+        """
+        Build the names of the indexes that the application declared, to record them in the index registry.
+        :param managed: The names that were recorded before.
+        :param dropped: The names of the indexes that were dropped.
+        :return: The sorted names.
+        """
+        return sorted((managed - set(dropped)) | {index.document["name"] for index in self.indexes})
+
+    def _report_indexes(self, created: List[str], dropped: List[str]) -> None:
+        """
+        Report the indexes that were created and dropped by ensure_indexes().
+        :param created: The names of the created indexes.
+        :param dropped: The names of the dropped indexes.
+        """
+        if created or dropped:
+            print(
+                f"Reconciled indexes of {self.collection.name}: created {created}, dropped {dropped}."
+            )
+
+    @staticmethod
+    def _same_index(declared: Dict, existing: Dict) -> bool:
+        """
+        Compare a declared index with an existing one.
+        :param declared: The IndexModel document of the declared index.
+        :param existing: The index information as returned by index_information().
+        :return: True if both indexes have the same keys and options.
+        """
+        # Directions are returned as floats (1.0) by some server versions
+        declared_keys = [
+            (field, direction if isinstance(direction, str) else int(direction))
+            for field, direction in declared["key"].items()
+        ]
+        existing_keys = [
+            (field, direction if isinstance(direction, str) else int(direction))
+            for field, direction in existing["key"]
+        ]
+        if declared_keys != existing_keys:
+            return False
+        # unique and sparse default to False when they are not set
+        return all(
+            (declared.get(option) or False) == (existing.get(option) or False)
+            for option in INDEX_OPTIONS
+        )
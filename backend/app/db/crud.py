@@ -1,75 +1,38 @@
-from typing import Tuple, Any, Dict, List, Optional
-from pymongo.collection import Collection
-from bson import ObjectId
-from fastapi import HTTPException, status
-from pymongo.errors import PyMongoError
+from typing import Tuple, Any, Set, Dict, Iterator, List, Optional
+from bson import ObjectId, json_util
+from pymongo.errors import BulkWriteError, PyMongoError
+from app.db.base_crud import BaseCRUD, CountMode
 
 
-class CRUD:
+class CRUD(BaseCRUD):
     """
     This class implements the needed CRUD functions and manages all potential Exceptions.
-    By having this class we avoid the need of repeating the same code in every router and we enable better unittesting
+    By having this class we avoid the need of repeating the same code in every router and we enable better unittesting.
+    The validation and the errors are shared with AsyncCRUD in BaseCRUD, this class only queries the pymongo collection.
     """
 
-    def __init__(
-        self,
-        collection: Collection,
-        related_collection: Optional[Collection] = None,
-        reference_field: Optional[str] = None,
-        cascaded_collection: Optional[Collection] = None,
-        cascaded_field: Optional[str] = None,
-    ):
-        """
-        Initialize the CRUD object with a specific MongoDB collection.
-        :param collection: The pymongo collection instance.
-        """
-        if collection is None:
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail="Collection must not be None.",
-            )
-        self.collection = collection
-        self.related_collection = related_collection
-        self.reference_field = reference_field
-        self.cascaded_collection = cascaded_collection
-        self.cascaded_field = cascaded_field
-
     def _validate_reference(self, data: Dict) -> None:
         """
         Validate that the reference field exists in the related collection.
         :param data: The document data being validated.
         """
-        if self.related_collection is not None and self.reference_field is not None:
-            ref_value = data.get(self.reference_field)
-            if ref_value is None:
-                raise HTTPException(
-                    status_code=status.HTTP_400_BAD_REQUEST,
-                    detail=f"{self.reference_field} is required for this operation.",
-                )
-            if not self.related_collection.find_one({self.reference_field: ref_value}):
-                raise HTTPException(
-                    status_code=status.HTTP_400_BAD_REQUEST,
-                    detail=f"Reference {self.reference_field} with value {ref_value} does not exist.",
-                )
+        ref_value = self._reference_to_check(data)
+        if ref_value is not None and not self.related_collection.find_one(
+            {self.reference_field: ref_value}
+        ):
+            raise self._missing_reference(ref_value)
 
-    def _validate_object_id(self, document_id: str) -> ObjectId:
+    def _notify(self, operation: str, documents: List[Dict]) -> None:
         """
-        Validate and convert a string to an ObjectId.
-        :param document_id: The document's ID as a string.
-        :return: The ObjectId instance.
+        Call the listeners after a write. A failing listener does not fail the write.
+        :param operation: "create", "update" or "delete".
+        :param documents: The created, updated or deleted documents.
         """
-        if not isinstance(document_id, str):
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail=f"Document ID must be a string. Received {document_id}",
-            )
-        try:
-            return ObjectId(document_id)
-        except Exception as e:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail=f"Invalid ObjectId: {document_id}. Error: {e}",
-            )
+        for listener in self.listeners:
+            try:
+                listener(operation, documents)
+            except Exception as e:
+                self._listener_failed(listener, operation, e)
 
     def create(self, data: Dict) -> Dict:
         """
@@ -77,24 +40,103 @@ class CRUD:
         :param data: The data to be inserted.
         :return: The inserted document with its `_id`.
         """
-        if not isinstance(data, dict) or not data:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail=f"Data must be a non-empty dictionary. Received {data}",
-            )
-
+        self._validate_data(data)
+        data = self._preprocess(data)
         if self.reference_field in data.keys():
             self._validate_reference(data)
 
         try:
             result = self.collection.insert_one(data)
             data["_id"] = result.inserted_id
+            self._increment_count(self.collection.name, 1)
+            self._notify("create", [data])
             return data
         except PyMongoError as e:
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail=f"Database error: {str(e)}",
+            raise self._database_error(e)
+
+    def _validate_references(self, documents: List[Dict]) -> None:
+        """
+        Validate that the reference fields of many documents exist in the related collection.
+        All the referenced values are checked with a single query.
+        :param documents: The documents being validated.
+        """
+        self._require_references(documents)
+        self._missing_references_error(self._missing_references(documents))
+
+    def _missing_references(self, documents: List[Dict]) -> Set[Any]:
+        """
+        Find the reference values of many documents that do not exist in the related collection.
+        All the referenced values are checked with a single $in query.
+        :param documents: The documents being validated.
+        :return: The reference values that do not exist. Documents without a reference value are ignored.
+        """
+        ref_values = self._references_to_check(documents)
+        if not ref_values:
+            return set()
+        existing = set(
+            self.related_collection.distinct(
+                self.reference_field, {self.reference_field: {"$in": list(ref_values)}}
+            )
+        )
+        return ref_values - existing
+
+    def bulk_create(
+        self, documents: List[Dict]
+    ) -> Tuple[Dict[int, Dict], Dict[int, str]]:
+        """
+        Insert many new documents with a single unordered insert and report the result of every document.
+        Unlike create_many, invalid documents do not fail the others.
+        :param documents: The documents to be inserted.
+        :return: A tuple with the inserted documents (with their `_id`) and the errors, both by their index.
+        """
+        self._validate_documents(documents, allow_empty=True)
+        documents = [self._preprocess(data) for data in documents]
+
+        # Every referenced value of the batch is checked with a single query
+        errors = self._reference_errors(documents, self._missing_references(documents))
+        pending = [i for i in range(len(documents)) if i not in errors]
+        if not pending:
+            return {}, errors
+
+        failed = {}
+        try:
+            # insert_many sets the `_id` of every document
+            self.collection.insert_many(
+                [documents[i] for i in pending], ordered=False
             )
+        except BulkWriteError as e:
+            failed = self._write_errors(pending, e)
+        except PyMongoError as e:
+            raise self._database_error(e)
+        errors.update(failed)
+        created = {i: documents[i] for i in pending if i not in failed}
+        self._increment_count(self.collection.name, len(created))
+        if created:
+            self._notify("create", list(created.values()))
+        return created, errors
+
+    def create_many(self, documents: List[Dict]) -> List[Dict]:
+        """
+        Insert many new documents into the collection with a single round trip.
+        :param documents: The documents to be inserted.
+        :return: The inserted documents with their `_id`.
+        """
+        self._validate_documents(documents)
+        documents = [self._preprocess(data) for data in documents]
+        self._validate_references(documents)
+
+        try:
+            # insert_many sets the `_id` of every document
+            self.collection.insert_many(documents, ordered=False)
+            self._increment_count(self.collection.name, len(documents))
+            self._notify("create", documents)
+            return documents
+        except BulkWriteError as e:
+            # The documents that did not fail are still inserted
+            self._increment_count(self.collection.name, e.details.get("nInserted", 0))
+            raise self._database_error(e)
+        except PyMongoError as e:
+            raise self._database_error(e)
 
     def read(self, document_id: str) -> Optional[Dict]:
         """
@@ -106,16 +148,10 @@ class CRUD:
         try:
             document = self.collection.find_one({"_id": object_id})
             if not document:
-                raise HTTPException(
-                    status_code=status.HTTP_404_NOT_FOUND,
-                    detail=f"Document with id {document_id} not found.",
-                )
+                raise self._not_found(document_id)
             return document
         except PyMongoError as e:
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail=f"Database error trying to process document with id {document_id}: {str(e)}",
-            )
+            raise self._database_error(e, f"process document with id {document_id}")
 
     def update(self, document_id: str, update_data: Dict) -> Optional[Dict]:
         """
@@ -125,49 +161,55 @@ class CRUD:
         :return: The updated document if successful, otherwise None.
         """
         object_id = self._validate_object_id(document_id)
-        if not isinstance(update_data, dict) or not update_data:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail=f"Update data must be a non-empty dictionary. Received {update_data}",
-            )
+        self._validate_data(update_data, "Update data")
+        update_data = self._preprocess(update_data)
         if self.reference_field in update_data.keys():
             self._validate_reference(update_data)
         try:
             original_document = self.read(document_id)
-            result = self.collection.find_one_and_update(
-                {"_id": object_id}, {"$set": update_data}, return_document=True
-            )
+            result = self._find_one_and_update(object_id, update_data)
             if not result:
-                raise HTTPException(
-                    status_code=status.HTTP_404_NOT_FOUND,
-                    detail=f"Document with id {document_id} not found for update.",
+                raise self._not_found(document_id, "update")
+            cascade = self._cascaded_update(update_data, original_document, result)
+            if cascade is not None:
+                # Update all cascade collections with the new cascade value
+                updated_related = self.cascaded_collection.update_many(*cascade)
+                print(
+                    f"Cascaded update: {updated_related.modified_count} related documents updated."
                 )
-            # Cascade update if a cascaded collection exists and the cascaded_field was changed
-            if (
-                self.cascaded_collection is not None
-                and self.cascaded_field is not None
-                and self.cascaded_field in update_data.keys()
-            ):
-                cascade_value = result.get(self.cascaded_field)
-                if cascade_value is not None and original_document is not None:
-                    # Update all cascade collections with the new cascade value
-                    updated_related = self.cascaded_collection.update_many(
-                        {
-                            self.cascaded_field: original_document.get(
-                                self.cascaded_field
-                            )
-                        },
-                        {"$set": {self.cascaded_field: cascade_value}},
-                    )
-                    print(
-                        f"Cascaded update: {updated_related.modified_count} related documents updated."
-                    )
+            self._notify("update", [result])
             return result
         except PyMongoError as e:
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail=f"Database error trying to process document with id {document_id}: {str(e)}",
+            raise self._database_error(e, f"process document with id {document_id}")
+
+    def _find_one_and_update(self, object_id: ObjectId, update_data: Dict) -> Optional[Dict]:
+        """
+        Update a document by its ObjectId and return the updated document.
+        :param object_id: The document's ObjectId.
+        :param update_data: The data to update the document with.
+        :return: The updated document or None if it does not exist.
+        """
+        if not self.timeseries:
+            return self.collection.find_one_and_update(
+                {"_id": object_id}, {"$set": update_data}, return_document=True
             )
+        # Time-series collections only accept multi-document updates
+        self.collection.update_many({"_id": object_id}, {"$set": update_data})
+        return self.collection.find_one({"_id": object_id})
+
+    def _find_one_and_delete(self, object_id: ObjectId) -> Optional[Dict]:
+        """
+        Delete a document by its ObjectId and return the deleted document.
+        :param object_id: The document's ObjectId.
+        :return: The deleted document or None if it does not exist.
+        """
+        if not self.timeseries:
+            return self.collection.find_one_and_delete({"_id": object_id})
+        # Time-series collections only accept multi-document deletes
+        document = self.collection.find_one({"_id": object_id})
+        if document is not None:
+            self.collection.delete_many({"_id": object_id})
+        return document
 
     def delete(self, document_id: str) -> Tuple[bool, Dict[str, Any]]:
         """
@@ -178,29 +220,25 @@ class CRUD:
         """
         object_id = self._validate_object_id(document_id)
         try:
-            result = self.collection.find_one_and_delete({"_id": object_id})
+            result = self._find_one_and_delete(object_id)
             if result is None:
-                raise HTTPException(
-                    status_code=status.HTTP_404_NOT_FOUND,
-                    detail=f"Document with id {document_id} not found for deletion.",
-                )
+                raise self._not_found(document_id, "deletion")
+            self._increment_count(self.collection.name, -1)
             # Cascade deletion if a cascaded collection exists
-            if self.cascaded_collection is not None and self.cascaded_field is not None:
-                ref_value = result.get(self.cascaded_field)
-                if ref_value is not None:
-                    deleted_related = self.cascaded_collection.delete_many(
-                        {self.cascaded_field: ref_value}
-                    )
-                    print(
-                        f"Cascaded deletion: {deleted_related.deleted_count} related documents removed."
-                    )
+            cascade = self._cascaded_delete(result)
+            if cascade is not None:
+                deleted_related = self.cascaded_collection.delete_many(cascade)
+                self._increment_count(
+                    self.cascaded_collection.name, -deleted_related.deleted_count
+                )
+                print(
+                    f"Cascaded deletion: {deleted_related.deleted_count} related documents removed."
+                )
 
+            self._notify("delete", [result])
             return True, result
         except PyMongoError as e:
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail=f"Database error trying to process document with id {document_id}: {str(e)}",
-            )
+            raise self._database_error(e, f"process document with id {document_id}")
 
     def find(
         self, filters: Dict = {}, projection: Optional[Dict] = None, limit: int = 0
@@ -212,29 +250,12 @@ class CRUD:
         :param limit: The maximum number of documents to return (0 for no limit).
         :return: A list of matching documents.
         """
-        if not isinstance(filters, dict):
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail=f"Filters must be a dictionary. Received: {filters}",
-            )
-        if projection is not None and not isinstance(projection, dict):
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail=f"Projection must be a dictionary or None. Received {projection}",
-            )
-        if not isinstance(limit, int) or limit < 0:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail=f"Limit must be a non-negative integer. Received {limit}",
-            )
+        self._validate_find(filters, projection, limit)
         try:
             cursor = self.collection.find(filters, projection).limit(limit)
             return list(cursor)
         except PyMongoError as e:
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail=f"Database error trying to process filters {filters}: {str(e)}",
-            )
+            raise self._database_error(e, f"process filters {filters}")
 
     def find_one(self, filters: Dict = {}) -> Optional[Dict]:
         """
@@ -246,29 +267,75 @@ class CRUD:
             document = self.collection.find_one(filters)
             return document
         except PyMongoError as e:
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail=f"Database error trying to process filters {filters}: {str(e)}",
-            )
+            raise self._database_error(e, f"process filters {filters}")
 
-    def count(self, filters: Dict = {}) -> int:
+    def count(self, filters: Dict = {}, mode: CountMode = CountMode.EXACT) -> int:
         """
         Count documents matching the given filters.
         :param filters: Query filters.
+        :param mode: How to count. The estimated and maintained counts can not be filtered.
         :return: The count of matching documents.
         """
-        if not isinstance(filters, dict):
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail=f"Filters must be a dictionary. Received {filters}",
-            )
+        self._validate_count(filters, mode)
         try:
+            if mode == CountMode.ESTIMATED:
+                return self.collection.estimated_document_count()
+            if mode == CountMode.MAINTAINED:
+                counter = self.counters.find_one({"_id": self.collection.name})
+                if counter is not None:
+                    return counter["count"]
+                # The first time, the counter starts from an exact count
+                count = self.collection.count_documents({})
+                self.counters.update_one(
+                    {"_id": self.collection.name},
+                    {"$setOnInsert": {"count": count}},
+                    upsert=True,
+                )
+                return count
+            if mode == CountMode.CACHED:
+                key = json_util.dumps(filters)
+                count = self._cached_count(key)
+                if count is None:
+                    count = self.collection.count_documents(filters)
+                    self._cache_count(key, count)
+                return count
             return self.collection.count_documents(filters)
         except PyMongoError as e:
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail=f"Database error trying to process filters {filters}: {str(e)}",
+            raise self._database_error(e, f"process filters {filters}")
+
+    def total(self, filters: Dict = {}) -> Tuple[int, CountMode]:
+        """
+        Count documents matching the given filters with the cheapest mode that is accurate enough for pagination.
+        :param filters: Query filters.
+        :return: A tuple with the count and the mode that was used.
+        """
+        mode = self._total_mode(filters)
+        return self.count(filters, mode), mode
+
+    def reset_count(self) -> int:
+        """
+        Recount the documents of the collection and store the count in the counters collection.
+        This is needed after documents were created or deleted without this class (e.g. by a TTL index).
+        :return: The count of documents.
+        """
+        self._require_counters()
+        try:
+            count = self.collection.count_documents({})
+            self.counters.update_one(
+                {"_id": self.collection.name}, {"$set": {"count": count}}, upsert=True
             )
+            return count
+        except PyMongoError as e:
+            raise self._database_error(e, f"count {self.collection.name}")
+
+    def _increment_count(self, collection_name: str, amount: int) -> None:
+        """
+        Update the maintained count of a collection. Nothing happens until the counter is created by count().
+        :param collection_name: The name of the collection that changed.
+        :param amount: The number of documents that were created (positive) or deleted (negative).
+        """
+        if self.counters is not None and amount:
+            self.counters.update_one({"_id": collection_name}, {"$inc": {"count": amount}})
 
     def aggregate(self, pipeline: List[Dict]) -> List[Any]:
         """
@@ -276,17 +343,79 @@ class CRUD:
         :param pipeline: The aggregation pipeline as a list of stages.
         :return: The aggregation results as a list.
         """
-        if not isinstance(pipeline, list) or not all(
-            isinstance(stage, dict) for stage in pipeline
-        ):
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Pipeline must be a list of dictionaries.",
-            )
+        self._validate_pipeline(pipeline)
         try:
             return list(self.collection.aggregate(pipeline))
         except PyMongoError as e:
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail=f"Database error trying to process pipeline {pipeline}: {str(e)}",
+            raise self._database_error(e, f"process pipeline {pipeline}")
+
+    def aggregate_batches(
+        self, pipeline: List[Dict], batch_size: int
+    ) -> Iterator[List[Any]]:
+        """
+        Perform an aggregation pipeline query and yield the results in batches instead of one list.
+        Only one batch is held in memory at a time. The query is sent when the first batch is requested.
+        :param pipeline: The aggregation pipeline as a list of stages.
+        :param batch_size: The number of documents per batch.
+        :return: An iterator over the batches of results.
+        """
+        self._validate_pipeline(pipeline, batch_size)
+        try:
+            cursor = self.collection.aggregate(pipeline, batchSize=batch_size)
+            batch = []
+            for document in cursor:
+                batch.append(document)
+                if len(batch) == batch_size:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+        except PyMongoError as e:
+            raise self._database_error(e, f"process pipeline {pipeline}")
+
+    def explain(self, pipeline: List[Dict]) -> Dict:
+        """
+        Explain how an aggregation pipeline query is executed.
+        :param pipeline: The aggregation pipeline as a list of stages.
+        :return: The query plan of the aggregation.
+        """
+        self._validate_pipeline(pipeline)
+        try:
+            return self.collection.database.command(
+                "aggregate",
+                self.collection.name,
+                pipeline=pipeline,
+                explain=True,
+            )
+        except PyMongoError as e:
+            raise self._database_error(e, f"explain pipeline {pipeline}")
+
+    def ensure_indexes(self) -> Tuple[List[str], List[str]]:
+        """
+        Reconcile the indexes of the collection with the declared ones.
+        Missing indexes are created and indexes whose keys or options changed are rebuilt. An index that is not declared
+        anymore is only dropped if the application declared it before, as recorded in the index registry. The other ones
+        (e.g. created by hand by an operator) are reported and kept. The "_id" index is never touched.
+        :return: A tuple with the names of the created and the dropped indexes.
+        """
+        try:
+            existing = self.collection.index_information()
+            record = (
+                self.index_registry.find_one({"_id": self.collection.name})
+                if self.index_registry is not None
+                else None
             )
+            managed = self._managed_indexes(record)
+            dropped, missing = self._reconcile_indexes(existing, managed)
+            for name in dropped:
+                self.collection.drop_index(name)
+            created = self.collection.create_indexes(missing) if missing else []
+            names = self._registered_indexes(managed, dropped)
+            if self.index_registry is not None and names != sorted(managed):
+                self.index_registry.update_one(
+                    {"_id": self.collection.name}, {"$set": {"names": names}}, upsert=True
+                )
+            self._report_indexes(created, dropped)
+            return created, dropped
+        except PyMongoError as e:
+            raise self._database_error(e, f"reconcile indexes of {self.collection.name}")
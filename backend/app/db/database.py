@@ -1,9 +1,17 @@
+import asyncio
+import threading
 from pymongo import MongoClient, ASCENDING
 from pymongo import database
 from pymongo.server_api import ServerApi
 from pymongo.database import Database
 from pymongo.collection import Collection
-from typing import Optional
+from bson.codec_options import CodecOptions
+from motor.motor_asyncio import (
+    AsyncIOMotorClient,
+    AsyncIOMotorDatabase,
+    AsyncIOMotorCollection,
+)
+from typing import Any, Dict, List, Optional
 
 
 class MongoDB:
@@ -11,26 +19,31 @@ class MongoDB:
     This class is used to manage the connection with the MongoDB.
     """
 
-    def __init__(self, url: str, db_name: str):
+    def __init__(self, url: str, db_name: str, event_listeners: Optional[List[Any]] = None):
         """
         Constructs a new instance.
 
-        :param      url:      the mongodb url
-        :type       url:      string
-        :param      db_name:  The database name
-        :type       db_name:  str
+        :param      url:              the mongodb url
+        :type       url:              string
+        :param      db_name:          The database name
+        :type       db_name:          str
+        :param      event_listeners:  The pymongo monitoring listeners of the client (e.g. for the metrics)
+        :type       event_listeners:  List
         """
         self._client: Optional[MongoClient] = None
         self.database: Optional[Database] = None
         self.url = url
         self.db_name = db_name
+        self.event_listeners = event_listeners or []
 
     def connect(self):
         """
         Initialize the connection client and create the database
         """
         print(f"Trying to connect to {self.db_name}")
-        self._client = MongoClient(self.url, server_api=ServerApi("1"))
+        self._client = MongoClient(
+            self.url, server_api=ServerApi("1"), event_listeners=self.event_listeners
+        )
 
         self.database = self._client[self.db_name]
         print("Connected to MongoDB")
@@ -50,6 +63,45 @@ class MongoDB:
             )
         return self.database[collection_name]
 
+    def ensure_collection(self, collection_name: str, **options: Any) -> bool:
+        """
+        Create a collection with specific options (e.g. timeseries) if it does not exist yet.
+        The options of an existing collection can not be changed, so a mismatch is only reported.
+
+        :param      collection_name:  The collection name
+        :type       collection_name:  str
+        :param      options:          The options passed to create_collection
+
+        :returns:   True if the collection was created
+        :rtype:     bool"""
+        if self.database is None:
+            raise Exception(
+                "Database connection not established. Call `connect()` first."
+            )
+        existing = list(
+            self.database.list_collections(filter={"name": collection_name})
+        )
+        if not existing:
+            self.database.create_collection(collection_name, **options)
+            print(f"Created collection {collection_name} with options {options}")
+            return True
+        existing_options = existing[0].get("options", {})
+        for option, value in options.items():
+            if option == "timeseries":
+                # The server adds defaults (e.g. bucketMaxSpanSeconds) to the timeseries options
+                matches = all(
+                    existing_options.get(option, {}).get(k) == v
+                    for k, v in value.items()
+                )
+            else:
+                matches = existing_options.get(option) == value
+            if not matches:
+                print(
+                    f"WARNING: Collection {collection_name} exists with {option}={existing_options.get(option)} "
+                    f"instead of {value}. It needs to be migrated manually."
+                )
+        return False
+
     def drop(self):
         """
         Drops the database
@@ -68,3 +120,114 @@ class MongoDB:
         if self._client:
             self._client.close()
             print("MongoDB connection closed.")
+
+
+class AsyncMongoDB:
+    """
+    This class is used to manage the asynchronous connection with the MongoDB using Motor.
+    A Motor client is bound to the event loop it is used on, so one client is kept per running event loop.
+    A server runs a single event loop and therefore a single connection pool.
+    """
+
+    def __init__(self, url: str, db_name: str, event_listeners: Optional[List[Any]] = None):
+        """
+        Constructs a new instance.
+
+        :param      url:              the mongodb url
+        :type       url:              string
+        :param      db_name:          The database name
+        :type       db_name:          str
+        :param      event_listeners:  The pymongo monitoring listeners of the clients (e.g. for the metrics)
+        :type       event_listeners:  List
+        """
+        self._clients: Dict[asyncio.AbstractEventLoop, AsyncIOMotorClient] = {}
+        self._lock = threading.Lock()
+        self.url = url
+        self.db_name = db_name
+        self.event_listeners = event_listeners or []
+
+    def connect(self):
+        """
+        Prepare the connection. The clients are created lazily inside the running event loop.
+        """
+        print(f"Preparing asynchronous connection to {self.db_name}")
+
+    @property
+    def database(self) -> AsyncIOMotorDatabase:
+        """
+        Retrieve the database using the client of the running event loop.
+
+        :returns:   The database.
+        :rtype:     AsyncIOMotorDatabase
+        """
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            with self._lock:
+                # Close the clients of event loops that do not exist anymore
+                for closed_loop in [l for l in self._clients if l.is_closed()]:
+                    self._clients.pop(closed_loop).close()
+                client = self._clients.get(loop)
+                if client is None:
+                    client = AsyncIOMotorClient(
+                        self.url,
+                        server_api=ServerApi("1"),
+                        io_loop=loop,
+                        event_listeners=self.event_listeners,
+                    )
+                    self._clients[loop] = client
+        return client[self.db_name]
+
+    def get_collection(
+        self, collection_name: str, codec_options: Optional[CodecOptions] = None
+    ) -> "LoopBoundCollection":
+        """
+        Retrieve a specific collection from the database.
+
+        :param      collection_name:  The collection name
+        :type       collection_name:  str
+        :param      codec_options:    The codec options of the collection
+        :type       codec_options:    CodecOptions
+
+        :returns:   The collection.
+        :rtype:     LoopBoundCollection"""
+        return LoopBoundCollection(self, collection_name, codec_options)
+
+    def close(self):
+        """
+        Closes all database connections.
+        """
+        with self._lock:
+            for client in self._clients.values():
+                client.close()
+            self._clients.clear()
+        print("Asynchronous MongoDB connections closed.")
+
+
+class LoopBoundCollection:
+    """
+    This class represents a Motor collection that resolves to the client of the running event loop.
+    Attribute access is forwarded to the AsyncIOMotorCollection, so it can be used the same way.
+    """
+
+    def __init__(
+        self,
+        mongodb: AsyncMongoDB,
+        name: str,
+        codec_options: Optional[CodecOptions] = None,
+    ):
+        self.mongodb = mongodb
+        self.name = name
+        self.codec_options = codec_options
+
+    @property
+    def collection(self) -> AsyncIOMotorCollection:
+        """
+        Retrieve the collection using the client of the running event loop.
+        """
+        return self.mongodb.database.get_collection(
+            self.name, codec_options=self.codec_options
+        )
+
+    def __getattr__(self, attribute: str) -> Any:
+        return getattr(self.collection, attribute)
@@ -1,9 +1,22 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Response, status
+from fastapi.concurrency import run_in_threadpool
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 from fastapi.middleware.cors import CORSMiddleware
 import app.db
-from app.routers import satellites, locations, iss
+from app.db import (
+    ensure_collections,
+    ensure_indexes,
+    backfill_name_keys,
+    migrate_timestamps,
+    async_mongodb,
+)
+from app.routers import satellites, locations, iss, orbits
 from app.config import app_config
-from app.services.task_scheduler import TaskScheduler
+from app.services.task_scheduler import TaskScheduler, lease_manager
+from app.services import pull_position_task
+from app.components.satellite_registry import satellite_registry
+from app.components.event_bus import event_bus
+from app.components import metrics
 
 # Initialize FastAPI application with the provided configuration
 app = FastAPI(
@@ -13,8 +26,34 @@ app = FastAPI(
     version=app_config.app_version,
     terms_of_service=app_config.app_terms_of_service,
 )
-# Initialize the task scheduler
-taskScheduler = TaskScheduler()
+# Initialize the task scheduler. With many workers or replicas, every service runs on the one that holds its lease
+taskScheduler = TaskScheduler(lease_manager if app_config.app_leader_enabled else None)
+
+
+# Create the collections that need options, migrate the stored data and reconcile the declared indexes of all collections when application starts
+# These are blocking pymongo calls, so they run in the threadpool instead of on the event loop
+def prepare_database():
+    ensure_collections()
+    migrate_timestamps()
+    ensure_indexes()
+    backfill_name_keys()
+
+
+@app.on_event("startup")
+async def reconcile_indexes():
+    await run_in_threadpool(prepare_database)
+
+
+# Load the satellites in memory when application starts
+@app.on_event("startup")
+async def load_satellite_registry():
+    await run_in_threadpool(satellite_registry.refresh)
+
+
+# Follow the locations and the cache invalidations of the other workers or replicas when application starts
+@app.on_event("startup")
+async def start_event_bus():
+    event_bus.start()
 
 
 # Start the task scheduler when application starts
@@ -23,10 +62,38 @@ async def start_scheduler():
     taskScheduler.start()
 
 
-# Stop the task scheduler when application starts
+# Stop the task scheduler, release its leases and flush the buffered locations when application stops
+def drain_scheduler():
+    # The write-ahead log is shared by the workers of the host, so it is only replayed by the one that runs the service
+    replay = not app_config.app_leader_enabled or lease_manager.held("pull_position")
+    taskScheduler.stop()
+    pull_position_task.poller.close()
+    # Store the buffered locations, or keep them in the write-ahead log if the database is unreachable
+    pull_position_task.flush(replay)
+
+
 @app.on_event("shutdown")
 async def stop_scheduler():
-    taskScheduler.stop()
+    await run_in_threadpool(drain_scheduler)
+
+
+# Stop following the events of the other workers or replicas when application stops
+@app.on_event("shutdown")
+async def stop_event_bus():
+    # Joining the publisher and the follower threads blocks until they finish
+    await run_in_threadpool(event_bus.stop)
+
+
+# Drop the live metrics of the worker when application stops, so the other workers of the host do not expose them
+@app.on_event("shutdown")
+async def remove_metrics():
+    metrics.mark_process_dead()
+
+
+# Close the asynchronous database connections when application stops
+@app.on_event("shutdown")
+async def close_database():
+    async_mongodb.close()
 
 
 # To allow localhost:3000 to connect. Normally for production this should be removed and replaced with the actual origins.
@@ -43,13 +110,27 @@ app.add_middleware(
 )
 
 
+# Record the latency of every request per route for /api/metrics
+if app_config.app_metrics_enabled:
+    app.add_middleware(metrics.MetricsMiddleware)
+
+
 # Import all routers
 app.include_router(satellites.router, tags=["Satellite"], prefix="/api/satellite")
 app.include_router(locations.router, tags=["Location"], prefix="/api/location")
 app.include_router(iss.router, tags=["ISS"], prefix="/api/iss")
+app.include_router(orbits.router, tags=["Orbit"], prefix="/api/orbit")
 
 
 # Dummy router to healthcheck the API
 @app.get("/api/healthchecker", tags=["Generic"])
 def healthchecker():
     return {"message": "Welcome to Interactive Maps API"}
+
+
+# Metrics of the process, or of every worker of the host in multiprocess mode, in the Prometheus text format. Look at metrics in app_config.yaml for how it is configured
+@app.get("/api/metrics", tags=["Generic"], include_in_schema=app_config.app_metrics_enabled)
+def get_metrics():
+    if not app_config.app_metrics_enabled:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="The metrics are disabled.")
+    return Response(generate_latest(metrics.exposition_registry()), media_type=CONTENT_TYPE_LATEST)
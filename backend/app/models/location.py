@@ -1,6 +1,6 @@
 from pydantic import BaseModel, Field
 from datetime import datetime
-from typing import List
+from typing import List, Optional
 
 """
 Schema that holds the Location information from a satellite.
@@ -50,5 +50,69 @@ Schema used whenever there is a need to reply with a list of LocationSchemas
 class ListLocationResponses(BaseModel):
     status: str
     results: int
-    total: int
+    total: Optional[int] = None  # None when the locations were served from memory and they were not counted recently
+    total_mode: Optional[str] = None  # How the total was counted: exact, estimated, maintained or cached
+    next_cursor: Optional[str] = None  # Pass it as "cursor" to get the next page
     locations: List[LocationInDBSchema]
+
+
+"""
+Schema used to reply with the locations of a time range from a retention tier
+"""
+
+
+class LocationHistoryResponse(BaseModel):
+    status: str
+    sat_id: int
+    resolution: int  # Seconds between two locations of the retention tier that was used
+    results: int
+    locations: List[LocationInDBSchema]
+
+
+"""
+Schema that holds a point of a simplified ground track
+"""
+
+
+class TrackPoint(BaseModel):
+    latitude: float
+    longitude: float
+    timestamp: datetime
+
+
+"""
+Schema used to reply with a simplified ground track. The track is split where it crosses the antimeridian
+and where locations are missing, so every segment can be drawn as its own polyline.
+"""
+
+
+class TrackResponse(BaseModel):
+    status: str
+    sat_id: int
+    resolution: int  # Seconds between two locations of the retention tier that was simplified
+    results: int  # Number of points of all segments
+    segments: List[List[TrackPoint]]
+
+
+"""
+Schema that holds the result of a single location of a bulk request
+"""
+
+
+class BulkItemResponse(BaseModel):
+    index: int  # Position of the location in the request
+    status: str  # "created" or "error"
+    id: Optional[str] = Field(None, alias="_id")
+    detail: Optional[str] = None  # Why the location was not created
+
+
+"""
+Schema used to reply to a bulk request with the result of every location
+"""
+
+
+class BulkLocationResponse(BaseModel):
+    status: str  # "success", "partial" or "error"
+    results: int  # Number of created locations
+    errors: int
+    items: List[BulkItemResponse]
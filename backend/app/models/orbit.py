@@ -0,0 +1,89 @@
+from pydantic import BaseModel, Field, field_validator, model_validator
+from datetime import datetime
+from typing import List
+from app.models.location import LocationSchema
+
+"""
+Schema that holds the Two-Line Element set (TLE) of a satellite, used to predict its locations.
+This is almost identical to the https://api.wheretheiss.at/v1/satellites/{id}/tles schema for easy ingestion
+"""
+
+
+class TLESchema(BaseModel):
+    sat_id: int  # Used to link the TLE to a satellite
+    line1: str
+    line2: str
+
+    @field_validator("line1", "line2")
+    @classmethod
+    def check_line(cls, line: str, info) -> str:
+        # Every line has 69 characters, starts with its number and ends with the checksum of the others
+        line = line.strip()
+        number = "1" if info.field_name == "line1" else "2"
+        if len(line) != 69 or not line.startswith(f"{number} "):
+            raise ValueError(f"Line {number} of a TLE has 69 characters and starts with '{number} '")
+        checksum = sum(int(c) if c.isdigit() else c == "-" for c in line[:68]) % 10
+        if line[68] != str(checksum):
+            raise ValueError(f"Invalid checksum of line {number}. Expected {checksum}")
+        return line
+
+    @model_validator(mode="after")
+    def check_lines(self) -> "TLESchema":
+        # Both lines describe the same satellite
+        if self.line1[2:7] != self.line2[2:7]:
+            raise ValueError("The lines of a TLE have different catalog numbers")
+        return self
+
+
+"""
+TLESchema with the addition of the "_id" that MongoDB will assign and of the epoch of the TLE
+"""
+
+
+class TLEInDBSchema(TLESchema):
+    id: str = Field(None, alias="_id")
+    epoch: datetime  # The predictions are the most accurate around the epoch
+
+
+"""
+Schema used whenever there is a need to reply with a TLESchema
+"""
+
+
+class TLEResponse(BaseModel):
+    status: str
+    tle: TLEInDBSchema
+
+
+"""
+Schema used to reply with predicted locations. They have the same fields as the locations pulled from the sat_loc API.
+"""
+
+
+class PredictedLocationsResponse(BaseModel):
+    status: str
+    results: int
+    locations: List[LocationSchema]
+
+
+"""
+Schema that holds a predicted daylight window
+"""
+
+
+class DaylightWindow(BaseModel):
+    start: datetime
+    end: datetime
+
+
+"""
+Schema used to reply with the predicted daylight windows of a satellite
+"""
+
+
+class PredictedDaylightWindowsResponse(BaseModel):
+    status: str
+    sat_id: int
+    orbits: float
+    results: int
+    windows: List[DaylightWindow]
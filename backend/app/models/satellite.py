@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field
-from typing import List
+from typing import List, Optional
 
 """
 Schema that holds the Satellite information.
@@ -41,4 +41,6 @@ class ListSatelliteResponses(BaseModel):
     status: str
     results: int
     total: int
+    total_mode: Optional[str] = None  # How the total was counted: exact, estimated, maintained or cached
+    next_cursor: Optional[str] = None  # Pass it as "cursor" to get the next page
     satellites: List[SatelliteInDBSchema]
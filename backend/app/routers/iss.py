@@ -1,56 +1,106 @@
+import asyncio
 from datetime import datetime, timezone
+from typing import AsyncIterator, Dict, List, Optional
 from fastapi import (
     HTTPException,
     status,
     APIRouter,
+    Query,
+    Request,
+    WebSocket,
+    WebSocketDisconnect,
 )
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 
 from app.models import iss
-from app.db import SatellitesCRUD, LocationsCRUD
+from app.db import (
+    AsyncSatellitesCRUD,
+    AsyncLocationsCRUD,
+    AsyncDaylightWindowsCRUD,
+)
 from app.utils.model_utils import objectid_to_str
+from app.utils.pagination import time_range
 from app.config import app_config
-from app.utils.model_utils import objectid_to_str
-from app.components.location import LocationComponent
+from app.components.location_cache import location_cache
+from app.components.broadcaster import broadcaster, BroadcastMessage, Subscription
+from app.components.satellite_registry import satellite_registry
+from app.routers.orbits import find_tle, predict_daylight_windows
 
 router = APIRouter()
 
 
+def daylight_windows_pipeline(
+    sat_id: int, from_: Optional[datetime] = None, to: Optional[datetime] = None
+) -> List[Dict]:
+    """
+    Builds the pipeline that returns the daylight windows of a satellite that overlap with a time range.
+    """
+    filters = {"sat_id": sat_id}
+    bounds = time_range(from_, to)
+    if "$gte" in bounds:
+        filters["end"] = {"$gte": bounds["$gte"]}
+    if "$lte" in bounds:
+        filters["start"] = {"$lte": bounds["$lte"]}
+    return [
+        {"$match": filters},
+        {"$sort": {"end": 1}},  # 1 for ascending order (oldest to newest)
+        {"$project": {"_id": 0, "start": 1, "end": 1}},
+    ]
+
+
+def last_location_pipeline(sat_id: int) -> List[Dict]:
+    """
+    Builds the pipeline that returns the last location of a satellite.
+    """
+    return [
+        {"$match": {"sat_id": sat_id}},
+        {"$sort": {"timestamp": -1}},  # -1 for descending order (newest to oldest),
+        {"$limit": 1},  # Setting limit to 1 optimizes performance for the search
+    ]
+
+
+async def find_satellite(sat_id: int) -> Dict:
+    """
+    Finds a satellite in the in-memory registry. Unknown satellites are searched in the database,
+    since they may have been created by another process.
+    """
+    if satellite_registry.stale():
+        await run_in_threadpool(satellite_registry.refresh)
+    satellite = satellite_registry.get(sat_id)
+    if satellite is None:
+        satellite = await AsyncSatellitesCRUD.find_one({"sat_id": sat_id})
+    if satellite is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"ISS Satellite with id {sat_id} not found in db.",
+        )
+    return satellite
+
+
 # Get the Timestamps when the ISS is exposed to the sun
 @router.get(
     "/sun",
     response_model=iss.ISSSun,
     summary="Timestamps when the ISS is exposed to the sun",
 )
-def iss_sun():
-    # Retrieve the iss satellite from the database
-    iss = SatellitesCRUD.find_one({"sat_id": app_config.app_iss_id})
-    if iss is None:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"ISS Satellite with id {app_config.app_iss_id} not found in db.",
-        )
+async def iss_sun(
+    from_: datetime | None = Query(None, alias="from"),
+    to: datetime | None = None,
+):
+    # Retrieve the iss satellite from memory
+    iss = await find_satellite(app_config.app_iss_id)
 
-    # Get all locations of the ISS sorted by ascending order
-    pipeline = [
-        {"$match": {"sat_id": iss["sat_id"]}},
-        {"$sort": {"timestamp": 1}},  # 1 for ascending order (oldest to newest)
-    ]
+    # The daylight windows are materialized by the pull_position service. The locations written through the API
+    # are included once the windows of the satellite are rebuilt, with its next pulled location.
+    # Get only the windows that overlap with the requested time range.
+    pipeline = daylight_windows_pipeline(iss["sat_id"], from_, to)
     try:
-        locations = LocationsCRUD.aggregate(pipeline)
+        windows = await AsyncDaylightWindowsCRUD.aggregate(pipeline)
     except HTTPException as e:
         raise HTTPException(
             status_code=e.status_code,
-            detail=f"Error retrieving locations for {iss}: {e}",
-        )
-
-    # The windows List will store or time windows of "daylight"
-    locationComponent = LocationComponent()
-    try:
-        windows = locationComponent.get_daylight_windows(locations)
-    except Exception as e:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Error calculating daylight windows for {iss}: {e}",
+            detail=f"Error retrieving daylight windows for {iss}: {e}",
         )
 
     return {
@@ -60,6 +110,25 @@ def iss_sun():
     }
 
 
+# Predict the Timestamps when the ISS will be exposed to the sun, from its TLE (look at the orbit router)
+@router.get(
+    "/sun/predicted",
+    response_model=iss.ISSSun,
+    summary="Predicted timestamps when the ISS will be exposed to the sun in the next orbits",
+)
+async def iss_sun_predicted(
+    from_: datetime | None = Query(None, alias="from", description="Now by default"),
+    orbits: float = Query(1, gt=0, le=app_config.app_orbit_max_orbits),
+):
+    tle = await find_tle(app_config.app_iss_id)
+    windows = await predict_daylight_windows(tle, from_, orbits)
+    return {
+        "sat_id": tle["sat_id"],
+        "results": len(windows),
+        "windows": windows,
+    }
+
+
 # Get the last known location of the iss. We are capturing the location of the ISS with the Background task at the maximum frequency (20s).
 # So we consider the last known location as the "present time".
 @router.get(
@@ -67,24 +136,25 @@ def iss_sun():
     response_model=iss.ISSPos,
     summary="Get the last known location of the iss",
 )
-def iss_loc():
-    # Retrieve the iss satellite from the database
-    iss = SatellitesCRUD.find_one({"sat_id": app_config.app_iss_id})
-    if iss is None:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"ISS Satellite with id {app_config.app_iss_id} not found in db.",
-        )
+async def iss_loc():
+    # The pull_position service keeps the latest location of every satellite in memory
+    location = location_cache.latest(app_config.app_iss_id)
+    if location is not None:
+        return {
+            "sat_id": location["sat_id"],
+            "latitude": location["latitude"],
+            "longitude": location["longitude"],
+            "timestamp": location["timestamp"],
+        }
+
+    # On a cache miss, retrieve the iss satellite from memory
+    iss = await find_satellite(app_config.app_iss_id)
 
     # Search the last location captured for the ISS.
-    pipeline = [
-        {"$match": {"sat_id": iss["sat_id"]}},
-        {"$sort": {"timestamp": -1}},  # -1 for descending order (newest to oldest),
-        {"$limit": 1},  # Setting limit to 1 optimizes performance for the search
-    ]
+    pipeline = last_location_pipeline(iss["sat_id"])
     try:
         # Aggregate() returns a List
-        locations = LocationsCRUD.aggregate(pipeline)
+        locations = await AsyncLocationsCRUD.aggregate(pipeline)
     except HTTPException as e:
         raise HTTPException(
             status_code=e.status_code,
@@ -100,3 +170,88 @@ def iss_loc():
         return_dict["longitude"] = locations[0]["longitude"]
         return_dict["timestamp"] = locations[0]["timestamp"]
     return return_dict
+
+
+async def sse_events(request: Request, subscription) -> AsyncIterator[bytes]:
+    """
+    Yields the Server-Sent Events of a subscription until the client disconnects.
+    """
+    try:
+        # Start with the last known location so that the client does not wait for the next poll
+        location = location_cache.latest(subscription.topic)
+        if location is not None:
+            yield BroadcastMessage.from_location(location).sse
+        while not await request.is_disconnected():
+            try:
+                message = await asyncio.wait_for(
+                    subscription.get(), timeout=app_config.app_stream_keepalive
+                )
+            except asyncio.TimeoutError:
+                # SSE comment that keeps proxies from closing an idle connection
+                yield b": keep-alive\n\n"
+                continue
+            yield message.sse
+    finally:
+        broadcaster.unsubscribe(subscription)
+
+
+# Stream the location of the iss with Server-Sent Events. Every location stored by the pull_position service is pushed to the client.
+@router.get(
+    "/stream",
+    summary="Stream the location of the iss with Server-Sent Events",
+    response_class=StreamingResponse,
+)
+async def iss_stream(request: Request):
+    subscription = broadcaster.subscribe(app_config.app_iss_id)
+    return StreamingResponse(
+        sse_events(request, subscription),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+# Stream the location of the iss over a WebSocket. The messages have the same keys as /position.
+# The socket is read alongside the stream, so a client that disconnects is noticed even while no location is sent.
+@router.websocket("/ws")
+async def iss_ws(websocket: WebSocket):
+    subscription = broadcaster.subscribe(app_config.app_iss_id)
+    try:
+        await websocket.accept()
+        tasks = [
+            asyncio.create_task(send_iss_locations(websocket, subscription)),
+            asyncio.create_task(receive_until_disconnect(websocket)),
+        ]
+        try:
+            # The connection ends as soon as one of them ends
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        broadcaster.unsubscribe(subscription)
+
+
+async def send_iss_locations(websocket: WebSocket, subscription: Subscription) -> None:
+    """
+    Sends the cached location of the iss and then every new one.
+    """
+    location = location_cache.latest(app_config.app_iss_id)
+    if location is not None:
+        await websocket.send_text(BroadcastMessage.from_location(location).json)
+    while True:
+        message = await subscription.get()
+        await websocket.send_text(message.json)
+
+
+async def receive_until_disconnect(websocket: WebSocket) -> None:
+    """
+    Reads the messages of the client, which are ignored, until it disconnects.
+    """
+    while True:
+        message = await websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            return
@@ -1,41 +1,198 @@
-from fastapi import status, APIRouter, HTTPException
+import json
+from datetime import datetime, timedelta, timezone
+from typing import AsyncIterator, Dict, List, Literal, Optional, Tuple
+from fastapi import status, APIRouter, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
 
 from app.models import location
-from app.db import LocationsCRUD
-from app.utils.model_utils import objectid_to_str
+from app.db import AsyncLocationsCRUD, AsyncRollupsCRUD
+from app.db.async_crud import AsyncCRUD
+from app.config import app_config
+from app.components.location_cache import location_cache
+from app.components.event_bus import event_bus
+from app.components.retention import retention_policy, RetentionTier
+from app.components.track import TrackComponent, track_cache
+from app.utils.model_utils import objectid_to_str, document_to_json, to_utc_datetime
+from app.utils.pagination import decode_cursor, keyset_filter, next_cursor, time_range
+from app.utils.responses import list_response
 
 router = APIRouter()
 
+# The locations are paginated on their timestamp. The _id breaks ties between equal timestamps.
+LOCATION_CURSOR_FIELDS = ["timestamp", "_id"]
+# Media types of the export formats
+EXPORT_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "json": "application/json"}
+# Content types that are read line by line by the bulk endpoint
+NDJSON_CONTENT_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonl")
+
+
+def locations_pipeline(
+    limit: int, page: int, cursor: Optional[str] = None
+) -> List[Dict]:
+    """
+    Builds the pipeline that returns a page of all locations, oldest first.
+    The sort on ("timestamp", "_id") makes the pages stable and lets the query use the timestamp index.
+    When a cursor is provided the page starts right after it, otherwise the page number is used.
+    """
+    if cursor is not None:
+        values = decode_cursor(cursor, LOCATION_CURSOR_FIELDS)
+        match, skip = keyset_filter(values, LOCATION_CURSOR_FIELDS, 1), 0
+    else:
+        # Calculate the right amount of skipped pages based on input
+        match, skip = {}, (page - 1) * limit
+    return [
+        {"$match": match},
+        {"$sort": {"timestamp": 1, "_id": 1}},  # 1 for ascending order (oldest to newest)
+        {"$skip": skip},
+        {"$limit": limit},
+    ]
+
+
+def last_locations_pipeline(
+    sat_id: int,
+    limit: int,
+    page: int,
+    cursor: Optional[str] = None,
+    from_: Optional[datetime] = None,
+    to: Optional[datetime] = None,
+) -> List[Dict]:
+    """
+    Builds the pipeline that returns a page of the locations of a satellite, newest first.
+    Sorting before skipping lets the query walk the (sat_id, timestamp, _id) index instead of sorting in memory.
+    When a cursor is provided the page starts right after it, otherwise the page number is used.
+    A time range becomes the bounds of the timestamp in the same index scan.
+    """
+    match = {"sat_id": sat_id}
+    bounds = time_range(from_, to)
+    if bounds:
+        match["timestamp"] = bounds
+    if cursor is not None:
+        values = decode_cursor(cursor, LOCATION_CURSOR_FIELDS)
+        keyset = keyset_filter(values, LOCATION_CURSOR_FIELDS, -1)
+        if bounds:
+            # The cursor bounds the timestamp as well. The bounds of both are intersected by the query planner
+            match["$and"] = [{"timestamp": keyset.pop("timestamp")}]
+        match.update(keyset)
+        skip = 0
+    else:
+        # Calculate the right amount of skipped pages based on input
+        skip = (page - 1) * limit
+    return [
+        {"$match": match},
+        {"$sort": {"timestamp": -1, "_id": -1}},  # -1 for descending order (newest to oldest),
+        {"$skip": skip},
+        {"$limit": limit},
+    ]
+
 
 @router.get(
     "/", response_model=location.ListLocationResponses, summary="Get the first records"
 )
-def get_locations(
+async def get_locations(
     limit: int = 10,
     page: int = 1,
+    cursor: str | None = None,
 ):
-    # Calculate the right amount of skipped pages based on input
-    skip = (page - 1) * limit
-    pipeline = [
-        {"$match": {}},
-        {"$skip": skip},
-        {"$limit": limit},
-    ]
+    pipeline = locations_pipeline(limit, page, cursor)
 
     # Run pipeline and get the locations
     try:
-        locations = LocationsCRUD.aggregate(pipeline)
+        locations = await AsyncLocationsCRUD.aggregate(pipeline)
     except HTTPException as e:
         raise HTTPException(
             status_code=e.status_code,
             detail=f"Error retrieving locations with pipeline {pipeline}: {e}",
         )
-    return {
-        "status": "success",
-        "results": len(locations),
-        "total": LocationsCRUD.count(),
-        "locations": objectid_to_str(locations),
-    }
+    # The total comes from the maintained count instead of scanning the collection on every page
+    total, total_mode = await AsyncLocationsCRUD.total()
+    return list_response(
+        {
+            "status": "success",
+            "results": len(locations),
+            "total": total,
+            "total_mode": total_mode,
+            "next_cursor": next_cursor(locations, limit, LOCATION_CURSOR_FIELDS),
+            "locations": locations,
+        },
+        location.ListLocationResponses,
+    )
+
+
+def export_pipeline(pipeline: List[Dict]) -> List[Dict]:
+    """
+    Removes the $skip and $limit stages that do nothing from a listing pipeline, so that a limit of 0 exports everything.
+    """
+    return [stage for stage in pipeline if stage not in ({"$skip": 0}, {"$limit": 0})]
+
+
+def location_to_json(document: Dict) -> str:
+    """
+    Serializes a location the same way as the LocationInDBSchema, without validating it.
+    """
+    # Older locations hold epoch seconds instead of datetimes
+    if isinstance(document.get("timestamp"), (int, float)):
+        document["timestamp"] = to_utc_datetime(document["timestamp"])
+    return document_to_json(document)
+
+
+async def export_chunks(
+    first: List[Dict], batches: AsyncIterator[List[Dict]], format_: str
+) -> AsyncIterator[bytes]:
+    """
+    Writes the batches of locations as NDJSON (one location per line) or as a JSON array.
+    One chunk is written per batch, so only one batch is held in memory at a time.
+    """
+    ndjson = format_ == "ndjson"
+    if not ndjson:
+        yield b"["
+    batch, written = first, 0
+    while batch:
+        chunk = ("\n" if ndjson else ",").join(location_to_json(l) for l in batch)
+        if ndjson:
+            chunk += "\n"
+        elif written:
+            chunk = "," + chunk
+        yield chunk.encode("utf-8")
+        written += len(batch)
+        # An error after this point can not change the status code anymore, the response ends incomplete
+        batch = await anext(batches, [])
+    if not ndjson:
+        yield b"]"
+
+
+async def export_locations(pipeline: List[Dict], format_: str) -> StreamingResponse:
+    """
+    Streams the results of a pipeline. The query runs before the response starts,
+    so that its errors are still returned with their status code.
+    """
+    batches = AsyncLocationsCRUD.aggregate_batches(
+        export_pipeline(pipeline), app_config.app_export_batch_size
+    )
+    try:
+        first = await anext(batches, [])
+    except HTTPException as e:
+        raise HTTPException(
+            status_code=e.status_code,
+            detail=f"Error exporting locations with pipeline {pipeline}: {e}",
+        )
+    return StreamingResponse(
+        export_chunks(first, batches, format_), media_type=EXPORT_MEDIA_TYPES[format_]
+    )
+
+
+@router.get(
+    "/export",
+    response_class=StreamingResponse,
+    summary="Stream all records as NDJSON or as a JSON array",
+)
+async def export_all_locations(
+    limit: int = Query(0, ge=0, description="0 exports all the records"),
+    cursor: str | None = None,
+    format_: Literal["ndjson", "json"] = Query("ndjson", alias="format"),
+):
+    return await export_locations(locations_pipeline(limit, 1, cursor), format_)
 
 
 @router.get(
@@ -43,11 +200,11 @@ def get_locations(
     response_model=location.LocationResponse,
     summary="Get single location using Database ID",
 )
-def get_location(
+async def get_location(
     locationId: str,
 ):
     # Try to get the required location. The CRUD function is managing the HttpExceptions
-    result = LocationsCRUD.read(locationId)
+    result = await AsyncLocationsCRUD.read(locationId)
 
     return {"status": "success", "location": objectid_to_str(result)}
 
@@ -57,40 +214,208 @@ def get_location(
     response_model=location.ListLocationResponses,
     summary="Get the last records for a specific satellite (sat_id)",
 )
-def get_last_locations(
+async def get_last_locations(
     sat_id: int,
     limit: int = 10,
     page: int = 1,
+    cursor: str | None = None,
+    from_: datetime | None = Query(None, alias="from"),
+    to: datetime | None = None,
 ):
-    # Calculate the right amount of skipped pages based on input
-    skip = (page - 1) * limit
-    pipeline = [
-        {"$match": {"sat_id": sat_id}},
-        {"$skip": skip},
-        {"$sort": {"timestamp": -1}},  # -1 for descending order (newest to oldest),
-        {"$limit": limit},
-    ]
+    # The total counts the locations of the time range, if there is one
+    filters = {"sat_id": sat_id}
+    bounds = time_range(from_, to)
+    if bounds:
+        filters["timestamp"] = bounds
+
+    # The first page is usually served from the latest locations that the pull_position service keeps in memory
+    if page == 1 and cursor is None and not bounds:
+        locations = location_cache.last(sat_id, limit)
+        if locations is not None:
+            # The database is not queried for the total either, so it is only reported if it was counted recently.
+            # The cached locations may not be stored yet (look at storage.buffer in app_config.yaml), so they are counted.
+            total, total_mode = AsyncLocationsCRUD.cached_total(filters)
+            if total is not None:
+                total = max(total, len(locations))
+            return list_response(
+                {
+                    "status": "success",
+                    "results": len(locations),
+                    "total": total,
+                    "total_mode": total_mode,
+                    "next_cursor": next_cursor(locations, limit, LOCATION_CURSOR_FIELDS),
+                    "locations": locations,
+                },
+                location.ListLocationResponses,
+            )
+
+    pipeline = last_locations_pipeline(sat_id, limit, page, cursor, from_, to)
 
     # Run pipeline and get the locations
     try:
-        locations = LocationsCRUD.aggregate(pipeline)
+        locations = await AsyncLocationsCRUD.aggregate(pipeline)
     except HTTPException as e:
         raise HTTPException(
             status_code=e.status_code,
             detail=f"Error retrieving locations with pipeline {pipeline}: {e}",
         )
-    # Raise an exception if no locations were found
-    if not locations:
+    # Raise an exception if no locations were found.
+    # An empty page after a cursor is the end of the results and a time range can be empty.
+    if not locations and cursor is None and not bounds:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"No locations found for sat_id {sat_id}.",
         )
-    return {
+    total, total_mode = await AsyncLocationsCRUD.total(filters)
+    return list_response(
+        {
+            "status": "success",
+            "results": len(locations),
+            "total": total,
+            "total_mode": total_mode,
+            "next_cursor": next_cursor(locations, limit, LOCATION_CURSOR_FIELDS),
+            "locations": locations,
+        },
+        location.ListLocationResponses,
+    )
+
+
+def history_pipeline(
+    sat_id: int, from_: Optional[datetime] = None, to: Optional[datetime] = None
+) -> List[Dict]:
+    """
+    Builds the pipeline that returns the locations of a satellite in a time range, oldest first.
+    It runs on the raw locations or on the rollups of a retention tier, which are both indexed on (sat_id, timestamp).
+    """
+    match = {"sat_id": sat_id}
+    bounds = time_range(from_, to)
+    if bounds:
+        match["timestamp"] = bounds
+    return [
+        {"$match": match},
+        {"$sort": {"timestamp": 1}},  # 1 for ascending order (oldest to newest)
+    ]
+
+
+def retention_crud(
+    from_: Optional[datetime], to: Optional[datetime]
+) -> Tuple[RetentionTier, AsyncCRUD]:
+    """
+    Picks the retention tier of a time range and the CRUD of its collection.
+    Look at retention in app_config.yaml for how the tier is picked.
+    """
+    tier = retention_policy.select(from_, to)
+    if tier is retention_policy.raw:
+        return tier, AsyncLocationsCRUD
+    return tier, AsyncRollupsCRUD[tier.resolution]
+
+
+@router.get(
+    "/by_sat_id/{sat_id}/history",
+    response_model=location.LocationHistoryResponse,
+    summary="Get the records of a time range for a specific satellite (sat_id), from the coarsest retention tier that covers it",
+)
+async def get_location_history(
+    sat_id: int,
+    from_: datetime | None = Query(None, alias="from"),
+    to: datetime | None = None,
+):
+    tier, crud = retention_crud(from_, to)
+    pipeline = history_pipeline(sat_id, from_, to)
+    try:
+        locations = await crud.aggregate(pipeline)
+    except HTTPException as e:
+        raise HTTPException(
+            status_code=e.status_code,
+            detail=f"Error retrieving locations from {tier.name} with pipeline {pipeline}: {e}",
+        )
+    return list_response(
+        {
+            "status": "success",
+            "sat_id": sat_id,
+            "resolution": tier.resolution,
+            "results": len(locations),
+            "locations": locations,
+        },
+        location.LocationHistoryResponse,
+    )
+
+
+@router.get(
+    "/by_sat_id/{sat_id}/track",
+    response_model=location.TrackResponse,
+    summary="Get the simplified ground track of a specific satellite (sat_id) in a time range, as polyline segments",
+)
+async def get_track(
+    sat_id: int,
+    from_: datetime | None = Query(
+        None, alias="from", description="About one orbit before the end by default"
+    ),
+    to: datetime | None = None,
+    points: int | None = Query(None, ge=2, le=10000, description="Simplify with LTTB to this number of points"),
+    tolerance: float | None = Query(
+        None, gt=0, description="Simplify with Douglas-Peucker to this tolerance in degrees"
+    ),
+):
+    if points is not None and tolerance is not None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Use either points or tolerance.",
+        )
+    if points is None and tolerance is None:
+        points = app_config.app_track_default_points
+
+    # The key holds the requested range, so that a range that ends now is cached until it expires
+    key = (sat_id, from_, to, points, tolerance)
+    track = track_cache.get(key)
+    if track is not None:
+        return track
+
+    if from_ is None:
+        from_ = (to or datetime.now(timezone.utc)) - timedelta(
+            seconds=app_config.app_track_default_range
+        )
+    tier, crud = retention_crud(from_, to)
+    pipeline = history_pipeline(sat_id, from_, to) + [
+        {"$project": {"_id": 0, "latitude": 1, "longitude": 1, "timestamp": 1}}
+    ]
+    try:
+        locations = await crud.aggregate(pipeline)
+    except HTTPException as e:
+        raise HTTPException(
+            status_code=e.status_code,
+            detail=f"Error retrieving locations from {tier.name} with pipeline {pipeline}: {e}",
+        )
+    # The simplification runs in a thread, so that long tracks do not block the other requests
+    trackComponent = TrackComponent(app_config.app_track_max_gap)
+    segments = await run_in_threadpool(
+        trackComponent.simplify, locations, tier.resolution, points, tolerance
+    )
+    track = {
         "status": "success",
-        "results": len(locations),
-        "total": len(locations),
-        "locations": objectid_to_str(locations),
+        "sat_id": sat_id,
+        "resolution": tier.resolution,
+        "results": sum(len(segment) for segment in segments),
+        "segments": segments,
     }
+    track_cache.put(key, track)
+    return track
+
+
+@router.get(
+    "/by_sat_id/{sat_id}/export",
+    response_class=StreamingResponse,
+    summary="Stream the records of a specific satellite (sat_id) as NDJSON or as a JSON array, newest first",
+)
+async def export_sat_locations(
+    sat_id: int,
+    limit: int = Query(0, ge=0, description="0 exports all the records"),
+    cursor: str | None = None,
+    format_: Literal["ndjson", "json"] = Query("ndjson", alias="format"),
+):
+    return await export_locations(
+        last_locations_pipeline(sat_id, limit, 1, cursor), format_
+    )
 
 
 @router.post(
@@ -99,27 +424,177 @@ def get_last_locations(
     response_model=location.LocationResponse,
     summary="Create a new record",
 )
-def create_location(
+async def create_location(
     payload: location.LocationSchema,
 ):
     # Create a new Location ignoring all None properties. The CRUD function is managing the HttpExceptions
-    result = LocationsCRUD.create(payload.dict(exclude_none=True))
+    result = await AsyncLocationsCRUD.create(payload.dict(exclude_none=True))
+    # The cached latest locations of the satellite may not include the new one anymore
+    event_bus.invalidate([result["sat_id"]])
 
     # Try to read the newly created location to confirm it was created. The CRUD function is managing the HttpExceptions
-    new_location = LocationsCRUD.read(str(result["_id"]))
+    new_location = await AsyncLocationsCRUD.read(str(result["_id"]))
 
     return {"status": "success", "location": objectid_to_str(new_location)}
 
 
+async def ndjson_items(request: Request) -> AsyncIterator[object]:
+    """
+    Reads an NDJSON body line by line while it is received. Empty lines are skipped.
+    A line that is not valid JSON is returned as the error that it raised, so that it can be reported by its index.
+    """
+    buffer = b""
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield parse_line(line)
+    if buffer.strip():
+        yield parse_line(buffer)
+
+
+def parse_line(line: bytes) -> object:
+    """
+    Parses a line of an NDJSON body.
+    """
+    try:
+        return json.loads(line)
+    except ValueError as e:
+        return e
+
+
+async def json_items(request: Request) -> AsyncIterator[object]:
+    """
+    Reads a JSON array body.
+    """
+    try:
+        items = await request.json()
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"The body is not valid JSON: {e}",
+        )
+    if not isinstance(items, list):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="The body must be a JSON array of locations.",
+        )
+    for item in items:
+        yield item
+
+
+def validate_item(item: object) -> Tuple[Optional[Dict], Optional[str]]:
+    """
+    Validates a location of a bulk request.
+
+    :returns:   The location to be inserted or the reason it is invalid
+    """
+    if isinstance(item, ValueError):
+        return None, f"Invalid JSON: {item}"
+    if not isinstance(item, dict):
+        return None, "A location must be a JSON object."
+    try:
+        return location.LocationSchema(**item).dict(exclude_none=True), None
+    except ValidationError as e:
+        return None, "; ".join(
+            f"{'.'.join(str(field) for field in error['loc'])}: {error['msg']}"
+            for error in e.errors()
+        )
+
+
+async def insert_batch(batch: List[Tuple[int, Dict]], items: Dict[int, Dict]) -> None:
+    """
+    Inserts a batch of valid locations with a single unordered insert and records the result of every location.
+    The created locations are not read back, their `_id` is set by the insert.
+    """
+    created, errors = await AsyncLocationsCRUD.bulk_create([data for _, data in batch])
+    for position, (index, _) in enumerate(batch):
+        if position in created:
+            items[index] = {
+                "index": index,
+                "status": "created",
+                "_id": str(created[position]["_id"]),
+            }
+        else:
+            items[index] = {"index": index, "status": "error", "detail": errors[position]}
+    # The cached latest locations of the satellites may not include the new ones anymore
+    event_bus.invalidate([data["sat_id"] for data in created.values()])
+
+
+@router.post(
+    "/bulk",
+    status_code=status.HTTP_201_CREATED,
+    response_model=location.BulkLocationResponse,
+    summary="Create many records from a JSON array or an NDJSON stream",
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {
+                "application/json": {
+                    "schema": {
+                        "type": "array",
+                        "items": {"$ref": "#/components/schemas/LocationSchema"},
+                    }
+                },
+                "application/x-ndjson": {
+                    "schema": {"$ref": "#/components/schemas/LocationSchema"},
+                    "description": "One location per line",
+                },
+            },
+        }
+    },
+)
+async def create_locations(request: Request):
+    content_type = request.headers.get("content-type", "").split(";")[0].strip()
+    if content_type in NDJSON_CONTENT_TYPES:
+        source = ndjson_items(request)
+    else:
+        source = json_items(request)
+
+    # The locations are inserted in batches while the body is read, so only one batch is held in memory at a time
+    items: Dict[int, Dict] = {}
+    batch: List[Tuple[int, Dict]] = []
+    index = 0
+    async for item in source:
+        data, detail = validate_item(item)
+        if data is None:
+            items[index] = {"index": index, "status": "error", "detail": detail}
+        else:
+            batch.append((index, data))
+        if len(batch) == app_config.app_bulk_batch_size:
+            await insert_batch(batch, items)
+            batch = []
+        index += 1
+    if batch:
+        await insert_batch(batch, items)
+
+    results = [items[i] for i in range(index)]
+    created = sum(1 for item in results if item["status"] == "created")
+    if created == len(results):
+        result_status = "success"
+    elif created:
+        result_status = "partial"
+    else:
+        result_status = "error"
+    return {
+        "status": result_status,
+        "results": created,
+        "errors": len(results) - created,
+        "items": results,
+    }
+
+
 @router.delete(
     "/{locationId}",
     response_model=location.LocationResponse,
     summary="Delete a record",
 )
-def delete_satellite(
+async def delete_satellite(
     locationId: str,
 ):
     # Deletes a location based on an ID. The CRUD function is managing the HttpExceptions
-    success, result = LocationsCRUD.delete(locationId)
+    success, result = await AsyncLocationsCRUD.delete(locationId)
+    event_bus.invalidate([result["sat_id"]])
 
     return {"status": "success", "location": objectid_to_str(result)}
@@ -0,0 +1,147 @@
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Literal
+import numpy as np
+from fastapi import status, APIRouter, HTTPException, Query
+from fastapi.concurrency import run_in_threadpool
+
+from app.models import orbit
+from app.db import AsyncTLEsCRUD
+from app.config import app_config
+from app.components.orbit import OrbitComponent
+from app.utils.model_utils import objectid_to_str, to_utc_datetime
+from app.utils.pagination import time_range
+
+router = APIRouter()
+
+
+async def find_tle(sat_id: int) -> Dict:
+    """
+    Finds the TLE of a satellite. Raises a HTTPException if the satellite has no TLE.
+    """
+    tle = await AsyncTLEsCRUD.find_one({"sat_id": sat_id})
+    if tle is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"No TLE found for sat_id {sat_id}.",
+        )
+    return tle
+
+
+def prediction_timestamps(start: datetime, end: datetime, step: float, satellites: int = 1) -> np.ndarray:
+    """
+    Builds the timestamps of the predicted locations from the start to the end (both included).
+    Raises a HTTPException if more locations than the configured maximum would be predicted.
+    """
+    begin, finish = start.timestamp(), end.timestamp()
+    points = (int((finish - begin) // step) + 1) * satellites
+    if points > app_config.app_orbit_max_points:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Too many predicted locations: {points}. Shorten the range or increase the step. "
+            f"The maximum is {app_config.app_orbit_max_points}.",
+        )
+    return np.arange(begin, finish + step / 2, step)
+
+
+@router.put(
+    "/tle",
+    response_model=orbit.TLEResponse,
+    summary="Create or replace the TLE of a satellite",
+)
+async def put_tle(
+    payload: orbit.TLESchema,
+):
+    # A satellite has a single TLE. The CRUD functions are managing the HttpExceptions
+    existing = await AsyncTLEsCRUD.find_one({"sat_id": payload.sat_id})
+    if existing is None:
+        result = await AsyncTLEsCRUD.create(payload.dict())
+    else:
+        result = await AsyncTLEsCRUD.update(str(existing["_id"]), payload.dict())
+
+    return {"status": "success", "tle": objectid_to_str(result)}
+
+
+@router.get(
+    "/tle/{sat_id}",
+    response_model=orbit.TLEResponse,
+    summary="Get the TLE of a specific satellite (sat_id)",
+)
+async def get_tle(sat_id: int):
+    tle = await find_tle(sat_id)
+    return {"status": "success", "tle": objectid_to_str(tle)}
+
+
+@router.get(
+    "/positions",
+    response_model=orbit.PredictedLocationsResponse,
+    summary="Predict the locations of many satellites at the same time",
+)
+async def predict_positions(
+    sat_id: List[int] | None = Query(None, description="All the satellites with a TLE by default"),
+    at: datetime | None = Query(None, description="Now by default"),
+    units: Literal["kilometers", "miles"] = "kilometers",
+):
+    filters = {"sat_id": {"$in": sat_id}} if sat_id else {}
+    tles = await AsyncTLEsCRUD.find(filters, {"_id": 0, "sat_id": 1, "line1": 1, "line2": 1})
+    at = to_utc_datetime(at) if at is not None else datetime.now(timezone.utc)
+    timestamps = prediction_timestamps(at, at, app_config.app_orbit_step, len(tles))
+
+    # All the satellites are propagated at once, in a thread so that the other requests are not blocked
+    orbitComponent = OrbitComponent(app_config.app_orbit_daylight_step)
+    locations = await run_in_threadpool(orbitComponent.locations, tles, timestamps, units)
+    return {"status": "success", "results": len(locations), "locations": locations}
+
+
+@router.get(
+    "/by_sat_id/{sat_id}/positions",
+    response_model=orbit.PredictedLocationsResponse,
+    summary="Predict the locations of a specific satellite (sat_id) in a time range",
+)
+async def predict_sat_positions(
+    sat_id: int,
+    from_: datetime | None = Query(None, alias="from", description="Now by default"),
+    to: datetime | None = Query(None, description="One orbit after the start by default"),
+    step: float | None = Query(None, gt=0, description="Seconds between two locations"),
+    units: Literal["kilometers", "miles"] = "kilometers",
+):
+    tle = await find_tle(sat_id)
+    step = step or app_config.app_orbit_step
+    start = to_utc_datetime(from_) if from_ is not None else datetime.now(timezone.utc)
+    end = to_utc_datetime(to) if to is not None else start + timedelta(seconds=OrbitComponent.period(tle))
+    # Raises a HTTPException if the range ends before it starts
+    time_range(start, end)
+    timestamps = prediction_timestamps(start, end, step)
+
+    orbitComponent = OrbitComponent(app_config.app_orbit_daylight_step)
+    locations = await run_in_threadpool(orbitComponent.locations, [tle], timestamps, units)
+    return {"status": "success", "results": len(locations), "locations": locations}
+
+
+@router.get(
+    "/by_sat_id/{sat_id}/sun",
+    response_model=orbit.PredictedDaylightWindowsResponse,
+    summary="Predict the time windows when a specific satellite (sat_id) will be exposed to the sun",
+)
+async def predict_sat_sun(
+    sat_id: int,
+    from_: datetime | None = Query(None, alias="from", description="Now by default"),
+    orbits: float = Query(1, gt=0, le=app_config.app_orbit_max_orbits),
+):
+    tle = await find_tle(sat_id)
+    windows = await predict_daylight_windows(tle, from_, orbits)
+    return {
+        "status": "success",
+        "sat_id": sat_id,
+        "orbits": orbits,
+        "results": len(windows),
+        "windows": windows,
+    }
+
+
+async def predict_daylight_windows(tle: Dict, from_: datetime | None, orbits: float) -> List[Dict]:
+    """
+    Predicts the daylight windows of the satellite of a TLE for a number of orbits, starting now by default.
+    """
+    start = to_utc_datetime(from_) if from_ is not None else datetime.now(timezone.utc)
+    orbitComponent = OrbitComponent(app_config.app_orbit_daylight_step)
+    return await run_in_threadpool(orbitComponent.daylight_windows, tle, start, orbits)
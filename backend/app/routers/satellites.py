@@ -1,11 +1,62 @@
-from fastapi import status, APIRouter, HTTPException
+import re
+from typing import Dict, List, Optional
+from fastapi import status, APIRouter, HTTPException, Query
+from fastapi.concurrency import run_in_threadpool
 
 from app.models import satellite
-from app.db import SatellitesCRUD
-from app.utils.model_utils import objectid_to_str
+from app.db import AsyncSatellitesCRUD
+from app.db.crud import CountMode
+from app.components.event_bus import event_bus
+from app.components.satellite_search import satellite_search
+from app.utils.model_utils import objectid_to_str, normalize_name
+from app.utils.pagination import decode_cursor, keyset_filter, next_cursor
+from app.utils.responses import list_response
 
 router = APIRouter()
 
+# The satellites are paginated on their _id, or on their normalized name when searching
+SATELLITE_CURSOR_FIELDS = ["_id"]
+SATELLITE_SEARCH_CURSOR_FIELDS = ["name_key", "_id"]
+
+
+def satellites_filter(search: str) -> Dict:
+    """
+    Builds the filter of the satellites whose normalized name starts with the normalized search.
+    The search is escaped and anchored, so it can use the name_key index. An empty search matches all satellites.
+    """
+    key = normalize_name(search)
+    if not key:
+        return {}
+    return {"name_key": {"$regex": f"^{re.escape(key)}"}}
+
+
+def satellites_pipeline(
+    limit: int, page: int, search: str, cursor: Optional[str] = None
+) -> List[Dict]:
+    """
+    Builds the pipeline that returns a page of the satellites whose name starts with the search.
+    The satellites are sorted by "_id", or by ("name_key", "_id") when searching. When a cursor is provided
+    the page starts right after it, otherwise the page number is used.
+    """
+    match = satellites_filter(search)
+    fields = SATELLITE_SEARCH_CURSOR_FIELDS if match else SATELLITE_CURSOR_FIELDS
+    if cursor is not None:
+        values = decode_cursor(cursor, fields)
+        if match:
+            match = {"$and": [match, keyset_filter(values, fields, 1)]}
+        else:
+            match = {"_id": {"$gt": values["_id"]}}
+        skip = 0
+    else:
+        # Calculate the right amount of skipped pages based on input
+        skip = (page - 1) * limit
+    return [
+        {"$match": match},
+        {"$sort": {field: 1 for field in fields}},
+        {"$skip": skip},
+        {"$limit": limit},
+    ]
+
 
 # Get First 10 Records
 @router.get(
@@ -13,37 +64,66 @@ router = APIRouter()
     response_model=satellite.ListSatelliteResponses,
     summary="Get the first records",
 )
-def get_satellites(
+async def get_satellites(
     limit: int = 10,
     page: int = 1,
     search: str = "",
+    cursor: str | None = None,
 ):
-    # Calculate the right amount of skipped pages based on input
-    skip = (page - 1) * limit
-    pipeline = [
-        {
-            "$match": {
-                "name": {"$regex": search, "$options": "i"},
-            }
-        },
-        {"$skip": skip},
-        {"$limit": limit},
-    ]
+    pipeline = satellites_pipeline(limit, page, search, cursor)
 
     # Run pipeline and get the satellites
     try:
-        satellites = SatellitesCRUD.aggregate(pipeline)
+        satellites = await AsyncSatellitesCRUD.aggregate(pipeline)
     except HTTPException as e:
         raise HTTPException(
             status_code=e.status_code,
             detail=f"Error retrieving locations with pipeline {pipeline}: {e}",
         )
-    return {
-        "status": "success",
-        "results": len(satellites),
-        "total": SatellitesCRUD.count(),
-        "satellites": objectid_to_str(satellites),
-    }
+    # The total counts the satellites that match the search, not all of them
+    filters = satellites_filter(search)
+    total, total_mode = await AsyncSatellitesCRUD.total(filters)
+    return list_response(
+        {
+            "status": "success",
+            "results": len(satellites),
+            "total": total,
+            "total_mode": total_mode,
+            "next_cursor": next_cursor(
+                satellites,
+                limit,
+                SATELLITE_SEARCH_CURSOR_FIELDS if filters else SATELLITE_CURSOR_FIELDS,
+            ),
+            "satellites": satellites,
+        },
+        satellite.ListSatelliteResponses,
+    )
+
+
+# Autocomplete search on the names of the satellites
+@router.get(
+    "/search",
+    response_model=satellite.ListSatelliteResponses,
+    summary="Find the satellites whose name or words start with the query, best matches first",
+)
+async def search_satellites(
+    q: str = Query(..., min_length=1),
+    limit: int = Query(10, ge=1, le=100),
+):
+    # The satellites are kept in memory. Reloading them is the only database access, so it runs in a thread
+    if satellite_search.stale():
+        await run_in_threadpool(satellite_search.refresh)
+    satellites, total = satellite_search.search(q, limit)
+    return list_response(
+        {
+            "status": "success",
+            "results": len(satellites),
+            "total": total,
+            "total_mode": CountMode.EXACT,
+            "satellites": satellites,
+        },
+        satellite.ListSatelliteResponses,
+    )
 
 
 @router.get(
@@ -51,11 +131,11 @@ def get_satellites(
     response_model=satellite.SatelliteResponse,
     summary="Get single satellite using Database ID",
 )
-def get_satellite(
+async def get_satellite(
     satelliteId: str,
 ):
     # Try to get the required satelite. The CRUD function is managing the HttpExceptions
-    result = SatellitesCRUD.read(satelliteId)
+    result = await AsyncSatellitesCRUD.read(satelliteId)
 
     return {"status": "success", "satellite": objectid_to_str(result)}
 
@@ -66,13 +146,13 @@ def get_satellite(
     response_model=satellite.SatelliteResponse,
     summary="Create a new record",
 )
-def create_satellite(
+async def create_satellite(
     payload: satellite.SatelliteSchema,
 ):
     # Create a new Satellite ignoring all None properties. The CRUD function is managing the HttpExceptions
-    result = SatellitesCRUD.create(payload.dict(exclude_none=True))
+    result = await AsyncSatellitesCRUD.create(payload.dict(exclude_none=True))
     # Try to read the newly created satellite to confirm it was created. The CRUD function is managing the HttpExceptions
-    new_satellite = SatellitesCRUD.read(str(result["_id"]))
+    new_satellite = await AsyncSatellitesCRUD.read(str(result["_id"]))
 
     return {"status": "success", "satellite": objectid_to_str(new_satellite)}
 
@@ -82,10 +162,12 @@ def create_satellite(
     response_model=satellite.SatelliteResponse,
     summary="Delete a record",
 )
-def delete_satellite(
+async def delete_satellite(
     satelliteId: str,
 ):
     # Deletes a satellite based on an ID. The CRUD function is managing the HttpExceptions
-    success, result = SatellitesCRUD.delete(satelliteId)
+    success, result = await AsyncSatellitesCRUD.delete(satelliteId)
+    # The locations of the satellite are deleted with it
+    event_bus.invalidate([result["sat_id"]])
 
     return {"status": "success", "satellite": objectid_to_str(result)}
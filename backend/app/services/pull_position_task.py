@@ -1,47 +1,329 @@
+import asyncio
+import threading
 import time
-from typing import Dict, Tuple
-from app.db import SatellitesCRUD, LocationsCRUD
-import requests
+import httpx
+from datetime import datetime, timezone
+from typing import Dict, List, Tuple, Optional
+from app.db import LocationsCRUD, DaylightWindowsCRUD, DaylightRebuildsDB
 from app.config import app_config
+from app.components.location import LocationComponent, VISIBILITY_CODES
+from app.components.event_bus import event_bus
+from app.components.satellite_registry import satellite_registry
+from app.components.write_buffer import WriteBuffer
+from app.components.metrics import observe_upstream
+from app.utils.model_utils import normalize_timestamp
+from app.components.rate_limiter import BACKOFF_STATUS_CODES, RateLimiter, retry_after, sat_loc_limiter
 
 
-def main() -> Tuple[Dict, int]:
+class PositionPoller:
     """
-    Function that pulls the iss location from the provided API. This is built in
-    a way to be compatible with background tasks, services or cloud functions.
+    This class pulls the positions of many satellites from the sat_loc API concurrently.
+    It owns an event loop and a pooled HTTP client that live as long as the service, so the
+    keep-alive connections are reused between polls instead of being opened for every request.
+    """
+
+    def __init__(
+        self,
+        timeout: float,
+        max_connections: int,
+        max_in_flight: int,
+        limiter: RateLimiter,
+        max_retries: int,
+    ):
+        """
+        Constructs a new instance.
+
+        :param      timeout:          Seconds to wait for a connection or a response
+        :type       timeout:          float
+        :param      max_connections:  The size of the connection pool
+        :type       max_connections:  int
+        :param      max_in_flight:    The maximum number of requests in flight at the same time
+        :type       max_in_flight:    int
+        :param      limiter:          The rate limiter of the API
+        :type       limiter:          RateLimiter
+        :param      max_retries:      Times a request is retried after a backoff
+        :type       max_retries:      int
+        """
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.max_in_flight = max_in_flight
+        self.limiter = limiter
+        self.max_retries = max_retries
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._client: Optional[httpx.AsyncClient] = None
+        # The scheduler thread and callers such as tests must not run the loop at the same time
+        self._lock = threading.Lock()
+
+    def poll(self, satellites: List[Dict]) -> List[Tuple[Optional[Dict], int]]:
+        """
+        Pulls the location of every satellite.
+
+        :param      satellites:  The satellites with at least the keys "sat_id" and "units"
+        :type       satellites:  List[Dict]
+
+        :returns:   A (location, status code) tuple per satellite, in the same order. The location is None
+                    if the request failed and the status code is 0 if there was no response at all.
+        :rtype:     List[Tuple[Optional[Dict], int]]
+        """
+        with self._lock:
+            if self._loop is None or self._loop.is_closed():
+                self._loop = asyncio.new_event_loop()
+            return self._loop.run_until_complete(self._poll(satellites))
+
+    async def _poll(self, satellites: List[Dict]) -> List[Tuple[Optional[Dict], int]]:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.timeout),
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections,
+                ),
+            )
+        # Cap the number of requests in flight to stay friendly with the upstream API
+        semaphore = asyncio.Semaphore(self.max_in_flight)
+        return await asyncio.gather(
+            *(self._fetch(satellite, semaphore) for satellite in satellites)
+        )
+
+    async def _fetch(
+        self, satellite: Dict, semaphore: asyncio.Semaphore
+    ) -> Tuple[Optional[Dict], int]:
+        # Define the API URL
+        url = f"{app_config.app_apis_sat_loc_url}{satellite['sat_id']}?units={satellite['units']}"
+
+        # Make the API request. Every request waits for its turn of the rate limit of the API,
+        # and a request that is throttled or fails is retried after the backoff
+        for attempt in range(self.max_retries + 1):
+            async with semaphore:
+                await self.limiter.wait()
+                start = time.perf_counter()
+                try:
+                    response = await self._client.get(url)
+                    status_code, wait = response.status_code, retry_after(response.headers)
+                except httpx.HTTPError as e:
+                    print(f"Failed to fetch data for {satellite['sat_id']}: {e!r}")
+                    response, status_code, wait = None, 0, None
+                observe_upstream("sat_loc", status_code, time.perf_counter() - start)
+            backoff = self.limiter.record(status_code, wait)
+            if status_code not in BACKOFF_STATUS_CODES or attempt == self.max_retries:
+                break
+            print(
+                f"Retrying {satellite['sat_id']} in {backoff:.1f}s after status code {status_code}"
+            )
+
+        if response is None:
+            return None, 0
+        # Check if the request was successful
+        if response.status_code != 200:
+            print(
+                f"Failed to fetch data for {satellite['sat_id']}. Status code: {response.status_code}"
+            )
+            return None, response.status_code
+
+        # Convert the JSON response to a Python dictionary. A malformed response only fails its own satellite
+        try:
+            loc = response.json()
+        except ValueError as e:
+            print(f"Invalid JSON for {satellite['sat_id']}: {e}")
+            return None, response.status_code
+        if not isinstance(loc, dict) or "id" not in loc:
+            print(f"Invalid location for {satellite['sat_id']}: {loc!r}")
+            return None, response.status_code
+        loc.pop("name", None)  # Remove name since it is not needed for the Location Schema
+        loc["sat_id"] = loc.pop(
+            "id"
+        )  # Rename key "id" to "sat_id" to compy with the Location Schema
+        # The epoch timestamp is stored as a BSON date by the LocationsCRUD, the same as every other location
+        return loc, response.status_code
+
+    def close(self):
+        """
+        Closes the pooled HTTP client and the event loop.
+        """
+        with self._lock:
+            if self._loop is None or self._loop.is_closed():
+                return
+            if self._client is not None:
+                self._loop.run_until_complete(self._client.aclose())
+                self._client = None
+            self._loop.close()
+
+
+# The poller of the service. It is shared between the runs so its connections stay open.
+poller = PositionPoller(
+    timeout=app_config.app_apis_sat_loc_timeout,
+    max_connections=app_config.app_apis_sat_loc_max_connections,
+    max_in_flight=app_config.app_apis_sat_loc_max_in_flight,
+    limiter=sat_loc_limiter,
+    max_retries=app_config.app_apis_sat_loc_max_retries,
+)
+
+# The buffer of the new locations. Look at storage in app_config.yaml for how it is configured
+location_buffer = WriteBuffer(
+    LocationsCRUD,
+    path=app_config.app_storage_buffer_wal,
+    max_size=app_config.app_storage_buffer_max_size,
+    max_age=app_config.app_storage_buffer_max_age,
+    timeout=app_config.app_storage_buffer_timeout,
+)
+
+
+def main() -> Tuple[List[Dict], Dict[int, int]]:
+    """
+    Function that pulls the location of every satellite in the database from the provided API.
+    This is built in a way to be compatible with background tasks, services or cloud functions.
     Look at app_config.yaml for how it is defined and configured
 
-    :returns:   Location that was pulled
+    :returns:   Locations that were pulled. They are stored by the buffer
+    :rtype:     List[dict]
+    :returns:   The http status code of the request per sat_id
+    :rtype:     Dict[int, int]
+    """
+    # Retrieve all satellites from memory. They are reloaded from the database when they are stale.
+    # While the database can not be reached the last loaded satellites are polled, and their locations are logged
+    # by the buffer until it is back
+    satellite_registry.refresh_if_stale()
+    satellites = [
+        {"sat_id": satellite["sat_id"], "units": satellite.get("units")}
+        for satellite in satellite_registry.all(allow_stale=True)
+    ]
+
+    if not satellites:
+        print("No Satellites found. Skipping...")
+        # The buffered locations are still stored when they are due
+        if location_buffer.due():
+            flush()
+        return [], {}
+
+    # Make the API requests
+    results = poller.poll(satellites)
+    statuses = {
+        satellite["sat_id"]: status_code
+        for satellite, (_, status_code) in zip(satellites, results)
+    }
+    locations = ingest([location for location, _ in results if location is not None])
+    return locations, statuses
+
+
+def ingest(locations: List[Dict]) -> List[Dict]:
+    """
+    Function that ingests the locations of a poll: they are buffered, cached, streamed and they update the
+    daylight windows once they are stored. It is also used to load test the ingestion without the sat_loc API.
+
+    :param      locations:  The new locations
+    :type       locations:  List[dict] compliant with LocationSchema
+
+    :returns:   The locations with their "_id" and their normalized timestamps
+    :rtype:     List[dict]
+    """
+    # The timestamps are normalized the same way the LocationsCRUD stores them
+    locations = [normalize_timestamp(location) for location in locations]
+
+    # Buffer the new Locations. They get their "_id" here and they are stored with a single write when the buffer is due.
+    # If the database is unreachable they are kept in the write-ahead log of the buffer until it is back
+    stored = location_buffer.add(locations)
+    # Keep the latest locations in memory for the routers and push them to the subscribers of the stream endpoints,
+    # on every process
+    event_bus.publish_locations(locations)
+    for location in stored:
+        # Open, extend or close the current daylight window of the satellite, in the order the locations were stored
+        update_daylight_windows(location)
+    return locations
+
+
+def flush(replay: bool = True) -> List[Dict]:
+    """
+    Function that stores the buffered locations without waiting for the buffer to be due, e.g. when the
+    application stops.
+
+    :param      replay:  When False the write-ahead log is left to the process that holds the lease of the service
+    :type       replay:  bool
+
+    :returns:   Locations that were stored
+    :rtype:     List[dict]
+    """
+    stored = location_buffer.flush(replay)
+    for location in stored:
+        update_daylight_windows(location)
+    return stored
+
+
+def update_daylight_windows(location: Dict) -> Optional[Dict]:
+    """
+    Updates the materialized daylight windows of a satellite with a newly stored location.
+    Only the latest window of the satellite is read, so the cost does not depend on the size of the history.
+    The windows are rebuilt from the full location history when the satellite has no rebuild marker: the first time
+    it is seen, and after its locations were written through the API (look at invalidate_daylight_windows).
+    A satellite without daylight in its history keeps its marker, so it is not rebuilt again.
+
+    :param      location:  The newly stored location
+    :type       location:  Dictionary compliant with LocationSchema
+
+    :returns:   The window that was stored or None if nothing changed
     :rtype:     dict
-    :returns:   The http status code of the request
+    """
+    if DaylightRebuildsDB.find_one({"_id": location["sat_id"]}) is None:
+        # The location is part of the history, so it is already applied
+        rebuild_daylight_windows(location["sat_id"])
+        return None
+
+    # Get the latest window of the satellite, open or closed
+    pipeline = [
+        {"$match": {"sat_id": location["sat_id"]}},
+        {"$sort": {"end": -1}},  # -1 for descending order (newest to oldest)
+        {"$limit": 1},
+    ]
+    latest_windows = DaylightWindowsCRUD.aggregate(pipeline)
+    latest_window = latest_windows[0] if latest_windows else None
+    window = LocationComponent().update_daylight_window(latest_window, location)
+    if window is None:
+        return None
+    if "_id" in window:
+        return DaylightWindowsCRUD.update(
+            str(window["_id"]), {"end": window["end"], "open": window["open"]}
+        )
+    return DaylightWindowsCRUD.create(window)
+
+
+def rebuild_daylight_windows(sat_id: int) -> int:
+    """
+    Calculates the daylight windows of a satellite from its location history and replaces the stored ones.
+    After that the windows are updated incrementally, until the locations of the satellite are written through the API.
+    The windows that end before the oldest stored location (e.g. its raw locations expired) are kept.
+
+    :param      sat_id:  The satellite id
+    :type       sat_id:  int
+
+    :returns:   The number of windows that were stored
     :rtype:     int
     """
-    # Retrieve the iss satellite from the database
-    iss = SatellitesCRUD.find_one({"sat_id": app_config.app_iss_id})
-
-    if iss is None:
-        print("ISS Satellite not found. Skipping...")
-        return {}, 0
-    # Define the API URL
-    url = f"{app_config.app_apis_sat_loc_url}{iss['sat_id']}?units={iss['units']}"
-
-    # Make the API request
-    response = requests.get(url)
-
-    # Check if the request was successful
-    if response.status_code == 200:
-        # Convert the JSON response to a Python dictionary
-        loc = response.json()
-        print("API Response as Dictionary:")
-        print(loc)
-        loc.pop("name")  # Remove name since it is not needed for the Location Schema
-        loc["sat_id"] = loc.pop(
-            "id"
-        )  # Rename key "id" to "sat_id" to compy with the Location Schema
+    # The marker is set before the history is read, so a write through the API meanwhile removes it
+    # and the windows are rebuilt again
+    DaylightRebuildsDB.update_one(
+        {"_id": sat_id}, {"$set": {"rebuilt": datetime.now(timezone.utc)}}, upsert=True
+    )
+    pipeline = [
+        {"$match": {"sat_id": sat_id}},
+        {"$sort": {"timestamp": 1}},  # 1 for ascending order (oldest to newest)
+        {"$project": {"_id": 0, "visibility": 1, "timestamp": 1}},
+    ]
+    locations = LocationsCRUD.aggregate(pipeline)
+    # The history is processed as columns. Older locations hold epoch seconds instead of datetimes.
+    locationComponent = LocationComponent()
+    timestamps, visibility = locationComponent.to_columns(locations)
 
-        # Store the new Location
-        location = LocationsCRUD.create(loc)
-        return location, response.status_code
-    else:
-        print(f"Failed to fetch data. Status code: {response.status_code}")
-        return {}, response.status_code
+    windows = locationComponent.get_daylight_windows_columnar(timestamps, visibility)
+    for i, window in enumerate(windows):
+        window["sat_id"] = sat_id
+        # Only the last window can still be open, if it was not closed by an eclipsed location
+        window["open"] = bool(
+            i == len(windows) - 1
+            and visibility[-1] != VISIBILITY_CODES["eclipsed"]
+            and window["end"].timestamp() == timestamps[-1]
+        )
+    if len(timestamps):
+        oldest = datetime.fromtimestamp(timestamps[0], timezone.utc)
+        DaylightWindowsCRUD.collection.delete_many({"sat_id": sat_id, "end": {"$gte": oldest}})
+    if windows:
+        DaylightWindowsCRUD.create_many(windows)
+    return len(windows)
@@ -0,0 +1,200 @@
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+from app.config import app_config
+from app.db import LocationsCRUD, RollupsCRUD, SatellitesCRUD, enable_raw_expiry, raw_expiry_enabled
+from app.db.crud import CRUD
+from app.components.retention import retention_policy
+
+
+def rollup_pipeline(
+    target: str, resolution: int, starts: Dict[int, Optional[datetime]], end: datetime
+) -> List[Dict]:
+    """
+    Builds the pipeline that rolls up the locations of a time range of every satellite into buckets of `resolution` seconds.
+    Every rollup is the first location of its bucket, with the bucket and the number of samples it represents.
+    The rollups are merged into the target collection on (sat_id, bucket), so rolling up a bucket again replaces it.
+    It runs on the raw locations or on the rollups of a finer tier, which already hold their number of samples.
+    """
+    return [
+        {
+            "$match": {
+                # Older locations hold epoch seconds and can not be bucketed
+                "timestamp": {"$type": "date", "$lt": end},
+                "$or": satellite_ranges(starts),
+            }
+        },
+        {"$sort": {"timestamp": 1}},  # 1 for ascending order (oldest to newest)
+        {
+            "$group": {
+                "_id": {
+                    "sat_id": "$sat_id",
+                    "bucket": {
+                        "$dateTrunc": {
+                            "date": "$timestamp",
+                            "unit": "second",
+                            "binSize": resolution,
+                        }
+                    },
+                },
+                "location": {"$first": "$$ROOT"},
+                "samples": {"$sum": {"$ifNull": ["$samples", 1]}},
+            }
+        },
+        {
+            "$replaceWith": {
+                "$mergeObjects": [
+                    "$location",
+                    {
+                        "bucket": "$_id.bucket",
+                        "samples": "$samples",
+                        "resolution": resolution,
+                    },
+                ]
+            }
+        },
+        # The rollups get their own _id, so that an existing rollup keeps its _id when it is replaced
+        {"$unset": "_id"},
+        {
+            "$merge": {
+                "into": target,
+                "on": ["sat_id", "bucket"],
+                "whenMatched": "replace",
+                "whenNotMatched": "insert",
+            }
+        },
+    ]
+
+
+def satellite_ranges(starts: Dict[int, Optional[datetime]]) -> List[Dict]:
+    """
+    Builds the $or clauses that match the locations of every satellite from its own start, or its whole history
+    when the start is None. Every clause uses the (sat_id, timestamp) index.
+    """
+    return [
+        {"sat_id": sat_id, "timestamp": {"$gte": start}} if start is not None else {"sat_id": sat_id}
+        for sat_id, start in starts.items()
+    ]
+
+
+def watermarks(target: CRUD) -> Dict[int, Optional[datetime]]:
+    """
+    Gets the latest rolled up bucket of every satellite in a tier. A satellite that was not rolled up yet gets None.
+    Every satellite has its own watermark, so the older locations of a satellite that is added later are still rolled up.
+
+    :param      target:  The CRUD of the tier
+    :type       target:  CRUD
+
+    :returns:   The latest bucket per sat_id
+    :rtype:     Dict[int, Optional[datetime]]
+    """
+    latest = {satellite["sat_id"]: None for satellite in SatellitesCRUD.find({}, {"sat_id": 1})}
+    # The unique (sat_id, bucket) index returns the latest bucket of every satellite without reading the other ones
+    pipeline = [
+        {"$sort": {"sat_id": -1, "bucket": -1}},
+        {"$group": {"_id": "$sat_id", "bucket": {"$first": "$bucket"}}},
+    ]
+    for rollup in target.aggregate(pipeline):
+        if rollup["_id"] in latest:
+            latest[rollup["_id"]] = rollup["bucket"]
+    return latest
+
+
+def align(timestamp: datetime, resolution: int) -> datetime:
+    """
+    Truncates a datetime to the start of its bucket of `resolution` seconds.
+    """
+    return datetime.fromtimestamp(int(timestamp.timestamp()) // resolution * resolution, tz=timezone.utc)
+
+
+def rollup(
+    source: CRUD, target: CRUD, resolution: int, now: datetime, lag: float
+) -> Tuple[Optional[datetime], datetime]:
+    """
+    Rolls up the complete buckets of a tier that were not rolled up yet, per satellite.
+    The locations are not always stored in order: the pull_position service buffers them and the finer tiers roll up
+    their own late locations again. So the buckets of the last `lag` seconds before the latest bucket of every
+    satellite are rolled up again, in case locations arrived after them.
+
+    :param      source:      The CRUD of the finer tier
+    :type       source:      CRUD
+    :param      target:      The CRUD of the tier
+    :type       target:      CRUD
+    :param      resolution:  Seconds per bucket
+    :type       resolution:  int
+    :param      now:         The current time. Only the buckets that ended before it are rolled up.
+    :type       now:         datetime
+    :param      lag:         Seconds a location can be stored after a later one
+    :type       lag:         float
+
+    :returns:   The time range that was rolled up. The start is None when the whole history of a satellite was rolled up.
+    :rtype:     Tuple[Optional[datetime], datetime]
+    """
+    end = align(now, resolution)
+    starts = {
+        sat_id: align(bucket - timedelta(seconds=lag), resolution) if bucket is not None else None
+        for sat_id, bucket in watermarks(target).items()
+    }
+    if not starts:
+        return end, end
+    source.aggregate(rollup_pipeline(target.collection.name, resolution, starts, end))
+    start = None if None in starts.values() else min(starts.values())
+    return start, end
+
+
+def raw_rolled_up(now: datetime) -> bool:
+    """
+    Checks if every raw location that would expire now is held by the first rollup tier,
+    i.e. if no location older than the retention of the raw locations is newer than the rolled up buckets of its satellite.
+
+    :param      now:  The current time
+    :type       now:  datetime
+
+    :returns:   True if the raw locations can expire without being lost
+    :rtype:     bool
+    """
+    if not retention_policy.rollups:
+        return True
+    tier = retention_policy.rollups[0]
+    starts = {
+        sat_id: bucket + timedelta(seconds=tier.resolution) if bucket is not None else None
+        for sat_id, bucket in watermarks(RollupsCRUD[tier.resolution]).items()
+    }
+    if not starts:
+        return True
+    filters = {
+        "timestamp": {"$type": "date", "$lt": now - timedelta(seconds=retention_policy.raw.ttl)},
+        "$or": satellite_ranges(starts),
+    }
+    return not LocationsCRUD.find(filters, {"_id": 1}, limit=1)
+
+
+def main(now: Optional[datetime] = None) -> Dict[int, Tuple[Optional[datetime], datetime]]:
+    """
+    Function that rolls up the locations into every retention tier, finest first, so that a tier is rolled up
+    from the one before it. Look at app_config.yaml for how the tiers are configured.
+    The raw locations only start to expire once they are rolled up (look at enable_raw_expiry), so that the history
+    that was stored before the retention was configured is rolled up before it expires.
+    They expire through their TTL index, which does not go through the CRUD, so their count is reset.
+
+    :param      now:  The current time, used by the tests
+    :type       now:  Optional[datetime]
+
+    :returns:   The time range that was rolled up per resolution
+    :rtype:     Dict[int, Tuple[Optional[datetime], datetime]]
+    """
+    now = now or datetime.now(timezone.utc)
+    ranges = {}
+    source = LocationsCRUD
+    # The raw locations are stored up to max_age seconds late by the buffer of the pull_position service,
+    # and every tier rolls up again the late buckets of the tier before it
+    lag = app_config.app_storage_buffer_max_age
+    for tier in retention_policy.rollups:
+        target = RollupsCRUD[tier.resolution]
+        lag += tier.resolution
+        ranges[tier.resolution] = rollup(source, target, tier.resolution, now, lag)
+        source = target
+    if retention_policy.raw.ttl is not None:
+        if not raw_expiry_enabled() and raw_rolled_up(now):
+            enable_raw_expiry()
+        LocationsCRUD.reset_count()
+    return ranges
@@ -1,7 +1,15 @@
+import functools
+from typing import Callable, List, Optional
 from apscheduler.schedulers.background import BackgroundScheduler
 import app.services as app_services
-from app.services import pull_position_task
+from app.services import pull_position_task, rollup_task, tle_task
 from app.config import app_config
+from app.db import LeasesDB
+from app.components.lease import LeaseManager, process_owner
+from app.components.metrics import JOB_EVENTS, job_listener, timed_job
+
+# Options of the jobs that can be set in the scheduler and services sections of app_config.yaml
+JOB_OPTIONS = ("coalesce", "max_instances", "misfire_grace_time", "jitter")
 
 
 class TaskScheduler:
@@ -9,11 +17,56 @@ class TaskScheduler:
     A class to manage and schedule tasks using BackgroundScheduler.
     """
 
-    def __init__(self):
+    def __init__(self, leases: Optional[LeaseManager] = None):
         """
         Initializes the TaskScheduler instance with a BackgroundScheduler.
+
+        Args:
+            leases (LeaseManager): Elects the process that runs every service, so that a service runs once
+                when many processes run the scheduler. Without it every process runs every service.
         """
         self.task_scheduler = BackgroundScheduler()
+        if app_config.app_metrics_enabled:
+            # Count the failed and the skipped runs of the services for /api/metrics
+            self.task_scheduler.add_listener(job_listener, JOB_EVENTS)
+        self.leases = leases
+        # The names of the leases of the started services. A service holds the lease named after it, unless it shares
+        # the lease of another service
+        self.services: List[str] = []
+
+    def _guard(self, service_key: str, function: Callable) -> Callable:
+        """
+        Wraps the function of a service so that it only runs on the process that holds the lease of the service.
+        A run that lasts longer than the lease may overlap with the first run of the process that takes it over.
+        The holder keeps running the service while the database can not be reached (look at LeaseManager).
+        """
+        if self.leases is None:
+            return function
+
+        @functools.wraps(function)
+        def run(*args, **kwargs):
+            if not self.leases.held(service_key):
+                return None
+            return function(*args, **kwargs)
+
+        return run
+
+    @staticmethod
+    def lease_name(service_key: str, service_values: dict) -> str:
+        """
+        Returns the name of the lease of a service. Services that call the same external API share a lease
+        (the "lease" key of the service in app_config.yaml), so they run on the same process and share its rate limiter.
+        """
+        return service_values.get("lease") or service_key
+
+    @staticmethod
+    def job_options(service_values: dict) -> dict:
+        """
+        Returns the options of the job of a service: the options of the scheduler in app_config.yaml,
+        overridden by the ones of the service. A slow run never piles up runs of the same service.
+        """
+        options = {key: service_values.get(key, app_config.app_scheduler.get(key)) for key in JOB_OPTIONS}
+        return {key: value for key, value in options.items() if value is not None}
 
     def start(self):
         """
@@ -29,6 +82,7 @@ class TaskScheduler:
             int: The number of tasks that were started.
         """
         tasks_enabled = 0  # Counter for the number of tasks enabled
+        self.services = []
 
         # Iterate over each service defined in the application configuration
         for service_key, service_values in app_config.app_services.items():
@@ -47,13 +101,22 @@ class TaskScheduler:
                     # Get the function within the service
                     function = getattr(service, function_str)
 
-                    # Add the function as a scheduled job
+                    # Record the duration of the runs for /api/metrics. Only the runs of the lease holder are recorded
+                    if app_config.app_metrics_enabled:
+                        function = timed_job(service_key, function)
+                    lease = self.lease_name(service_key, service_values)
+                    # Add the function as a scheduled job, named after the service
                     self.task_scheduler.add_job(
-                        function,
+                        self._guard(lease, function),
                         "interval",  # The job type is interval-based
                         seconds=service_values.get("freq"),  # Frequency of execution
+                        id=service_key,
+                        replace_existing=True,
+                        **self.job_options(service_values),
                     )
                     tasks_enabled += 1
+                    if lease not in self.services:
+                        self.services.append(lease)
                 except KeyError as e:
                     raise KeyError(f"Missing or invalid key in app configuration: {e}")
                 except AttributeError as e:
@@ -70,6 +133,20 @@ class TaskScheduler:
 
         # Start the scheduler only if there are tasks to run
         if tasks_enabled > 0:
+            if self.leases is not None:
+                # Take the free leases before the first runs and keep renewing them.
+                # Look at leader in app_config.yaml for how it is configured
+                self.leases.heartbeat(self.services)
+                self.task_scheduler.add_job(
+                    self.leases.heartbeat,
+                    "interval",
+                    seconds=app_config.app_leader_heartbeat,
+                    args=[self.services],
+                    id="leases_heartbeat",
+                    replace_existing=True,
+                    coalesce=True,
+                    max_instances=1,
+                )
             self.task_scheduler.start()
 
         return tasks_enabled  # Return the number of tasks that were started
@@ -80,6 +157,9 @@ class TaskScheduler:
         """
         if self.isrunning():
             self.task_scheduler.shutdown()
+        # Hand over the services to the other processes once the running jobs have finished
+        if self.leases is not None:
+            self.leases.release(self.services)
 
     def isrunning(self):
         """
@@ -88,3 +168,9 @@ class TaskScheduler:
             bool: True if scheduler is running, False otherwise.
         """
         return self.task_scheduler.running
+
+
+# Define application wide the lease manager object. Every process has its own owner name.
+lease_manager = LeaseManager(
+    LeasesDB, process_owner(), app_config.app_leader_ttl, app_config.app_leader_timeout
+)
@@ -0,0 +1,96 @@
+import time
+import httpx
+from typing import Dict, List, Tuple
+from fastapi import HTTPException
+from pydantic import ValidationError
+from app.db import TLEsCRUD
+from app.config import app_config
+from app.models.orbit import TLESchema
+from app.components.satellite_registry import satellite_registry
+from app.components.rate_limiter import retry_after, sat_loc_limiter
+from app.components.metrics import observe_upstream
+
+
+def fetch_tle(client: httpx.Client, sat_id: int) -> Tuple[Dict | None, int]:
+    """
+    Fetches the latest TLE of a satellite from the sat_tle API.
+
+    :returns:   The validated TLE or None if the request failed, and the http status code (0 without a response)
+    :rtype:     Tuple[Dict | None, int]
+    """
+    url = f"{app_config.app_apis_sat_tle_url}{sat_id}/tles?format=json"
+    # The TLEs share the rate limit of the sat_loc API. A throttled request is not retried before the next refresh
+    sat_loc_limiter.acquire()
+    start = time.perf_counter()
+    try:
+        response = client.get(url)
+    except httpx.HTTPError as e:
+        observe_upstream("sat_tle", 0, time.perf_counter() - start)
+        sat_loc_limiter.record(0)
+        print(f"Failed to fetch the TLE of {sat_id}: {e!r}")
+        return None, 0
+    observe_upstream("sat_tle", response.status_code, time.perf_counter() - start)
+    sat_loc_limiter.record(response.status_code, retry_after(response.headers))
+    if response.status_code != 200:
+        print(f"Failed to fetch the TLE of {sat_id}. Status code: {response.status_code}")
+        return None, response.status_code
+    # A malformed response only fails its own satellite
+    try:
+        data = response.json()
+    except ValueError as e:
+        print(f"Invalid JSON for the TLE of {sat_id}: {e}")
+        return None, response.status_code
+    if not isinstance(data, dict):
+        print(f"Invalid TLE of {sat_id}: {data!r}")
+        return None, response.status_code
+    try:
+        tle = TLESchema(sat_id=sat_id, line1=data.get("line1", ""), line2=data.get("line2", ""))
+    except ValidationError as e:
+        print(f"Invalid TLE of {sat_id}: {e}")
+        return None, response.status_code
+    return tle.dict(), response.status_code
+
+
+def store_tle(tle: Dict) -> Dict:
+    """
+    Stores the TLE of a satellite, replacing its previous one.
+    """
+    existing = TLEsCRUD.find_one({"sat_id": tle["sat_id"]})
+    if existing is None:
+        return TLEsCRUD.create(tle)
+    return TLEsCRUD.update(str(existing["_id"]), tle)
+
+
+def main() -> Tuple[List[Dict], Dict[int, int]]:
+    """
+    Function that refreshes the TLE of every satellite in the database from the provided API.
+    The TLEs are used to predict the locations of the satellites without the sat_loc API.
+    Look at app_config.yaml for how it is defined and configured
+
+    :returns:   TLEs that were pulled and stored
+    :rtype:     List[dict]
+    :returns:   The http status code of the request per sat_id
+    :rtype:     Dict[int, int]
+    """
+    # The TLEs can not be stored while the database can not be reached, so the API is not called for nothing
+    if not satellite_registry.refresh_if_stale():
+        print("The satellites could not be loaded. Skipping...")
+        return [], {}
+    sat_ids = [satellite["sat_id"] for satellite in satellite_registry.all()]
+    if not sat_ids:
+        print("No Satellites found. Skipping...")
+        return [], {}
+
+    # The TLEs change a few times per day, so they are pulled one after the other over a single connection
+    tles, statuses = [], {}
+    with httpx.Client(timeout=httpx.Timeout(app_config.app_apis_sat_tle_timeout)) as client:
+        for sat_id in sat_ids:
+            tle, statuses[sat_id] = fetch_tle(client, sat_id)
+            if tle is None:
+                continue
+            # A TLE that can not be stored (e.g. its satellite was deleted meanwhile) does not stop the other satellites
+            try:
+                tles.append(store_tle(tle))
+            except HTTPException as e:
+                print(f"Failed to store the TLE of {sat_id}: {e.detail}")
+    return tles, statuses
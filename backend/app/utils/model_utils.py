@@ -1,3 +1,7 @@
+import json
+import re
+import unicodedata
+from datetime import datetime, timezone
 from bson.objectid import ObjectId
 
 
@@ -30,3 +34,75 @@ def objectid_to_str(model):
     except Exception as e:
         print(f"Unexpected error: {e}")
     return model
+
+
+def to_utc_datetime(value) -> datetime:
+    """
+    Function that takes as input a timestamp stored in a Location and transforms it to a timezone aware UTC datetime.
+    Locations pulled from the external API hold epoch seconds while locations created through the API hold datetimes.
+    Returns:
+        The timestamp as a timezone aware datetime in UTC"""
+    if isinstance(value, datetime):
+        # MongoDB returns naive datetimes that are always in UTC
+        if value.tzinfo is None:
+            return value.replace(tzinfo=timezone.utc)
+        return value.astimezone(timezone.utc)
+    return datetime.fromtimestamp(value, tz=timezone.utc)
+
+
+def normalize_timestamp(data: dict) -> dict:
+    """
+    Function that stores the "timestamp" of the data of a location that is created or updated as a BSON date.
+    Epoch seconds and datetimes in any timezone become UTC datetimes, truncated to the milliseconds that BSON dates hold,
+    so every location has the same type and the time ranges are answered by the timestamp indexes.
+    Returns:
+        The same data, with the normalized "timestamp" if it has one"""
+    if data.get("timestamp") is not None:
+        timestamp = to_utc_datetime(data["timestamp"])
+        data["timestamp"] = timestamp.replace(microsecond=timestamp.microsecond // 1000 * 1000)
+    return data
+
+
+def json_default(value):
+    """
+    Function used as the default of json.dumps for the BSON types that are stored in the documents.
+    The values are written the same way as the response models write them.
+    Returns:
+        The JSON compatible value"""
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, datetime):
+        if value.tzinfo is not None and value.utcoffset().total_seconds() == 0:
+            return value.replace(tzinfo=None).isoformat() + "Z"
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def document_to_json(document) -> str:
+    """
+    Function that serializes a MongoDB document without validating it through a response model.
+    This is used when streaming large results, where the validation would cost more than the query.
+    Returns:
+        The document as a JSON string"""
+    return json.dumps(document, default=json_default, separators=(",", ":"))
+
+
+def normalize_name(name: str) -> str:
+    """
+    Function that builds the search key of a name. Accents are removed, the case is folded and
+    everything that is not a letter or a digit becomes a single space, so "ISS (ZARYA)" becomes "iss zarya".
+    Returns:
+        The normalized name"""
+    text = unicodedata.normalize("NFKD", name)
+    text = "".join(c for c in text if not unicodedata.combining(c)).casefold()
+    return " ".join(re.findall(r"\w+", text))
+
+
+def add_name_key(data: dict) -> dict:
+    """
+    Function that adds the normalized "name_key" to the data of a satellite that is created or updated.
+    Returns:
+        The same data, with the "name_key" if it has a name"""
+    if isinstance(data.get("name"), str):
+        data["name_key"] = normalize_name(data["name"])
+    return data
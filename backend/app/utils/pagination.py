@@ -0,0 +1,87 @@
+import base64
+from datetime import datetime
+from typing import Dict, List, Optional
+from bson import json_util
+from fastapi import HTTPException, status
+from app.utils.model_utils import to_utc_datetime
+
+
+def encode_cursor(document: Dict, fields: List[str]) -> str:
+    """
+    Function that builds an opaque cursor token from the sort key of the last document of a page.
+    The values are serialized with Extended JSON so that ObjectIds and datetimes keep their BSON types.
+    Returns:
+        The cursor as a URL safe string"""
+    values = {field: document[field] for field in fields}
+    token = base64.urlsafe_b64encode(json_util.dumps(values).encode("utf-8"))
+    return token.decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str, fields: List[str]) -> Dict:
+    """
+    Function that reads the sort key from a cursor token created by encode_cursor.
+    Raises a HTTPException if the cursor is malformed or does not hold the expected fields.
+    Returns:
+        The sort key values of the last document of the previous page"""
+    try:
+        padding = "=" * (-len(cursor) % 4)
+        values = json_util.loads(base64.urlsafe_b64decode(cursor + padding))
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Invalid cursor: {cursor}. Error: {e}",
+        )
+    if not isinstance(values, dict) or any(field not in values for field in fields):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Invalid cursor: {cursor}. Expected the fields {fields}",
+        )
+    return values
+
+
+def keyset_filter(values: Dict, fields: List[str], direction: int) -> Dict:
+    """
+    Function that builds the filter that selects the documents after a cursor for a compound sort on two fields.
+    The range on the first field is kept outside of the $or so that it can be used as index bounds.
+    Returns:
+        The filter to be used in a $match stage"""
+    first, second = fields
+    inclusive, exclusive = ("$gte", "$gt") if direction > 0 else ("$lte", "$lt")
+    return {
+        first: {inclusive: values[first]},
+        "$or": [
+            {first: {exclusive: values[first]}},
+            {second: {exclusive: values[second]}},
+        ],
+    }
+
+
+def next_cursor(documents: List[Dict], limit: int, fields: List[str]) -> Optional[str]:
+    """
+    Function that builds the cursor of the page after the provided one.
+    This needs to be called before the ObjectIds of the documents are transformed to strings.
+    Returns:
+        The cursor of the next page or None if this is the last page"""
+    if limit <= 0 or len(documents) < limit:
+        return None
+    return encode_cursor(documents[-1], fields)
+
+
+def time_range(from_: Optional[datetime], to: Optional[datetime]) -> Dict:
+    """
+    Function that builds the bounds of a time range on a date field. Both limits are inclusive.
+    Query parameters without a timezone are in UTC, the same way as the stored timestamps.
+    Raises a HTTPException if the range ends before it starts.
+    Returns:
+        The bounds to be used in a $match stage, empty if the range has no limits"""
+    bounds = {}
+    if from_ is not None:
+        bounds["$gte"] = to_utc_datetime(from_)
+    if to is not None:
+        bounds["$lte"] = to_utc_datetime(to)
+    if from_ is not None and to is not None and bounds["$gte"] > bounds["$lte"]:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Invalid time range: from {from_} is after to {to}.",
+        )
+    return bounds
@@ -0,0 +1,114 @@
+import types
+from datetime import datetime
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Tuple, Type, Union, get_args, get_origin
+import orjson
+from fastapi.responses import Response
+from pydantic import BaseModel
+from app.config import app_config
+from app.utils.model_utils import json_default, objectid_to_str, to_utc_datetime
+
+# The datetimes in UTC end with "Z", the same way as the response models write them
+ORJSON_OPTIONS = orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS
+
+
+class FastJSONResponse(Response):
+    """
+    Response that encodes its content with orjson. ObjectIds and datetimes are converted during the same encoding pass.
+    """
+
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, default=json_default, option=ORJSON_OPTIONS)
+
+
+class _Plan:
+    """
+    The fields of a response model and how their values are shaped. It is built once per model.
+    """
+
+    def __init__(self, model: Type[BaseModel]):
+        self.defaults: List[Tuple[str, Any]] = []
+        # Older documents hold epoch seconds instead of datetimes
+        self.datetimes: List[str] = []
+        self.nested: List[Tuple[str, Callable[[Any], Any]]] = []
+        for name, field in model.model_fields.items():
+            key = field.alias or name
+            self.defaults.append((key, field.get_default()))
+            annotation = _unwrap_optional(field.annotation)
+            if annotation is datetime:
+                self.datetimes.append(key)
+            elif get_origin(annotation) in (list, List) and _is_model(get_args(annotation)[0]):
+                item = get_args(annotation)[0]
+                self.nested.append((key, lambda values, item=item: shape_many(values, item)))
+            elif _is_model(annotation):
+                self.nested.append((key, lambda value, model=annotation: shape(value, model)))
+        self.keys = {key for key, _ in self.defaults}
+
+    def shape(self, document: Dict) -> Dict:
+        # Documents that have exactly the fields of the model are shaped in place, which is the common case
+        if document.keys() != self.keys:
+            get = document.get
+            document = {key: get(key, default) for key, default in self.defaults}
+        for key in self.datetimes:
+            value = document[key]
+            if value is not None and type(value) is not datetime:
+                document[key] = to_utc_datetime(value)
+        for key, converter in self.nested:
+            if document[key] is not None:
+                document[key] = converter(document[key])
+        return document
+
+
+def _unwrap_optional(annotation: Any) -> Any:
+    """
+    Returns the type of an Optional annotation.
+    """
+    if get_origin(annotation) in (Union, types.UnionType):
+        args = [arg for arg in get_args(annotation) if arg is not type(None)]
+        if len(args) == 1:
+            return args[0]
+    return annotation
+
+
+def _is_model(annotation: Any) -> bool:
+    return isinstance(annotation, type) and issubclass(annotation, BaseModel)
+
+
+@lru_cache(maxsize=None)
+def _plan(model: Type[BaseModel]) -> _Plan:
+    return _Plan(model)
+
+
+def shape(document: Dict, model: Type[BaseModel]) -> Dict:
+    """
+    Keeps the fields of a document that are part of a response model, without validating them.
+    Missing fields get their default value and the extra fields of the document are dropped, like the response model does.
+    ObjectIds and datetimes are converted by the encoder. Unlike the response model, integers stored in float fields
+    are written as integers, which is the same JSON number.
+    """
+    return _plan(model).shape(document)
+
+
+def shape_many(documents: List[Dict], model: Type[BaseModel]) -> List[Dict]:
+    """
+    Shapes a list of documents with the same response model.
+    """
+    plan = _plan(model).shape
+    return [plan(document) for document in documents]
+
+
+def list_response(content: Dict, model: Type[BaseModel]) -> Union[Dict, Response]:
+    """
+    Prepares the content of a list response. Look at app_config.yaml for how the fast path is enabled.
+    The fast path skips the validation of every document by the response model and encodes the content with orjson,
+    while the route keeps its response_model, so the OpenAPI schema stays the same.
+    Otherwise the ObjectIds of the lists are transformed to strings and the content is validated by the response model.
+    """
+    if app_config.app_responses_fast:
+        return FastJSONResponse(shape(content, model))
+    for value in content.values():
+        if isinstance(value, list):
+            objectid_to_str(value)
+    return content
@@ -0,0 +1,78 @@
+"""
+Helpers shared by the benchmarks: the synthetic locations, the latency percentiles and the check that keeps
+the benchmarks that drop their database away from any database that is not on this host.
+"""
+
+import random
+from datetime import datetime, timedelta
+from typing import Dict, Iterator, List
+
+# Seconds between two locations of the same satellite, the same as the pull_position service
+SAMPLE_PERIOD = 20
+# Hosts of a MongoDB that runs on this host
+LOCAL_HOSTS = {"localhost", "127.0.0.1", "::1"}
+
+
+def synthetic_location(sat_id: int, step: int, start: datetime) -> Dict:
+    """
+    Generates a location with the same fields as the ones of the pull_position service.
+    The satellite is in daylight for 60 of every 90 minutes.
+    """
+    return {
+        "sat_id": sat_id,
+        "latitude": random.uniform(-51.6, 51.6),
+        "longitude": random.uniform(-180, 180),
+        "altitude": random.uniform(410, 430),
+        "velocity": random.uniform(27500, 27700),
+        "visibility": "daylight" if step % 270 < 180 else "eclipsed",
+        "footprint": random.uniform(4400, 4500),
+        "timestamp": start + timedelta(seconds=step * SAMPLE_PERIOD),
+        "daynum": 2460310.5 + step * SAMPLE_PERIOD / 86400,
+        "solar_lat": random.uniform(-23.4, 23.4),
+        "solar_lon": random.uniform(0, 360),
+        "units": "kilometers",
+    }
+
+
+def synthetic_locations(sat_ids: List[int], samples: int, start: datetime) -> Iterator[Dict]:
+    """
+    Generates the locations of the satellites from the provided time, interleaved per satellite
+    the same way they are polled.
+    """
+    for step in range(samples // len(sat_ids)):
+        for sat_id in sat_ids:
+            yield synthetic_location(sat_id, step, start)
+
+
+def percentile(values: List[float], q: float) -> float:
+    """
+    Nearest rank percentile of a list of values.
+    """
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+def database_hosts(url: str) -> List[str]:
+    """
+    Reads the hosts of a MongoDB connection string, without their ports.
+    """
+    scheme, _, rest = url.partition("://")
+    hosts = rest.split("/", 1)[0].split("?", 1)[0].rpartition("@")[2]
+    if scheme == "mongodb+srv":
+        # The hosts are looked up in DNS, so they are never taken for this host
+        return []
+    names = []
+    for host in hosts.split(","):
+        if host.startswith("["):
+            names.append(host[1:].split("]", 1)[0])
+        else:
+            names.append(host.rsplit(":", 1)[0] if host.count(":") == 1 else host)
+    return names
+
+
+def is_local_database(url: str) -> bool:
+    """
+    Checks if every host of a MongoDB connection string is on this host.
+    """
+    hosts = database_hosts(url)
+    return bool(hosts) and all(host.lower() in LOCAL_HOSTS for host in hosts)
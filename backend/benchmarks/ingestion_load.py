@@ -0,0 +1,351 @@
+"""
+Load test of the ingestion path, with synthetic orbits or the replay of an exported history, far faster than real time.
+
+The locations are generated for N synthetic satellites by propagating synthetic TLEs with SGP4 (look at
+OrbitComponent), so their latitude, longitude, altitude and daylight/eclipse alternation progress like real orbits.
+Or they are read from a file written by the /api/location/export endpoints and replayed in the order of their
+timestamps, shifted to the present. Every poll interval of simulated time is a tick: the locations of a tick are
+written together through the real code, either the ingestion of the pull_position service (buffer, cache, streams
+and daylight windows) or the create_location and bulk endpoints. Simulated time runs --speedup times faster than
+wall time, or as fast as the writes allow with --speedup 0.
+
+Reader threads request read endpoints at the same time. They report their latency under the write load and the lag
+until a written location of the first satellite is visible to them.
+
+It uses the database of the benchmark suite (BENCHMARK_DB, benchmark_db by default), which is dropped at the end.
+A DATABASE_URL that is not on this host is refused unless --allow-remote is passed.
+
+Run it from the backend folder:
+    python benchmarks/ingestion_load.py synthetic --satellites 1000 --ticks 200 --speedup 0
+    python benchmarks/ingestion_load.py replay export.ndjson --speedup 100 --path bulk
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterator, List, Tuple
+
+import numpy as np
+
+# Required row to be able to import the app folder.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Points the application to the database of the benchmark before it is imported
+from suite import BENCHMARK_DB, git_commit, iso, summarize
+from common import is_local_database, percentile
+
+from fastapi.testclient import TestClient
+from app.main import app
+from app.config import app_config, secrets
+from app.db import mongodb, SatellitesCRUD, ensure_collections, ensure_indexes
+from app.components.orbit import OrbitComponent
+from app.components.satellite_registry import satellite_registry
+from app.components.location_cache import location_cache
+from app.services import pull_position_task
+
+# The first sat_id of the synthetic satellites. It is also their catalog number, which has 5 digits
+FIRST_SAT_ID = 80000
+# Ticks whose locations are propagated at once
+CHUNK_TICKS = 100
+
+
+def checksum(line: str) -> str:
+    """
+    Appends the checksum to the first 68 characters of a TLE line.
+    """
+    return line + str(sum(int(c) if c.isdigit() else c == "-" for c in line) % 10)
+
+
+def synthetic_tle(sat_id: int, epoch: datetime, rng: random.Random) -> Dict:
+    """
+    Builds the TLE of a satellite on a random near circular low Earth orbit, without drag, at the epoch.
+    """
+    start_of_year = datetime(epoch.year, 1, 1, tzinfo=timezone.utc)
+    day = 1 + (epoch - start_of_year).total_seconds() / 86400
+    line1 = f"1 {sat_id:05d}U 24001A   {epoch.year % 100:02d}{day:012.8f}  .00000000  00000-0  00000-0 0  999"
+    line2 = (
+        f"2 {sat_id:05d} {rng.uniform(30, 98):8.4f} {rng.uniform(0, 360):8.4f} {rng.randrange(1, 2000):07d} "
+        f"{rng.uniform(0, 360):8.4f} {rng.uniform(0, 360):8.4f} {rng.uniform(14.5, 15.8):11.8f}{1:5d}"
+    )
+    return {"sat_id": sat_id, "line1": checksum(line1), "line2": checksum(line2)}
+
+
+def synthetic_ticks(satellites: int, ticks: int, step: float, start: datetime, seed: int) -> Iterator[List[Dict]]:
+    """
+    Generates the locations of the synthetic satellites, one per satellite and tick.
+    The orbits are propagated CHUNK_TICKS ticks at a time, so that all the locations are never in memory.
+    """
+    rng = random.Random(seed)
+    tles = [synthetic_tle(FIRST_SAT_ID + i, start, rng) for i in range(satellites)]
+    orbitComponent = OrbitComponent(step)
+    for first in range(0, ticks, CHUNK_TICKS):
+        timestamps = start.timestamp() + np.arange(first, min(first + CHUNK_TICKS, ticks)) * step
+        per_tick: Dict[datetime, List[Dict]] = {}
+        for location in orbitComponent.locations(tles, timestamps):
+            per_tick.setdefault(location["timestamp"], []).append(location)
+        for timestamp in sorted(per_tick):
+            yield per_tick[timestamp]
+
+
+def parse_timestamp(value: str) -> datetime:
+    """
+    Reads a timestamp of a response or of an export as a UTC datetime.
+    """
+    timestamp = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    return timestamp if timestamp.tzinfo is not None else timestamp.replace(tzinfo=timezone.utc)
+
+
+def read_export(path: str) -> List[Dict]:
+    """
+    Reads the locations of a file written by the export endpoints, as NDJSON or as a JSON array.
+    """
+    with open(path) as f:
+        content = f.read()
+    if content.lstrip().startswith("["):
+        documents = json.loads(content)
+    else:
+        documents = [json.loads(line) for line in content.splitlines() if line.strip()]
+    for document in documents:
+        document.pop("_id", None)
+        document["timestamp"] = parse_timestamp(document["timestamp"])
+    return sorted(documents, key=lambda document: document["timestamp"])
+
+
+def replay_ticks(locations: List[Dict], step: float, start: datetime) -> Iterator[List[Dict]]:
+    """
+    Groups the exported locations in ticks of step seconds, shifted so that the first one is at the start.
+    """
+    if not locations:
+        return
+    shift = start - locations[0]["timestamp"]
+    tick, end = [], locations[0]["timestamp"] + timedelta(seconds=step)
+    for location in locations:
+        if location["timestamp"] >= end:
+            yield tick
+            tick = []
+            while location["timestamp"] >= end:
+                end += timedelta(seconds=step)
+        tick.append({**location, "timestamp": location["timestamp"] + shift})
+    yield tick
+
+
+def write(client: TestClient, path: str, locations: List[Dict]) -> int:
+    """
+    Writes the locations of a tick through the chosen ingestion path.
+
+    :returns:   The number of locations that failed
+    :rtype:     int
+    """
+    if path == "poller":
+        pull_position_task.ingest(locations)
+        return 0
+    documents = [{**location, "timestamp": iso(location["timestamp"])} for location in locations]
+    if path == "bulk":
+        return len(documents) if client.post("/api/location/bulk", json=documents).status_code >= 400 else 0
+    return sum(client.post("/api/location/", json=document).status_code >= 400 for document in documents)
+
+
+class Reader(threading.Thread):
+    """
+    This class requests a read endpoint in a loop while the writes run. It records the latency of every request
+    and, if the endpoint returns the latest locations of the probed satellite, the newest timestamp of every response.
+    """
+
+    def __init__(self, name: str, path: str, params: Dict, stop: threading.Event, probe: bool = False):
+        super().__init__(daemon=True)
+        self.name = name
+        self.path = path
+        self.params = params
+        self.stop = stop
+        self.probe = probe
+        self.latencies: List[float] = []
+        self.errors = 0
+        # (wall time of the response, newest timestamp in the response)
+        self.observations: List[Tuple[float, datetime]] = []
+
+    def run(self):
+        client = TestClient(app)
+        started = time.perf_counter()
+        while not self.stop.is_set():
+            sent = time.perf_counter()
+            response = client.get(self.path, params=self.params)
+            received = time.perf_counter()
+            self.latencies.append((received - sent) * 1000)
+            if response.status_code >= 400:
+                self.errors += 1
+                continue
+            locations = (response.json().get("locations") or []) if self.probe else []
+            if locations:
+                self.observations.append((received, parse_timestamp(locations[0]["timestamp"])))
+        self.seconds = time.perf_counter() - started
+
+    def result(self, written: List[Tuple[float, datetime]]) -> Dict:
+        """
+        Summarizes the reads. The lag of a written location is the time from the end of its write
+        until the first response that held it or a newer one.
+        """
+        if not self.latencies:
+            return {"runs": 0}
+        result = summarize(self.latencies, self.seconds, self.errors)
+        if not self.probe:
+            return result
+        lags, i = [], 0
+        for wrote, timestamp in written:
+            while i < len(self.observations) and (
+                self.observations[i][0] < wrote or self.observations[i][1] < timestamp
+            ):
+                i += 1
+            if i == len(self.observations):
+                break
+            lags.append(self.observations[i][0] - wrote)
+        result["visible"] = f"{len(lags)}/{len(written)}"
+        if lags:
+            result["lag_p50_s"] = round(percentile(lags, 50), 3)
+            result["lag_p95_s"] = round(percentile(lags, 95), 3)
+            result["lag_max_s"] = round(max(lags), 3)
+        return result
+
+
+def run(args: argparse.Namespace) -> Dict:
+    """
+    Seeds the satellites, writes the ticks at the requested speed while the readers run and summarizes both.
+    """
+    start = datetime.now(timezone.utc).replace(microsecond=0)
+    if args.source == "synthetic":
+        ticks = synthetic_ticks(args.satellites, args.ticks, args.step, start, args.seed)
+        sat_ids = [FIRST_SAT_ID + i for i in range(args.satellites)]
+    else:
+        locations = read_export(args.file)
+        ticks = replay_ticks(locations, args.step, start)
+        sat_ids = sorted({location["sat_id"] for location in locations})
+    if not sat_ids:
+        sys.exit("There are no locations to write.")
+
+    mongodb.drop()
+    ensure_collections()
+    ensure_indexes()
+    SatellitesCRUD.create_many([{"sat_id": sat_id, "name": f"load-{sat_id}", "units": "kilometers"} for sat_id in sat_ids])
+    satellite_registry.refresh()
+    location_cache.invalidate()
+
+    # The latest location of the probed satellite, from the cache and from the stored locations
+    probe = sat_ids[0]
+    stop = threading.Event()
+    readers = [
+        Reader("latest", f"/api/location/by_sat_id/{probe}", {"limit": 1}, stop, probe=True),
+        Reader(
+            "latest stored",
+            f"/api/location/by_sat_id/{probe}",
+            {"limit": 1, "from": iso(start - timedelta(days=1)), "to": iso(start + timedelta(days=3650))},
+            stop,
+            probe=True,
+        ),
+        Reader("listing", "/api/location/", {"limit": 10}, stop),
+    ][: args.readers]
+    for reader in readers:
+        reader.start()
+
+    client = TestClient(app)
+    latencies, written, errors, count, behind = [], [], 0, 0, 0.0
+    started = time.perf_counter()
+    try:
+        for tick_number, tick in enumerate(ticks):
+            if args.speedup > 0:
+                # The tick is written when its simulated time is reached
+                scheduled = started + tick_number * args.step / args.speedup
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    behind = max(behind, -delay)
+            sent = time.perf_counter()
+            errors += write(client, args.path, tick)
+            wrote = time.perf_counter()
+            latencies.append((wrote - sent) * 1000)
+            count += len(tick)
+            probed = [location["timestamp"] for location in tick if location["sat_id"] == probe]
+            if probed:
+                written.append((wrote, max(probed)))
+        # The last buffered locations are stored before the readers stop
+        if args.path == "poller":
+            pull_position_task.flush()
+        written_seconds = time.perf_counter() - started
+        time.sleep(args.settle)
+    finally:
+        stop.set()
+        for reader in readers:
+            reader.join()
+        if not args.keep:
+            mongodb.drop()
+
+    ticks_summary = summarize(latencies, written_seconds, errors, items=count / max(len(latencies), 1))
+    return {
+        "meta": {
+            **git_commit(),
+            "created": iso(datetime.now(timezone.utc)),
+            "args": vars(args),
+        },
+        "writes": {
+            "satellites": len(sat_ids),
+            "ticks": len(latencies),
+            "locations": count,
+            "errors": errors,
+            "target_per_s": round(len(sat_ids) * args.speedup / args.step, 1) if args.speedup > 0 else None,
+            # The rate the ingestion code sustains, without the time spent generating the locations or waiting
+            "sustained_per_s": round(count / (sum(latencies) / 1000), 1) if latencies else 0,
+            "wall_per_s": round(count / written_seconds, 1),
+            "behind_schedule_max_s": round(behind, 3),
+            "tick": ticks_summary,
+        },
+        "reads": {reader.name: reader.result(written) for reader in readers},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--path", choices=["poller", "api", "bulk"], default="poller",
+        help="poller: the ingestion of the pull_position service, api: POST /api/location/, bulk: POST /api/location/bulk",
+    )
+    parser.add_argument("--speedup", type=float, default=0, help="Simulated seconds per wall second, 0 for no pacing")
+    parser.add_argument(
+        "--step", type=float, default=app_config.app_services["pull_position"]["freq"],
+        help="Simulated seconds between two ticks, the polling frequency by default",
+    )
+    parser.add_argument("--readers", type=int, default=3, choices=range(0, 4), help="Reader threads, up to 3")
+    parser.add_argument("--settle", type=float, default=1, help="Seconds the readers keep reading after the writes")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--keep", action="store_true", help="Keep the database")
+    parser.add_argument(
+        "--allow-remote", action="store_true", help="Run against a DATABASE_URL that is not on this host"
+    )
+    sources = parser.add_subparsers(dest="source", required=True)
+    synthetic = sources.add_parser("synthetic", help="Generate the locations of synthetic satellites")
+    synthetic.add_argument("--satellites", type=int, default=100)
+    synthetic.add_argument("--ticks", type=int, default=100)
+    synthetic.add_argument("--seed", type=int, default=0)
+    replay = sources.add_parser("replay", help="Replay the locations of an export")
+    replay.add_argument("file", help="A file written by /api/location/export, as NDJSON or JSON")
+    args = parser.parse_args()
+
+    if args.source == "synthetic" and not 0 < args.satellites <= 100000 - FIRST_SAT_ID:
+        sys.exit(f"The number of synthetic satellites is between 1 and {100000 - FIRST_SAT_ID}.")
+    if secrets.MONGO_INITDB_DATABASE != BENCHMARK_DB:
+        sys.exit(f"The application does not use the database of the benchmark {BENCHMARK_DB}. Refusing to drop it.")
+    if not args.allow_remote and not is_local_database(secrets.DATABASE_URL):
+        sys.exit("DATABASE_URL is not on this host. Refusing to drop its database without --allow-remote.")
+    results = run(args)
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    print(json.dumps({"writes": results["writes"], "reads": results["reads"]}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
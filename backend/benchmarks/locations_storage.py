@@ -0,0 +1,175 @@
+"""
+Benchmark that compares the two storage modes of the locations collection (look at app_config.yaml):
+the standard collection with one document per location and the native time-series collection.
+
+The same synthetic locations are written to both layouts, then the disk footprint (data and indexes)
+and the latency of time range scans of a single satellite are reported.
+It needs a MongoDB 7.0 or newer and uses a separate database, which is dropped at the end. A DATABASE_URL that is
+not on this host is refused unless --allow-remote is passed.
+
+Run it from the backend folder:
+    python benchmarks/locations_storage.py --satellites 10 --samples 100000
+"""
+
+import argparse
+import json
+import random
+import statistics
+import sys
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List
+
+# Required row to be able to import the app folder.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.config import secrets
+from app.db.crud import CRUD
+from app.db.database import MongoDB
+from app.db import (
+    LOCATIONS_INDEXES,
+    LOCATIONS_TIMESERIES_INDEXES,
+    LOCATIONS_TIMESERIES_OPTIONS,
+)
+from common import SAMPLE_PERIOD, is_local_database, percentile, synthetic_locations
+
+BENCHMARK_DB = "benchmark_db"
+BATCH_SIZE = 10000
+# The first location of every satellite
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def prepare(mongodb: MongoDB, mode: str) -> CRUD:
+    """
+    Creates the collection of a storage mode with the indexes the application declares for it.
+    """
+    name = f"locations_{mode}"
+    mongodb.database.drop_collection(name)
+    if mode == "timeseries":
+        mongodb.ensure_collection(name, timeseries=LOCATIONS_TIMESERIES_OPTIONS)
+        indexes = LOCATIONS_TIMESERIES_INDEXES
+    else:
+        # The synthetic locations are old. They do not expire, since LOCATIONS_INDEXES has no TTL index
+        indexes = LOCATIONS_INDEXES
+    crud = CRUD(
+        mongodb.get_collection(name),
+        indexes=indexes,
+        timeseries=mode == "timeseries",
+    )
+    crud.ensure_indexes()
+    return crud
+
+
+def load(crud: CRUD, satellites: int, samples: int) -> float:
+    """
+    Inserts the synthetic locations in batches.
+
+    :returns:   The seconds it took
+    :rtype:     float
+    """
+    random.seed(0)
+    started = time.perf_counter()
+    batch = []
+    for location in synthetic_locations([10000 + i for i in range(satellites)], samples, START):
+        batch.append(location)
+        if len(batch) == BATCH_SIZE:
+            crud.create_many(batch)
+            batch = []
+    if batch:
+        crud.create_many(batch)
+    return time.perf_counter() - started
+
+
+def footprint(mongodb: MongoDB, crud: CRUD) -> Dict[str, int]:
+    """
+    Reads the storage statistics of a collection. For a time-series collection these are the stats of its buckets.
+    """
+    stats = mongodb.database.command("collStats", crud.collection.name)
+    return {
+        "documents": crud.collection.estimated_document_count(),
+        "size": stats.get("size", 0),
+        "storage_size": stats.get("storageSize", 0),
+        "index_size": stats.get("totalIndexSize", 0),
+    }
+
+
+def range_scans(
+    crud: CRUD, satellites: int, samples: int, queries: int, window: int
+) -> List[float]:
+    """
+    Runs time range scans of single satellites, like the ones of the /api/location/by_sat_id endpoint.
+
+    :returns:   The latency of every query in milliseconds
+    :rtype:     List[float]
+    """
+    random.seed(1)
+    steps = samples // satellites
+    latencies = []
+    for _ in range(queries):
+        sat_id = 10000 + random.randrange(satellites)
+        first = START + timedelta(
+            seconds=random.randrange(max(steps - window, 1)) * SAMPLE_PERIOD
+        )
+        last = first + timedelta(seconds=window * SAMPLE_PERIOD)
+        pipeline = [
+            {"$match": {"sat_id": sat_id, "timestamp": {"$gte": first, "$lt": last}}},
+            {"$sort": {"timestamp": 1}},
+        ]
+        started = time.perf_counter()
+        crud.aggregate(pipeline)
+        latencies.append((time.perf_counter() - started) * 1000)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--satellites", type=int, default=10)
+    parser.add_argument("--samples", type=int, default=100000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument(
+        "--window", type=int, default=180, help="Locations per range scan (1h)"
+    )
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    parser.add_argument(
+        "--allow-remote", action="store_true", help="Run against a DATABASE_URL that is not on this host"
+    )
+    args = parser.parse_args()
+
+    if not args.allow_remote and not is_local_database(secrets.DATABASE_URL):
+        sys.exit("DATABASE_URL is not on this host. Refusing to drop its database without --allow-remote.")
+    mongodb = MongoDB(secrets.DATABASE_URL, BENCHMARK_DB)
+    mongodb.connect()
+    results = {}
+    try:
+        for mode in ("standard", "timeseries"):
+            crud = prepare(mongodb, mode)
+            load_seconds = load(crud, args.satellites, args.samples)
+            latencies = range_scans(
+                crud, args.satellites, args.samples, args.queries, args.window
+            )
+            results[mode] = {
+                "load_seconds": round(load_seconds, 3),
+                **footprint(mongodb, crud),
+                "scan_ms_mean": round(statistics.mean(latencies), 3),
+                "scan_ms_p50": round(percentile(latencies, 50), 3),
+                "scan_ms_p95": round(percentile(latencies, 95), 3),
+                "scan_ms_p99": round(percentile(latencies, 99), 3),
+            }
+    finally:
+        mongodb.drop()
+        mongodb.close()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    metrics = list(results["standard"].keys())
+    print(f"{'metric':<16}{'standard':>16}{'timeseries':>16}")
+    for metric in metrics:
+        print(
+            f"{metric:<16}{results['standard'][metric]:>16}{results['timeseries'][metric]:>16}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+Benchmark that compares the two ways the list endpoints write their responses (look at app_config.yaml):
+the default path, where objectid_to_str is applied to every document, every document is validated by the response model
+and the response is encoded with the json module, and the fast path, that shapes the documents and encodes them with orjson.
+
+Both routes serve the same synthetic locations from memory, so only the serialization is measured, through the whole
+FastAPI request handling. Their bodies are checked to be identical.
+
+Run it from the backend folder:
+    python benchmarks/responses.py --rows 100 1000 --requests 200
+"""
+
+import argparse
+import json
+import random
+import statistics
+import sys
+import os
+import time
+from datetime import datetime, timezone
+from typing import Dict, List
+
+from bson import ObjectId
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+# Required row to be able to import the app folder.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.models.location import ListLocationResponses
+from app.utils.model_utils import objectid_to_str
+from app.utils.responses import FastJSONResponse, shape
+from common import percentile, synthetic_locations
+
+
+def documents(rows: int) -> List[Dict]:
+    """
+    Generates documents the way they are read from the locations collection.
+    """
+    random.seed(0)
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    return [{"_id": ObjectId(), **location} for location in synthetic_locations([25544], rows, start)]
+
+
+def build_app(documents: List[Dict]) -> FastAPI:
+    """
+    Builds an application with one route per path. Every request serializes a new copy of the documents,
+    the same way every request reads new documents from the database.
+    """
+    app = FastAPI()
+
+    def content() -> Dict:
+        locations = [dict(location) for location in documents]
+        return {
+            "status": "success",
+            "results": len(locations),
+            "total": len(locations),
+            "total_mode": "maintained",
+            "locations": locations,
+        }
+
+    @app.get("/default", response_model=ListLocationResponses)
+    def default_path():
+        response = content()
+        objectid_to_str(response["locations"])
+        return response
+
+    @app.get("/fast", response_model=ListLocationResponses)
+    def fast_path():
+        return FastJSONResponse(shape(content(), ListLocationResponses))
+
+    return app
+
+
+def measure(client: TestClient, path: str, requests: int) -> List[float]:
+    """
+    Sends the requests one after the other.
+
+    :returns:   The latency of every request in milliseconds
+    :rtype:     List[float]
+    """
+    latencies = []
+    for _ in range(requests):
+        started = time.perf_counter()
+        client.get(path)
+        latencies.append((time.perf_counter() - started) * 1000)
+    return latencies
+
+
+def run(rows: int, requests: int) -> Dict:
+    """
+    Runs both paths on the same documents.
+    """
+    client = TestClient(build_app(documents(rows)))
+    result = {"rows": rows}
+    for path in ("default", "fast"):
+        # Warm up the route before measuring it
+        measure(client, f"/{path}", 5)
+        latencies = measure(client, f"/{path}", requests)
+        result[f"{path}_ms_p50"] = round(percentile(latencies, 50), 3)
+        result[f"{path}_ms_p95"] = round(percentile(latencies, 95), 3)
+        result[f"{path}_ms_mean"] = round(statistics.mean(latencies), 3)
+    result["speedup"] = round(result["default_ms_mean"] / result["fast_ms_mean"], 1)
+    result["identical"] = client.get("/default").json() == client.get("/fast").json()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, nargs="+", default=[100, 1000])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args()
+
+    results = [run(rows, args.requests) for rows in args.rows]
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for result in results:
+        print(", ".join(f"{key}: {value}" for key, value in result.items()))
+    if not all(result["identical"] for result in results):
+        sys.exit("The fast responses are not identical to the default ones")
+
+
+if __name__ == "__main__":
+    main()
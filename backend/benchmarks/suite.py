@@ -0,0 +1,463 @@
+"""
+Benchmark suite that measures the API, the daylight windows and the ingestion path on seeded volumes of locations.
+
+For every volume, a separate database is seeded with the locations of several satellites (the ISS is one of them),
+their daylight windows and TLEs. Then every endpoint of the routers is requested through the whole FastAPI request
+handling, LocationComponent.get_daylight_windows runs on the locations of the ISS and poll cycles are ingested
+the same way the pull_position service does. The latency percentiles and the throughput of every benchmark are
+written as JSON together with the commit, so that the results of two commits can be compared.
+
+It needs a local MongoDB. The database is named after the BENCHMARK_DB environment variable (benchmark_db by
+default) and it is dropped at the end, so a DATABASE_URL that is not on this host is refused unless --allow-remote
+is passed. The raw locations do not expire during the benchmark.
+
+Run it from the backend folder:
+    python benchmarks/suite.py --volumes 10000 1000000 10000000 --output benchmarks/results/head.json
+    python benchmarks/suite.py --compare benchmarks/results/base.json benchmarks/results/head.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List
+
+# Required row to be able to import the app folder.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# The application is pointed to the database of the benchmark before it connects
+BENCHMARK_DB = os.environ.get("BENCHMARK_DB", "benchmark_db")
+os.environ["MONGO_INITDB_DATABASE"] = BENCHMARK_DB
+
+from app.config import app_config, secrets
+
+# The seeded locations are old, so the raw tier keeps them forever and the range queries do not move to the rollups
+app_config.app_retention_raw_days = None
+
+from fastapi.testclient import TestClient
+from app.main import app
+from app.db import (
+    mongodb,
+    SatellitesCRUD,
+    LocationsCRUD,
+    TLEsCRUD,
+    ensure_collections,
+    ensure_indexes,
+)
+from app.components.location import LocationComponent
+from app.components.satellite_registry import satellite_registry
+from app.components.location_cache import location_cache
+from app.components.write_buffer import WriteBuffer
+from app.services.pull_position_task import rebuild_daylight_windows, update_daylight_windows
+from common import SAMPLE_PERIOD, is_local_database, percentile, synthetic_location, synthetic_locations
+
+BATCH_SIZE = 10000
+# Satellites that are created and deleted by the write benchmarks
+FIRST_TEMPORARY_SAT_ID = 90000000
+# A TLE of the ISS, used for every satellite
+TLE = {
+    "line1": "1 25544U 98067A   08264.51782528 -.00002182  00000-0 -11606-4 0  2927",
+    "line2": "2 25544  51.6416 247.4627 0006703 130.5360 325.0288 15.72125391563537",
+}
+# Endpoints that are not measured, with the reason
+SKIPPED = {
+    "GET /api/iss/stream": "server-sent events stream that stays open",
+}
+
+
+def iso(value: datetime) -> str:
+    """
+    Writes a datetime for a query string. A "+" would be read as a space.
+    """
+    return value.isoformat().replace("+00:00", "Z")
+
+
+def seed(volume: int, satellites: int, end: datetime) -> Dict:
+    """
+    Creates the database of a volume: the satellites with their TLEs, the locations and the daylight windows.
+
+    :returns:   The ids of the satellites and the seconds every step took
+    :rtype:     Dict
+    """
+    random.seed(0)
+    mongodb.drop()
+    ensure_collections()
+    ensure_indexes()
+    sat_ids = [app_config.app_iss_id] + [10000 + i for i in range(1, satellites)]
+    for sat_id in sat_ids:
+        SatellitesCRUD.create({"sat_id": sat_id, "name": f"benchmark-{sat_id}", "units": "kilometers"})
+        TLEsCRUD.create({"sat_id": sat_id, **TLE})
+    satellite_registry.refresh()
+    location_cache.invalidate()
+
+    started = time.perf_counter()
+    batch = []
+    # The latest locations end at the provided time
+    start = end - timedelta(seconds=volume // len(sat_ids) * SAMPLE_PERIOD)
+    for location in synthetic_locations(sat_ids, volume, start):
+        batch.append(location)
+        if len(batch) == BATCH_SIZE:
+            LocationsCRUD.create_many(batch)
+            batch = []
+    if batch:
+        LocationsCRUD.create_many(batch)
+    load_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for sat_id in sat_ids:
+        rebuild_daylight_windows(sat_id)
+    windows_seconds = time.perf_counter() - started
+    return {
+        "sat_ids": sat_ids,
+        "load_seconds": round(load_seconds, 3),
+        "load_per_s": round(volume / load_seconds, 1),
+        "windows_seconds": round(windows_seconds, 3),
+    }
+
+
+def summarize(latencies: List[float], seconds: float, errors: int = 0, items: int = 1) -> Dict:
+    """
+    Summarizes the latencies of a benchmark in milliseconds.
+    The throughput is the number of items (requests, locations...) per second of the whole run.
+    """
+    return {
+        "runs": len(latencies),
+        "errors": errors,
+        "mean_ms": round(statistics.mean(latencies), 3),
+        "p50_ms": round(percentile(latencies, 50), 3),
+        "p90_ms": round(percentile(latencies, 90), 3),
+        "p95_ms": round(percentile(latencies, 95), 3),
+        "p99_ms": round(percentile(latencies, 99), 3),
+        "max_ms": round(max(latencies), 3),
+        "throughput_per_s": round(len(latencies) * items / seconds, 1),
+    }
+
+
+def measure(client: TestClient, request: Callable[[TestClient, int], object], runs: int, warmup: int) -> Dict:
+    """
+    Sends a request sequentially and measures its latency. A request is built for every run,
+    so that the write endpoints do not write the same document twice.
+    """
+    for i in range(warmup):
+        request(client, -1 - i)
+    latencies = []
+    errors = 0
+    started = time.perf_counter()
+    for i in range(runs):
+        sent = time.perf_counter()
+        response = request(client, i)
+        latencies.append((time.perf_counter() - sent) * 1000)
+        errors += response.status_code >= 400
+    return summarize(latencies, time.perf_counter() - started, errors)
+
+
+def endpoints(client: TestClient, end: datetime) -> Dict[str, Callable]:
+    """
+    Builds the requests of every endpoint of the routers, keyed by method and route.
+    The cursors and the ids are read from the seeded database.
+    """
+    iss = app_config.app_iss_id
+    hour = {"from": iso(end - timedelta(hours=1)), "to": iso(end)}
+    day = {"from": iso(end - timedelta(days=1)), "to": iso(end)}
+    location_id = str(LocationsCRUD.find_one({"sat_id": iss})["_id"])
+    satellite_id = str(SatellitesCRUD.find_one({"sat_id": iss})["_id"])
+    locations_cursor = client.get("/api/location/", params={"limit": 100}).json()["next_cursor"]
+    sat_locations_cursor = client.get(f"/api/location/by_sat_id/{iss}", params={"limit": 100}).json()["next_cursor"]
+    satellites_cursor = client.get("/api/satellite/", params={"limit": 1}).json()["next_cursor"]
+    # The locations deleted by the benchmark are written in the future, so they do not change the other results
+    deleted_ids = []
+
+    def new_location(i: int) -> Dict:
+        location = synthetic_location(iss, 0, end + timedelta(days=1, seconds=(i + 1000) * SAMPLE_PERIOD))
+        return {**location, "timestamp": iso(location["timestamp"])}
+
+    def delete_location(client: TestClient, i: int):
+        if not deleted_ids:
+            created = LocationsCRUD.create_many(
+                [synthetic_location(iss, j, end + timedelta(days=2)) for j in range(1000)]
+            )
+            deleted_ids.extend(str(location["_id"]) for location in created)
+        return client.delete(f"/api/location/{deleted_ids.pop()}")
+
+    def create_satellite(client: TestClient, i: int):
+        return client.post(
+            "/api/satellite/",
+            json={"sat_id": FIRST_TEMPORARY_SAT_ID + i + 1000, "name": "temporary", "units": "kilometers"},
+        )
+
+    def delete_satellite(client: TestClient, i: int):
+        satellite = SatellitesCRUD.find_one({"sat_id": {"$gte": FIRST_TEMPORARY_SAT_ID}})
+        if satellite is None:
+            satellite = SatellitesCRUD.create({"sat_id": FIRST_TEMPORARY_SAT_ID - 1 - i, "name": "temporary"})
+        return client.delete(f"/api/satellite/{satellite['_id']}")
+
+    return {
+        "GET /api/healthchecker": lambda c, i: c.get("/api/healthchecker"),
+        "GET /api/metrics": lambda c, i: c.get("/api/metrics"),
+        "GET /api/satellite/": lambda c, i: c.get("/api/satellite/", params={"limit": 10}),
+        "GET /api/satellite/ (cursor)": lambda c, i: c.get(
+            "/api/satellite/", params={"limit": 10, "cursor": satellites_cursor}
+        ),
+        "GET /api/satellite/search": lambda c, i: c.get("/api/satellite/search", params={"q": "bench"}),
+        "GET /api/satellite/{satelliteId}": lambda c, i: c.get(f"/api/satellite/{satellite_id}"),
+        "POST /api/satellite/": create_satellite,
+        "DELETE /api/satellite/{satelliteId}": delete_satellite,
+        "GET /api/location/": lambda c, i: c.get("/api/location/", params={"limit": 100}),
+        "GET /api/location/ (page 10)": lambda c, i: c.get("/api/location/", params={"limit": 100, "page": 10}),
+        "GET /api/location/ (cursor)": lambda c, i: c.get(
+            "/api/location/", params={"limit": 100, "cursor": locations_cursor}
+        ),
+        "GET /api/location/export": lambda c, i: c.get("/api/location/export", params={"limit": 1000}),
+        "GET /api/location/{locationId}": lambda c, i: c.get(f"/api/location/{location_id}"),
+        "POST /api/location/": lambda c, i: c.post("/api/location/", json=new_location(i)),
+        "POST /api/location/bulk": lambda c, i: c.post(
+            "/api/location/bulk", json=[new_location(i * 100 + j + 100000) for j in range(100)]
+        ),
+        "DELETE /api/location/{locationId}": delete_location,
+        "GET /api/location/by_sat_id/{sat_id}": lambda c, i: c.get(
+            f"/api/location/by_sat_id/{iss}", params={"limit": 100}
+        ),
+        "GET /api/location/by_sat_id/{sat_id} (cursor)": lambda c, i: c.get(
+            f"/api/location/by_sat_id/{iss}", params={"limit": 100, "cursor": sat_locations_cursor}
+        ),
+        "GET /api/location/by_sat_id/{sat_id} (range)": lambda c, i: c.get(
+            f"/api/location/by_sat_id/{iss}", params={"limit": 100, **hour}
+        ),
+        "GET /api/location/by_sat_id/{sat_id}/history": lambda c, i: c.get(
+            f"/api/location/by_sat_id/{iss}/history", params=day
+        ),
+        "GET /api/location/by_sat_id/{sat_id}/track": lambda c, i: c.get(
+            # A different range every time, so that the cache of the tracks is not measured
+            f"/api/location/by_sat_id/{iss}/track",
+            params={"from": iso(end - timedelta(days=1, seconds=i)), "to": iso(end), "points": 500},
+        ),
+        "GET /api/location/by_sat_id/{sat_id}/export": lambda c, i: c.get(
+            f"/api/location/by_sat_id/{iss}/export", params={"limit": 1000}
+        ),
+        "GET /api/iss/sun": lambda c, i: c.get("/api/iss/sun"),
+        "GET /api/iss/sun (range)": lambda c, i: c.get("/api/iss/sun", params=day),
+        "GET /api/iss/sun/predicted": lambda c, i: c.get("/api/iss/sun/predicted", params={"from": iso(end)}),
+        "GET /api/iss/position": lambda c, i: c.get("/api/iss/position"),
+        "PUT /api/orbit/tle": lambda c, i: c.put("/api/orbit/tle", json={"sat_id": iss, **TLE}),
+        "GET /api/orbit/tle/{sat_id}": lambda c, i: c.get(f"/api/orbit/tle/{iss}"),
+        "GET /api/orbit/positions": lambda c, i: c.get("/api/orbit/positions", params={"at": iso(end)}),
+        "GET /api/orbit/by_sat_id/{sat_id}/positions": lambda c, i: c.get(
+            f"/api/orbit/by_sat_id/{iss}/positions", params={"from": iso(end)}
+        ),
+        "GET /api/orbit/by_sat_id/{sat_id}/sun": lambda c, i: c.get(
+            f"/api/orbit/by_sat_id/{iss}/sun", params={"from": iso(end)}
+        ),
+    }
+
+
+def unmeasured(requests: Dict[str, Callable]) -> List[str]:
+    """
+    Lists the endpoints of the application that have no benchmark and are not skipped on purpose.
+    """
+    measured = {" ".join(name.split(" ")[:2]) for name in requests} | set(SKIPPED)
+    routes = [
+        f"{method.upper()} {path}" for path, operations in app.openapi()["paths"].items() for method in operations
+    ]
+    return [route for route in routes if route not in measured]
+
+
+def daylight_windows(runs: int, limit: int) -> Dict:
+    """
+    Runs LocationComponent.get_daylight_windows and get_daylight_windows_columnar on the locations of the ISS.
+    The throughput is in locations per second.
+    """
+    locations = LocationsCRUD.aggregate(
+        [
+            {"$match": {"sat_id": app_config.app_iss_id}},
+            {"$sort": {"timestamp": 1}},
+            {"$limit": limit},
+            {"$project": {"_id": 0, "visibility": 1, "timestamp": 1}},
+        ]
+    )
+    locationComponent = LocationComponent()
+    timestamps, visibility = locationComponent.to_columns(locations)
+    results = {"locations": len(locations)}
+    for name, function, args in (
+        ("get_daylight_windows", locationComponent.get_daylight_windows, (locations,)),
+        ("get_daylight_windows_columnar", locationComponent.get_daylight_windows_columnar, (timestamps, visibility)),
+    ):
+        latencies = []
+        started = time.perf_counter()
+        for _ in range(runs):
+            sent = time.perf_counter()
+            function(*args)
+            latencies.append((time.perf_counter() - sent) * 1000)
+        results[name] = summarize(latencies, time.perf_counter() - started, items=len(locations))
+    return results
+
+
+def ingestion(sat_ids: List[int], polls: int, end: datetime) -> Dict:
+    """
+    Ingests poll cycles the same way the pull_position service does, without the requests to the API:
+    one location per satellite goes through the write buffer, is stored and updates the daylight windows.
+    The throughput is in locations per second.
+    """
+    random.seed(2)
+    with tempfile.TemporaryDirectory() as directory:
+        buffer = WriteBuffer(
+            LocationsCRUD, os.path.join(directory, "benchmark.wal"), max_size=len(sat_ids), max_age=0
+        )
+        latencies = []
+        started = time.perf_counter()
+        for poll in range(polls):
+            locations = [synthetic_location(sat_id, poll, end + timedelta(days=3)) for sat_id in sat_ids]
+            sent = time.perf_counter()
+            for location in buffer.add(locations):
+                update_daylight_windows(location)
+            latencies.append((time.perf_counter() - sent) * 1000)
+        return summarize(latencies, time.perf_counter() - started, items=len(sat_ids))
+
+
+def git_commit() -> Dict:
+    """
+    Reads the commit of the working tree, so that the results can be compared across commits.
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout
+        dirty = subprocess.run(["git", "status", "--porcelain"], capture_output=True, text=True, check=True).stdout
+        return {"commit": commit.strip(), "dirty": bool(dirty.strip())}
+    except (OSError, subprocess.CalledProcessError):
+        return {"commit": None, "dirty": None}
+
+
+def run(args: argparse.Namespace) -> Dict:
+    """
+    Seeds and measures every volume.
+    """
+    client = TestClient(app)
+    results = {
+        "meta": {
+            **git_commit(),
+            "created": iso(datetime.now(timezone.utc)),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "mongodb": mongodb.database.command("buildInfo")["version"],
+            "args": {key: value for key, value in vars(args).items() if key != "compare"},
+            "skipped": SKIPPED,
+        },
+        "volumes": {},
+    }
+    try:
+        for volume in args.volumes:
+            end = datetime.now(timezone.utc).replace(microsecond=0)
+            print(f"Seeding {volume} locations of {args.satellites} satellites...", file=sys.stderr)
+            seeded = seed(volume, args.satellites, end)
+            sat_ids = seeded.pop("sat_ids")
+            requests = endpoints(client, end)
+            missing = unmeasured(requests)
+            if missing:
+                print(f"WARNING: No benchmark for {missing}", file=sys.stderr)
+            result = {"seed": seeded, "endpoints": {}}
+            for name, request in requests.items():
+                print(f"Measuring {name}...", file=sys.stderr)
+                result["endpoints"][name] = measure(client, request, args.requests, args.warmup)
+            result["components"] = daylight_windows(args.component_runs, args.component_limit)
+            result["ingestion"] = ingestion(sat_ids, args.polls, end)
+            results["volumes"][str(volume)] = result
+    finally:
+        if not args.keep:
+            mongodb.drop()
+    return results
+
+
+def flatten(results: Dict) -> Dict[str, Dict]:
+    """
+    Flattens the results to one entry per volume and benchmark, with the statistics of the benchmark.
+    """
+    entries = {}
+    for volume, result in results["volumes"].items():
+        for name, stats in result["endpoints"].items():
+            entries[f"{volume} {name}"] = stats
+        for name, stats in result["components"].items():
+            if isinstance(stats, dict):
+                entries[f"{volume} {name}"] = stats
+        entries[f"{volume} ingestion"] = result["ingestion"]
+    return entries
+
+
+def compare(base_path: str, head_path: str, metric: str, threshold: float) -> bool:
+    """
+    Compares two result files and prints the change of a metric for every benchmark they have in common.
+
+    :returns:   True if no benchmark regressed by more than the threshold
+    :rtype:     bool
+    """
+    with open(base_path) as f:
+        base = json.load(f)
+    with open(head_path) as f:
+        head = json.load(f)
+    print(f"base: {base['meta']['commit']}  head: {head['meta']['commit']}  metric: {metric}")
+    base_entries, head_entries = flatten(base), flatten(head)
+    regressions = 0
+    for name, stats in head_entries.items():
+        if name not in base_entries:
+            continue
+        before, after = base_entries[name][metric], stats[metric]
+        change = (after - before) / before if before else 0.0
+        # A higher throughput is better, a higher latency is worse
+        regressed = (-change if metric == "throughput_per_s" else change) > threshold
+        regressions += regressed
+        print(f"{name:<64}{before:>12}{after:>12}{change:>+10.1%}{'  REGRESSION' if regressed else ''}")
+    return regressions == 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--volumes", type=int, nargs="+", default=[10000, 1000000])
+    parser.add_argument("--satellites", type=int, default=10)
+    parser.add_argument("--requests", type=int, default=100, help="Measured requests per endpoint")
+    parser.add_argument("--warmup", type=int, default=5, help="Requests per endpoint before measuring")
+    parser.add_argument("--component-runs", type=int, default=5)
+    parser.add_argument(
+        "--component-limit", type=int, default=1000000, help="Maximum locations of the daylight windows benchmark"
+    )
+    parser.add_argument("--polls", type=int, default=100, help="Poll cycles of the ingestion benchmark")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--keep", action="store_true", help="Keep the database of the last volume")
+    parser.add_argument(
+        "--allow-remote", action="store_true", help="Run against a DATABASE_URL that is not on this host"
+    )
+    parser.add_argument(
+        "--compare", nargs=2, metavar=("BASE", "HEAD"), help="Compare two result files instead of running"
+    )
+    parser.add_argument("--metric", default="p95_ms", help="The metric compared by --compare")
+    parser.add_argument(
+        "--threshold", type=float, default=0.2, help="Relative change of the metric reported as a regression"
+    )
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(0 if compare(*args.compare, args.metric, args.threshold) else 1)
+
+    if secrets.MONGO_INITDB_DATABASE != BENCHMARK_DB:
+        sys.exit(f"The application does not use the database of the benchmark {BENCHMARK_DB}. Refusing to drop it.")
+    if not args.allow_remote and not is_local_database(secrets.DATABASE_URL):
+        sys.exit("DATABASE_URL is not on this host. Refusing to drop its database without --allow-remote.")
+    results = run(args)
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}", file=sys.stderr)
+
+    for name, stats in flatten(results).items():
+        print(
+            f"{name:<64}p50 {stats['p50_ms']:>10} ms  p95 {stats['p95_ms']:>10} ms  "
+            f"p99 {stats['p99_ms']:>10} ms  {stats['throughput_per_s']:>12}/s"
+        )
+
+
+if __name__ == "__main__":
+    main()
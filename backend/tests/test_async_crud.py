@@ -0,0 +1,173 @@
+import pytest
+from fastapi import HTTPException
+from pymongo import IndexModel, ASCENDING
+import sys
+import os
+
+# Required row to be able to import the app folder.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.db.async_crud import AsyncCRUD
+from app.config import secrets
+from app.db.database import MongoDB, AsyncMongoDB
+
+TEST_DB = "test_async_db"
+TEST_COLLECTION_1 = "test_collection_1"
+TEST_COLLECTION_2 = "test_collection_2"
+TEST_RELATIONSHIP_FIELD = "relationship_field"
+
+
+def test01_database_connect():
+    # Test database connection and initialization of AsyncCRUD objects.
+    pytest.async_mongodb = AsyncMongoDB(secrets.DATABASE_URL, TEST_DB)
+    pytest.async_mongodb.connect()
+    # The unique index is created with the synchronous client
+    pytest.sync_mongodb = MongoDB(secrets.DATABASE_URL, TEST_DB)
+    pytest.sync_mongodb.connect()
+    pytest.sync_mongodb.get_collection(TEST_COLLECTION_1).create_index(
+        TEST_RELATIONSHIP_FIELD, unique=True
+    )
+    Coll_1_DB = pytest.async_mongodb.get_collection(TEST_COLLECTION_1)
+    Coll_2_DB = pytest.async_mongodb.get_collection(TEST_COLLECTION_2)
+
+    # Initialize AsyncCRUD objects with cascading and reference relationships.
+    # When Coll_1_DB object is deleted or updated, this cascades to Coll_2_DB
+    pytest.Async_Coll_1_CRUD = AsyncCRUD(
+        Coll_1_DB, cascaded_collection=Coll_2_DB, cascaded_field=TEST_RELATIONSHIP_FIELD
+    )
+    # When Coll_2_DB object is created or updated, we validate that the reference exists in Coll_1_DB
+    pytest.Async_Coll_2_CRUD = AsyncCRUD(
+        Coll_2_DB, related_collection=Coll_1_DB, reference_field=TEST_RELATIONSHIP_FIELD
+    )
+
+
+@pytest.mark.asyncio
+async def test02_crud():
+    # Test CRUD operations with related and cascaded collections.
+
+    # Prepare data for tests.
+    data = {"name": "test_item", TEST_RELATIONSHIP_FIELD: "1"}
+    data_rel_1 = {"name": "test_rel_item_1", TEST_RELATIONSHIP_FIELD: "1"}
+    data_rel_2 = {"name": "test_rel_item_2", TEST_RELATIONSHIP_FIELD: "1"}
+
+    # Test create: Should raise an exception since the related object doesn't exist.
+    with pytest.raises(HTTPException):
+        await pytest.Async_Coll_2_CRUD.create(data_rel_1)
+
+    # Test successful creation of the main document.
+    pytest.created = await pytest.Async_Coll_1_CRUD.create(data)
+    assert pytest.created == data
+
+    # Test creation of related documents after the main document exists.
+    pytest.created_rel_1 = await pytest.Async_Coll_2_CRUD.create(data_rel_1)
+    assert pytest.created_rel_1 == data_rel_1
+    pytest.created_rel_2 = await pytest.Async_Coll_2_CRUD.create(data_rel_2)
+    assert pytest.created_rel_2 == data_rel_2
+
+    # Test read: Should raise an exception if the document does not exist.
+    with pytest.raises(HTTPException):
+        await pytest.Async_Coll_1_CRUD.read("doesn't exist")
+
+    # Test successful retrieval of an existing document.
+    read = await pytest.Async_Coll_1_CRUD.read(str(pytest.created["_id"]))
+    assert read is not None
+    assert read == pytest.created
+
+    # Test update: Should raise an exception if the document does not exist.
+    update_data = {"name": "updated_item"}
+    with pytest.raises(HTTPException):
+        await pytest.Async_Coll_2_CRUD.update("doesn't exist", update_data)
+
+    # Test successful update of an existing document.
+    updated_document = await pytest.Async_Coll_2_CRUD.update(
+        str(pytest.created_rel_1["_id"]), update_data
+    )
+    assert updated_document["name"] == "updated_item"
+
+    # Test successful update of an existing document with cascade.
+    update_data = {TEST_RELATIONSHIP_FIELD: "2"}
+    updated_document = await pytest.Async_Coll_1_CRUD.update(
+        str(pytest.created["_id"]), update_data
+    )
+    assert updated_document[TEST_RELATIONSHIP_FIELD] == "2"
+    updated_rel_document_1 = await pytest.Async_Coll_2_CRUD.read(
+        str(pytest.created_rel_1["_id"])
+    )
+    updated_rel_document_2 = await pytest.Async_Coll_2_CRUD.read(
+        str(pytest.created_rel_2["_id"])
+    )
+    assert (
+        updated_rel_document_1[TEST_RELATIONSHIP_FIELD]
+        == updated_rel_document_2[TEST_RELATIONSHIP_FIELD]
+        == "2"
+    )
+
+    # Test find, find_one, count and aggregate for existing and non-existing documents.
+    found_documents = await pytest.Async_Coll_2_CRUD.find({"name": "updated_item"})
+    assert len(found_documents) == 1
+    assert found_documents[0]["name"] == "updated_item"
+    assert await pytest.Async_Coll_2_CRUD.find({"name": "doesn't exist"}) == []
+
+    found_one = await pytest.Async_Coll_2_CRUD.find_one({"name": "updated_item"})
+    assert found_one["name"] == "updated_item"
+    assert await pytest.Async_Coll_2_CRUD.find_one({"name": "doesn't exist"}) is None
+
+    assert await pytest.Async_Coll_2_CRUD.count({"name": "updated_item"}) == 1
+    assert await pytest.Async_Coll_2_CRUD.count({"name": "doesn't exist"}) == 0
+
+    pipeline = [{"$match": {"name": "updated_item"}}, {"$project": {"name": 1}}]
+    aggregated = await pytest.Async_Coll_2_CRUD.aggregate(pipeline)
+    assert len(aggregated) == 1
+    assert aggregated[0]["name"] == "updated_item"
+
+
+@pytest.mark.asyncio
+async def test03_delete():
+    # Test deletion of documents and cascading behavior from a new event loop.
+
+    # Test deletion of a single document.
+    deleted, deleted_document = await pytest.Async_Coll_2_CRUD.delete(
+        str(pytest.created_rel_2["_id"])
+    )
+    assert deleted
+    assert deleted_document["name"] == "test_rel_item_2"
+
+    # Test cascading deletion of related documents.
+    deleted, deleted_document = await pytest.Async_Coll_1_CRUD.delete(
+        str(pytest.created["_id"])
+    )
+    assert deleted
+    assert deleted_document["name"] == "test_item"
+    assert await pytest.Async_Coll_2_CRUD.count({}) == 0
+
+    # Test deletion of a document that does not exist anymore.
+    with pytest.raises(HTTPException):
+        await pytest.Async_Coll_1_CRUD.delete(str(pytest.created["_id"]))
+
+
+@pytest.mark.asyncio
+async def test04_ensure_indexes():
+    # Test the reconciliation of the declared indexes.
+    crud = AsyncCRUD(
+        pytest.async_mongodb.get_collection(TEST_COLLECTION_2),
+        indexes=[IndexModel([("name", ASCENDING)])],
+        index_registry=pytest.async_mongodb.get_collection("test_indexes"),
+    )
+    created, dropped = await crud.ensure_indexes()
+    assert created == ["name_1"]
+    assert dropped == []
+    # Nothing changes when the indexes are reconciled again
+    assert await crud.ensure_indexes() == ([], [])
+
+    # An index that is not declared anymore is dropped, but not an index that was created by hand
+    await crud.collection.create_index([("value", ASCENDING)])
+    crud.indexes = []
+    assert await crud.ensure_indexes() == ([], ["name_1"])
+    assert "value_1" in await crud.collection.index_information()
+
+
+def test05_drop_close():
+    # Cleanup: Drop the test database and close the connections.
+    pytest.sync_mongodb.drop()
+    pytest.sync_mongodb.close()
+    pytest.async_mongodb.close()
@@ -1,6 +1,7 @@
 import pytest
 from pymongo import MongoClient
 from bson.objectid import ObjectId
+from datetime import datetime, timezone
 from fastapi import HTTPException
 import sys
 import os
@@ -8,7 +9,7 @@ import os
 # Required row to be able to import the app folder.
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from app.db.crud import CRUD
+from app.db.crud import CRUD, CountMode
 from app.config import secrets
 from app.db.database import MongoDB
 
@@ -16,6 +17,8 @@ TEST_DB = "test_db"
 TEST_COLLECTION_1 = "test_collection_1"
 TEST_COLLECTION_2 = "test_collection_2"
 TEST_RELATIONSHIP_FIELD = "relationship_field"
+TEST_TIMESERIES_COLLECTION = "test_timeseries_collection"
+TEST_COUNTERS_COLLECTION = "test_counters"
 
 
 def test01_database_connect():
@@ -149,7 +152,84 @@ def test03_delete():
     assert deleted_document["name"] == "test_item"
 
 
-def test04_drop_close():
+def test04_timeseries_crud():
+    # Test the CRUD operations on a time-series collection, which does not support findAndModify.
+    timeseries = {"timeField": "timestamp", "metaField": TEST_RELATIONSHIP_FIELD}
+    assert pytest.mongodb.ensure_collection(TEST_TIMESERIES_COLLECTION, timeseries=timeseries)
+    # The collection is only created once
+    assert not pytest.mongodb.ensure_collection(
+        TEST_TIMESERIES_COLLECTION, timeseries=timeseries
+    )
+    Coll_TS_CRUD = CRUD(
+        pytest.mongodb.get_collection(TEST_TIMESERIES_COLLECTION), timeseries=True
+    )
+
+    created = Coll_TS_CRUD.create_many(
+        [
+            {
+                "name": f"test_ts_item_{i}",
+                TEST_RELATIONSHIP_FIELD: "1",
+                "timestamp": datetime(2024, 1, 1, 0, 0, i),
+            }
+            for i in range(3)
+        ]
+    )
+    assert Coll_TS_CRUD.count({TEST_RELATIONSHIP_FIELD: "1"}) == 3
+
+    # Test update of a single document.
+    updated = Coll_TS_CRUD.update(str(created[0]["_id"]), {"name": "updated_ts_item"})
+    assert updated["name"] == "updated_ts_item"
+    assert Coll_TS_CRUD.read(str(created[1]["_id"]))["name"] == "test_ts_item_1"
+
+    # Test deletion of a single document.
+    deleted, deleted_document = Coll_TS_CRUD.delete(str(created[1]["_id"]))
+    assert deleted
+    assert deleted_document["name"] == "test_ts_item_1"
+    assert Coll_TS_CRUD.count({TEST_RELATIONSHIP_FIELD: "1"}) == 2
+    with pytest.raises(HTTPException):
+        Coll_TS_CRUD.delete(str(created[1]["_id"]))
+
+
+def test05_count_modes():
+    # Test the counting modes of a collection with a maintained count.
+    Coll_3_DB = pytest.mongodb.get_collection("test_collection_3")
+    Coll_3_CRUD = CRUD(
+        Coll_3_DB,
+        counters=pytest.mongodb.get_collection(TEST_COUNTERS_COLLECTION),
+        count_cache_ttl=60,
+    )
+    Coll_3_CRUD.create_many([{"name": f"test_item_{i}"} for i in range(3)])
+
+    # The maintained count starts from an exact count and then follows creates and deletes.
+    assert Coll_3_CRUD.total() == (3, CountMode.MAINTAINED)
+    created = Coll_3_CRUD.create({"name": "test_item_3"})
+    Coll_3_CRUD.create_many([{"name": "test_item_4"}, {"name": "test_item_5"}])
+    Coll_3_CRUD.delete(str(created["_id"]))
+    assert Coll_3_CRUD.count(mode=CountMode.MAINTAINED) == 5
+    assert Coll_3_CRUD.count(mode=CountMode.EXACT) == 5
+    assert Coll_3_CRUD.count(mode=CountMode.ESTIMATED) == 5
+
+    # Filtered counts are cached, so a new matching document is not counted until the cache expires.
+    assert Coll_3_CRUD.total({"name": "test_item_0"}) == (1, CountMode.CACHED)
+    Coll_3_DB.insert_one({"name": "test_item_0"})
+    assert Coll_3_CRUD.total({"name": "test_item_0"}) == (1, CountMode.CACHED)
+    assert Coll_3_CRUD.count({"name": "test_item_0"}) == 2
+
+    # Documents inserted without the CRUD are only counted after a reset.
+    assert Coll_3_CRUD.count(mode=CountMode.MAINTAINED) == 5
+    assert Coll_3_CRUD.reset_count() == 6
+
+    # The estimated and maintained counts can not be filtered.
+    with pytest.raises(HTTPException):
+        Coll_3_CRUD.count({"name": "test_item_0"}, mode=CountMode.MAINTAINED)
+    with pytest.raises(HTTPException):
+        Coll_3_CRUD.count({"name": "test_item_0"}, mode=CountMode.ESTIMATED)
+
+    # Without a counters collection the unfiltered total is estimated.
+    assert CRUD(Coll_3_DB).total() == (6, CountMode.ESTIMATED)
+
+
+def test06_drop_close():
     # Cleanup: Drop the test database and close the connection.
     pytest.mongodb.drop()
     pytest.mongodb.close()
@@ -0,0 +1,174 @@
+import pytest
+import sys
+import os
+from datetime import datetime, timezone
+
+# Required row to be able to import the app folder.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.db import (
+    SatellitesCRUD,
+    LocationsCRUD,
+    DaylightWindowsCRUD,
+    ensure_indexes,
+)
+from app.routers import satellites, locations, iss
+from pymongo import IndexModel, ASCENDING
+from app.config import app_config
+from app.utils.pagination import encode_cursor
+from bson import ObjectId
+
+# Cursors that point somewhere in the middle of the collections
+LOCATION_CURSOR = encode_cursor(
+    {"timestamp": datetime(2024, 1, 1, tzinfo=timezone.utc), "_id": ObjectId()},
+    locations.LOCATION_CURSOR_FIELDS,
+)
+SATELLITE_CURSOR = encode_cursor({"_id": ObjectId()}, satellites.SATELLITE_CURSOR_FIELDS)
+
+# Query plan stages that mean a query is not served by an index
+FORBIDDEN_STAGES = {"COLLSCAN", "SORT"}
+
+# Every pipeline that the routers run, together with the CRUD that runs it
+ROUTER_PIPELINES = {
+    "get_satellites": (SatellitesCRUD, satellites.satellites_pipeline(10, 1, "")),
+    "get_satellites_search": (
+        SatellitesCRUD,
+        satellites.satellites_pipeline(10, 2, "iss"),
+    ),
+    "get_satellites_cursor": (
+        SatellitesCRUD,
+        satellites.satellites_pipeline(10, 1, "", SATELLITE_CURSOR),
+    ),
+    "get_locations": (LocationsCRUD, locations.locations_pipeline(10, 2)),
+    "get_locations_cursor": (
+        LocationsCRUD,
+        locations.locations_pipeline(10, 1, LOCATION_CURSOR),
+    ),
+    "get_last_locations": (
+        LocationsCRUD,
+        locations.last_locations_pipeline(app_config.app_iss_id, 10, 2),
+    ),
+    "get_last_locations_cursor": (
+        LocationsCRUD,
+        locations.last_locations_pipeline(
+            app_config.app_iss_id, 10, 1, LOCATION_CURSOR
+        ),
+    ),
+    "get_last_locations_range": (
+        LocationsCRUD,
+        locations.last_locations_pipeline(
+            app_config.app_iss_id,
+            10,
+            1,
+            None,
+            datetime(2024, 1, 1, tzinfo=timezone.utc),
+            datetime(2024, 1, 2, tzinfo=timezone.utc),
+        ),
+    ),
+    "get_last_locations_range_cursor": (
+        LocationsCRUD,
+        locations.last_locations_pipeline(
+            app_config.app_iss_id,
+            10,
+            1,
+            LOCATION_CURSOR,
+            datetime(2024, 1, 1, tzinfo=timezone.utc),
+            datetime(2024, 1, 2, tzinfo=timezone.utc),
+        ),
+    ),
+    "export_all_locations": (
+        LocationsCRUD,
+        locations.export_pipeline(locations.locations_pipeline(0, 1)),
+    ),
+    "export_sat_locations": (
+        LocationsCRUD,
+        locations.export_pipeline(
+            locations.last_locations_pipeline(app_config.app_iss_id, 0, 1)
+        ),
+    ),
+    "iss_sun": (
+        DaylightWindowsCRUD,
+        iss.daylight_windows_pipeline(app_config.app_iss_id),
+    ),
+    "iss_sun_range": (
+        DaylightWindowsCRUD,
+        iss.daylight_windows_pipeline(
+            app_config.app_iss_id,
+            datetime(2024, 1, 1, tzinfo=timezone.utc),
+            datetime(2024, 1, 2, tzinfo=timezone.utc),
+        ),
+    ),
+    "iss_loc": (LocationsCRUD, iss.last_location_pipeline(app_config.app_iss_id)),
+    "get_location_history": (
+        LocationsCRUD,
+        locations.history_pipeline(
+            app_config.app_iss_id,
+            datetime(2024, 1, 1, tzinfo=timezone.utc),
+            datetime(2024, 1, 2, tzinfo=timezone.utc),
+        ),
+    ),
+}
+
+
+def plan_stages(explain):
+    """
+    Collects the names of all stages of the winning plans and of the aggregation pipeline in an explain output.
+    Rejected plans are skipped since they are never executed.
+    """
+    stages = set()
+
+    def walk(node):
+        if isinstance(node, dict):
+            for key, value in node.items():
+                if key == "rejectedPlans":
+                    continue
+                if key == "stage" and isinstance(value, str):
+                    stages.add(value)
+                walk(value)
+        elif isinstance(node, list):
+            for value in node:
+                walk(value)
+
+    walk(explain)
+    # Stages that the aggregation runs after the query layer, for example {"$sort": ...}
+    for stage in explain.get("stages", []):
+        stages.update(key for key in stage.keys() if key != "$cursor")
+    return stages
+
+
+def test01_ensure_indexes():
+    # Reconcile the indexes twice. The second time there should be nothing to do.
+    ensure_indexes()
+    for collection, (created, dropped) in ensure_indexes().items():
+        assert created == [], collection
+        assert dropped == [], collection
+
+    # Every declared index should exist
+    for crud in (SatellitesCRUD, LocationsCRUD, DaylightWindowsCRUD):
+        existing = crud.collection.index_information()
+        for index in crud.indexes:
+            assert index.document["name"] in existing
+
+    # An index created by hand is kept, while an index that is not declared anymore is dropped
+    DaylightWindowsCRUD.collection.create_index([("start", ASCENDING)], name="test_by_hand")
+    declared = DaylightWindowsCRUD.indexes
+    try:
+        DaylightWindowsCRUD.indexes = declared + [IndexModel([("open", ASCENDING)])]
+        assert DaylightWindowsCRUD.ensure_indexes() == (["open_1"], [])
+        DaylightWindowsCRUD.indexes = declared
+        assert DaylightWindowsCRUD.ensure_indexes() == ([], ["open_1"])
+        assert "test_by_hand" in DaylightWindowsCRUD.collection.index_information()
+    finally:
+        DaylightWindowsCRUD.indexes = declared
+        DaylightWindowsCRUD.collection.drop_index("test_by_hand")
+
+
+@pytest.mark.parametrize("name", ROUTER_PIPELINES.keys())
+def test02_router_pipelines_use_indexes(name):
+    crud, pipeline = ROUTER_PIPELINES[name]
+    stages = plan_stages(crud.explain(pipeline))
+    # Expect the query to be answered by an index scan
+    assert "IXSCAN" in stages or "EXPRESS_IXSCAN" in stages, f"{name}: {stages}"
+    # Expect no collection scans and no in-memory sorts
+    assert not stages & FORBIDDEN_STAGES, f"{name}: {stages}"
+    assert "$sort" not in stages, f"{name}: {stages}"
@@ -1,3 +1,4 @@
+import asyncio
 import pytest
 from fastapi.testclient import TestClient
 import sys
@@ -9,6 +10,8 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from app.main import app
 from app.models.satellite import SatelliteSchema
 from app.config import app_config
+from app.components.broadcaster import broadcaster
+from app.routers import iss
 
 client = TestClient(app)
 
@@ -47,3 +50,73 @@ def test02_iss_loc():
     assert isinstance(data["longitude"], float)
     # Assert that the 'timestamp' field is a string (representing an ISO8601 timestamp)
     assert isinstance(data["timestamp"], str)
+
+
+# Test case for the /sun endpoint with a time range
+def test03_iss_sun_range():
+    # Make a GET request to the /sun endpoint for a range in the past
+    response = client.get(
+        "/api/iss/sun?from=2000-01-01T00:00:00Z&to=2000-01-02T00:00:00Z"
+    )
+    assert response.status_code == 200
+    data = response.json()
+    assert data["sat_id"] == app_config.app_iss_id
+    # Assert that there are no windows before the ISS location was tracked
+    assert data["results"] == 0
+    assert data["windows"] == []
+
+    # Make a GET request to the /sun endpoint for an open ended range
+    response = client.get("/api/iss/sun?from=2000-01-01T00:00:00Z")
+    assert response.status_code == 200
+    data = response.json()
+    # Assert that all windows are returned in ascending order
+    assert data["results"] == client.get("/api/iss/sun").json()["results"]
+    starts = [window["start"] for window in data["windows"]]
+    assert starts == sorted(starts)
+
+
+# Test case for the /ws endpoint to ensure that published locations are pushed to the client
+def test04_iss_ws():
+    location = {
+        "sat_id": app_config.app_iss_id,
+        "latitude": 10.5,
+        "longitude": -20.25,
+        "timestamp": 1733011200,
+    }
+    with client.websocket_connect("/api/iss/ws") as websocket:
+        # The first message is the cached location, if the pull_position service has already run
+        assert broadcaster.subscribers(app_config.app_iss_id) == 1
+        broadcaster.publish_location(location)
+        data = websocket.receive_json()
+        while data["latitude"] != location["latitude"]:
+            data = websocket.receive_json()
+        # Assert that the message has the same keys as the /position endpoint
+        assert data == {
+            "sat_id": app_config.app_iss_id,
+            "latitude": 10.5,
+            "longitude": -20.25,
+            "timestamp": "2024-12-01T00:00:00Z",
+        }
+
+
+class QuietWebSocket:
+    """
+    A WebSocket client that disconnects while no location is published.
+    """
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, text):
+        pass
+
+    async def receive(self):
+        await asyncio.sleep(0.05)
+        return {"type": "websocket.disconnect", "code": 1000}
+
+
+# Test case for the /ws endpoint to ensure that a client is unsubscribed when it disconnects on a quiet stream
+@pytest.mark.asyncio
+async def test05_iss_ws_disconnect():
+    await asyncio.wait_for(iss.iss_ws(QuietWebSocket()), timeout=5)
+    assert broadcaster.subscribers(app_config.app_iss_id) == 0
@@ -1,14 +1,28 @@
+import math
+import numpy as np
 import pytest
+import random
+import subprocess
+import time
 from fastapi.testclient import TestClient
 import sys
 import os
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 
 # Required row to be able to import the app folder.
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from app.main import app
 from app.components.location import LocationComponent
+from app.components.location_cache import LocationCache
+from app.components.broadcaster import Broadcaster, BroadcastMessage
+from app.components.retention import RetentionPolicy
+from app.components.track import TrackComponent, TrackCache
+from app.components.orbit import OrbitComponent
+from app.components.event_bus import EventBus, events_collection
+from app.components.location_cache import location_cache
+from app.db import ensure_collections
+from app.db.database import MongoDB
 
 client = TestClient(app)
 
@@ -83,3 +97,365 @@ def test01_get_daylight_windows():
     with pytest.raises(OverflowError):
         test_location_3["timestamp"] = 999999999999999999999999
         windows = locationComponent.get_daylight_windows([test_location_3])
+
+
+def test02_update_daylight_window():
+    locationComponent = LocationComponent()
+    start = datetime(2024, 12, 1, 0, 0, 0, 0, tzinfo=timezone.utc).timestamp()
+    locations = [
+        {"sat_id": 1, "visibility": "eclipsed", "timestamp": start},
+        {"sat_id": 1, "visibility": "daylight", "timestamp": start + 30},
+        {"sat_id": 1, "visibility": "daylight", "timestamp": start + 60},
+        {"sat_id": 1, "visibility": "eclipsed", "timestamp": start + 90},
+        {"sat_id": 1, "visibility": "eclipsed", "timestamp": start + 120},
+        {"sat_id": 1, "visibility": "daylight", "timestamp": start + 150},
+    ]
+
+    # Apply the locations one by one to the latest window, the same way the pull_position service does
+    windows = []
+    for location in locations:
+        latest_window = windows[-1] if windows else None
+        window = locationComponent.update_daylight_window(latest_window, location)
+        if window is None:
+            continue
+        if window is not latest_window:
+            windows.append(window)
+
+    # Expect the same windows as when calculating them from the full history
+    expected = locationComponent.get_daylight_windows(locations)
+    assert [{"start": w["start"], "end": w["end"]} for w in windows] == expected
+    assert windows[0]["open"] == False
+    assert windows[1]["open"] == True
+
+    # Expect an older location to be ignored
+    assert locationComponent.update_daylight_window(windows[1], locations[0]) is None
+    # Expect a late daylight location to be ignored after a closed window too, instead of opening an overlapping one
+    late = {"sat_id": 1, "visibility": "daylight", "timestamp": start + 75}
+    assert locationComponent.update_daylight_window(windows[0], late) is None
+
+    # Expect datetimes to be accepted as well as epoch seconds
+    window = locationComponent.update_daylight_window(
+        None,
+        {
+            "sat_id": 1,
+            "visibility": "daylight",
+            "timestamp": datetime(2024, 12, 1, 0, 0, 0, 0),
+        },
+    )
+    assert window["start"] == datetime(2024, 12, 1, 0, 0, 0, 0, tzinfo=timezone.utc)
+
+    # Test all exceptions of function
+    with pytest.raises(KeyError):
+        locationComponent.update_daylight_window(None, {"timestamp": start})
+
+    with pytest.raises(TypeError):
+        locationComponent.update_daylight_window(
+            None, {"visibility": "daylight", "timestamp": "2024-01-01T00:00:00"}
+        )
+
+
+def test03_location_cache():
+    locationCache = LocationCache(size=3)
+    start = datetime(2024, 12, 1, 0, 0, 0, 0, tzinfo=timezone.utc).timestamp()
+    locations = [
+        {"sat_id": 1, "visibility": "daylight", "timestamp": start + 20 * i}
+        for i in range(5)
+    ]
+
+    # Expect a cache miss before any location is added
+    assert locationCache.latest(1) is None
+    assert locationCache.last(1, 1) is None
+
+    for location in locations:
+        locationCache.add(location)
+
+    # Expect the latest location and only the last 3 locations, newest first
+    assert locationCache.latest(1) == locations[-1]
+    assert locationCache.last(1, 3) == locations[:1:-1]
+    # Expect a cache miss when asking for more locations than the cache holds
+    assert locationCache.last(1, 4) is None
+
+    # Expect copies that can be changed without changing the cache
+    locationCache.latest(1)["timestamp"] = 0
+    assert locationCache.latest(1) == locations[-1]
+
+    # Expect an older location to invalidate the satellite
+    locationCache.add(locations[0])
+    assert locationCache.latest(1) is None
+
+    # Expect invalidate to remove the locations of a satellite
+    locationCache.add(locations[0])
+    locationCache.invalidate(1)
+    assert locationCache.latest(1) is None
+
+
+# Test case for the Broadcaster. Slow subscribers keep only the latest messages and all subscribers share one message object
+@pytest.mark.asyncio
+async def test04_broadcaster():
+    broadcaster = Broadcaster(queue_size=2)
+    fast = broadcaster.subscribe(25544)
+    slow = broadcaster.subscribe(25544)
+    other = broadcaster.subscribe(99999)
+    assert broadcaster.subscribers(25544) == 2
+    assert broadcaster.subscribers() == 3
+
+    # Nothing is built for topics without subscribers
+    assert broadcaster.publish_location({"sat_id": 12345}) == 0
+
+    messages = []
+    for i in range(4):
+        location = {
+            "sat_id": 25544,
+            "latitude": float(i),
+            "longitude": float(i),
+            "timestamp": test_location_1["timestamp"] + i,
+        }
+        assert broadcaster.publish_location(location) == 2
+        # The fast subscriber consumes every message
+        messages.append(await fast.get())
+    assert [m.json for m in messages] == [
+        BroadcastMessage.from_location(
+            {
+                "sat_id": 25544,
+                "latitude": float(i),
+                "longitude": float(i),
+                "timestamp": test_location_1["timestamp"] + i,
+            }
+        ).json
+        for i in range(4)
+    ]
+    assert messages[0].sse == f"data: {messages[0].json}\n\n".encode("utf-8")
+    assert '"timestamp": "2024-12-01T00:00:00Z"' in messages[0].json
+
+    # The slow subscriber only keeps the 2 latest messages and shares them with the fast one
+    assert slow.dropped == 2
+    assert await slow.get() is messages[2]
+    assert await slow.get() is messages[3]
+    assert other.queue.empty()
+
+    broadcaster.unsubscribe(fast)
+    broadcaster.unsubscribe(slow)
+    broadcaster.unsubscribe(other)
+    assert broadcaster.subscribers() == 0
+
+
+# Test case for the columnar version of get_daylight_windows. It must return identical windows
+def test05_get_daylight_windows_columnar():
+    locationComponent = LocationComponent()
+    random.seed(0)
+    start = datetime(2024, 12, 1, 0, 0, 0, 0, tzinfo=timezone.utc).timestamp()
+    for n in range(30):
+        for _ in range(20):
+            # Unknown visibilities are ignored by both versions
+            locations = [
+                {
+                    "visibility": random.choice(["daylight", "eclipsed", "unknown"]),
+                    "timestamp": start + 20 * i + random.random(),
+                }
+                for i in range(n)
+            ]
+            windows = locationComponent.get_daylight_windows_columnar(
+                *locationComponent.to_columns(locations)
+            )
+            assert windows == locationComponent.get_daylight_windows(locations)
+
+    # Test all exceptions of function
+    with pytest.raises(ValueError):
+        locationComponent.get_daylight_windows_columnar([start, start + 20], ["daylight"])
+
+    with pytest.raises(TypeError):
+        locationComponent.get_daylight_windows_columnar(
+            ["2024-01-01T00:00:00"], ["daylight"]
+        )
+
+    with pytest.raises(ValueError):
+        locationComponent.get_daylight_windows_columnar([999999999999], ["daylight"])
+
+    with pytest.raises(OverflowError):
+        locationComponent.get_daylight_windows_columnar([1e300], ["daylight"])
+
+
+def test06_retention_policy():
+    policy = RetentionPolicy(
+        "locations",
+        20,
+        7,
+        [{"resolution": 600, "days": None}, {"resolution": 60, "days": 90}],
+        min_points=500,
+    )
+    # The tiers are sorted finest first
+    assert [tier.resolution for tier in policy.tiers] == [20, 60, 600]
+    now = datetime(2024, 12, 1, tzinfo=timezone.utc)
+
+    # A short recent range needs the raw locations
+    assert policy.select(now - timedelta(hours=1), now, now=now) is policy.raw
+    # 1 day has 1440 minutes but only 144 buckets of 10 minutes
+    assert policy.select(now - timedelta(days=1), now, now=now).resolution == 60
+    # 30 days have enough buckets of 10 minutes
+    assert policy.select(now - timedelta(days=30), now, now=now).resolution == 600
+    # The raw locations of 10 days ago expired, even for a short range
+    start = now - timedelta(days=10)
+    assert policy.select(start, start + timedelta(hours=1), now=now).resolution == 60
+    # Only the last tier holds a year ago and the whole history
+    start = now - timedelta(days=365)
+    assert policy.select(start, start + timedelta(hours=1), now=now).resolution == 600
+    assert policy.select(now=now).resolution == 600
+    # Naive datetimes are in UTC
+    assert policy.select(datetime(2024, 11, 30, 23), now=now) is policy.raw
+
+
+
+def test07_track_simplification():
+    track = TrackComponent(max_gap=3)
+    start = datetime(2024, 12, 1, tzinfo=timezone.utc)
+    # A satellite moving east, crossing the antimeridian once, with a gap of 10 minutes in the middle
+    locations = [
+        {
+            "latitude": 50 * math.sin(i / 50),
+            "longitude": (100 + i * 0.5 + 180) % 360 - 180,
+            "timestamp": start + timedelta(seconds=20 * i + (600 if i >= 300 else 0)),
+        }
+        for i in range(600)
+    ]
+
+    # The two runs share the points and the first run is split at the antimeridian
+    segments = track.simplify(locations, 20, points=100)
+    assert len(segments) == 3
+    assert segments[0][-1]["longitude"] == 180.0
+    assert segments[1][0]["longitude"] == -180.0
+    assert segments[0][-1]["latitude"] == segments[1][0]["latitude"]
+    # One interpolated point on every side of the crossing
+    assert sum(len(segment) for segment in segments) == 102
+    assert segments[2][0]["timestamp"] == start + timedelta(seconds=20 * 300 + 600)
+    assert all(-180 <= point["longitude"] <= 180 for segment in segments for point in segment)
+
+    # Douglas-Peucker keeps more points with a smaller tolerance
+    coarse = track.simplify(locations, 20, tolerance=1)
+    fine = track.simplify(locations, 20, tolerance=0.01)
+    assert sum(map(len, coarse)) < sum(map(len, fine)) < len(locations)
+    with pytest.raises(ValueError):
+        track.simplify(locations, 20, points=100, tolerance=1)
+    assert track.simplify([], 20, points=100) == []
+
+    # The least recently used track is removed first
+    cache = TrackCache(size=2, ttl=60)
+    cache.put(1, "a")
+    cache.put(2, "b")
+    cache.get(1)
+    cache.put(3, "c")
+    assert cache.get(2) is None
+    assert cache.get(1) == "a" and cache.get(3) == "c"
+    # The tracks expire
+    cache = TrackCache(size=2, ttl=0)
+    cache.put(1, "a")
+    assert cache.get(1) is None
+
+
+def test08_orbit_propagation():
+    orbit = OrbitComponent(step=10)
+    # The sidereal time of the J2000 epoch is 280.46 degrees
+    jd, fr = orbit.julian_dates(np.array([datetime(2000, 1, 1, 12, tzinfo=timezone.utc).timestamp()]))
+    assert math.degrees(orbit.gmst(jd, fr)[0]) == pytest.approx(280.4606, abs=1e-3)
+    # At the December solstice the sun is above the tropic of Capricorn
+    solstice = datetime(2024, 12, 21, 9, 20, tzinfo=timezone.utc).timestamp()
+    _, _, declination = orbit.sun(*orbit.julian_dates(np.array([solstice])))
+    assert math.degrees(declination[0]) == pytest.approx(-23.44, abs=0.01)
+    # Points on the ellipsoid have no altitude, including the poles
+    latitude, longitude, altitude = orbit.geodetic(
+        np.array([6378.137, 0.0]), np.array([0.0, 0.0]), np.array([0.0, 6356.7523142])
+    )
+    assert latitude.tolist() == pytest.approx([0, 90])
+    assert altitude.tolist() == pytest.approx([0, 0], abs=1e-6)
+
+    # Many satellites and timestamps are propagated at once
+    tle = {
+        "sat_id": 25544,
+        "line1": "1 25544U 98067A   08264.51782528 -.00002182  00000-0 -11606-4 0  2927",
+        "line2": "2 25544  51.6416 247.4627 0006703 130.5360 325.0288 15.72125391563537",
+    }
+    start = datetime(2008, 9, 20, 12, 25, 40, tzinfo=timezone.utc).timestamp()
+    timestamps = np.arange(start, start + 3600, 60)
+    columns = orbit.propagate([tle, {**tle, "sat_id": 1}], timestamps)
+    assert columns["latitude"].shape == (2, 60)
+    assert (columns["error"] == 0).all()
+    kilometers = orbit.locations([tle], timestamps)
+    miles = orbit.locations([tle], timestamps, units="miles")
+    assert len(kilometers) == 60
+    assert miles[0]["altitude"] == pytest.approx(kilometers[0]["altitude"] / 1.609344)
+    assert {location["visibility"] for location in kilometers} == {"daylight", "eclipsed"}
+
+
+# Publishes a location and then invalidates the satellite from another process
+EVENT_WRITER = """
+import sys
+from datetime import datetime, timezone
+from app.components.event_bus import EventBus, events_collection
+
+sat_id = int(sys.argv[1])
+bus = EventBus(events_collection, "test-writer")
+bus.publish_locations([{"sat_id": sat_id, "visibility": "daylight", "timestamp": datetime.now(timezone.utc)}])
+input()
+bus.invalidate([sat_id])
+bus.stop()
+"""
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.1)
+    return condition()
+
+
+def test09_event_bus():
+    ensure_collections()
+    sat_id = random.randint(10**8, 10**9)
+    reader = EventBus(events_collection, "test-reader")
+    reader.start()
+    try:
+        # Let the reader open its cursor before the events are published
+        time.sleep(1)
+        writer = subprocess.Popen(
+            [sys.executable, "-c", EVENT_WRITER, str(sat_id)],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            stdin=subprocess.PIPE,
+            text=True,
+        )
+        try:
+            # Expect the location of the other process in the cache of this process
+            assert wait_for(lambda: location_cache.latest(sat_id) is not None)
+            assert location_cache.latest(sat_id)["visibility"] == "daylight"
+
+            # Expect the invalidation of the other process to remove it
+            writer.communicate("\n", timeout=30)
+            assert writer.returncode == 0
+            assert wait_for(lambda: location_cache.latest(sat_id) is None)
+        finally:
+            writer.kill()
+    finally:
+        reader.stop()
+
+
+def test10_event_bus_unreachable():
+    # A database that can not be reached, with the settings of the client of the application
+    unreachable = MongoDB("mongodb://127.0.0.1:1", "unreachable")
+    unreachable.connect()
+    sat_id = random.randint(10**8, 10**9)
+    bus = EventBus(lambda: unreachable.get_collection("events"), "test-unreachable", queue_size=10, timeout=0.2)
+    try:
+        # Publishing does not wait for the database, and the locations are applied to this process at once
+        start = time.monotonic()
+        for _ in range(3):
+            bus.publish_locations(
+                [{"sat_id": sat_id, "visibility": "daylight", "timestamp": datetime.now(timezone.utc)}] * 5
+            )
+        assert time.monotonic() - start < 0.5
+        assert location_cache.latest(sat_id) is not None
+        bus.invalidate([sat_id])
+        assert location_cache.latest(sat_id) is None
+    finally:
+        # The queued events time out instead of waiting for the server selection of the client
+        start = time.monotonic()
+        bus.stop()
+        assert time.monotonic() - start < 5
+        unreachable.close()
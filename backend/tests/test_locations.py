@@ -2,13 +2,24 @@ import pytest
 from fastapi.testclient import TestClient
 import sys
 import os
-from datetime import datetime
+import json
+from datetime import datetime, timedelta, timezone
+from bson import ObjectId
 
 # Required row to be able to import the app folder.
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from app.main import app
-from app.models.location import LocationSchema
+from app.db import LocationsDB, migrate_timestamps
+from app.models.location import (
+    LocationSchema,
+    LocationInDBSchema,
+    ListLocationResponses,
+)
+from app.config import app_config
+from app.components import metrics
+from app.components.location_cache import location_cache
+from app.utils.responses import FastJSONResponse, shape
 
 client = TestClient(app)
 
@@ -19,6 +30,9 @@ test_satellite = {
     "units": "kilometers",
 }
 
+# Recent timestamps, so that the locations do not expire during the tests (look at retention in app_config.yaml)
+recent = datetime.now(timezone.utc).replace(tzinfo=None, microsecond=0) - timedelta(hours=3)
+
 # Location 1 will be used to test the Location "delete" endpoint without cascading effect
 test_location_1 = {
     "sat_id": test_satellite["sat_id"],
@@ -28,7 +42,7 @@ test_location_1 = {
     "velocity": 4,
     "visibility": "daylight",
     "footprint": 5,
-    "timestamp": "2024-01-01T00:00:00",
+    "timestamp": recent.isoformat(),
     "daynum": 6,
     "solar_lat": 7,
     "solar_lon": 8,
@@ -44,7 +58,7 @@ test_location_2 = {
     "velocity": 14,
     "visibility": "eclipsed",
     "footprint": 15,
-    "timestamp": "2024-01-01T02:00:00",
+    "timestamp": (recent + timedelta(hours=2)).isoformat(),
     "daynum": 16,
     "solar_lat": 17,
     "solar_lon": 18,
@@ -144,8 +158,152 @@ def test04_get_locations_by_sat_id():
         len(data["locations"]) == 2
     )  # Confirm the number of locations matches the expected count.
 
+    # Test paginating the same locations one by one with a cursor.
+    response = client.get(f"/api/location/by_sat_id/{satellite_sat_id}?limit=1")
+    assert response.status_code == 200
+    data = response.json()
+    assert data["locations"][0]["_id"] == test_location_2["_id"]  # Newest first.
+    assert data["next_cursor"] is not None
+    response = client.get(
+        f"/api/location/by_sat_id/{satellite_sat_id}?limit=1&cursor={data['next_cursor']}"
+    )
+    assert response.status_code == 200
+    data = response.json()
+    assert data["locations"][0]["_id"] == test_location_1["_id"]
+    response = client.get(
+        f"/api/location/by_sat_id/{satellite_sat_id}?limit=1&cursor={data['next_cursor']}"
+    )
+    assert response.status_code == 200
+    data = response.json()
+    assert data["results"] == 0  # The end of the results.
+    assert data["next_cursor"] is None
+
+    # Test that the page parameter still works.
+    response = client.get(f"/api/location/by_sat_id/{satellite_sat_id}?limit=1&page=2")
+    assert response.status_code == 200
+    assert response.json()["locations"][0]["_id"] == test_location_1["_id"]
+
+    # Test that an invalid cursor is rejected.
+    response = client.get(f"/api/location/by_sat_id/{satellite_sat_id}?cursor=invalid")
+    assert response.status_code == 400
+
+    # Test streaming the same locations as NDJSON, one location per line.
+    response = client.get(f"/api/location/by_sat_id/{satellite_sat_id}/export")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [line["_id"] for line in lines] == [
+        test_location_2["_id"],
+        test_location_1["_id"],
+    ]
+    # The streamed locations are serialized the same way as the listed ones.
+    listed = client.get(f"/api/location/by_sat_id/{satellite_sat_id}").json()
+    assert [
+        LocationInDBSchema(**line).model_dump(by_alias=True) for line in lines
+    ] == [
+        LocationInDBSchema(**item).model_dump(by_alias=True)
+        for item in listed["locations"]
+    ]
+
+    # Test streaming them as a JSON array with a limit.
+    response = client.get(
+        f"/api/location/by_sat_id/{satellite_sat_id}/export?format=json&limit=1"
+    )
+    assert response.status_code == 200
+    assert [item["_id"] for item in response.json()] == [test_location_2["_id"]]
+    response = client.get(f"/api/location/export?format=json")
+    assert response.status_code == 200
+    assert {test_location_1["_id"], test_location_2["_id"]} <= {
+        item["_id"] for item in response.json()
+    }
+
+    # Test that an invalid format is rejected.
+    response = client.get(f"/api/location/export?format=csv")
+    assert response.status_code == 422
+
+    # Test that a recent time range is served from the raw locations, oldest first.
+    start = (recent - timedelta(hours=1)).isoformat()
+    response = client.get(f"/api/location/by_sat_id/{satellite_sat_id}/history?from={start}")
+    assert response.status_code == 200
+    data = response.json()
+    assert data["resolution"] == app_config.app_services["pull_position"]["freq"]
+    assert [item["_id"] for item in data["locations"]] == [
+        test_location_1["_id"],
+        test_location_2["_id"],
+    ]
 
-def test05_delete_location_no_cascade():
+    # Test the ground track of the same range. The locations are 2 hours apart, so the track is split between them.
+    response = client.get(f"/api/location/by_sat_id/{satellite_sat_id}/track?from={start}&points=10")
+    assert response.status_code == 200
+    data = response.json()
+    assert data["results"] == 2
+    assert [[point["longitude"] for point in segment] for segment in data["segments"]] == [
+        [test_location_1["longitude"]],
+        [test_location_2["longitude"]],
+    ]
+    response = client.get(
+        f"/api/location/by_sat_id/{satellite_sat_id}/track?from={start}&points=10&tolerance=1"
+    )
+    assert response.status_code == 400
+
+    # Test that a time range returns only the locations between its limits, newest first.
+    end = (recent + timedelta(hours=1)).isoformat()
+    response = client.get(f"/api/location/by_sat_id/{satellite_sat_id}?from={start}&to={end}")
+    assert response.status_code == 200
+    data = response.json()
+    assert [item["_id"] for item in data["locations"]] == [test_location_1["_id"]]
+    assert data["total"] == 1
+    # An empty range is not an error, while a range that ends before it starts is.
+    response = client.get(f"/api/location/by_sat_id/{satellite_sat_id}?to={start}")
+    assert response.status_code == 200
+    assert response.json()["results"] == 0
+    response = client.get(f"/api/location/by_sat_id/{satellite_sat_id}?from={end}&to={start}")
+    assert response.status_code == 400
+
+
+def test05_bulk_create_locations():
+    # Test creating many locations from a JSON array. Every location is reported by its index.
+    unknown = {**test_location_1, "sat_id": 99998}  # The satellite does not exist.
+    malformed = {"sat_id": test_satellite["sat_id"]}  # Most fields are missing.
+    response = client.post(
+        "/api/location/bulk", json=[test_location_1, unknown, malformed, test_location_2]
+    )
+    assert response.status_code == 201
+    data = response.json()
+    assert data["status"] == "partial"
+    assert data["results"] == 2
+    assert data["errors"] == 2
+    assert [item["status"] for item in data["items"]] == [
+        "created",
+        "error",
+        "error",
+        "created",
+    ]
+    assert "99998" in data["items"][1]["detail"]
+    assert "latitude" in data["items"][2]["detail"]
+    response = client.get(f"/api/location/{data['items'][0]['_id']}")
+    assert response.status_code == 200
+    assert response.json()["location"]["latitude"] == test_location_1["latitude"]
+
+    # Test creating them from an NDJSON stream, with a line that is not valid JSON.
+    body = "\n".join([json.dumps(test_location_1), "{invalid", json.dumps(test_location_2)])
+    response = client.post(
+        "/api/location/bulk",
+        content=body.encode("utf-8"),
+        headers={"Content-Type": "application/x-ndjson"},
+    )
+    assert response.status_code == 201
+    data = response.json()
+    assert data["results"] == 2
+    assert [item["index"] for item in data["items"]] == [0, 1, 2]
+    assert data["items"][1]["status"] == "error"
+
+    # Test that a body that is not an array is rejected.
+    response = client.post("/api/location/bulk", json=test_location_1)
+    assert response.status_code == 400
+
+
+def test06_delete_location_no_cascade():
     # Test deleting a location without cascading effects.
     location_id = test_location_1["_id"]
     assert location_id is not None
@@ -160,7 +318,7 @@ def test05_delete_location_no_cascade():
     )  # Verify the correct location was deleted.
 
 
-def test06_delete_location_with_cascade():
+def test07_delete_location_with_cascade():
     # Test deleting a satellite and cascading deletion of associated locations.
     satellite_id = test_satellite["_id"]
     assert satellite_id is not None
@@ -175,7 +333,7 @@ def test06_delete_location_with_cascade():
     )  # Verify the correct satellite was deleted.
 
 
-def test07_get_satellite_after_deletion():
+def test08_get_satellite_after_deletion():
     # Test retrieving locations by satellite ID after it has been deleted.
     location_id = test_location_1["_id"]
     response = client.get(f"/api/satellite/{location_id}")
@@ -184,3 +342,94 @@ def test07_get_satellite_after_deletion():
     location_id = test_location_2["_id"]
     response = client.get(f"/api/satellite/{location_id}")
     assert response.status_code == 404  # Confirm the satellite no longer exists.
+
+
+def test09_fast_list_response(monkeypatch):
+    # Test that the fast path writes the same JSON as the response model, without validating every document.
+    document = {
+        "_id": ObjectId(),
+        **LocationSchema(**test_location_1).model_dump(),
+        "timestamp": 1704067200,  # Older locations hold epoch seconds.
+        "extra": "dropped",  # Fields that are not part of the schema are dropped.
+    }
+    content = {"status": "success", "results": 1, "total": 1, "locations": [document]}
+    fast = json.loads(FastJSONResponse(shape(content, ListLocationResponses)).body)
+    expected = ListLocationResponses(
+        **{**content, "locations": [{**document, "_id": str(document["_id"])}]}
+    ).model_dump(mode="json", by_alias=True)
+    assert fast == expected
+
+    # Test that the endpoints return the same body on both paths.
+    slow = client.get("/api/location/?limit=5")
+    monkeypatch.setattr(app_config, "app_responses_fast", True)
+    response = client.get("/api/location/?limit=5")
+    assert response.status_code == 200
+    assert response.json() == slow.json()
+
+
+def test10_migrate_timestamps():
+    # Test that the locations stored with epoch seconds are converted to BSON dates.
+    epoch = {**LocationSchema(**test_location_1).model_dump(), "sat_id": 99997}
+    epoch["timestamp"] = int(recent.replace(tzinfo=timezone.utc).timestamp())
+    inserted = LocationsDB.insert_one(epoch).inserted_id
+    try:
+        assert migrate_timestamps() >= 1
+        assert LocationsDB.find_one({"_id": inserted})["timestamp"] == recent
+        # Running it again finds nothing to convert
+        assert migrate_timestamps() == 0
+        # The migrated location is found by a time range.
+        response = client.get(
+            f"/api/location/by_sat_id/99997?from={recent.isoformat()}&to={recent.isoformat()}"
+        )
+        assert response.status_code == 200
+        assert [item["_id"] for item in response.json()["locations"]] == [str(inserted)]
+    finally:
+        LocationsDB.delete_one({"_id": inserted})
+
+
+def mongodb_commands() -> float:
+    # The number of MongoDB commands recorded by the metrics, of every client, collection and command
+    return sum(
+        sample.value
+        for metric in metrics.registry.collect()
+        if metric.name == "mongodb_command_duration_seconds"
+        for sample in metric.samples
+        if sample.name.endswith("_count")
+    )
+
+
+def test11_last_locations_from_memory():
+    # Locations pulled for a satellite that has none stored yet, e.g. they are still in the buffer
+    sat_id = 99979
+    location_cache.invalidate(sat_id)
+    for hours in range(3):
+        location_cache.add(
+            {
+                **test_location_1,
+                "_id": ObjectId(),
+                "sat_id": sat_id,
+                "timestamp": recent + timedelta(hours=hours),
+            }
+        )
+    try:
+        # The latest locations are served without any MongoDB command, and the total was not counted
+        commands = mongodb_commands()
+        response = client.get(f"/api/location/by_sat_id/{sat_id}?limit=2")
+        assert mongodb_commands() == commands
+        assert response.status_code == 200
+        data = response.json()
+        assert data["results"] == 2
+        assert data["total"] is None
+        assert data["total_mode"] is None
+
+        # Once the total was counted, it is reported from the count cache and includes the locations in memory
+        response = client.get(f"/api/location/by_sat_id/{sat_id}?limit=2&cursor={data['next_cursor']}")
+        assert response.status_code == 200
+        assert response.json()["total"] == 0
+        commands = mongodb_commands()
+        response = client.get(f"/api/location/by_sat_id/{sat_id}?limit=2")
+        assert mongodb_commands() == commands
+        assert response.json()["total"] == 2
+        assert response.json()["total_mode"] == "cached"
+    finally:
+        location_cache.invalidate(sat_id)
@@ -0,0 +1,104 @@
+import pytest
+from fastapi.testclient import TestClient
+from datetime import datetime, timezone
+import subprocess
+import sys
+import os
+
+# Required row to be able to import the app folder.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from apscheduler.events import EVENT_JOB_ERROR, EVENT_JOB_MAX_INSTANCES, JobExecutionEvent, JobSubmissionEvent
+from app.main import app
+from app.db import SatellitesCRUD
+from app.components import metrics
+
+client = TestClient(app)
+
+
+def sample(name: str, **labels) -> float:
+    # The current value of a metric, 0 if it was never recorded
+    return metrics.registry.get_sample_value(name, labels) or 0
+
+
+def test01_metrics_endpoint():
+    client.get("/api/healthchecker")
+    client.get("/api/satellite/unknown/route")
+    response = client.get("/api/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    # The requests are recorded per route template, the ones that do not match a route share one series
+    assert 'http_request_duration_seconds_count{method="GET",route="/api/healthchecker",status="200"}' in response.text
+    assert 'route="unmatched",status="404"' in response.text
+
+
+def test02_request_metrics():
+    before = sample(
+        "http_request_duration_seconds_count", method="GET", route="/api/location/{locationId}", status="400"
+    )
+    # Different ids are recorded in the same series
+    client.get("/api/location/invalid1")
+    client.get("/api/location/invalid2")
+    after = sample(
+        "http_request_duration_seconds_count", method="GET", route="/api/location/{locationId}", status="400"
+    )
+    assert after == before + 2
+
+
+def test03_mongodb_metrics():
+    before = sample("mongodb_command_duration_seconds_count", collection="satellites", command="find")
+    SatellitesCRUD.find({}, limit=1)
+    assert sample("mongodb_command_duration_seconds_count", collection="satellites", command="find") == before + 1
+    # The connections of the pool are open and none is left checked out
+    assert any(
+        s.value > 0 for s in metrics.mongodb_pool_connections.collect()[0].samples if s.labels["client"] == "sync"
+    )
+    assert all(
+        s.value == 0 for s in metrics.mongodb_pool_checked_out.collect()[0].samples if s.labels["client"] == "sync"
+    )
+
+
+def test04_scheduler_and_upstream_metrics():
+    # The runs of the services are timed, and the failed and skipped runs are counted
+    runs = sample("scheduler_job_duration_seconds_count", service="test_service")
+    assert metrics.timed_job("test_service", lambda: 42)() == 42
+    assert sample("scheduler_job_duration_seconds_count", service="test_service") == runs + 1
+
+    now = datetime.now(timezone.utc)
+    metrics.job_listener(JobExecutionEvent(EVENT_JOB_ERROR, "test_service", None, now, exception=ValueError()))
+    metrics.job_listener(JobSubmissionEvent(EVENT_JOB_MAX_INSTANCES, "test_service", None, [now]))
+    assert sample("scheduler_job_failures_total", service="test_service") >= 1
+    assert sample("scheduler_job_misfires_total", service="test_service", reason="max_instances") >= 1
+
+    # The requests to the external APIs are counted per status code
+    before = sample("upstream_responses_total", api="test_api", status="429")
+    metrics.observe_upstream("test_api", 429, 0.2)
+    assert sample("upstream_responses_total", api="test_api", status="429") == before + 1
+    assert sample("upstream_request_duration_seconds_sum", api="test_api") >= 0.2
+
+
+def test05_multiprocess_metrics(tmp_path):
+    # In multiprocess mode the metrics of every worker of the host are exposed, whichever worker gets the scrape
+    backend = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=str(tmp_path))
+
+    def worker(code: str) -> str:
+        return subprocess.run(
+            [sys.executable, "-c", "from app.components import metrics\n" + code],
+            cwd=backend, env=env, capture_output=True, text=True, check=True,
+        ).stdout
+
+    for _ in range(2):
+        worker(
+            "metrics.observe_upstream('test_multiprocess', 200, 0.1)\n"
+            "metrics.mongodb_pool_connections.labels('test_client', 'localhost:27017').inc()\n"
+            "metrics.mark_process_dead()"
+        )
+    exposed = worker(
+        "from prometheus_client import generate_latest\n"
+        "metrics.mongodb_pool_connections.labels('test_client', 'localhost:27017').inc()\n"
+        "print(generate_latest(metrics.exposition_registry()).decode())"
+    )
+    assert 'upstream_responses_total{api="test_multiprocess",status="200"} 2.0' in exposed
+    # Only the connections of the workers that are alive are counted
+    assert 'mongodb_pool_connections{address="localhost:27017",client="test_client"} 1.0' in exposed
@@ -0,0 +1,136 @@
+import pytest
+from fastapi.testclient import TestClient
+import sys
+import os
+from datetime import datetime, timedelta, timezone
+
+# Required row to be able to import the app folder.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.main import app
+from app.db import SatellitesCRUD, TLEsCRUD
+from app.config import app_config
+
+client = TestClient(app)
+
+# Shared test data
+test_satellite = {
+    "sat_id": 99989,
+    "name": "Test Orbit Satellite",
+    "units": "kilometers",
+}
+
+# A TLE of the ISS. The predictions are checked around its epoch (2008-09-20T12:25:40Z)
+test_tle = {
+    "sat_id": test_satellite["sat_id"],
+    "line1": "1 25544U 98067A   08264.51782528 -.00002182  00000-0 -11606-4 0  2927",
+    "line2": "2 25544  51.6416 247.4627 0006703 130.5360 325.0288 15.72125391563537",
+}
+epoch = datetime(2008, 9, 20, 12, 25, 40, tzinfo=timezone.utc)
+
+
+def iso(value: datetime) -> str:
+    # The "+" of the UTC offset would be read as a space in a query string
+    return value.isoformat().replace("+00:00", "Z")
+
+
+def test01_put_tle():
+    # The TLE of a satellite that does not exist is rejected
+    response = client.put("/api/orbit/tle", json=test_tle)
+    assert response.status_code == 400
+
+    response = client.post("/api/satellite/", json=test_satellite)
+    assert response.status_code == 201
+    response = client.put("/api/orbit/tle", json=test_tle)
+    assert response.status_code == 200
+    data = response.json()["tle"]
+    assert data["line1"] == test_tle["line1"]
+    assert abs(datetime.fromisoformat(data["epoch"].replace("Z", "+00:00")) - epoch) < timedelta(seconds=1)
+
+    # Replacing the TLE keeps a single TLE per satellite
+    response = client.put("/api/orbit/tle", json=test_tle)
+    assert response.status_code == 200
+    assert response.json()["tle"]["_id"] == data["_id"]
+    assert len(TLEsCRUD.find({"sat_id": test_satellite["sat_id"]})) == 1
+
+    # Lines with a wrong checksum are rejected
+    invalid = {**test_tle, "line2": test_tle["line2"][:-1] + "0"}
+    response = client.put("/api/orbit/tle", json=invalid)
+    assert response.status_code == 422
+
+    response = client.get(f"/api/orbit/tle/{test_satellite['sat_id']}")
+    assert response.status_code == 200
+    assert response.json()["tle"]["line2"] == test_tle["line2"]
+    response = client.get("/api/orbit/tle/99988")
+    assert response.status_code == 404
+
+
+def test02_predict_positions():
+    sat_id = test_satellite["sat_id"]
+    end = epoch + timedelta(minutes=10)
+    response = client.get(
+        f"/api/orbit/by_sat_id/{sat_id}/positions?from={iso(epoch)}&to={iso(end)}&step=60"
+    )
+    assert response.status_code == 200
+    data = response.json()
+    assert data["results"] == 11
+    for location in data["locations"]:
+        assert location["sat_id"] == sat_id
+        assert abs(location["latitude"]) <= 52
+        assert 300 < location["altitude"] < 400
+        assert 27000 < location["velocity"] < 28500
+
+    # Many satellites at the same time
+    response = client.get(f"/api/orbit/positions?sat_id={sat_id}&at={iso(epoch)}")
+    assert response.status_code == 200
+    assert response.json()["locations"][0]["latitude"] == data["locations"][0]["latitude"]
+
+    # Too many locations and a range that ends before it starts
+    response = client.get(f"/api/orbit/by_sat_id/{sat_id}/positions?from={iso(epoch)}&step=0.1")
+    assert response.status_code == 400
+    response = client.get(
+        f"/api/orbit/by_sat_id/{sat_id}/positions?from={iso(end)}&to={iso(epoch)}"
+    )
+    assert response.status_code == 400
+
+
+def test03_predict_sun():
+    sat_id = test_satellite["sat_id"]
+    response = client.get(f"/api/orbit/by_sat_id/{sat_id}/sun?from={iso(epoch)}&orbits=3")
+    assert response.status_code == 200
+    data = response.json()
+    # About one daylight window per orbit of about 92 minutes
+    assert 3 <= data["results"] <= 4
+    for window in data["windows"]:
+        start = datetime.fromisoformat(window["start"].replace("Z", "+00:00"))
+        end = datetime.fromisoformat(window["end"].replace("Z", "+00:00"))
+        assert epoch <= start < end <= epoch + timedelta(minutes=3 * 93)
+        assert end - start < timedelta(minutes=93)
+    response = client.get(
+        f"/api/orbit/by_sat_id/{sat_id}/sun?orbits={app_config.app_orbit_max_orbits + 1}"
+    )
+    assert response.status_code == 422
+
+    # The ISS uses its own TLE
+    iss_tle = {**test_tle, "sat_id": app_config.app_iss_id}
+    existing = TLEsCRUD.find_one({"sat_id": app_config.app_iss_id})
+    if existing is None:
+        TLEsCRUD.collection.insert_one(iss_tle)
+    try:
+        response = client.get(f"/api/iss/sun/predicted?from={iso(epoch)}&orbits=3")
+        assert response.status_code == 200
+        assert response.json()["sat_id"] == app_config.app_iss_id
+        if existing is None:
+            assert response.json()["windows"] == data["windows"]
+    finally:
+        if existing is None:
+            TLEsCRUD.collection.delete_one({"sat_id": app_config.app_iss_id})
+
+
+def test04_delete():
+    # Remove the TLE and its satellite
+    TLEsCRUD.collection.delete_many({"sat_id": test_satellite["sat_id"]})
+    satellite = SatellitesCRUD.find_one({"sat_id": test_satellite["sat_id"]})
+    SatellitesCRUD.delete(str(satellite["_id"]))
+    response = client.get(f"/api/orbit/tle/{test_satellite['sat_id']}")
+    assert response.status_code == 404
@@ -8,6 +8,8 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from app.main import app
 from app.models.satellite import SatelliteSchema
+from app.components.satellite_search import SatelliteSearchIndex
+from app.components.satellite_registry import SatelliteRegistry
 
 # Create a TestClient instance for testing the FastAPI app
 client = TestClient(app)
@@ -30,6 +32,18 @@ def test01_get_satellites():
     assert data["results"] >= 0  # Ensure results count is non-negative
     assert isinstance(data["satellites"], list)  # Verify satellites field is a list
 
+    # Follow the cursor of the first page, if there is one
+    if data["next_cursor"] is not None:
+        response = client.get(f"/api/satellite/?limit=10&cursor={data['next_cursor']}")
+        assert response.status_code == 200
+        next_data = response.json()
+        first_page_ids = {satellite["_id"] for satellite in data["satellites"]}
+        # The next page must not repeat satellites from the first page
+        assert all(
+            satellite["_id"] not in first_page_ids
+            for satellite in next_data["satellites"]
+        )
+
 
 # Test for creating a new satellite (POST /api/satellite/)
 def test02_create_satellite():
@@ -62,6 +76,31 @@ def test03_get_satellite_after_creation():
         data["satellite"] == test_satellite
     )  # Ensure the retrieved satellite matches the created one
 
+    # The total of a search counts only the matching satellites
+    response = client.get("/api/satellite/?search=Test%20Satellite")
+    assert response.status_code == 200
+    data = response.json()
+    assert data["total"] == data["results"] == 1
+    assert data["total_mode"] == "cached"
+    # The total without a search is maintained on every create and delete
+    response = client.get("/api/satellite/")
+    assert response.json()["total_mode"] == "maintained"
+
+    # The search is a prefix of the normalized name, so the case and the punctuation do not matter
+    response = client.get("/api/satellite/?search=test-SAT")
+    assert response.json()["satellites"][0]["_id"] == test_satellite["_id"]
+    # Regex metacharacters are not interpreted ("T.st" would match "Test" as a regex)
+    response = client.get("/api/satellite/?search=T.st")
+    assert response.status_code == 200
+    assert response.json()["results"] == 0
+
+    # The autocomplete search also matches the words of the name
+    response = client.get("/api/satellite/search?q=satel")
+    assert response.status_code == 200
+    data = response.json()
+    assert test_satellite["_id"] in [s["_id"] for s in data["satellites"]]
+    assert data["total_mode"] == "exact"
+
 
 # Test for deleting the created satellite (DELETE /api/satellite/{satelliteId})
 def test04_delete_satellite():
@@ -88,3 +127,76 @@ def test05_get_satellite_after_deletion():
     assert (
         response.status_code == 404
     )  # Ensure the response status code is 404 (Not Found)
+
+
+# Test for the ranking of the in-memory autocomplete search
+def test06_satellite_search_index():
+    satellites = [
+        {"_id": str(i), "sat_id": i, "name": name}
+        for i, name in enumerate(
+            ["ISS (ZARYA)", "ISS", "ISS DEB", "Zarya Cube", "Starlink-1007", "Télé Sat"]
+        )
+    ]
+    search = SatelliteSearchIndex(lambda: [dict(s) for s in satellites], max_age=60)
+    assert search.stale()
+    assert search.refresh() == len(satellites)
+    assert not search.stale()
+
+    # The exact name first, then the names that start with the query, shortest first
+    results, total = search.search("iss")
+    assert [s["name"] for s in results] == ["ISS", "ISS DEB", "ISS (ZARYA)"]
+    assert total == 3
+    # Then the names that have words starting with the query
+    results, total = search.search("zar")
+    assert [s["name"] for s in results] == ["Zarya Cube", "ISS (ZARYA)"]
+    # Every word of the query must match a word of the name
+    results, _ = search.search("iss zar")
+    assert [s["name"] for s in results] == ["ISS (ZARYA)"]
+    assert search.search("starlink 1007")[0][0]["sat_id"] == 4
+    assert search.search("tele")[0][0]["sat_id"] == 5
+    assert search.search("iss", limit=1)[0][0]["name"] == "ISS"
+    assert search.search("") == ([], 0)
+
+    # Writes are applied without reloading
+    search.on_write("create", [{"_id": "6", "sat_id": 6, "name": "ISS Tracker"}])
+    search.on_write("delete", [{"_id": "1"}])
+    results, _ = search.search("iss")
+    assert [s["name"] for s in results] == ["ISS DEB", "ISS (ZARYA)", "ISS Tracker"]
+
+    # Writes that happen while the satellites are reloaded are not lost, whether the reload saw them or not
+    def load_during_writes():
+        snapshot = [dict(s) for s in satellites]
+        search.on_write("create", [{"_id": "7", "sat_id": 7, "name": "ISS Relay"}])
+        search.on_write("delete", [{"_id": "2"}])
+        return snapshot
+
+    search.loader = load_during_writes
+    search.refresh()
+    results, _ = search.search("iss")
+    assert [s["name"] for s in results] == ["ISS", "ISS Relay", "ISS (ZARYA)"]
+
+
+def test07_satellite_registry():
+    satellites = [{"_id": "0", "sat_id": 100, "name": "A"}, {"_id": "1", "sat_id": 200, "name": "B"}]
+    registry = SatelliteRegistry(lambda: [dict(s) for s in satellites], max_age=60)
+    # A stale registry answers nothing, so the lookups go to the database
+    assert registry.get(100) is None
+    assert registry.all() is None
+    assert not registry.exists({100})
+    registry.refresh_if_stale()
+    assert registry.get(100)["name"] == "A"
+    assert registry.exists({100, 200})
+    # Unknown satellites are not reported as existing, they may have been created by another process
+    assert not registry.exists({100, 300})
+
+    # Writes are applied without reloading, including a change of sat_id
+    registry.on_write("update", [{"_id": "0", "sat_id": 101, "name": "A"}])
+    registry.on_write("delete", [{"_id": "1", "sat_id": 200}])
+    assert registry.get(100) is None
+    assert registry.get(101)["name"] == "A"
+    assert [s["sat_id"] for s in registry.all()] == [101]
+    # A reload sees the writes of other processes
+    registry.refresh()
+    assert registry.exists({100, 200})
+    registry.max_age = 0
+    assert registry.stale()
@@ -1,8 +1,13 @@
 import pytest
+from fastapi import HTTPException
 
-# from fastapi.testclient import TestClient
+from fastapi.testclient import TestClient
 import sys
 import os
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from apscheduler.schedulers.background import BackgroundScheduler
 
 # Required row to be able to import the app folder.
@@ -10,10 +15,32 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from app.main import app
 from app.services.task_scheduler import TaskScheduler
-from app.services import pull_position_task
+from app.services import pull_position_task, rollup_task, tle_task
 from app.config import app_config
+from datetime import datetime, timedelta, timezone
+from app.components.lease import LeaseManager
+from app.components.event_bus import EventBus
+from app.components.rate_limiter import RateLimiter, retry_after, sat_loc_limiter
+from app.components.write_buffer import WriteBuffer
+from app.components.retention import retention_policy
+from app.components.satellite_registry import SatelliteRegistry, satellite_registry
+from app.db.crud import CRUD
+from app.db.database import MongoDB
+from pymongo.errors import ServerSelectionTimeoutError
+from app.db import (
+    mongodb,
+    LeasesDB,
+    SatellitesCRUD,
+    LocationsCRUD,
+    DaylightWindowsCRUD,
+    TLEsCRUD,
+    RollupsCRUD,
+    DaylightRebuildsDB,
+    ensure_indexes,
+    raw_expiry_enabled,
+)
 
-# client = TestClient(app)
+client = TestClient(app)
 
 taskScheduler = TaskScheduler()
 
@@ -52,6 +79,10 @@ def test02_start():
 
     assert n_of_started_services == n_of_enabled_services
     assert taskScheduler.task_scheduler.running == True
+    # Missed runs are merged into one and a slow run never overlaps with the next one
+    for job in taskScheduler.task_scheduler.get_jobs():
+        assert job.coalesce == app_config.app_scheduler["coalesce"]
+        assert job.max_instances == app_config.app_scheduler["max_instances"]
 
 
 def test03_stop():
@@ -61,13 +92,603 @@ def test03_stop():
 
 
 def test04_pull_position_task():
-    # Test the pull_position task
-    location, status = pull_position_task.main()
-    assert location != {}
-    assert status == 200
-    assert location["sat_id"] == app_config.app_iss_id
-
-    app_config.app_iss_id = 0
-    location, status = pull_position_task.main()
-    assert location == {}
-    assert status != 200
+    # Test the pull_position task against the real API
+    locations, statuses = pull_position_task.main()
+    assert statuses[app_config.app_iss_id] == 200
+    assert app_config.app_iss_id in [location["sat_id"] for location in locations]
+
+
+class StubSatLocHandler(BaseHTTPRequestHandler):
+    """
+    Local stub of the sat_loc API. It answers like https://api.wheretheiss.at/v1/satellites/{id}
+    and keeps track of the connections and of the requests that are in flight at the same time.
+    """
+
+    protocol_version = "HTTP/1.1"  # Needed for keep-alive connections
+    lock = threading.Lock()
+    ports = set()
+    requests = 0
+    in_flight = 0
+    max_in_flight = 0
+    throttled = set()
+
+    def do_GET(self):
+        cls = StubSatLocHandler
+        with cls.lock:
+            cls.ports.add(self.client_address[1])
+            cls.requests += 1
+            cls.in_flight += 1
+            cls.max_in_flight = max(cls.max_in_flight, cls.in_flight)
+        time.sleep(0.05)
+        with cls.lock:
+            cls.in_flight -= 1
+
+        sat_id = int(self.path.split("?")[0].rstrip("/").split("/")[-1])
+        headers = {}
+        with cls.lock:
+            # The first request of every cycle for the throttled satellite is answered with a 429
+            throttled = sat_id == STUB_THROTTLED_SAT_ID and sat_id not in cls.throttled
+            cls.throttled.add(sat_id)
+        if sat_id == STUB_MISSING_SAT_ID:
+            body, code = b'{"error": "satellite not found"}', 404
+        elif sat_id == STUB_MALFORMED_SAT_ID:
+            body, code = b"<html>maintenance</html>", 200
+        elif sat_id == STUB_INVALID_SAT_ID:
+            body, code = b'["stub"]', 200
+        elif throttled:
+            body, code = b'{"error": "too many requests"}', 429
+            headers["Retry-After"] = "0"
+        else:
+            body, code = json.dumps(
+                {
+                    "name": "stub",
+                    "id": sat_id,
+                    "latitude": 1.0,
+                    "longitude": 2.0,
+                    "altitude": 400.0,
+                    "velocity": 27000.0,
+                    "visibility": "daylight",
+                    "footprint": 4500.0,
+                    "timestamp": int(time.time()),
+                    "daynum": 2460000.5,
+                    "solar_lat": 1.0,
+                    "solar_lon": 2.0,
+                    "units": "kilometers",
+                }
+            ).encode(), 200
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+STUB_SAT_IDS = [99991, 99992, 99993, 99994, 99995, 99996, 99985, 99986]
+STUB_MISSING_SAT_ID = 99996
+STUB_THROTTLED_SAT_ID = 99995
+# Answered with a body that is not JSON, and with JSON that is not a location
+STUB_MALFORMED_SAT_ID = 99985
+STUB_INVALID_SAT_ID = 99986
+STUB_FAILED_SAT_IDS = {STUB_MISSING_SAT_ID, STUB_MALFORMED_SAT_ID, STUB_INVALID_SAT_ID}
+
+
+def test05_pull_position_task_stub():
+    # Start the stub API and point the sat_loc url to it
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubSatLocHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    original_url = app_config.app_apis_sat_loc_url
+    app_config.app_apis_sat_loc_url = (
+        f"http://127.0.0.1:{server.server_address[1]}/v1/satellites/"
+    )
+    # Pace the requests fast enough for the test
+    limits = (sat_loc_limiter.rate, sat_loc_limiter.burst, sat_loc_limiter.backoff_base)
+    sat_loc_limiter.rate, sat_loc_limiter.burst, sat_loc_limiter.backoff_base = 1000, 1000, 0.01
+    satellites = [
+        SatellitesCRUD.create({"sat_id": sat_id, "name": "stub", "units": "kilometers"})
+        for sat_id in STUB_SAT_IDS
+    ]
+    try:
+        # Run two poll cycles
+        for _ in range(2):
+            StubSatLocHandler.throttled.clear()
+            locations, statuses = pull_position_task.main()
+            # Every satellite in the database is polled
+            assert all(sat_id in statuses for sat_id in STUB_SAT_IDS)
+            # The satellite that the API does not know is reported and skipped
+            assert statuses[STUB_MISSING_SAT_ID] == 404
+            # The throttled satellite is retried after the backoff
+            assert statuses[STUB_THROTTLED_SAT_ID] == 200
+            # The malformed responses are skipped without failing the other satellites
+            assert statuses[STUB_MALFORMED_SAT_ID] == 200
+            assert statuses[STUB_INVALID_SAT_ID] == 200
+            stored = {location["sat_id"] for location in locations}
+            assert set(STUB_SAT_IDS) - STUB_FAILED_SAT_IDS <= stored
+            assert not STUB_FAILED_SAT_IDS & stored
+            assert all("_id" in location for location in locations)
+            # The epoch timestamps of the API are stored as BSON dates
+            assert all(isinstance(location["timestamp"], datetime) for location in locations)
+
+        # The buffered locations are stored when the buffer is flushed
+        stored = pull_position_task.flush()
+        ids = [location["_id"] for location in stored]
+        assert len(LocationsCRUD.find({"_id": {"$in": ids}})) == len(stored)
+        assert set(STUB_SAT_IDS) - STUB_FAILED_SAT_IDS <= {location["sat_id"] for location in stored}
+
+        # The requests in flight are capped and the connections are reused between cycles
+        assert StubSatLocHandler.max_in_flight <= app_config.app_apis_sat_loc_max_in_flight
+        assert len(StubSatLocHandler.ports) <= app_config.app_apis_sat_loc_max_connections
+        assert len(StubSatLocHandler.ports) < StubSatLocHandler.requests
+    finally:
+        app_config.app_apis_sat_loc_url = original_url
+        sat_loc_limiter.rate, sat_loc_limiter.burst, sat_loc_limiter.backoff_base = limits
+        server.shutdown()
+        # Deleting the satellites cascades to their locations
+        for satellite in satellites:
+            SatellitesCRUD.delete(str(satellite["_id"]))
+        DaylightWindowsCRUD.collection.delete_many({"sat_id": {"$in": STUB_SAT_IDS}})
+
+
+def test06_rollup_task():
+    # 30 minutes of locations of a satellite, every 20 seconds, ending 10 seconds before "now".
+    # "now" is the start of a bucket of every tier, so the last bucket of every tier is complete
+    coarsest = max(RollupsCRUD)
+    now = datetime.fromtimestamp(int(time.time()) // coarsest * coarsest, tz=timezone.utc)
+    start = now - timedelta(minutes=30)
+    sat_id = 99990
+    late_sat_id = 99987
+
+    def location(sat_id, latitude, timestamp):
+        return {
+            "sat_id": sat_id,
+            "latitude": latitude,
+            "longitude": 2.0,
+            "altitude": 400.0,
+            "velocity": 27000.0,
+            "visibility": "daylight",
+            "footprint": 4500.0,
+            "timestamp": timestamp,
+            "daynum": 2460000.5,
+            "solar_lat": 1.0,
+            "solar_lon": 2.0,
+            "units": "kilometers",
+        }
+
+    # The rollups are merged on their unique (sat_id, bucket) index
+    ensure_indexes()
+    satellite = SatellitesCRUD.create({"sat_id": sat_id, "name": "rollup", "units": "kilometers"})
+    late_satellite = SatellitesCRUD.create({"sat_id": late_sat_id, "name": "late rollup", "units": "kilometers"})
+    LocationsCRUD.create_many(
+        [location(sat_id, float(i), start + timedelta(seconds=20 * i + 10)) for i in range(90)]
+    )
+    try:
+        # Running the task twice gives the same rollups
+        for _ in range(2):
+            ranges = rollup_task.main(now)
+            assert set(ranges) == set(RollupsCRUD)
+            for resolution, crud in RollupsCRUD.items():
+                rollups = crud.find({"sat_id": sat_id})
+                # Every bucket keeps its first location and the number of samples it represents
+                assert len(rollups) == 30 * 60 // resolution
+                assert sum(rollup["samples"] for rollup in rollups) == 90
+                first = min(rollups, key=lambda rollup: rollup["bucket"])
+                assert first["latitude"] == 0.0
+                assert first["resolution"] == resolution
+
+        # A location stored late, in a bucket that was already rolled up, and the older locations of a satellite
+        # that is rolled up for the first time after the other satellites
+        late = location(sat_id, -1.0, now - timedelta(seconds=115))
+        LocationsCRUD.create(late)
+        LocationsCRUD.create(location(late_sat_id, 0.0, start + timedelta(seconds=15)))
+        rollup_task.main(now)
+        for resolution, crud in RollupsCRUD.items():
+            rollups = crud.find({"sat_id": sat_id})
+            assert len(rollups) == 30 * 60 // resolution
+            assert sum(rollup["samples"] for rollup in rollups) == 91
+            assert len(crud.find({"sat_id": late_sat_id})) == 1
+        # The late location is the first one of its bucket of the finest tier
+        finest = RollupsCRUD[retention_policy.rollups[0].resolution]
+        assert finest.find({"sat_id": sat_id, "latitude": -1.0})
+    finally:
+        # Deleting the satellite cascades to its raw locations but not to the rollups
+        SatellitesCRUD.delete(str(satellite["_id"]))
+        SatellitesCRUD.delete(str(late_satellite["_id"]))
+        for crud in RollupsCRUD.values():
+            crud.collection.delete_many({"sat_id": {"$in": [sat_id, late_sat_id]}})
+
+
+def test07_leader_election():
+    # Two processes compete for the lease of a service
+    first = LeaseManager(LeasesDB, "first", ttl=0.5)
+    second = LeaseManager(LeasesDB, "second", ttl=0.5)
+    LeasesDB.delete_many({"_id": "test_service"})
+    try:
+        assert first.acquire("test_service")
+        assert not second.acquire("test_service")
+        # Renewing a held lease keeps it
+        assert first.heartbeat(["test_service"]) == ["test_service"]
+        assert first.held("test_service") and not second.held("test_service")
+
+        # Only the process that holds the lease runs the service
+        runs = []
+        TaskScheduler(first)._guard("test_service", lambda: runs.append("first"))()
+        TaskScheduler(second)._guard("test_service", lambda: runs.append("second"))()
+        assert runs == ["first"]
+
+        # The lease is taken over after it expires without a heartbeat
+        time.sleep(0.6)
+        assert not first.held("test_service")
+        assert second.acquire("test_service")
+        assert not first.acquire("test_service")
+        # A released lease is taken over immediately
+        second.release(["test_service"])
+        assert not second.held("test_service")
+        assert first.acquire("test_service")
+
+        # The services that call the same API share a lease, so they run on the same process
+        tles = TaskScheduler.lease_name("tles", app_config.app_services["tles"])
+        assert tles == TaskScheduler.lease_name("pull_position", app_config.app_services["pull_position"])
+    finally:
+        LeasesDB.delete_many({"_id": "test_service"})
+
+
+def test08_rate_limiter():
+    # A fake clock that only moves when the test moves it
+    now = [0.0]
+    limiter = RateLimiter(rate=2, burst=2, backoff_base=1, backoff_max=8, clock=lambda: now[0])
+
+    # The burst is sent at once and the next requests are spread at the rate
+    assert [limiter.reserve() for _ in range(4)] == [0, 0, 0.5, 1.0]
+    now[0] = 1.0
+    assert limiter.reserve() == 0.5
+
+    # The backoff doubles with every failure in a row, with a jitter of up to half of it
+    now[0] = 10.0
+    delays = [limiter.record(503) for _ in range(5)]
+    for failures, delay in enumerate(delays):
+        expected = min(8, 2**failures)
+        assert expected / 2 <= delay <= expected
+    # No request is sent until the backoff passes
+    assert limiter.reserve() == pytest.approx(max(delays))
+    # The Retry-After of the API is honored even if it is longer than the maximum backoff
+    assert limiter.record(429, wait=30) == 30
+    assert limiter.reserve() == pytest.approx(30)
+    # A successful response resets the backoff
+    assert limiter.record(200) == 0
+    assert limiter.failures == 0
+    assert limiter.record(500) <= 1
+
+    # Retry-After is given in seconds or as an HTTP date
+    assert retry_after({"retry-after": "120"}) == 120
+    assert retry_after({"retry-after": "Wed, 21 Oct 2015 07:28:00 GMT"}) == 0
+    assert retry_after({}) is None
+
+
+def test09_write_buffer(tmp_path):
+    # A fake clock that only moves when the test moves it
+    now = [0.0]
+    crud = CRUD(mongodb.get_collection("test_write_buffer"))
+    crud.collection.delete_many({})
+    buffer = WriteBuffer(crud, str(tmp_path / "test.wal"), max_size=3, max_age=10, clock=lambda: now[0])
+
+    # The documents are buffered until there are max_size of them or the oldest is max_age old
+    assert buffer.add([{"n": 0}, {"n": 1}]) == []
+    assert crud.collection.count_documents({}) == 0
+    assert [document["n"] for document in buffer.add([{"n": 2}])] == [0, 1, 2]
+    assert buffer.add([{"n": 3}]) == []
+    now[0] = 10.0
+    assert [document["n"] for document in buffer.add([])] == [3]
+
+    # The database becomes unreachable: the documents are logged on the disk instead of being lost
+    def unreachable(data):
+        raise ServerSelectionTimeoutError("No servers available")
+
+    crud.preprocess = unreachable
+    assert buffer.add([{"n": 4}, {"n": 5}, {"n": 6}]) == []
+    assert buffer.logged()
+    # Newer documents go to the log after the older ones, even before the buffer is due
+    assert buffer.add([{"n": 7}]) == []
+
+    # The log survives a restart and is replayed in order, before the newer documents, once the database is back
+    crud.preprocess = None
+    buffer = WriteBuffer(crud, buffer.path, max_size=3, max_age=10, clock=lambda: now[0])
+    buffer.add([{"n": 8}])
+    now[0] = 20.0
+    assert [document["n"] for document in buffer.flush()] == [4, 5, 6, 7, 8]
+    assert not buffer.logged()
+    # The documents that were stored before a failure are not stored twice when the log is replayed
+    stored = crud.find({}, {"_id": 1, "n": 1})
+    assert sorted(document["n"] for document in stored) == list(range(9))
+
+    # Another worker of the host shares the path of the log. It leaves the log to the worker that runs the service
+    # and appends its own documents after the logged ones
+    crud.preprocess = unreachable
+    buffer.add([{"n": 9}, {"n": 10}, {"n": 11}])
+    crud.preprocess = None
+    worker = WriteBuffer(crud, buffer.path, max_size=3, max_age=10, clock=lambda: now[0])
+    worker.add([{"n": 12}])
+    assert worker.flush(replay=False) == []
+    assert buffer.logged()
+    assert [document["n"] for document in buffer.flush()] == [9, 10, 11, 12]
+    assert not buffer.logged()
+    crud.collection.delete_many({})
+
+
+def test10_raw_expiry():
+    # The raw locations are kept forever, so there is no TTL index
+    ttl = retention_policy.raw.ttl
+    retention_policy.raw.ttl = None
+    ensure_indexes()
+    assert not raw_expiry_enabled()
+
+    # A location stored before the retention was configured
+    now = datetime.now(timezone.utc).replace(second=0, microsecond=0)
+    sat_id = 99988
+    satellite = SatellitesCRUD.create({"sat_id": sat_id, "name": "expiry", "units": "kilometers"})
+    LocationsCRUD.create(
+        {
+            "sat_id": sat_id,
+            "latitude": 1.0,
+            "longitude": 2.0,
+            "altitude": 400.0,
+            "velocity": 27000.0,
+            "visibility": "daylight",
+            "footprint": 4500.0,
+            "timestamp": now - timedelta(hours=2),
+            "daynum": 2460000.5,
+            "solar_lat": 1.0,
+            "solar_lon": 2.0,
+            "units": "kilometers",
+        }
+    )
+    try:
+        # Configuring the retention does not expire the history at startup, since it is not rolled up yet
+        retention_policy.raw.ttl = 3600
+        ensure_indexes()
+        assert not raw_expiry_enabled()
+        assert not rollup_task.raw_rolled_up(now)
+
+        # The rollups service turns on the expiration once the history is rolled up
+        rollup_task.main(now)
+        assert rollup_task.raw_rolled_up(now)
+        assert raw_expiry_enabled()
+        finest = RollupsCRUD[retention_policy.rollups[0].resolution]
+        assert len(finest.find({"sat_id": sat_id})) == 1
+        # The expiration is kept when the application starts again
+        ensure_indexes()
+        assert raw_expiry_enabled()
+    finally:
+        retention_policy.raw.ttl = ttl
+        ensure_indexes()
+        SatellitesCRUD.delete(str(satellite["_id"]))
+        for crud in RollupsCRUD.values():
+            crud.collection.delete_many({"sat_id": sat_id})
+
+
+def test11_database_outage(tmp_path, monkeypatch):
+    # A database that can not be reached, with the settings of the client of the application.
+    # The client waits 30 seconds to select a server, so every wait below is bounded by the timeouts of the components
+    unreachable = MongoDB("mongodb://127.0.0.1:1", "unreachable")
+    unreachable.connect()
+    holder = LeaseManager(LeasesDB, "holder", ttl=0.5, timeout=0.1)
+    LeasesDB.delete_many({"_id": "test_service"})
+    registry = SatelliteRegistry(lambda: [{"_id": "1", "sat_id": 1}], max_age=0.5, timeout=0.1)
+    registry.refresh()
+    try:
+        assert holder.acquire("test_service")
+
+        # The outage lasts longer than the ttl of the lease and the age of the satellites
+        holder.collection = unreachable.get_collection("leases")
+        registry.loader = CRUD(unreachable.get_collection("satellites")).find
+        for _ in range(3):
+            time.sleep(0.3)
+            # The holder keeps its lease and keeps running the service
+            assert holder.heartbeat(["test_service"]) == ["test_service"]
+            runs = []
+            TaskScheduler(holder)._guard("test_service", lambda: runs.append("holder"))()
+            assert runs == ["holder"]
+        # A lease that was not held is not taken without the database
+        assert not holder.acquire("other_service")
+
+        # The last loaded satellites are still polled, but the stale registry answers nothing to the other lookups
+        start = time.monotonic()
+        assert not registry.refresh_if_stale()
+        assert time.monotonic() - start < 1
+        assert registry.all() is None
+        assert [satellite["sat_id"] for satellite in registry.all(allow_stale=True)] == [1]
+
+        # The polls keep their pace: every poll tries to store its locations and logs them once the write times out,
+        # and the locations are shared with the other processes without waiting for the database
+        buffer = WriteBuffer(
+            CRUD(unreachable.get_collection("locations")),
+            str(tmp_path / "outage.wal"),
+            max_size=1000,
+            max_age=0,
+            timeout=0.2,
+        )
+        bus = EventBus(lambda: unreachable.get_collection("events"), "test-outage", timeout=0.2)
+        monkeypatch.setattr(pull_position_task, "location_buffer", buffer)
+        monkeypatch.setattr(pull_position_task, "event_bus", bus)
+        now = datetime.now(timezone.utc)
+        try:
+            for poll in range(3):
+                start = time.monotonic()
+                pull_position_task.ingest(
+                    [{"sat_id": 1, "visibility": "daylight", "timestamp": now + timedelta(seconds=poll)}]
+                )
+                assert time.monotonic() - start < 1
+        finally:
+            bus.stop()
+        assert [location["sat_id"] for location in buffer._read()] == [1, 1, 1]
+
+        # Once the database is back, the holder renews its lease, unless another process took it over meanwhile
+        holder.collection = LeasesDB
+        registry.loader = lambda: [{"_id": "1", "sat_id": 1}, {"_id": "2", "sat_id": 2}]
+        time.sleep(0.5)
+        assert registry.refresh_if_stale()
+        assert len(registry.all()) == 2
+        other = LeaseManager(LeasesDB, "other", ttl=0.5)
+        assert other.acquire("test_service")
+        assert not holder.acquire("test_service")
+        assert not holder.held("test_service")
+    finally:
+        LeasesDB.delete_many({"_id": "test_service"})
+        unreachable.close()
+
+
+# A TLE of the ISS, answered for every satellite by the stub of the sat_tle API
+STUB_TLE = {
+    "line1": "1 25544U 98067A   08264.51782528 -.00002182  00000-0 -11606-4 0  2927",
+    "line2": "2 25544  51.6416 247.4627 0006703 130.5360 325.0288 15.72125391563537",
+}
+STUB_TLE_SAT_IDS = [99981, 99982, 99983, 99984]
+# Answered with a body that is not JSON, and with JSON that is not a TLE
+STUB_TLE_MALFORMED_SAT_ID = 99982
+STUB_TLE_INVALID_SAT_ID = 99983
+# The TLE of this satellite is rejected by the database
+STUB_TLE_REJECTED_SAT_ID = 99984
+
+
+class StubSatTLEHandler(BaseHTTPRequestHandler):
+    """
+    Local stub of the sat_tle API. It answers like https://api.wheretheiss.at/v1/satellites/{id}/tles?format=json
+    """
+
+    protocol_version = "HTTP/1.1"  # Needed for keep-alive connections
+
+    def do_GET(self):
+        sat_id = int(self.path.split("?")[0].rstrip("/").split("/")[-2])
+        if sat_id == STUB_TLE_MALFORMED_SAT_ID:
+            body = b"<html>maintenance</html>"
+        elif sat_id == STUB_TLE_INVALID_SAT_ID:
+            body = b'["stub"]'
+        else:
+            body = json.dumps(STUB_TLE).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test12_tle_task():
+    # Start the stub API and point the sat_tle url to it
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubSatTLEHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    original_url = app_config.app_apis_sat_tle_url
+    app_config.app_apis_sat_tle_url = f"http://127.0.0.1:{server.server_address[1]}/v1/satellites/"
+    limits = (sat_loc_limiter.rate, sat_loc_limiter.burst)
+    sat_loc_limiter.rate, sat_loc_limiter.burst = 1000, 1000
+    satellites = [
+        SatellitesCRUD.create({"sat_id": sat_id, "name": "stub tle", "units": "kilometers"})
+        for sat_id in STUB_TLE_SAT_IDS
+    ]
+    preprocess = TLEsCRUD.preprocess
+
+    def reject(data):
+        if data["sat_id"] == STUB_TLE_REJECTED_SAT_ID:
+            raise HTTPException(status_code=400, detail="Rejected by the test")
+        return preprocess(data)
+
+    TLEsCRUD.preprocess = reject
+    try:
+        satellite_registry.refresh()
+        tles, statuses = tle_task.main()
+        # Every satellite is requested, and the failures of some satellites do not stop the others
+        assert all(statuses[sat_id] == 200 for sat_id in STUB_TLE_SAT_IDS)
+        assert [tle["sat_id"] for tle in tles if tle["sat_id"] in STUB_TLE_SAT_IDS] == [99981]
+        assert TLEsCRUD.find_one({"sat_id": 99981})["line1"] == STUB_TLE["line1"]
+        assert TLEsCRUD.find_one({"sat_id": STUB_TLE_REJECTED_SAT_ID}) is None
+    finally:
+        TLEsCRUD.preprocess = preprocess
+        app_config.app_apis_sat_tle_url = original_url
+        sat_loc_limiter.rate, sat_loc_limiter.burst = limits
+        server.shutdown()
+        for satellite in satellites:
+            SatellitesCRUD.delete(str(satellite["_id"]))
+        TLEsCRUD.collection.delete_many({"sat_id": {"$in": STUB_TLE_SAT_IDS}})
+
+
+# The satellite of the daylight windows test
+DAYLIGHT_SAT_ID = 99980
+
+
+def test13_daylight_windows(monkeypatch):
+    satellite = SatellitesCRUD.create({"sat_id": DAYLIGHT_SAT_ID, "name": "daylight", "units": "kilometers"})
+    rebuilds = []
+    rebuild = pull_position_task.rebuild_daylight_windows
+    monkeypatch.setattr(
+        pull_position_task, "rebuild_daylight_windows", lambda sat_id: rebuilds.append(sat_id) or rebuild(sat_id)
+    )
+    start = datetime(2024, 12, 1, tzinfo=timezone.utc)
+
+    def location(visibility, seconds):
+        return {
+            "sat_id": DAYLIGHT_SAT_ID,
+            "latitude": 1.0,
+            "longitude": 2.0,
+            "altitude": 400.0,
+            "velocity": 27000.0,
+            "visibility": visibility,
+            "footprint": 4500.0,
+            "timestamp": start + timedelta(seconds=seconds),
+            "daynum": 2460000.5,
+            "solar_lat": 1.0,
+            "solar_lon": 2.0,
+            "units": "kilometers",
+        }
+
+    def pull(visibility, seconds):
+        # The same as a location stored by the buffer of the pull_position service
+        return pull_position_task.update_daylight_windows(LocationsCRUD.create(location(visibility, seconds)))
+
+    def windows():
+        return [
+            (window["start"], window["end"], window["open"])
+            for window in DaylightWindowsCRUD.find({"sat_id": DAYLIGHT_SAT_ID})
+        ]
+
+    try:
+        # A satellite without daylight yet is rebuilt from its history once, then its windows are updated incrementally
+        for seconds in (0, 20, 40):
+            assert pull("eclipsed", seconds) is None
+        assert rebuilds == [DAYLIGHT_SAT_ID]
+        pull("daylight", 60)
+        pull("eclipsed", 80)
+        assert rebuilds == [DAYLIGHT_SAT_ID]
+        assert windows() == [(start + timedelta(seconds=60), start + timedelta(seconds=80), False)]
+
+        # A late daylight location does not open a window that overlaps with the closed one
+        assert pull("daylight", 70) is None
+        assert len(windows()) == 1
+
+        # A location written through the API is part of the windows once they are rebuilt with the next location
+        payload = {**location("daylight", 30), "timestamp": (start + timedelta(seconds=30)).isoformat()}
+        response = client.post("/api/location/", json=payload)
+        assert response.status_code == 201
+        assert DaylightRebuildsDB.find_one({"_id": DAYLIGHT_SAT_ID}) is None
+        pull("eclipsed", 100)
+        assert rebuilds == [DAYLIGHT_SAT_ID] * 2
+        assert windows() == [
+            (start + timedelta(seconds=30), start + timedelta(seconds=40), False),
+            (start + timedelta(seconds=60), start + timedelta(seconds=80), False),
+        ]
+
+        # So is a location deleted through the API
+        response = client.delete(f"/api/location/{response.json()['location']['_id']}")
+        assert response.status_code == 200
+        pull("eclipsed", 120)
+        assert rebuilds == [DAYLIGHT_SAT_ID] * 3
+        assert windows() == [(start + timedelta(seconds=60), start + timedelta(seconds=80), False)]
+    finally:
+        # Deleting the satellite cascades to its locations
+        SatellitesCRUD.delete(str(satellite["_id"]))
+        DaylightWindowsCRUD.collection.delete_many({"sat_id": DAYLIGHT_SAT_ID})
+        DaylightRebuildsDB.delete_many({"_id": DAYLIGHT_SAT_ID})
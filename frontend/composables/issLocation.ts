@@ -43,4 +43,50 @@ export async function fetchIssLocation() {
             timestamp}
 
   
-};
\ No newline at end of file
+};
+
+//
+// Composable to stream the ISS position with Server-Sent Events. The backend pushes every new position,
+// so there is no need to poll. If the stream cannot be opened, or no position arrives for two intervals
+// (e.g. a proxy buffers the stream), it falls back to polling fetchIssLocation until the stream delivers again.
+//
+// @param      interval   The polling interval in ms that is used as a fallback
+// @return     Function:  Closes the stream or stops the polling
+//
+export function streamIssLocation(interval = 20000) {
+  const config = useRuntimeConfig();
+  const latitude = useState('latitude', () => 0);
+  const longitude = useState('longitude', () => 0);
+  const timestamp = useState('timestamp', () => 0);
+
+  if (typeof EventSource === 'undefined') {
+    fetchIssLocation();
+    const timer = setInterval(() => fetchIssLocation(), interval);
+    return () => clearInterval(timer);
+  }
+
+  let lastMessage = Date.now();
+  const source = new EventSource(`${config.public.apiBaseUrl}iss/stream`);
+  source.onmessage = (event) => {
+    lastMessage = Date.now();
+    const data = JSON.parse(event.data);
+    latitude.value = data.latitude
+    longitude.value = data.longitude
+    timestamp.value = data.timestamp
+  };
+  // EventSource reconnects on its own. Fetch once so that the position is not stale while it reconnects
+  source.onerror = () => {
+    fetchIssLocation();
+  };
+  // Poll while the stream is open but silent. The positions are pushed about once per interval, so a single late
+  // position does not trigger a poll
+  const timer = setInterval(() => {
+    if (Date.now() - lastMessage >= 2 * interval) {
+      fetchIssLocation();
+    }
+  }, interval);
+  return () => {
+    clearInterval(timer);
+    source.close();
+  };
+};
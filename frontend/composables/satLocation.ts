@@ -36,4 +36,23 @@ export async function fetchSatLocations(sat_id, n) {
   return locations
 
   
-};
\ No newline at end of file
+};
+//
+// Composable to fetch the simplified ground track of a satellite, about one orbit by default
+//
+// @param      sat_id      The id of the satellite
+// @param      points      The number of points of the track
+// @return     track:      The Shared State with the segments of the track. Every segment is drawn as its own line
+//
+export async function fetchSatTrack(sat_id, points) {
+  const config = useRuntimeConfig();
+  const track = useState('track', () => []);
+
+  try {
+    const data = await $fetch(`${config.public.apiBaseUrl}location/by_sat_id/${sat_id}/track?points=${points}`);
+    track.value = data.segments
+  } catch (e) {
+    console.error('Error fetching satellite track:', e);
+  }
+  return track
+};